@@ -0,0 +1,34 @@
+''' Benchmark of the BCID jump fit of the hit delay scan (scan_hit_delay.fit_bcid_jumps()) for the mean relative BCID of one PlsrDAC
+setting of a full chip. The fit of all pixels at once in one process is compared to the fit pixel by pixel in the analysis pool.
+'''
+import time
+
+import numpy as np
+from scipy.special import erf
+
+from pybar.analysis import analysis_pool
+from pybar.scans.scan_hit_delay import fit_bcid_jumps
+
+
+def benchmark_bcid_jump_fit(n_delays=60, n_hits=100):
+    random_state = np.random.RandomState(0)
+    delay = np.arange(n_delays)[np.newaxis, np.newaxis, :]
+    first_jump = random_state.uniform(5, 25, (80, 336, 1))
+    second_jump = first_jump + random_state.uniform(20, 30, (80, 336, 1))
+    sigma = random_state.uniform(0.5, 3, (80, 336, 1))
+    probability = 0.5 * erf((delay - first_jump) / (np.sqrt(2) * sigma)) + 0.5
+    probability_second = 0.5 * erf((delay - second_jump) / (np.sqrt(2) * sigma)) + 0.5
+    mean_bcid = (4 + (random_state.binomial(n_hits, probability) + random_state.binomial(n_hits, probability_second)) / float(n_hits)).astype(np.float32)
+
+    start_time = time.time()
+    result_per_pixel = np.array(analysis_pool.map_rows(fit_bcid_jumps, mean_bcid.reshape(-1, n_delays))).reshape(80, 336, 4)
+    print 'Per pixel (%d processes): %.3f s' % (analysis_pool.get_pool_size(), time.time() - start_time)
+    start_time = time.time()
+    result = fit_bcid_jumps(mean_bcid)
+    print 'All pixels (1 process): %.3f s' % (time.time() - start_time)
+    found = (result != -1) & (result_per_pixel != -1)
+    print 'Pixels with jumps: %d, maximum delay difference: %.2e' % (np.count_nonzero(found[:, :, 0]), np.amax(np.abs(result - result_per_pixel)[found]))
+
+
+if __name__ == "__main__":
+    benchmark_bcid_jump_fit()
@@ -0,0 +1,54 @@
+''' Benchmark of the per pixel TDC histograms of several hit selection conditions (see analyze_source_scan_tdc_data.py). Histogramming the hits
+of each condition separately (one selection and one full size histogram per condition and chunk) is compared to filling the histograms of
+all conditions in one pass from the condition bit mask (analysis_utils.ConditionHistogram) with dense and sparse storage.
+'''
+import time
+
+import numpy as np
+
+from pybar_fei4_interpreter.analysis_utils import hist_3d_index
+from pybar.analysis import analysis_utils
+
+
+conditions = ['(n_cluster==1)',
+              '(n_cluster==1) & (cluster_size == 1)',
+              '(n_cluster==1) & (cluster_size == 1) & (relative_BCID > 1) & (relative_BCID < 4) & ((tot > 12) | ((TDC * 1.5625 - tot * 25 < 100) & (tot * 25 - TDC * 1.5625 < 100))) & (((column > 55) & (column < 75)) & ((row > 79) & (row < 271)))',
+              '(n_cluster==1) & (cluster_size == 1) & (relative_BCID > 1) & (relative_BCID < 4) & ((tot > 12) | ((TDC * 1.5625 - tot * 25 < 100) & (tot * 25 - TDC * 1.5625 < 100)))']
+
+
+def get_cluster_hits(n_hits, random_state):
+    cluster_hits = np.zeros(n_hits, dtype=[('column', np.uint8), ('row', np.uint16), ('relative_BCID', np.uint8), ('tot', np.uint8), ('TDC', np.uint16), ('n_cluster', np.uint16), ('cluster_size', np.uint16)])
+    cluster_hits['column'] = random_state.randint(1, 81, n_hits)
+    cluster_hits['row'] = random_state.randint(1, 337, n_hits)
+    cluster_hits['relative_BCID'] = random_state.randint(0, 16, n_hits)
+    cluster_hits['tot'] = random_state.randint(0, 14, n_hits)
+    cluster_hits['TDC'] = random_state.randint(0, 1000, n_hits)
+    cluster_hits['n_cluster'] = random_state.randint(1, 3, n_hits)
+    cluster_hits['cluster_size'] = random_state.randint(1, 4, n_hits)
+    return cluster_hits
+
+
+def benchmark_condition_histograms(n_hits=1000000, n_chunks=5, max_tdc=1000):
+    random_state = np.random.RandomState(0)
+    chunks = [get_cluster_hits(n_hits // n_chunks, random_state) for _ in range(n_chunks)]
+    hit_selection = analysis_utils.HitSelection(conditions)
+
+    start_time = time.time()
+    hists = [np.zeros(shape=(80, 336, max_tdc), dtype=np.uint16) for _ in conditions]
+    for cluster_hits in chunks:
+        for hist, selected_hits in zip(hists, hit_selection.select(cluster_hits)):
+            hist += hist_3d_index(selected_hits['column'] - 1, selected_hits['row'] - 1, selected_hits['TDC'], shape=(80, 336, max_tdc)).astype(np.uint16)
+    print 'Per condition: %.3f s, %.1f MB' % (time.time() - start_time, sum(hist.nbytes for hist in hists) / 1e6)
+
+    for sparse in (False, True):
+        start_time = time.time()
+        condition_hists = analysis_utils.ConditionHistogram(len(conditions), shape=(80, 336, max_tdc), dtype=np.uint16, sparse=sparse)
+        for cluster_hits in chunks:
+            condition_hists.fill(hit_selection.get_bitmask(cluster_hits), (cluster_hits['column'] - 1, cluster_hits['row'] - 1, cluster_hits['TDC']))
+        print 'One pass (%s): %.3f s, %.1f MB' % ('sparse' if sparse else 'dense', time.time() - start_time, condition_hists.nbytes / 1e6)
+        for index, hist in enumerate(hists):
+            assert np.array_equal(condition_hists[index], hist)
+
+
+if __name__ == "__main__":
+    benchmark_condition_histograms()
@@ -0,0 +1,43 @@
+''' Benchmark of the FE-I4 configuration load/save round trip for the text configuration (global configuration file and pixel
+register files), the HDF5 configuration and the binary snapshot (.npz file). Text files are loaded without and with the parse cache
+(register.clear_parse_cache()), the cache is filled when the files are loaded or saved.
+'''
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+from pybar.fei4 import register
+from pybar.fei4.register import FEI4Register
+
+
+def benchmark_configuration(n_round_trips=20):
+    configuration = FEI4Register(configuration_file=os.path.join(os.path.dirname(__file__), '../../pybar/config/fei4/configs/std_cfg_fei4b.cfg'))
+    configuration.set_pixel_register_value('TDAC', np.random.RandomState(0).randint(0, 32, (80, 336)))
+    configuration.set_pixel_register_value('FDAC', np.random.RandomState(1).randint(0, 16, (80, 336)))
+    output_folder = tempfile.mkdtemp()
+    try:
+        for name, file_name, loaded_file_name in (('Text', 'fei4b.cfg', os.path.join('configs', 'fei4b.cfg')), ('HDF5', 'fei4b.h5', 'fei4b.h5'), ('Binary snapshot', 'fei4b.npz', 'fei4b.npz')):
+            start_time = time.time()
+            for _ in range(n_round_trips):
+                configuration.save_configuration(os.path.join(output_folder, file_name))
+            save_time = (time.time() - start_time) / n_round_trips
+            load_times = []
+            for parse_cache in (False, True):
+                start_time = time.time()
+                for _ in range(n_round_trips):
+                    if not parse_cache:
+                        register.clear_parse_cache()
+                    FEI4Register(configuration_file=os.path.join(output_folder, loaded_file_name))
+                load_times.append((time.time() - start_time) / n_round_trips)
+            print '%s: save %.1f ms, load %.1f ms, load with parse cache %.1f ms' % (name, save_time * 1e3, load_times[0] * 1e3, load_times[1] * 1e3)
+    finally:
+        shutil.rmtree(output_folder)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.WARNING)  # every load and save is logged
+    benchmark_configuration()
@@ -0,0 +1,60 @@
+''' Benchmark of the hit selection with several conditions. The hits of an interpreted data file are selected with conditions
+sharing terms (e.g. the TDC analysis conditions in analyze_source_scan_tdc_data.py) once per condition (analysis.select_hits(),
+analysis_utils.select_hits()) and with all conditions in one pass (analysis.select_hits_with_conditions(), analysis_utils.HitSelection).
+The times of the in memory selection and of the selection from file to file are printed.
+'''
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import tables as tb
+
+from pybar.analysis import analysis
+from pybar.analysis import analysis_utils
+
+
+conditions = ['(relative_BCID > 3) & (relative_BCID < 9)',
+              '(relative_BCID > 3) & (relative_BCID < 9) & (tot > 5)',
+              '(relative_BCID > 3) & (relative_BCID < 9) & (column > 40) & (column < 60) & (row > 16) & (row < 324)',
+              '(relative_BCID > 3) & (relative_BCID < 9) & (column > 40) & (column < 60) & (row > 16) & (row < 324) & (((column % 2 == 1) & (row % 12 == 1)) | ((column % 2 == 0) & (row % 12 == 7)))',
+              '(tot > 5) & (row < 100)']
+
+
+def benchmark_hit_selection(interpreted_data_file, n_repetitions=5):
+    with tb.open_file(interpreted_data_file, mode="r") as in_file_h5:
+        hits = in_file_h5.root.Hits[:]
+    print 'Select %d hits with %d conditions' % (hits.shape[0], len(conditions))
+
+    start_time = time.time()
+    for _ in range(n_repetitions):
+        selected_hits = [analysis_utils.select_hits(hits, condition) for condition in conditions]
+    per_condition_time = (time.time() - start_time) / n_repetitions
+    start_time = time.time()
+    for _ in range(n_repetitions):
+        selected_hits_one_pass = analysis_utils.HitSelection(conditions).select(hits)
+    one_pass_time = (time.time() - start_time) / n_repetitions
+    if not all(np.array_equal(selected, selected_one_pass) for selected, selected_one_pass in zip(selected_hits, selected_hits_one_pass)):
+        raise RuntimeError('Selected hits differ')
+    print 'In memory: per condition %.3f s, one pass %.3f s' % (per_condition_time, one_pass_time)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_file_hits = os.path.join(tmp_dir, 'hits.h5')
+        shutil.copy(interpreted_data_file, input_file_hits)  # the file is modified by analysis.select_hits (event number index)
+        output_files_hits = [os.path.join(tmp_dir, 'selected_hits_%d.h5' % index) for index in range(len(conditions))]
+        start_time = time.time()
+        for condition, output_file_hits in zip(conditions, output_files_hits):
+            analysis.select_hits(input_file_hits, output_file_hits, condition=condition)
+        per_condition_time = time.time() - start_time
+        start_time = time.time()
+        analysis.select_hits_with_conditions(input_file_hits, output_files_hits, conditions)
+        one_pass_time = time.time() - start_time
+        print 'File to file: per condition %.3f s, one pass %.3f s' % (per_condition_time, one_pass_time)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    benchmark_hit_selection(os.path.join(os.path.dirname(__file__), '../../pybar/testing/test_analysis_data/unit_test_data_1_result.h5'))
@@ -0,0 +1,46 @@
+''' Benchmark of the hit table output profiles. The raw data file is interpreted with each profile, the file size
+and the time to read back the hit table (completely and in event aligned chunks like the analysis functions) are printed.
+'''
+import os
+import time
+import shutil
+import tempfile
+
+import tables as tb
+
+from pybar.analysis import analysis_utils
+from pybar.analysis.analyze_raw_data import AnalyzeRawData
+
+
+def benchmark_hit_table_profiles(raw_data_file, profiles=None, chunk_size=1000000, n_reads=3):
+    if profiles is None:
+        profiles = sorted(analysis_utils.hit_table_profiles.keys())
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print '%-10s %12s %12s %10s %12s %12s' % ('profile', 'file [kB]', 'hits [kB]', 'bytes/hit', 'read [ms]', 'chunks [ms]')
+        for profile in profiles:
+            analyzed_data_file = os.path.join(tmp_dir, profile + '.h5')
+            with AnalyzeRawData(raw_data_file=raw_data_file, analyzed_data_file=analyzed_data_file, create_pdf=False) as analyze_raw_data:
+                analyze_raw_data.analysis_cache = None
+                analyze_raw_data.create_hit_table = True
+                analyze_raw_data.hit_table_profile = profile
+                analyze_raw_data.interpreter.set_warning_output(False)
+                analyze_raw_data.interpret_word_table()
+            with tb.open_file(analyzed_data_file, mode="r") as in_file_h5:
+                hit_table = in_file_h5.root.Hits
+                start_time = time.time()
+                for _ in range(n_reads):
+                    hit_table[:]
+                read_time = (time.time() - start_time) / n_reads
+                start_time = time.time()
+                for _ in range(n_reads):
+                    for _ in analysis_utils.data_aligned_at_events(hit_table, chunk_size=chunk_size):
+                        pass
+                chunk_read_time = (time.time() - start_time) / n_reads
+                print '%-10s %12.1f %12.1f %10d %12.1f %12.1f' % (profile, os.path.getsize(analyzed_data_file) / 1024., hit_table.size_on_disk / 1024., hit_table.dtype.itemsize, read_time * 1000., chunk_read_time * 1000.)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    benchmark_hit_table_profiles(os.path.join(os.path.dirname(__file__), '../../pybar/testing/test_analysis_data/unit_test_data_1.h5'))
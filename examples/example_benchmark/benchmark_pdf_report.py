@@ -0,0 +1,45 @@
+''' Benchmark of the PDF report rendering (pdf_report.PdfReport). The plots of a typical threshold scan report (three way plots,
+occupancy, S-curves) are rendered one after another into one PDF file and in the worker processes of the analysis pool with
+and without rasterizing the dense 2D maps.
+'''
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+from pybar.analysis import analysis_pool
+from pybar.analysis.plotting import plotting
+from pybar.analysis.plotting.pdf_report import PdfReport
+
+
+def get_report(processes, rasterize):
+    random_state = np.random.RandomState(0)
+    threshold = random_state.normal(50, 3, (336, 80))
+    noise = random_state.normal(2, 0.2, (336, 80))
+    occupancy = random_state.binomial(100, 1.0 / (1.0 + np.exp(-(np.arange(100)[np.newaxis, np.newaxis, :] - threshold.T[:, :, np.newaxis]) / noise.T[:, :, np.newaxis])))
+    report = PdfReport(processes=processes, rasterize=rasterize)
+    for _ in range(2):
+        report.add(plotting.plot_three_way, hist=threshold, title='Threshold', x_axis_title='threshold [PlsrDAC]', bins=100, minimum=0)
+        report.add(plotting.plot_three_way, hist=noise, title='Noise', x_axis_title='noise [PlsrDAC]', bins=100, minimum=0)
+        report.add(plotting.plot_scurves, occupancy_hist=occupancy, scan_parameters=range(100), scan_parameter_name='PlsrDAC')
+        report.add(plotting.plot_occupancy, hist=np.ma.masked_equal(occupancy.sum(axis=2).T, 0), z_max='median')
+    return report
+
+
+def benchmark_pdf_report():
+    output_dir = tempfile.mkdtemp()
+    try:
+        for processes, rasterize in ((1, False), (None, False), (None, True)):
+            report = get_report(processes, rasterize)
+            output_pdf_file = os.path.join(output_dir, 'report.pdf')
+            start_time = time.time()
+            report.save(output_pdf_file)
+            print '%s, %s: %.3f s, %.1f MB' % ('1 process' if processes == 1 else '%d processes' % analysis_pool.get_pool_size(), 'rasterized' if rasterize else 'vector graphics', time.time() - start_time, os.path.getsize(output_pdf_file) / 1e6)
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    benchmark_pdf_report()
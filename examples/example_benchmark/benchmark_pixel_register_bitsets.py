@@ -0,0 +1,48 @@
+''' Benchmark of the pixel register bitstream generation of FEI4Register. The previous calculation (one bitarray per double column
+and pixel register bit from a list of booleans) is compared to FEI4Register.get_pixel_register_bitsets() (all double columns and bits
+of a pixel register with one numpy.packbits()). The time of the full chip WrFrontEnd command generation for all pixel registers is given.
+'''
+import os
+import time
+import logging
+
+import numpy as np
+from bitarray import bitarray
+
+from pybar.fei4.register import FEI4Register
+
+
+def get_pixel_register_bitset_from_list(register_object, bit_no, dc_no):
+    col0 = register_object['value'][dc_no * 2, :]
+    bv0 = bitarray((2 ** bit_no == (col0 & 2 ** bit_no)).tolist(), endian='little')
+    col1 = register_object['value'][dc_no * 2 + 1, :]
+    bv1 = bitarray((2 ** bit_no == (col1 & 2 ** bit_no)).tolist(), endian='little')
+    bv1.reverse()  # shifted first
+    return bv1 + bv0
+
+
+def benchmark_pixel_register_bitsets(n_repetitions=10):
+    configuration = FEI4Register(configuration_file=os.path.join(os.path.dirname(__file__), '../../pybar/config/fei4/configs/std_cfg_fei4b.cfg'))
+    random_state = np.random.RandomState(0)
+    for register_object in configuration.pixel_registers.itervalues():
+        configuration.set_pixel_register_value(register_object['name'], random_state.randint(0, 2 ** register_object['bitlength'], (80, 336)))
+    register_objects = configuration.get_pixel_register_objects(do_sort=['pxstrobe'], name=configuration.pixel_registers.keys())
+
+    start_time = time.time()
+    for _ in range(n_repetitions):
+        register_bitsets = [[[get_pixel_register_bitset_from_list(register_object, bit_no, dc_no) for dc_no in range(40)] for bit_no in range(register_object['bitlength'])] for register_object in register_objects]
+    print 'Bitsets per double column and bit: %.2f ms' % ((time.time() - start_time) / n_repetitions * 1e3)
+    start_time = time.time()
+    for _ in range(n_repetitions):
+        register_bitsets_packed = [configuration.get_pixel_register_bitsets(register_object) for register_object in register_objects]
+    print 'Bitsets per pixel register: %.2f ms' % ((time.time() - start_time) / n_repetitions * 1e3)
+    assert register_bitsets_packed == register_bitsets
+    start_time = time.time()
+    for _ in range(n_repetitions):
+        commands = configuration.get_commands('WrFrontEnd', same_mask_for_all_dc=False, name=configuration.pixel_registers.keys())
+    print 'Full chip WrFrontEnd (%d commands): %.2f ms' % (len(commands), (time.time() - start_time) / n_repetitions * 1e3)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.WARNING)
+    benchmark_pixel_register_bitsets()
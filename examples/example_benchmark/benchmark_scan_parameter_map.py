@@ -0,0 +1,63 @@
+''' Benchmark of the per scan parameter hit analysis. A hit file with scan parameter settings is created from the hits of an interpreted
+data file. The hits of each scan parameter setting are histogrammed sequentially (analysis_utils.get_hits_of_scan_parameter()) and in
+the analysis pool with different numbers of worker processes (analysis_utils.map_hits_of_scan_parameter()).
+'''
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import tables as tb
+
+from pybar_fei4_interpreter.analysis_utils import hist_3d_index
+
+from pybar.analysis import analysis_utils
+from pybar.analysis import analysis_pool
+
+
+def histogram_tot(hits):  # has to be global for the multiprocessing module
+    return hist_3d_index(hits['column'] - 1, hits['row'] - 1, hits['tot'], shape=(80, 336, 16)).astype(np.uint32)
+
+
+def create_scan_parameter_file(interpreted_data_file, output_file, n_parameters=100, n_copies=4):
+    with tb.open_file(interpreted_data_file, mode="r") as in_file_h5:
+        hits = in_file_h5.root.Hits[:]
+    n_events = hits['event_number'][-1] + 1
+    with tb.open_file(output_file, mode="w") as out_file_h5:
+        hit_table = out_file_h5.create_table(out_file_h5.root, name='Hits', description=hits.dtype, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        for _ in range(n_copies):
+            hit_table.append(hits)
+            hits['event_number'] += n_events
+        meta_data = np.zeros(n_parameters, dtype=[('event_number', np.int64), ('timestamp_start', np.float64), ('timestamp_stop', np.float64), ('error_code', np.uint32), ('PlsrDAC', np.uint32)])
+        event_numbers = np.unique(hit_table.read(field='event_number'))  # scan parameter settings start at events with hits
+        meta_data['event_number'] = event_numbers[np.linspace(0, event_numbers.shape[0], n_parameters, endpoint=False).astype(np.int64)]
+        meta_data['PlsrDAC'] = np.arange(n_parameters)
+        out_file_h5.create_table(out_file_h5.root, name='meta_data', description=meta_data.dtype).append(meta_data)
+
+
+def benchmark_scan_parameter_map(interpreted_data_file, chunk_size=1000000):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_file_hits = os.path.join(tmp_dir, 'hits.h5')
+        create_scan_parameter_file(interpreted_data_file, input_file_hits)
+        start_time = time.time()
+        results = {}
+        for parameter, hits in analysis_utils.get_hits_of_scan_parameter(input_file_hits, ['PlsrDAC'], chunk_size=chunk_size):
+            results[parameter[0]] = results.get(parameter[0], 0) + histogram_tot(hits)
+        print 'Sequential: %.3f s' % (time.time() - start_time)
+        for processes in sorted(set([1, 2, 4, analysis_pool.mp.cpu_count()])):
+            analysis_pool.set_pool_size(processes)
+            analysis_pool.get_pool()  # exclude the pool start
+            start_time = time.time()
+            for parameter, result in analysis_utils.map_hits_of_scan_parameter(histogram_tot, input_file_hits, ['PlsrDAC'], chunk_size=chunk_size):
+                if result is not None and not np.array_equal(result, results[parameter[0]]):
+                    raise RuntimeError('Results differ')
+            print '%d process(es): %.3f s' % (processes, time.time() - start_time)
+    finally:
+        analysis_pool.set_pool_size(None)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    benchmark_scan_parameter_map(os.path.join(os.path.dirname(__file__), '../../pybar/testing/test_analysis_data/unit_test_data_1_result.h5'))
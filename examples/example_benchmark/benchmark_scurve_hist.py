@@ -0,0 +1,41 @@
+''' Benchmark of the S-curve density of plotting.plot_scurves(). The previous calculation (one numpy.histogram2d per scan parameter
+of the compressed occupancy) is compared to plotting.get_scurve_hist() with a dense and a sparse occupancy histogram of a full chip
+threshold scan.
+'''
+import time
+
+import numpy as np
+
+from pybar.analysis.plotting import plotting
+from pybar.analysis.sparse_histogram import SparseHistogram
+
+
+def get_scurve_hist_per_scan_parameter(occupancy_hist, scan_parameters, x_bins, y_bins, pixel_mask):
+    hist = np.zeros(shape=(y_bins.shape[0] - 1, x_bins.shape[0] - 1))
+    for index, scan_parameter in enumerate(scan_parameters):
+        compressed_data = np.ma.masked_array(occupancy_hist[:, :, index], mask=pixel_mask, copy=True).compressed()
+        hist += np.histogram2d(compressed_data, [scan_parameter] * compressed_data.shape[0], bins=(y_bins, x_bins))[0]
+    return hist
+
+
+def benchmark_scurve_hist(n_scan_parameters=200, n_injections=100):
+    random_state = np.random.RandomState(0)
+    threshold = random_state.normal(n_scan_parameters / 2, 3, (80, 336, 1))
+    occupancy = random_state.binomial(n_injections, 1.0 / (1.0 + np.exp(-(np.arange(n_scan_parameters)[np.newaxis, np.newaxis, :] - threshold) / 2.0))).astype(np.uint32)
+    scan_parameters = np.arange(n_scan_parameters)
+    x_bins, y_bins = np.arange(-0.5, n_scan_parameters + 0.5), np.arange(-0.5, 2 * n_injections + 1.5)
+    pixel_mask = np.all(occupancy == 0, axis=2)
+    sparse_occupancy = SparseHistogram.from_dense(occupancy)
+    print 'Occupancy: dense %.1f MB, sparse %.1f MB' % (occupancy.nbytes / 1e6, sparse_occupancy.nbytes / 1e6)
+
+    start_time = time.time()
+    hist = get_scurve_hist_per_scan_parameter(occupancy, scan_parameters, x_bins, y_bins, pixel_mask)
+    print 'Per scan parameter: %.3f s' % (time.time() - start_time)
+    for name, occupancy_hist in (('dense', occupancy), ('sparse', sparse_occupancy)):
+        start_time = time.time()
+        assert np.array_equal(plotting.get_scurve_hist(occupancy_hist, scan_parameters, x_bins=x_bins, y_bins=y_bins, pixel_mask=pixel_mask)[0], hist)
+        print 'All scan parameters (%s): %.3f s' % (name, time.time() - start_time)
+
+
+if __name__ == "__main__":
+    benchmark_scurve_hist()
@@ -0,0 +1,69 @@
+''' Benchmark of the layout (chunk shape, compression level) of the interpreted data tables. The tables of an interpreted data file
+are written with different layouts and the write time, the file size and the time of the common read workloads are printed:
+complete read, event aligned chunks of 1000000 and 50000 rows (analysis.py, analyze_hits_per_scan_parameter()) and short event ranges
+with the event number index (get_hits_of_scan_parameter(), analyze_source_scan_gdac_data).
+'''
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import tables as tb
+
+from pybar.analysis import analysis_utils
+from pybar.analysis import table_layout
+
+
+def benchmark_layout(data, chunkshape, filters, filename, write_chunk_size=300000, n_event_ranges=50):
+    start_time = time.time()
+    with tb.open_file(filename, mode='w') as out_file_h5:
+        table = out_file_h5.create_table(out_file_h5.root, name='Table', description=data.dtype, filters=filters, chunkshape=chunkshape, expectedrows=data.shape[0])
+        for index in range(0, data.shape[0], write_chunk_size):
+            table.append(data[index:index + write_chunk_size])
+    times = [time.time() - start_time]
+    with tb.open_file(filename, mode='r+') as in_file_h5:
+        table = in_file_h5.root.Table
+        start_time = time.time()
+        table[:]
+        times.append(time.time() - start_time)
+        for chunk_size in (1000000, 50000):
+            start_time = time.time()
+            for _ in analysis_utils.data_aligned_at_events(table, chunk_size=chunk_size):
+                pass
+            times.append(time.time() - start_time)
+        analysis_utils.index_event_number(table)
+        event_numbers = np.unique(data['event_number'])
+        start_time = time.time()
+        for start_event_number in event_numbers[np.linspace(0, max(event_numbers.shape[0] - 11, 0), n_event_ranges).astype(np.int64)]:
+            for _ in analysis_utils.data_aligned_at_events(table, start_event_number=start_event_number, stop_event_number=start_event_number + 10, chunk_size=50000, try_speedup=True, fail_on_missing_events=False):
+                pass
+        times.append(time.time() - start_time)
+    return os.path.getsize(filename), times
+
+
+def benchmark_table_layout(interpreted_data_file, node_names=('Hits', 'ClusterHits', 'Cluster', 'EventMetaData'), chunk_size=3000000):
+    filters = tb.Filters(complib='blosc', complevel=5, fletcher32=False)  # filters of AnalyzeRawData
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with tb.open_file(interpreted_data_file, mode="r") as in_file_h5:
+            for node_name in node_names:
+                if node_name not in in_file_h5.root:
+                    continue
+                data = in_file_h5.get_node(in_file_h5.root, node_name)[:]
+                tuned_chunkshape = table_layout.get_chunkshape(data.dtype.itemsize, data.shape[0])
+                tuned_filters = table_layout.get_filters(data, data.dtype, tuned_chunkshape, filters)
+                layouts = [('static', (chunk_size / 100,), filters), ('tuned', tuned_chunkshape, tuned_filters)]
+                layouts.extend(('chunk %d' % n_rows, (n_rows,), tuned_filters) for n_rows in (4096, 16384, 65536, 262144))
+                layouts.extend(('level %d' % complevel, tuned_chunkshape, filters.copy(complevel=complevel)) for complevel in table_layout.complevels)
+                print '%s: %d rows, %d bytes/row' % (node_name, data.shape[0], data.dtype.itemsize)
+                print '%-14s %8s %6s %10s %10s %10s %10s %10s %10s' % ('layout', 'chunk', 'level', 'size [MB]', 'write [s]', 'read [s]', '1M [s]', '50k [s]', 'events [s]')
+                for name, chunkshape, layout_filters in layouts:
+                    size, times = benchmark_layout(data, chunkshape, layout_filters, os.path.join(tmp_dir, 'layout.h5'))
+                    print '%-14s %8d %6d %10.2f %10.3f %10.3f %10.3f %10.3f %10.3f' % ((name, chunkshape[0], layout_filters.complevel, size / 1e6) + tuple(times))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    benchmark_table_layout(os.path.join(os.path.dirname(__file__), '../../pybar/testing/test_analysis_data/unit_test_data_1_result.h5'))
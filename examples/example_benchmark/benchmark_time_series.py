@@ -0,0 +1,30 @@
+''' Benchmark of the time series analysis (beam spot, event rate and number of cluster per event as a function of time). The time of
+one pass over the hit and cluster table for all quantities (analysis.analyze_time_series(), time_series.get_time_series()) is compared
+to one pass per quantity and to the time of reading the tables only.
+'''
+import os
+import time
+
+import tables as tb
+
+from pybar.analysis.time_series import get_time_series
+
+
+def benchmark_time_series(interpreted_data_file, combine_n_readouts=5, chunk_size=1000000):
+    start_time = time.time()
+    with tb.open_file(interpreted_data_file, mode="r") as in_file_h5:
+        for table in (in_file_h5.root.Hits, in_file_h5.root.Cluster):
+            for start_index in range(0, table.nrows, chunk_size):
+                table.read(start_index, start_index + chunk_size)
+    print 'Read tables: %.3f s' % (time.time() - start_time)
+    start_time = time.time()
+    for hits, cluster in ((True, False), (False, False), (False, True)):  # beam spot, event rate, number of cluster per event
+        get_time_series(interpreted_data_file, combine_n_readouts=combine_n_readouts, hits=hits, cluster=cluster, chunk_size=chunk_size)
+    print 'One pass per quantity: %.3f s' % (time.time() - start_time)
+    start_time = time.time()
+    get_time_series(interpreted_data_file, combine_n_readouts=combine_n_readouts, chunk_size=chunk_size)
+    print 'One pass: %.3f s' % (time.time() - start_time)
+
+
+if __name__ == "__main__":
+    benchmark_time_series(os.path.join(os.path.dirname(__file__), '../../pybar/testing/test_analysis_data/unit_test_data_1_result.h5'))
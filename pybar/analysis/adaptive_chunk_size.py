@@ -0,0 +1,97 @@
+"""Adaptive number of raw data words interpreted at once. The chunk size is limited by a memory budget, the memory per raw data word
+is estimated from the measured number of hits per raw data word and clusters per hit. Below the memory limit the chunk size is increased
+as long as the measured throughput increases.
+"""
+from __future__ import division
+
+import logging
+
+
+class AdaptiveChunkSize(object):
+    '''Controller of the raw data chunk size.
+
+    Parameters
+    ----------
+    memory_budget : int
+        Memory in bytes for the data of one chunk.
+    chunk_size : int
+        Initial chunk size in raw data words.
+    bytes_per_word : int
+        Memory per raw data word independent of the data (raw data word and pre-allocated buffers).
+    bytes_per_hit : int
+        Memory per hit (hit arrays and cluster hit arrays).
+    bytes_per_cluster : int
+        Memory per cluster.
+    min_chunk_size, max_chunk_size : int
+        Limits of the chunk size. The maximum is only limited by the memory budget if None.
+    min_throughput_gain : float
+        Minimum relative throughput gain to keep a larger chunk size.
+    '''
+    def __init__(self, memory_budget, chunk_size, bytes_per_word, bytes_per_hit, bytes_per_cluster=0, min_chunk_size=10000, max_chunk_size=None, min_throughput_gain=0.05):
+        self.memory_budget = memory_budget
+        self.bytes_per_word = bytes_per_word
+        self.bytes_per_hit = bytes_per_hit
+        self.bytes_per_cluster = bytes_per_cluster
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.min_throughput_gain = min_throughput_gain
+        self.hits_per_word = 0.0  # maximum of all chunks, the memory estimate has to hold for high occupancy chunks
+        self._n_hits, self._n_clusters = 0, 0
+        self._throughputs = {}  # measured throughput (words/s) per chunk size
+        self._throughput_limit = None  # larger chunks do not increase the throughput
+        self.chunk_sizes = []  # chosen chunk sizes
+        self.chunk_size = self._limit(min(chunk_size, self.get_memory_limit()))
+
+    @property
+    def clusters_per_hit(self):
+        return self._n_clusters / self._n_hits if self._n_hits else 0.0
+
+    def get_memory_limit(self):
+        '''Returns the largest chunk size within the memory budget for the measured hits per word and clusters per hit.
+        '''
+        bytes_per_word = self.bytes_per_word + self.hits_per_word * (self.bytes_per_hit + self.clusters_per_hit * self.bytes_per_cluster)
+        return int(self.memory_budget // bytes_per_word)
+
+    def _limit(self, chunk_size):
+        if self.max_chunk_size is not None:
+            chunk_size = min(chunk_size, self.max_chunk_size)
+        return int(max(chunk_size, self.min_chunk_size))
+
+    def update(self, n_words, n_hits, n_clusters, processing_time):
+        '''Updates the chunk size with the measurements of the last chunk.
+
+        Parameters
+        ----------
+        n_words : int
+            Number of raw data words of the chunk.
+        n_hits, n_clusters : int
+            Number of hits and clusters of the chunk.
+        processing_time : float
+            Processing time of the chunk in seconds.
+
+        Returns
+        -------
+        int
+            Chunk size of the next chunk.
+        '''
+        if n_words == 0:
+            return self.chunk_size
+        self.hits_per_word = max(self.hits_per_word, n_hits / n_words)
+        self._n_hits += n_hits
+        self._n_clusters += n_clusters
+        chunk_size = self.chunk_size
+        if n_words == chunk_size:  # the last chunk of a file is shorter
+            throughput = n_words / max(processing_time, 1e-6)
+            self._throughputs[chunk_size] = throughput
+            smaller_chunk_sizes = [size for size in self._throughputs if size < chunk_size]
+            if smaller_chunk_sizes and throughput < (1 + self.min_throughput_gain) * self._throughputs[max(smaller_chunk_sizes)]:
+                self._throughput_limit = max(smaller_chunk_sizes)
+            chunk_size = 2 * chunk_size
+        if self._throughput_limit is not None:
+            chunk_size = min(chunk_size, self._throughput_limit)
+        chunk_size = self._limit(min(chunk_size, self.get_memory_limit()))
+        if chunk_size != self.chunk_size:
+            logging.info('Chunk size %d raw data words (%.2f hits/word, %.3f clusters/hit, memory limit %d words)', chunk_size, self.hits_per_word, self.clusters_per_hit, self.get_memory_limit())
+            self.chunk_size = chunk_size
+        self.chunk_sizes.append(chunk_size)
+        return chunk_size
@@ -12,10 +12,10 @@ import tables as tb
 
 import progressbar
 
-from pybar_fei4_interpreter import data_struct
 from pybar_fei4_interpreter.data_histograming import PyDataHistograming
 
 from pybar.analysis import analysis_utils
+from pybar.analysis.time_series import get_time_series
 from pybar.analysis.plotting import plotting
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
 
@@ -35,68 +35,8 @@ def analyze_beam_spot(scan_base, combine_n_readouts=1000, chunk_size=10000000, p
     output_pdf: PdfPages
         PdfPages file object, if none the plot is printed to screen
     '''
-    time_stamp = []
-    x = []
-    y = []
-
-    for data_file in scan_base:
-        with tb.open_file(data_file + '_interpreted.h5', mode="r+") as in_hit_file_h5:
-            # get data and data pointer
-            meta_data_array = in_hit_file_h5.root.meta_data[:]
-            hit_table = in_hit_file_h5.root.Hits
-
-            # determine the event ranges to analyze (timestamp_start, start_event_number, stop_event_number)
-            parameter_ranges = np.column_stack((analysis_utils.get_ranges_from_array(meta_data_array['timestamp_start'][::combine_n_readouts]), analysis_utils.get_ranges_from_array(meta_data_array['event_number'][::combine_n_readouts])))
-
-            # create a event_numer index (important)
-            analysis_utils.index_event_number(hit_table)
-
-            # initialize the analysis and set settings
-            analyze_data = AnalyzeRawData()
-            analyze_data.create_tot_hist = False
-            analyze_data.create_bcid_hist = False
-            analyze_data.histogram.set_no_scan_parameter()
-
-            # variables for read speed up
-            index = 0  # index where to start the read out, 0 at the beginning, increased during looping
-            best_chunk_size = chunk_size
-
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=hit_table.shape[0], term_width=80)
-            progress_bar.start()
-
-            # loop over the selected events
-            for parameter_index, parameter_range in enumerate(parameter_ranges):
-                logging.debug('Analyze time stamp ' + str(parameter_range[0]) + ' and data from events = [' + str(parameter_range[2]) + ',' + str(parameter_range[3]) + '[ ' + str(int(float(float(parameter_index) / float(len(parameter_ranges)) * 100.0))) + '%')
-                analyze_data.reset()  # resets the data of the last analysis
-
-                # loop over the hits in the actual selected events with optimizations: determine best chunk size, start word index given
-                readout_hit_len = 0  # variable to calculate a optimal chunk size value from the number of hits for speed up
-                for hits, index in analysis_utils.data_aligned_at_events(hit_table, start_event_number=parameter_range[2], stop_event_number=parameter_range[3], start_index=index, chunk_size=best_chunk_size):
-                    analyze_data.analyze_hits(hits)  # analyze the selected hits in chunks
-                    readout_hit_len += hits.shape[0]
-                    progress_bar.update(index)
-                best_chunk_size = int(1.5 * readout_hit_len) if int(1.05 * readout_hit_len) < chunk_size else chunk_size  # to increase the readout speed, estimated the number of hits for one read instruction
-
-                # get and store results
-                occupancy_array = analyze_data.histogram.get_occupancy()
-                projection_x = np.sum(occupancy_array, axis=0).ravel()
-                projection_y = np.sum(occupancy_array, axis=1).ravel()
-                x.append(analysis_utils.get_mean_from_histogram(projection_x, bin_positions=range(0, 80)))
-                y.append(analysis_utils.get_mean_from_histogram(projection_y, bin_positions=range(0, 336)))
-                time_stamp.append(parameter_range[0])
-                if plot_occupancy_hists:
-                    plotting.plot_occupancy(occupancy_array[:, :, 0], title='Occupancy for events between ' + time.strftime('%H:%M:%S', time.localtime(parameter_range[0])) + ' and ' + time.strftime('%H:%M:%S', time.localtime(parameter_range[1])), filename=output_pdf)
-            progress_bar.finish()
-    plotting.plot_scatter([i * 250 for i in x], [i * 50 for i in y], title='Mean beam position', x_label='x [um]', y_label='y [um]', marker_style='-o', filename=output_pdf)
-    if output_file:
-        with tb.open_file(output_file, mode="a") as out_file_h5:
-            rec_array = np.array(zip(time_stamp, x, y), dtype=[('time_stamp', float), ('x', float), ('y', float)])
-            try:
-                beam_spot_table = out_file_h5.create_table(out_file_h5.root, name='Beamspot', description=rec_array, title='Beam spot position', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                beam_spot_table[:] = rec_array
-            except tb.exceptions.NodeError:
-                logging.warning(output_file + ' has already a Beamspot note, do not overwrite existing.')
-    return time_stamp, x, y
+    time_series = [_get_time_series(data_file, combine_n_readouts, chunk_size, hits=True, cluster=False, plot_occupancy_hists=plot_occupancy_hists, output_pdf=output_pdf) for data_file in scan_base]
+    return _store_beam_spot(time_series, output_pdf=output_pdf, output_file=output_file)
 
 
 def analyze_event_rate(scan_base, combine_n_readouts=1000, time_line_absolute=True, output_pdf=None, output_file=None):
@@ -114,37 +54,8 @@ def analyze_event_rate(scan_base, combine_n_readouts=1000, time_line_absolute=Tr
     output_pdf: PdfPages
         PdfPages file object, if none the plot is printed to screen
     '''
-    time_stamp = []
-    rate = []
-
-    start_time_set = False
-
-    for data_file in scan_base:
-        with tb.open_file(data_file + '_interpreted.h5', mode="r") as in_file_h5:
-            meta_data_array = in_file_h5.root.meta_data[:]
-            parameter_ranges = np.column_stack((analysis_utils.get_ranges_from_array(meta_data_array['timestamp_start'][::combine_n_readouts]), analysis_utils.get_ranges_from_array(meta_data_array['event_number'][::combine_n_readouts])))
-
-            if time_line_absolute:
-                time_stamp.extend(parameter_ranges[:-1, 0])
-            else:
-                if not start_time_set:
-                    start_time = parameter_ranges[0, 0]
-                    start_time_set = True
-                time_stamp.extend((parameter_ranges[:-1, 0] - start_time) / 60.0)
-            rate.extend((parameter_ranges[:-1, 3] - parameter_ranges[:-1, 2]) / (parameter_ranges[:-1, 1] - parameter_ranges[:-1, 0]))  # d#Events / dt
-    if time_line_absolute:
-        plotting.plot_scatter_time(time_stamp, rate, title='Event rate [Hz]', marker_style='o', filename=output_pdf)
-    else:
-        plotting.plot_scatter(time_stamp, rate, title='Events per time', x_label='Progressed time [min.]', y_label='Events rate [Hz]', marker_style='o', filename=output_pdf)
-    if output_file:
-        with tb.open_file(output_file, mode="a") as out_file_h5:
-            rec_array = np.array(zip(time_stamp, rate), dtype=[('time_stamp', float), ('rate', float)]).view(np.recarray)
-            try:
-                rate_table = out_file_h5.create_table(out_file_h5.root, name='Eventrate', description=rec_array, title='Event rate', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-                rate_table[:] = rec_array
-            except tb.exceptions.NodeError:
-                logging.warning(output_file + ' has already a Eventrate note, do not overwrite existing.')
-    return time_stamp, rate
+    time_series = [_get_time_series(data_file, combine_n_readouts, hits=False, cluster=False) for data_file in scan_base]
+    return _store_event_rate(time_series, time_line_absolute=time_line_absolute, output_pdf=output_pdf, output_file=output_file)
 
 
 def analyse_n_cluster_per_event(scan_base, include_no_cluster=False, time_line_absolute=True, combine_n_readouts=1000, chunk_size=10000000, plot_n_cluster_hists=False, output_pdf=None, output_file=None):
@@ -163,75 +74,106 @@ def analyse_n_cluster_per_event(scan_base, include_no_cluster=False, time_line_a
     output_pdf: PdfPages
         PdfPages file object, if none the plot is printed to screen
     '''
+    time_series = [_get_time_series(data_file, combine_n_readouts, chunk_size, hits=False, cluster=True) for data_file in scan_base]
+    return _store_n_cluster_per_event(time_series, include_no_cluster=include_no_cluster, time_line_absolute=time_line_absolute, plot_n_cluster_hists=plot_n_cluster_hists, output_pdf=output_pdf, output_file=output_file)
 
-    time_stamp = []
-    n_cluster = []
 
-    start_time_set = False
+def analyze_time_series(scan_base, combine_n_readouts=1000, include_no_cluster=False, time_line_absolute=True, chunk_size=10000000, plot_occupancy_hists=False, plot_n_cluster_hists=False, output_pdf=None, output_file=None):
+    ''' Determines the mean beam spot position, the event rate and the number of cluster per event as a function of time in one pass over the hit and cluster table.
+    The results are the same as the results of analyze_beam_spot(), analyze_event_rate() and analyse_n_cluster_per_event(), but the files are read only once.
 
-    for data_file in scan_base:
-        with tb.open_file(data_file + '_interpreted.h5', mode="r+") as in_cluster_file_h5:
-            # get data and data pointer
-            meta_data_array = in_cluster_file_h5.root.meta_data[:]
-            cluster_table = in_cluster_file_h5.root.Cluster
+    Parameters
+    ----------
+    scan_base: list of str
+        scan base names (e.g.:  ['//data//SCC_50_fei4_self_trigger_scan_390', ]
+    combine_n_readouts: int
+        the number of read outs to combine (e.g. 1000)
+    include_no_cluster: bool
+        Set to true to also consider all events without any hit.
+    time_line_absolute: bool
+        if true the event rate and the number of cluster per event use absolute time stamps
+    chunk_size: int
+        the number of table rows read at once
+    output_pdf: PdfPages
+        PdfPages file object, if none the plot is printed to screen
 
-            # determine the event ranges to analyze (timestamp_start, start_event_number, stop_event_number)
-            parameter_ranges = np.column_stack((analysis_utils.get_ranges_from_array(meta_data_array['timestamp_start'][::combine_n_readouts]), analysis_utils.get_ranges_from_array(meta_data_array['event_number'][::combine_n_readouts])))
+    Returns
+    -------
+    dict
+        The results of analyze_beam_spot(), analyze_event_rate() and analyse_n_cluster_per_event() (keys beam_spot, event_rate, n_cluster).
+    '''
+    time_series = [_get_time_series(data_file, combine_n_readouts, chunk_size, hits=True, cluster=True, plot_occupancy_hists=plot_occupancy_hists, output_pdf=output_pdf) for data_file in scan_base]
+    return {'beam_spot': _store_beam_spot(time_series, output_pdf=output_pdf, output_file=output_file),
+            'event_rate': _store_event_rate(time_series, time_line_absolute=time_line_absolute, output_pdf=output_pdf, output_file=output_file),
+            'n_cluster': _store_n_cluster_per_event(time_series, include_no_cluster=include_no_cluster, time_line_absolute=time_line_absolute, plot_n_cluster_hists=plot_n_cluster_hists, output_pdf=output_pdf, output_file=output_file)}
 
-            # create a event_numer index (important for speed)
-            analysis_utils.index_event_number(cluster_table)
 
-            # initialize the analysis and set settings
-            analyze_data = AnalyzeRawData()
-            analyze_data.create_tot_hist = False
-            analyze_data.create_bcid_hist = False
+def _get_time_series(data_file, combine_n_readouts, chunk_size=10000000, hits=True, cluster=True, plot_occupancy_hists=False, output_pdf=None):
+    if plot_occupancy_hists:
+        with tb.open_file(data_file + '_interpreted.h5', mode="r") as in_file_h5:
+            timestamps = in_file_h5.root.meta_data.read(field='timestamp_start')[::combine_n_readouts]
 
-            # variables for read speed up
-            index = 0  # index where to start the read out, 0 at the beginning, increased during looping
-            best_chunk_size = chunk_size
+        def plot_occupancy(time_bin, occupancy):
+            title = 'Occupancy for events between ' + time.strftime('%H:%M:%S', time.localtime(timestamps[time_bin]))
+            title += ' and ' + (time.strftime('%H:%M:%S', time.localtime(timestamps[time_bin + 1])) if time_bin + 1 < timestamps.shape[0] else 'end')
+            plotting.plot_occupancy(occupancy, title=title, filename=output_pdf)
+    else:
+        plot_occupancy = None
+    return get_time_series(data_file + '_interpreted.h5', combine_n_readouts=combine_n_readouts, hits=hits, cluster=cluster, chunk_size=chunk_size, occupancy_callback=plot_occupancy)
 
-            total_cluster = cluster_table.shape[0]
 
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=total_cluster, term_width=80)
-            progress_bar.start()
+def _get_time_line(time_series, time_line_absolute, last_bin=True):  # time stamps of all files, relative time in minutes to the start of the first file
+    time_stamp = np.concatenate([series.timestamp_start if last_bin else series.timestamp_start[:-1] for series in time_series])
+    if not time_line_absolute and time_series:
+        time_stamp = (time_stamp - time_series[0].timestamp_start[0]) / 60.0
+    return time_stamp.tolist()
 
-            # loop over the selected events
-            for parameter_index, parameter_range in enumerate(parameter_ranges):
-                logging.debug('Analyze time stamp ' + str(parameter_range[0]) + ' and data from events = [' + str(parameter_range[2]) + ',' + str(parameter_range[3]) + '[ ' + str(int(float(float(parameter_index) / float(len(parameter_ranges)) * 100.0))) + '%')
-                analyze_data.reset()  # resets the data of the last analysis
-
-                # loop over the cluster in the actual selected events with optimizations: determine best chunk size, start word index given
-                readout_cluster_len = 0  # variable to calculate a optimal chunk size value from the number of hits for speed up
-                hist = None
-                for clusters, index in analysis_utils.data_aligned_at_events(cluster_table, start_event_number=parameter_range[2], stop_event_number=parameter_range[3], start_index=index, chunk_size=best_chunk_size):
-                    n_cluster_per_event = analysis_utils.get_n_cluster_in_events(clusters['event_number'])[:, 1]  # array with the number of cluster per event, cluster per event are at least 1
-                    if hist is None:
-                        hist = np.histogram(n_cluster_per_event, bins=10, range=(0, 10))[0]
-                    else:
-                        hist = np.add(hist, np.histogram(n_cluster_per_event, bins=10, range=(0, 10))[0])
-                    if include_no_cluster and parameter_range[3] is not None:  # happend for the last readout
-                        hist[0] = (parameter_range[3] - parameter_range[2]) - len(n_cluster_per_event)  # add the events without any cluster
-                    readout_cluster_len += clusters.shape[0]
-                    total_cluster -= len(clusters)
-                    progress_bar.update(index)
-                best_chunk_size = int(1.5 * readout_cluster_len) if int(1.05 * readout_cluster_len) < chunk_size else chunk_size  # to increase the readout speed, estimated the number of hits for one read instruction
 
-                if plot_n_cluster_hists:
-                    plotting.plot_1d_hist(hist, title='Number of cluster per event at ' + str(parameter_range[0]), x_axis_title='Number of cluster', y_axis_title='#', log_y=True, filename=output_pdf)
-                hist = hist.astype('f4') / np.sum(hist)  # calculate fraction from total numbers
+def _store_beam_spot(time_series, output_pdf=None, output_file=None):
+    time_stamp = _get_time_line(time_series, time_line_absolute=True)
+    x, y = [], []
+    for series in time_series:
+        x_series, y_series = series.get_beam_spot()
+        x.extend(x_series.tolist())
+        y.extend(y_series.tolist())
+    plotting.plot_scatter([i * 250 for i in x], [i * 50 for i in y], title='Mean beam position', x_label='x [um]', y_label='y [um]', marker_style='-o', filename=output_pdf)
+    if output_file:
+        with tb.open_file(output_file, mode="a") as out_file_h5:
+            rec_array = np.array(zip(time_stamp, x, y), dtype=[('time_stamp', float), ('x', float), ('y', float)])
+            try:
+                beam_spot_table = out_file_h5.create_table(out_file_h5.root, name='Beamspot', description=rec_array, title='Beam spot position', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                beam_spot_table[:] = rec_array
+            except tb.exceptions.NodeError:
+                logging.warning(output_file + ' has already a Beamspot note, do not overwrite existing.')
+    return time_stamp, x, y
 
-                if time_line_absolute:
-                    time_stamp.append(parameter_range[0])
-                else:
-                    if not start_time_set:
-                        start_time = parameter_ranges[0, 0]
-                        start_time_set = True
-                    time_stamp.append((parameter_range[0] - start_time) / 60.0)
-                n_cluster.append(hist)
-            progress_bar.finish()
-            if total_cluster != 0:
-                logging.warning('Not all clusters were selected during analysis. Analysis is therefore not exact')
 
+def _store_event_rate(time_series, time_line_absolute=True, output_pdf=None, output_file=None):
+    time_stamp = _get_time_line(time_series, time_line_absolute, last_bin=False)  # the rate of the last time bin is not known
+    rate = np.concatenate([series.get_event_rate() for series in time_series]).tolist()
+    if time_line_absolute:
+        plotting.plot_scatter_time(time_stamp, rate, title='Event rate [Hz]', marker_style='o', filename=output_pdf)
+    else:
+        plotting.plot_scatter(time_stamp, rate, title='Events per time', x_label='Progressed time [min.]', y_label='Events rate [Hz]', marker_style='o', filename=output_pdf)
+    if output_file:
+        with tb.open_file(output_file, mode="a") as out_file_h5:
+            rec_array = np.array(zip(time_stamp, rate), dtype=[('time_stamp', float), ('rate', float)]).view(np.recarray)
+            try:
+                rate_table = out_file_h5.create_table(out_file_h5.root, name='Eventrate', description=rec_array, title='Event rate', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                rate_table[:] = rec_array
+            except tb.exceptions.NodeError:
+                logging.warning(output_file + ' has already a Eventrate note, do not overwrite existing.')
+    return time_stamp, rate
+
+
+def _store_n_cluster_per_event(time_series, include_no_cluster=False, time_line_absolute=True, plot_n_cluster_hists=False, output_pdf=None, output_file=None):
+    time_stamp = _get_time_line(time_series, time_line_absolute)
+    n_cluster = []
+    for series in time_series:
+        if plot_n_cluster_hists:
+            for timestamp, hist in zip(series.timestamp_start, series.n_cluster_hist):
+                plotting.plot_1d_hist(hist, title='Number of cluster per event at ' + str(timestamp), x_axis_title='Number of cluster', y_axis_title='#', log_y=True, filename=output_pdf)
+        n_cluster.extend(series.get_n_cluster_per_event(include_no_cluster=include_no_cluster))
     if time_line_absolute:
         plotting.plot_scatter_time(time_stamp, n_cluster, title='Number of cluster per event as a function of time', marker_style='o', filename=output_pdf, legend=('0 cluster', '1 cluster', '2 cluster', '3 cluster') if include_no_cluster else ('0 cluster not plotted', '1 cluster', '2 cluster', '3 cluster'))
     else:
@@ -269,7 +211,7 @@ def select_hits_from_cluster_info(input_file_hits, output_file_hits, cluster_siz
         analysis_utils.index_event_number(in_hit_file_h5.root.Hits)
         analysis_utils.index_event_number(in_hit_file_h5.root.Cluster)
         with tb.open_file(output_file_hits, mode="w") as out_hit_file_h5:
-            hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=data_struct.HitInfoTable, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=in_hit_file_h5.root.Hits.description, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
             cluster_table = in_hit_file_h5.root.Cluster
             last_word_number = 0
             progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=cluster_table.shape[0], term_width=80)
@@ -309,7 +251,7 @@ def select_hits(input_file_hits, output_file_hits, condition=None, cluster_size_
         with tb.open_file(input_file_hits, mode="r+") as in_hit_file_h5:
             analysis_utils.index_event_number(in_hit_file_h5.root.Hits)  # create event index for faster selection
             with tb.open_file(output_file_hits, mode="w") as out_hit_file_h5:
-                hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=data_struct.HitInfoTable, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=in_hit_file_h5.root.Hits.description, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
                 analysis_utils.write_hits_in_event_range(hit_table_in=in_hit_file_h5.root.Hits, hit_table_out=hit_table_out, condition=condition)  # write the hits of the selected events into a new table
                 in_hit_file_h5.root.meta_data.copy(out_hit_file_h5.root)  # copy meta_data note to new file
     else:
@@ -317,7 +259,7 @@ def select_hits(input_file_hits, output_file_hits, condition=None, cluster_size_
             analysis_utils.index_event_number(in_hit_file_h5.root.Hits)  # create event index for faster selection
             analysis_utils.index_event_number(in_hit_file_h5.root.Cluster)  # create event index for faster selection
             with tb.open_file(output_file_hits, mode="w") as out_hit_file_h5:
-                hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=data_struct.HitInfoTable, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+                hit_table_out = out_hit_file_h5.create_table(out_hit_file_h5.root, name='Hits', description=in_hit_file_h5.root.Hits.description, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
                 cluster_table = in_hit_file_h5.root.Cluster
                 last_word_number = 0
                 progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=cluster_table.shape[0], term_width=80)
@@ -338,6 +280,46 @@ def select_hits(input_file_hits, output_file_hits, condition=None, cluster_size_
                 in_hit_file_h5.root.meta_data.copy(out_hit_file_h5.root)  # copy meta_data note to new file
 
 
+def select_hits_with_conditions(input_file_hits, output_files_hits, conditions, chunk_size=5000000):
+    ''' Takes a hit table and stores the hits selected by each condition into its own file. All conditions are evaluated in one pass over
+    the hit table, terms that are common to several conditions are evaluated once (see analysis_utils.HitSelection).
+
+     Parameters
+    ----------
+    input_file_hits: str
+        the input file name with hits
+    output_files_hits: list of str
+        the output file names for the hits, one per condition
+    conditions: list of str
+        Numexpr strings to select hits (e.g.: ['(relative_BCID == 6) & (column == row)', '(relative_BCID == 6) & (tot > 5)'])
+        All hit infos can be used (column, row, ...)
+    chunk_size: int
+        the number of hits read at once
+
+    Returns
+    -------
+    list of int
+        the number of selected hits per condition
+    '''
+    if len(output_files_hits) != len(conditions):
+        raise ValueError('One output file per condition needed')
+    logging.info('Write hits with %d conditions into %s', len(conditions), ', '.join(str(output_file_hits) for output_file_hits in output_files_hits))
+    out_hit_files_h5 = []
+    try:
+        with tb.open_file(input_file_hits, mode="r") as in_hit_file_h5:
+            hit_tables_out = []
+            for output_file_hits in output_files_hits:
+                out_hit_files_h5.append(tb.open_file(output_file_hits, mode="w"))
+                hit_tables_out.append(out_hit_files_h5[-1].create_table(out_hit_files_h5[-1].root, name='Hits', description=in_hit_file_h5.root.Hits.description, title='hit_data', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False)))
+            n_selected_hits = analysis_utils.write_selected_hits(hit_table_in=in_hit_file_h5.root.Hits, hit_tables_out=hit_tables_out, conditions=conditions, chunk_size=chunk_size)
+            for out_hit_file_h5 in out_hit_files_h5:
+                in_hit_file_h5.root.meta_data.copy(out_hit_file_h5.root)  # copy meta_data note to new file
+    finally:
+        for out_hit_file_h5 in out_hit_files_h5:
+            out_hit_file_h5.close()
+    return n_selected_hits
+
+
 def analyze_cluster_size_per_scan_parameter(input_file_hits, output_file_cluster_size, parameter='GDAC', max_chunk_size=10000000, overwrite_output_files=False, output_pdf=None):
     ''' This method takes multiple hit files and determines the cluster size for different scan parameter values of
 
@@ -0,0 +1,277 @@
+"""Disk cache for interpreted raw data. The interpreted data file is stored under a key computed from a fingerprint
+of the raw data file(s) and the interpretation settings. Interpreting the same raw data with the same settings again
+(e.g. in tuning loops or when re-running a scan analysis) copies the cached result instead of interpreting the raw data.
+Arrays calculated from other input data (e.g. the per pixel charge calibration) are cached under a key computed from the input data.
+"""
+import logging
+import os
+import hashlib
+
+import numpy as np
+import tables as tb
+
+
+CACHE_VERSION = 1  # increase to invalidate cache entries created by a different interpretation
+
+_cache = None
+
+
+def get_cache():
+    '''Returns the analysis cache of the session or None if caching is disabled.
+    '''
+    return _cache
+
+
+def set_cache(cache_dir=None, max_size=10 * 1024 ** 3):
+    '''Enables the analysis cache for the session.
+
+    Parameters
+    ----------
+    cache_dir : string, None
+        Directory of the cache files. If None, the cache is disabled.
+    max_size : int
+        Maximum size of the cache in bytes. The least recently used entries are removed when the size is exceeded.
+
+    Returns
+    -------
+    AnalysisCache or None
+    '''
+    global _cache
+    _cache = None if cache_dir is None else AnalysisCache(cache_dir=cache_dir, max_size=max_size)
+    return _cache
+
+
+def _update_hash(sha, value):
+    if isinstance(value, np.ndarray):
+        sha.update(str(value.dtype) + str(value.shape))
+        sha.update(np.ascontiguousarray(value).tostring())
+    elif isinstance(value, dict):
+        for key in sorted(value.keys()):
+            _update_hash(sha, key)
+            _update_hash(sha, value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _update_hash(sha, item)
+    else:
+        sha.update(repr(value))
+
+
+def get_raw_data_fingerprint(raw_data_files, chunk_size=10000000):
+    '''Calculates a fingerprint of the raw data file(s). The raw data, the meta data, the scan parameters and the configuration are hashed.
+    The raw data is read in chunks to limit the memory consumption.
+    Every raw data word is hashed, thus a cache lookup reads the raw data once. This is I/O bound and much faster than
+    the interpretation, but not free for large files. Hashing only the meta data or a sample of the raw data would be faster,
+    but could return a stale interpretation for raw data changed in place.
+
+    Parameters
+    ----------
+    raw_data_files : iterable of strings
+    chunk_size : int
+        Number of raw data words read at once.
+
+    Returns
+    -------
+    string
+        Hexadecimal SHA-1 digest.
+    '''
+    sha = hashlib.sha1()
+    for raw_data_file in raw_data_files:
+        with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+            n_words = in_file_h5.root.raw_data.shape[0]
+            _update_hash(sha, n_words)
+            _update_hash(sha, in_file_h5.root.meta_data[:])
+            if 'scan_parameters' in in_file_h5.root:
+                _update_hash(sha, in_file_h5.root.scan_parameters[:])
+            if 'configuration' in in_file_h5.root:
+                for node in in_file_h5.walk_nodes(in_file_h5.root.configuration, classname='Leaf'):
+                    _update_hash(sha, node._v_pathname)
+                    _update_hash(sha, node[:])
+            for start_index in range(0, n_words, chunk_size):
+                sha.update(np.ascontiguousarray(in_file_h5.root.raw_data.read(start_index, start_index + chunk_size)).tostring())
+    return sha.hexdigest()
+
+
+def get_cache_key(raw_data_files, settings):
+    '''Returns the cache key for the interpretation of the raw data file(s) with the given settings.
+
+    Parameters
+    ----------
+    raw_data_files : iterable of strings
+    settings : dict
+        Interpretation, histogramming and clustering settings.
+
+    Returns
+    -------
+    string
+    '''
+    sha = hashlib.sha1()
+    _update_hash(sha, CACHE_VERSION)
+    _update_hash(sha, get_raw_data_fingerprint(raw_data_files))
+    _update_hash(sha, settings)
+    return sha.hexdigest()
+
+
+def get_array_key(name, *values):
+    '''Returns the cache key of an array calculated from the given values (e.g. a calibration).
+
+    Parameters
+    ----------
+    name : string
+        Name of the calculation.
+    values
+        Input values of the calculation (arrays, dicts, lists, numbers, strings).
+
+    Returns
+    -------
+    string
+    '''
+    sha = hashlib.sha1()
+    _update_hash(sha, CACHE_VERSION)
+    _update_hash(sha, name)
+    _update_hash(sha, values)
+    return sha.hexdigest()
+
+
+class AnalysisCache(object):
+    '''Cache of interpreted data files with least recently used eviction.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory of the cache files. Created if not existing.
+    max_size : int
+        Maximum size of the cache in bytes.
+    '''
+    def __init__(self, cache_dir, max_size=10 * 1024 ** 3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def _get_file_name(self, key):
+        return os.path.join(self.cache_dir, key + '.h5')
+
+    def _get_entries(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.h5'):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.cache_dir, file_name)))
+        return sorted(entries)  # least recently used first
+
+    def get_size(self):
+        '''Returns the size of all cache entries in bytes.
+        '''
+        return sum(size for _, size, _ in self._get_entries())
+
+    def get_metrics(self):
+        '''Returns the number of cache hits, misses, evictions and the cache size.
+        '''
+        entries = self._get_entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(entries), 'size': sum(size for _, size, _ in entries)}
+
+    def get(self, key, out_file_h5):
+        '''Copies the cached interpreted data into the given file.
+
+        Parameters
+        ----------
+        key : string
+        out_file_h5 : tables.File
+            Opened output file.
+
+        Returns
+        -------
+        bool
+            True if the key was found in the cache.
+        '''
+        file_name = self._get_file_name(key)
+        if not os.path.isfile(file_name):
+            self.misses += 1
+            logging.info('Analysis cache miss (%d hit(s), %d miss(es))', self.hits, self.misses)
+            return False
+        with tb.open_file(file_name, mode="r") as cached_file_h5:
+            cached_file_h5.root._f_copy_children(out_file_h5.root, overwrite=True, recursive=True)
+        out_file_h5.flush()
+        os.utime(file_name, None)  # mark as recently used
+        self.hits += 1
+        logging.info('Analysis cache hit (%d hit(s), %d miss(es)): using cached interpretation %s', self.hits, self.misses, file_name)
+        return True
+
+    def put(self, key, out_file_h5):
+        '''Stores the interpreted data of the given file in the cache and removes the least recently used entries
+        if the maximum cache size is exceeded.
+
+        Parameters
+        ----------
+        key : string
+        out_file_h5 : tables.File
+            Opened file with the interpreted data.
+        '''
+        file_name = self._get_file_name(key)
+        tmp_file_name = file_name + '.tmp'
+        out_file_h5.copy_file(tmp_file_name, overwrite=True)
+        if os.path.getsize(tmp_file_name) > self.max_size:
+            logging.warning('Interpreted data exceeds the analysis cache size, not cached')
+            os.remove(tmp_file_name)
+            return
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+        os.rename(tmp_file_name, file_name)
+        self._evict()
+
+    def get_array(self, key):
+        '''Returns a cached array, None if the key was not found in the cache.
+
+        Parameters
+        ----------
+        key : string
+
+        Returns
+        -------
+        numpy.array
+        '''
+        file_name = self._get_file_name(key)
+        if not os.path.isfile(file_name):
+            self.misses += 1
+            return None
+        with tb.open_file(file_name, mode="r") as cached_file_h5:
+            array = cached_file_h5.root.array[:]
+        os.utime(file_name, None)  # mark as recently used
+        self.hits += 1
+        logging.info('Analysis cache hit (%d hit(s), %d miss(es)): using cached array %s', self.hits, self.misses, file_name)
+        return array
+
+    def put_array(self, key, array):
+        '''Stores an array in the cache and removes the least recently used entries if the maximum cache size is exceeded.
+
+        Parameters
+        ----------
+        key : string
+        array : numpy.array
+        '''
+        file_name = self._get_file_name(key)
+        tmp_file_name = file_name + '.tmp'
+        with tb.open_file(tmp_file_name, mode="w") as cached_file_h5:
+            cached_file_h5.create_carray(cached_file_h5.root, name='array', obj=array, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+        os.rename(tmp_file_name, file_name)
+        self._evict()
+
+    def _evict(self):
+        entries = self._get_entries()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, file_name in entries[:-1]:  # keep the latest entry
+            if size <= self.max_size:
+                break
+            os.remove(file_name)
+            size -= entry_size
+            self.evictions += 1
+            logging.info('Analysis cache: removed %s', file_name)
+
+    def clear(self):
+        '''Removes all cache entries.
+        '''
+        for _, _, file_name in self._get_entries():
+            os.remove(file_name)
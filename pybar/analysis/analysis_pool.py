@@ -0,0 +1,284 @@
+"""Persistent worker pool for the analysis. The pool is created on first use and shared by all analysis functions and scans of a session
+(e.g. within a tuning sequence or a RunManager primlist). Large numpy arrays are passed to the workers as memory mapped files.
+"""
+import logging
+import os
+import time
+import atexit
+import signal
+import tempfile
+import threading
+import traceback
+import cPickle as pickle
+import multiprocessing as mp
+from Queue import Empty
+
+import numpy as np
+
+
+_pool = None
+_pool_size = None  # number of worker processes, None: number of CPU cores
+_pool_lock = threading.Lock()
+
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # keyboard interrupt is handled by the main process
+
+
+def get_pool_size():
+    '''Returns the number of worker processes of the analysis pool.
+    '''
+    return mp.cpu_count() if _pool_size is None else _pool_size
+
+
+def set_pool_size(processes=None):
+    '''Sets the number of worker processes of the analysis pool. A running pool with a different size is closed and will be recreated on next use.
+
+    Parameters
+    ----------
+    processes : int, None
+        Number of worker processes. If None, the number of CPU cores is used.
+    '''
+    global _pool_size
+    if processes is not None and processes < 1:
+        raise ValueError('Number of analysis processes has to be larger than 0')
+    with _pool_lock:
+        if _pool is not None and processes != _pool_size:
+            _close_pool()
+        _pool_size = processes
+
+
+def get_pool():
+    '''Returns the analysis pool. The pool is created on first use.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            logging.info('Starting analysis pool with %d worker process(es)', get_pool_size())
+            _pool = mp.Pool(processes=get_pool_size(), initializer=_init_worker)
+        return _pool
+
+
+def close_pool():
+    '''Closes the analysis pool and waits for the workers to exit. Called automatically at interpreter exit.
+    '''
+    with _pool_lock:
+        _close_pool()
+
+
+def _close_pool():
+    global _pool
+    if _pool is not None:
+        logging.debug('Closing analysis pool')
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+atexit.register(close_pool)
+
+
+def _get_shared_memory_dir():
+    if os.path.isdir('/dev/shm'):  # RAM based file system on Linux
+        return '/dev/shm'
+    return None  # system temporary directory
+
+
+class SharedArray(object):
+    '''Numpy array stored in a memory mapped temporary file. When pickled, only the file name is transferred and the
+    array data is shared between the processes. The file is removed when the array is released by the creating process.
+
+    Parameters
+    ----------
+    array : numpy.array
+    '''
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.dtype, self.shape = array.dtype, array.shape
+        self._owner = True
+        if array.nbytes == 0:  # empty files cannot be memory mapped
+            self.filename = None
+            self.array = array
+        else:
+            fd, self.filename = tempfile.mkstemp(prefix='pybar_', suffix='.dat', dir=_get_shared_memory_dir())
+            os.close(fd)
+            self.array = np.memmap(self.filename, dtype=self.dtype, mode='w+', shape=self.shape)
+            self.array[:] = array
+            self.array.flush()
+
+    def __getstate__(self):
+        state = {'filename': self.filename, 'dtype': self.dtype, 'shape': self.shape}
+        if self.filename is None:
+            state['array'] = self.array
+        return state
+
+    def __setstate__(self, state):
+        self.filename, self.dtype, self.shape = state['filename'], state['dtype'], state['shape']
+        self._owner = False
+        if self.filename is None:
+            self.array = state['array']
+        else:
+            self.array = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape)
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        self.array = None
+        if self._owner and self.filename is not None and os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+def _apply_to_rows(args):
+    func, shared_array, start, stop = args
+    return [func(row) for row in shared_array[start:stop]]
+
+
+def map_rows(func, array, n_chunks=None):
+    '''Applies a function to each row of an array in the analysis pool. The array is shared with the workers and
+    not pickled. The results are returned in the order of the rows.
+
+    Parameters
+    ----------
+    func : callable
+        Function taking a row of the array. Has to be picklable (module level function or functools.partial of it).
+    array : numpy.array
+    n_chunks : int
+        Number of chunks the rows are divided into. If None, four chunks per worker process are used.
+
+    Returns
+    -------
+    list
+        Results of func for each row.
+    '''
+    if n_chunks is None:
+        n_chunks = 4 * get_pool_size()
+    n_rows = array.shape[0]
+    boundaries = np.linspace(0, n_rows, num=min(n_chunks, max(n_rows, 1)) + 1).astype(np.int64)
+    with SharedArray(array) as shared_array:
+        results = get_pool().map(_apply_to_rows, [(func, shared_array, start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:])])
+    return [result for chunk_results in results for result in chunk_results]
+
+
+def _run_pipeline_stage(func, input_queue, output_queue):
+    _init_worker()
+    while True:
+        item = input_queue.get()
+        if item is None:  # end of input
+            break
+        index, data = item
+        start_time = time.time()
+        try:
+            result = pickle.dumps(func(pickle.loads(data)), pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            output_queue.put((index, False, traceback.format_exc(), time.time() - start_time))
+        else:
+            output_queue.put((index, True, result, time.time() - start_time))
+
+
+class Pipeline(object):
+    '''Pipeline stage processing items in separate processes in parallel to the main process. The items are passed to the
+    processes by a bounded queue, so that the main process is blocked if the processes cannot keep up. The results are returned
+    in the order of the items.
+
+    Items and results are pickled when passed to the queues, arrays can be reused afterwards. The processes are forked
+    from the main process, func has to be picklable only on platforms without fork().
+
+    Parameters
+    ----------
+    func : callable
+        Function taking an item and returning the result.
+    processes : int
+        Number of processes.
+    max_queued_items : int
+        Maximum number of items waiting to be processed. If None, two items per process.
+    '''
+    def __init__(self, func, processes=1, max_queued_items=None):
+        if processes < 1:
+            raise ValueError('Number of pipeline processes has to be larger than 0')
+        self._input_queue = mp.Queue(maxsize=2 * processes if max_queued_items is None else max_queued_items)
+        self._output_queue = mp.Queue()
+        self._processes = [mp.Process(target=_run_pipeline_stage, args=(func, self._input_queue, self._output_queue)) for _ in range(processes)]
+        for process in self._processes:
+            process.daemon = True
+            process.start()
+        self._n_items, self._n_results = 0, 0
+        self._results = {}  # results received out of order
+        self.busy_time = 0.0  # processing time of all processes in seconds
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.terminate()
+
+    def put(self, item):
+        '''Adds an item. Blocks if the maximum number of queued items is reached.
+        '''
+        self._input_queue.put((self._n_items, pickle.dumps(item, pickle.HIGHEST_PROTOCOL)))
+        self._n_items += 1
+
+    def get(self, block=False):
+        '''Returns the results of the processed items in the order of the items.
+
+        Parameters
+        ----------
+        block : bool
+            If True, wait for the results of all items.
+
+        Returns
+        -------
+        list
+        '''
+        while self._n_results + len(self._results) < self._n_items:
+            try:
+                index, success, result, busy_time = self._output_queue.get(block=block, timeout=1.0 if block else None)
+            except Empty:
+                if not block:
+                    break
+                if not all(process.is_alive() for process in self._processes):
+                    raise RuntimeError('Pipeline process died unexpectedly')
+                continue
+            if not success:
+                raise RuntimeError('Pipeline process failed:\n%s' % result)
+            self._results[index] = result
+            self.busy_time += busy_time
+        results = []
+        while self._n_results in self._results:
+            results.append(pickle.loads(self._results.pop(self._n_results)))
+            self._n_results += 1
+        return results
+
+    def close(self):
+        '''Waits for the results of all items and stops the processes.
+
+        Returns
+        -------
+        list
+            Remaining results in the order of the items.
+        '''
+        results = self.get(block=True)
+        for _ in self._processes:
+            self._input_queue.put(None)
+        for process in self._processes:
+            process.join()
+        self._processes = []
+        return results
+
+    def terminate(self):
+        '''Stops the processes immediately.
+        '''
+        for process in self._processes:
+            process.terminate()
+            process.join()
+        self._processes = []
+        self._input_queue.cancel_join_thread()  # do not wait for the items which were not transferred
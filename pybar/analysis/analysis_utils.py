@@ -18,8 +18,14 @@ from scipy.interpolate import interp1d
 from scipy.interpolate import splrep, splev
 
 from pybar_fei4_interpreter import analysis_utils
+from pybar_fei4_interpreter import data_struct
 from pybar.daq.fei4_record import FEI4Record
+from pybar.daq import run_catalog
 from pybar.analysis.plotting import plotting
+from pybar.analysis.sparse_histogram import get_histogram, SparseHistogram
+from pybar.analysis.event_index import get_event_index
+from pybar.analysis import analysis_pool
+from pybar.analysis import analysis_cache
 from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, logical_and
 
 
@@ -301,19 +307,21 @@ def get_rate_normalization(hit_file, parameter, reference='event', cluster_file=
 
 
 def get_total_n_data_words(files_dict, precise=False):
+    catalog_infos = run_catalog.get_file_infos(files_dict.iterkeys())  # the number of words of cataloged files is known without opening the files
     n_words = 0
-    if precise:  # open all files and determine the total number of words precicely, can take some time
-        if len(files_dict) > 10:
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(files_dict), term_width=80)
+    if precise or len(catalog_infos) == len(files_dict):  # open all files not in the run catalog and determine the total number of words precicely, can take some time
+        file_names = [file_name for file_name in files_dict.iterkeys() if file_name not in catalog_infos]
+        if len(file_names) > 10:
+            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(file_names), term_width=80)
             progress_bar.start()
-        for index, file_name in enumerate(files_dict.iterkeys()):
+        for index, file_name in enumerate(file_names):
             with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
                 n_words += in_file_h5.root.raw_data.shape[0]
-            if len(files_dict) > 10:
+            if len(file_names) > 10:
                 progress_bar.update(index)
-        if len(files_dict) > 10:
+        if len(file_names) > 10:
             progress_bar.finish()
-        return n_words
+        return n_words + sum(info['n_words'] for info in catalog_infos.itervalues())
     else:  # open just first an last file and take the mean to estimate the total numbe rof words
         with tb.open_file(files_dict.keys()[0], mode="r") as in_file_h5:  # open the actual file
             n_words += in_file_h5.root.raw_data.shape[0]
@@ -441,7 +449,14 @@ def get_data_file_names_from_scan_base(scan_base, filter_str=['_analyzed.h5', '_
         data_files = filter(lambda data_file: not any([(True if x in data_file else False) for x in filter_str]), data_files)
     if sort_by_time and len(data_files) > 1:
         f_list = {}
+        for data_file, info in run_catalog.get_file_infos(data_files).iteritems():  # time stamps of cataloged files without opening the files
+            if info['n_readouts'] == 0:
+                logging.info("File %s has empty meta_data" % data_file)
+            else:
+                f_list[data_file] = info['timestamp_start']
         for data_file in data_files:
+            if data_file in f_list:
+                continue
             with tb.open_file(data_file, mode="r") as h5_file:
                 try:
                     meta_data = h5_file.root.meta_data
@@ -503,55 +518,64 @@ def get_parameter_from_files(files, parameters=None, unique=False, sort=True):
     if isinstance(parameters, basestring):
         parameters = (parameters, )
     parameter_values_from_file_names_dict = get_parameter_value_from_file_names(files, parameters, unique=unique, sort=sort)  # get the parameter from the file name
+    catalog_infos = run_catalog.get_file_infos(files)  # scan parameter values of cataloged files without opening the files
     for file_name in files:
-        with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
-            scan_parameter_values = collections.OrderedDict()
-            try:
-                scan_parameters = in_file_h5.root.scan_parameters[:]  # get the scan parameters from the scan parameter table
-                if parameters is None:
-                    parameters = get_scan_parameter_names(scan_parameters)
-                for parameter in parameters:
-                    try:
-                        scan_parameter_values[parameter] = np.unique(scan_parameters[parameter]).tolist()  # different scan parameter values used
-                    except ValueError:  # the scan parameter does not exists
-                        pass
-            except tb.NoSuchNodeError:  # scan parameter table does not exist
+        scan_parameter_values = collections.OrderedDict()
+        if file_name in catalog_infos and catalog_infos[file_name]['scan_parameters']:  # scan parameter table of a cataloged file
+            catalog_scan_parameter_values = collections.OrderedDict(catalog_infos[file_name]['scan_parameters'])
+            if parameters is None:
+                parameters = tuple(catalog_scan_parameter_values.iterkeys())
+            for parameter in parameters:
+                if parameter in catalog_scan_parameter_values:
+                    scan_parameter_values[parameter] = catalog_scan_parameter_values[parameter]
+        else:
+            with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
                 try:
-                    scan_parameters = get_scan_parameter(in_file_h5.root.meta_data[:])  # get the scan parameters from the meta data
-                    if scan_parameters:
+                    scan_parameters = in_file_h5.root.scan_parameters[:]  # get the scan parameters from the scan parameter table
+                    if parameters is None:
+                        parameters = get_scan_parameter_names(scan_parameters)
+                    for parameter in parameters:
                         try:
-                            scan_parameter_values = np.unique(scan_parameters[parameters]).tolist()  # different scan parameter values used
+                            scan_parameter_values[parameter] = np.unique(scan_parameters[parameter]).tolist()  # different scan parameter values used
                         except ValueError:  # the scan parameter does not exists
                             pass
-                except tb.NoSuchNodeError:  # meta data table does not exist
-                    pass
-            if not scan_parameter_values:  # if no scan parameter values could be set from file take the parameter found in the file name
-                try:
-                    scan_parameter_values = parameter_values_from_file_names_dict[file_name]
-                except KeyError:  # no scan parameter found at all, neither in the file name nor in the file
-                    scan_parameter_values = None
-            else:  # use the parameter given in the file and cross check if it matches the file name parameter if these is given
-                try:
-                    for key, value in scan_parameter_values.items():
-                        if value and value[0] != parameter_values_from_file_names_dict[file_name][key][0]:  # parameter value exists: check if the first value is the file name value
-                            logging.warning('Parameter values in the file name and in the file differ. Take ' + str(key) + ' parameters ' + str(value) + ' found in %s.', file_name)
-                except KeyError:  # parameter does not exists in the file name
-                    pass
-                except IndexError:
-                    raise IncompleteInputError('Something wrong check!')
-            if unique and scan_parameter_values is not None:
-                existing = False
-                for parameter in scan_parameter_values:  # loop to determine if any value of any scan parameter exists already
-                    all_par_values = [values[parameter] for values in files_dict.values()]
-                    if any(x in [scan_parameter_values[parameter]] for x in all_par_values):
-                        existing = True
-                        break
-                if not existing:
-                    files_dict[file_name] = scan_parameter_values
-                else:
-                    logging.warning('Scan parameter value(s) from %s exists already, do not add to result', file_name)
-            else:
+                except tb.NoSuchNodeError:  # scan parameter table does not exist
+                    try:
+                        scan_parameters = get_scan_parameter(in_file_h5.root.meta_data[:])  # get the scan parameters from the meta data
+                        if scan_parameters:
+                            try:
+                                scan_parameter_values = np.unique(scan_parameters[parameters]).tolist()  # different scan parameter values used
+                            except ValueError:  # the scan parameter does not exists
+                                pass
+                    except tb.NoSuchNodeError:  # meta data table does not exist
+                        pass
+        if not scan_parameter_values:  # if no scan parameter values could be set from file take the parameter found in the file name
+            try:
+                scan_parameter_values = parameter_values_from_file_names_dict[file_name]
+            except KeyError:  # no scan parameter found at all, neither in the file name nor in the file
+                scan_parameter_values = None
+        else:  # use the parameter given in the file and cross check if it matches the file name parameter if these is given
+            try:
+                for key, value in scan_parameter_values.items():
+                    if value and value[0] != parameter_values_from_file_names_dict[file_name][key][0]:  # parameter value exists: check if the first value is the file name value
+                        logging.warning('Parameter values in the file name and in the file differ. Take ' + str(key) + ' parameters ' + str(value) + ' found in %s.', file_name)
+            except KeyError:  # parameter does not exists in the file name
+                pass
+            except IndexError:
+                raise IncompleteInputError('Something wrong check!')
+        if unique and scan_parameter_values is not None:
+            existing = False
+            for parameter in scan_parameter_values:  # loop to determine if any value of any scan parameter exists already
+                all_par_values = [values[parameter] for values in files_dict.values()]
+                if any(x in [scan_parameter_values[parameter]] for x in all_par_values):
+                    existing = True
+                    break
+            if not existing:
                 files_dict[file_name] = scan_parameter_values
+            else:
+                logging.warning('Scan parameter value(s) from %s exists already, do not add to result', file_name)
+        else:
+            files_dict[file_name] = scan_parameter_values
     return collections.OrderedDict(sorted(files_dict.iteritems(), key=itemgetter(1)) if sort else files_dict)
 
 
@@ -585,7 +609,11 @@ def combine_meta_data(files_dict, meta_data_v2=True):
         logging.info("Combine the meta data from %d files", len(files_dict))
     # determine total length needed for the new combined array, thats the fastest way to combine arrays
     total_length = 0  # the total length of the new table
+    catalog_infos = run_catalog.get_file_infos(files_dict.iterkeys())  # number of readouts of cataloged files without opening the files
     for file_name in files_dict.iterkeys():
+        if file_name in catalog_infos:
+            total_length += catalog_infos[file_name]['n_readouts']
+            continue
         with tb.open_file(file_name, mode="r") as in_file_h5:  # open the actual file
             total_length += in_file_h5.root.meta_data.shape[0]
 
@@ -642,6 +670,81 @@ def smooth_differentiation(x, y, weigths=None, order=5, smoothness=3, derivation
     return splev(x, f, der=derivation)
 
 
+def fit_levenberg_marquardt(function, jacobian, x, y, p0, weights=None, max_iterations=100, ftol=1.49012e-08, xtol=1.49012e-08, max_damping=None):
+    '''Least squares fits of a function to many data sets at once with the Levenberg-Marquardt algorithm (like scipy.optimize.curve_fit()
+    for each data set). The normal equations of all fits are set up and solved together, converged fits are removed from the iteration.
+    Fits with singular or non finite normal equations are removed as not converged.
+
+    Parameters
+    ----------
+    function : function
+        Function of the data points x and the parameters (n_fits, n_parameters) returning the values (n_fits, n_points).
+    jacobian : function
+        Function of the data points x and the parameters (n_fits, n_parameters) returning the derivatives of the values by the parameters (n_fits, n_points, n_parameters).
+    x : numpy.array
+        Data points (n_points).
+    y : numpy.array
+        Data values (n_fits, n_points).
+    p0 : numpy.array
+        Start values of the parameters (n_fits, n_parameters).
+    weights : numpy.array
+        Weight of each data value (n_fits, n_points), 0 to omit a value. If None, all data values have the weight 1.
+    max_iterations : int
+        Fits not converged after this number of iterations are failed.
+    ftol, xtol : float
+        Relative tolerance of the chi square and the parameters (as scipy.optimize.leastsq()).
+    max_damping : float
+        If not None, fits that cannot improve the chi square up to this damping are converged.
+
+    Returns
+    -------
+    tuple
+        Fit parameters (n_fits, n_parameters) and True for converged fits (n_fits).
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    p = np.array(p0, dtype=np.float64)
+    weights = np.ones_like(y) if weights is None else np.asarray(weights, dtype=np.float64)
+    converged = np.zeros(p.shape[0], dtype=np.bool_)
+    damping = np.full(p.shape[0], 1e-3)
+    active = np.arange(p.shape[0])
+
+    def get_chi_2(p, fits):
+        return np.sum(weights[fits] * (function(x, p) - y[fits]) ** 2, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        chi_2 = get_chi_2(p, active)
+        for _ in range(max_iterations):
+            if active.shape[0] == 0:
+                break
+            actual_p = p[active]
+            residuals = y[active] - function(x, actual_p)
+            actual_jacobian = jacobian(x, actual_p)
+            weighted_jacobian = actual_jacobian * weights[active][:, :, np.newaxis]
+            a = np.einsum('fpi,fpj->fij', weighted_jacobian, actual_jacobian)
+            g = np.einsum('fpi,fp->fi', weighted_jacobian, residuals)
+            diagonal = np.diagonal(a, axis1=1, axis2=2)
+            diagonal = np.maximum(diagonal, 1e-12 * np.amax(diagonal, axis=1)[:, np.newaxis])  # parameters without influence (e.g. mu far from the data) do not make the equations singular
+            a = a + (damping[active][:, np.newaxis] * diagonal)[:, :, np.newaxis] * np.eye(p.shape[1])
+            solvable = np.all(np.isfinite(a), axis=(1, 2)) & np.all(np.isfinite(g), axis=1)
+            solvable[solvable] = np.linalg.cond(a[solvable]) < 1.0 / np.finfo(np.float64).eps
+            if not np.all(solvable):  # failed fits, the other fits continue
+                active, actual_p, a, g = active[solvable], actual_p[solvable], a[solvable], g[solvable]
+                if active.shape[0] == 0:
+                    break
+            step = np.linalg.solve(a, g[:, :, np.newaxis])[:, :, 0]
+            new_p = actual_p + step
+            new_chi_2 = get_chi_2(new_p, active)
+            improved = new_chi_2 < chi_2[active]
+            done = (improved & (chi_2[active] - new_chi_2 <= ftol * chi_2[active])) | np.all(np.abs(step) <= xtol * (np.abs(actual_p) + xtol), axis=1)
+            if max_damping is not None:
+                done |= ~improved & (damping[active] >= max_damping)  # no improvement possible anymore
+            p[active[improved]], chi_2[active[improved]] = new_p[improved], new_chi_2[improved]
+            damping[active] = np.clip(np.where(improved, damping[active] / 10.0, damping[active] * 10.0), 1e-15, 1e15)
+            converged[active[done]] = True
+            active = active[~done]
+    return p, converged
+
+
 def reduce_sorted_to_intersect(ar1, ar2):
     """
     Takes two sorted arrays and return the intersection ar1 in ar2, ar2 in ar1.
@@ -746,9 +849,374 @@ def get_meta_data_at_scan_parameter(meta_data_array, scan_parameter_name):
     return meta_data_array[get_meta_data_index_at_scan_parameter(meta_data_array, scan_parameter_name)['index']]
 
 
+hit_table_profiles = {  # columns of the hit table output profiles (see AnalyzeRawData.hit_table_profile)
+    'full': None,  # all columns of the interpreter hit struct
+    'pixel': ('event_number', 'column', 'row', 'tot'),  # hit maps, ToT and clustering
+    'timing': ('event_number', 'relative_BCID', 'LVL1ID', 'BCID', 'column', 'row', 'tot', 'event_status'),  # timing and time walk scans
+    'trigger': ('event_number', 'trigger_number', 'trigger_time_stamp', 'relative_BCID', 'column', 'row', 'tot', 'TDC', 'TDC_time_stamp', 'trigger_status', 'event_status')  # external trigger and TDC scans
+}
+
+compact_hit_column_dtypes = {  # columns stored with a smaller dtype than in the interpreter hit struct
+    'TDC_time_stamp': np.uint8  # 8 bit time stamp of the TDC word
+}
+
+
+def get_hit_table_columns(profile):
+    '''Returns the columns of a hit table output profile.
+
+    Parameters
+    ----------
+    profile : string, iterable of strings
+        Name of the profile in hit_table_profiles or the column names.
+
+    Returns
+    -------
+    tuple of strings or None
+        The column names. None for all columns.
+    '''
+    if isinstance(profile, basestring):
+        try:
+            columns = hit_table_profiles[profile]
+        except KeyError:
+            raise InvalidInputError('Unknown hit table profile %s, possible profiles are %s' % (profile, ', '.join(sorted(hit_table_profiles.keys()))))
+        if columns is None:
+            return None
+    else:
+        columns = tuple(profile)
+    unknown_columns = [column for column in columns if column not in get_hit_dtype().names]
+    if unknown_columns:
+        raise InvalidInputError('Unknown hit table column(s): %s' % ', '.join(unknown_columns))
+    if 'event_number' not in columns:
+        raise InvalidInputError('The hit table needs the event_number column')
+    return columns
+
+
+def get_hit_dtype(columns=None):
+    '''Returns the dtype of the hit table with the given columns. The column order of the interpreter hit struct is kept
+    and the compact dtypes (compact_hit_column_dtypes) are used.
+
+    Parameters
+    ----------
+    columns : iterable of strings
+        Column names. If None, the dtype of the interpreter hit struct is returned.
+
+    Returns
+    -------
+    numpy.dtype
+    '''
+    hit_dtype = tb.description.dtype_from_descr(data_struct.HitInfoTable)
+    if columns is None:
+        return hit_dtype
+    return np.dtype([(name, compact_hit_column_dtypes.get(name, hit_dtype[name])) for name in hit_dtype.names if name in columns])
+
+
+def select_hit_columns(hits, dtype):
+    '''Returns the hits with the columns of the given dtype (e.g. to append hits to a hit table with a column subset).
+
+    Parameters
+    ----------
+    hits : numpy.array
+    dtype : numpy.dtype
+        Hit table dtype from get_hit_dtype().
+
+    Returns
+    -------
+    numpy.array
+    '''
+    selected_hits = np.empty(hits.shape[0], dtype=dtype)
+    for name in dtype.names:
+        if hits.shape[0] and name in compact_hit_column_dtypes and np.amax(hits[name]) > np.iinfo(dtype[name]).max:
+            raise AnalysisError('Values of hit column %s exceed the compact dtype %s' % (name, dtype[name]))
+        selected_hits[name] = hits[name]
+    return selected_hits
+
+
+def expand_hits(hits):
+    '''Returns the hits with all columns of the interpreter hit struct. Missing columns (hit tables with a column subset) are set to 0.
+    Needed for the histogramming and clustering of hits read from a hit table.
+
+    Parameters
+    ----------
+    hits : numpy.array
+
+    Returns
+    -------
+    numpy.array
+    '''
+    hit_dtype = get_hit_dtype()
+    if hits.dtype == hit_dtype:
+        return hits
+    expanded_hits = np.zeros(hits.shape[0], dtype=hit_dtype)
+    for name in hits.dtype.names:
+        expanded_hits[name] = hits[name]
+    return expanded_hits
+
+
+def check_hit_columns(hits_array, columns):
+    '''Raises IncompleteInputError if the hits do not have all the given columns (e.g. hit tables with a column subset).
+    '''
+    missing_columns = [column for column in columns if column not in hits_array.dtype.names]
+    if missing_columns:
+        raise IncompleteInputError('Hit table has no column(s) %s, select a hit table profile with these columns during interpretation' % ', '.join(sorted(missing_columns)))
+
+
+def get_condition_variables(condition):
+    '''Returns the variable names of a numexpr condition. Function names (e.g. abs) and number literals (e.g. 0b0101) are not included.
+    '''
+    return set(re.findall(r'\b[a-zA-Z_]\w*\b(?!\s*\()', condition)) - set(['True', 'False'])
+
+
+def _is_parenthesized(expression):
+    depth = 0
+    for index, char in enumerate(expression):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return index == len(expression) - 1
+        elif depth == 0:
+            return False
+    return False
+
+
+def split_condition(condition):
+    '''Splits a condition into the parenthesized terms joined by & (e.g. '(n_cluster == 1) & ((tot > 5) & (row < 10))' into
+    '(n_cluster == 1)', '(tot > 5)', '(row < 10)'). A condition that is not an & of parenthesized terms is returned as one term,
+    since & binds stronger than comparisons (e.g. 'tot > 5 & row < 10').
+
+    Parameters
+    ----------
+    condition : string
+
+    Returns
+    -------
+    tuple of strings
+    '''
+    condition = condition.strip()
+    terms, depth, start = [], 0, 0
+    for index, char in enumerate(condition):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '&' and depth == 0:
+            terms.append(condition[start:index].strip())
+            start = index + 1
+    terms.append(condition[start:].strip())
+    if not all(_is_parenthesized(term) for term in terms):
+        return (condition,)
+    split_terms = []
+    for term in terms:
+        inner_terms = split_condition(term[1:-1])
+        split_terms.extend(inner_terms if len(inner_terms) > 1 else (term,))
+    return tuple(split_terms)
+
+
+class HitSelection(object):
+    '''Selects hits with several conditions in one pass over the hits. The conditions are parsed once and split into their parenthesized
+    terms joined by & (see split_condition()). The terms used by the same conditions are evaluated together in one numexpr expression
+    once per hit array, e.g. for '(n_cluster == 1) & (cluster_size == 1)' and '(n_cluster == 1) & (cluster_size == 1) & (tot > 5)'
+    the expression '(n_cluster == 1) & (cluster_size == 1)' is evaluated once and '(tot > 5)' for the second condition only.
+    The compiled numexpr expressions are cached by numexpr.
+
+    Parameters
+    ----------
+    conditions : iterable of strings
+        Conditions in numexpr syntax (e.g. '(relative_BCID == 7) & (event_number < 1000)'). None selects all hits.
+    '''
+    def __init__(self, conditions):
+        self.conditions = tuple(conditions)
+        terms = collections.OrderedDict()  # indices of the conditions using the term per term
+        for index, condition in enumerate(self.conditions):
+            if condition is None:
+                continue
+            for term in split_condition(condition):
+                if not _is_parenthesized(term):
+                    term = '(' + term + ')'
+                key = ''.join(term.split())  # equal terms with different white spaces are evaluated once
+                if key not in terms:
+                    terms[key] = (term, [])
+                if index not in terms[key][1]:
+                    terms[key][1].append(index)
+        groups = collections.OrderedDict()  # terms per indices of the conditions using the terms
+        for term, indices in terms.itervalues():
+            groups.setdefault(tuple(indices), []).append(term)
+        self._expressions = []  # expression and variable names per term group
+        self._condition_groups = [None if condition is None else [] for condition in self.conditions]  # term groups per condition
+        for indices, group_terms in groups.iteritems():
+            for index in indices:
+                self._condition_groups[index].append(len(self._expressions))
+            expression = ' & '.join(group_terms)
+            self._expressions.append((expression, tuple(sorted(get_condition_variables(expression)))))
+        self.columns = set(variable for _, variables in self._expressions for variable in variables)
+
+    def get_masks(self, hits):
+        '''Returns the selection of each condition.
+
+        Parameters
+        ----------
+        hits : numpy.array
+
+        Returns
+        -------
+        list of numpy.arrays
+            Boolean array per condition, None for conditions that select all hits.
+        '''
+        check_hit_columns(hits, self.columns)
+        group_masks = [ne.evaluate(expression, local_dict=dict((variable, hits[variable]) for variable in variables)) for expression, variables in self._expressions]
+        return [None if groups is None else reduce(np.logical_and, [group_masks[group] for group in groups]) for groups in self._condition_groups]
+
+    def select(self, hits):
+        '''Returns the selected hits of each condition.
+
+        Parameters
+        ----------
+        hits : numpy.array
+
+        Returns
+        -------
+        list of numpy.arrays
+        '''
+        return [hits if mask is None else hits[mask] for mask in self.get_masks(hits)]
+
+    def get_bitmask(self, hits):
+        '''Returns the selection of all conditions as one bit mask per hit. Bit i is set if condition i selects the hit.
+
+        Parameters
+        ----------
+        hits : numpy.array
+
+        Returns
+        -------
+        numpy.array
+            Unsigned integer array with the smallest data type holding one bit per condition.
+        '''
+        bitmask = np.zeros(hits.shape[0], dtype=get_bitmask_dtype(len(self.conditions)))
+        for index, mask in enumerate(self.get_masks(hits)):
+            if mask is None:
+                bitmask |= bitmask.dtype.type(1 << index)
+            else:
+                bitmask |= mask.astype(bitmask.dtype) << bitmask.dtype.type(index)
+        return bitmask
+
+
+def get_bitmask_dtype(n_conditions):
+    '''Returns the smallest unsigned integer data type with one bit per condition.
+    '''
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_conditions <= np.dtype(dtype).itemsize * 8:
+            return dtype
+    raise NotSupportedError('More than 64 conditions are not supported')
+
+
+def get_bitmask_indices(bitmask, n_conditions):
+    '''Returns the hit index and the condition index of each set bit of a condition bit mask (see HitSelection.get_bitmask()).
+
+    Parameters
+    ----------
+    bitmask : numpy.array
+    n_conditions : int
+
+    Returns
+    -------
+    tuple of numpy.arrays
+        Hit index and condition index, ordered by hit index.
+    '''
+    bits = (bitmask[:, np.newaxis] >> np.arange(n_conditions, dtype=bitmask.dtype)) & bitmask.dtype.type(1)
+    return np.nonzero(bits)
+
+
+class ConditionHistogram(object):
+    '''Histograms of the hits selected by several conditions, e.g. per pixel TDC histograms per hit selection condition. The histograms of
+    all conditions are filled in one pass per hit chunk from the condition bit mask (see HitSelection.get_bitmask()): the bin index of each
+    hit is calculated once and each selected (condition, hit) pair is counted in one flat histogram. Only the filled bins are added, no
+    temporary histogram of the full shape is created per chunk and condition.
+
+    Parameters
+    ----------
+    n_conditions : int
+    shape : tuple
+        Shape of the histogram of one condition.
+    dtype : numpy.dtype
+        Data type of the bin contents.
+    sparse : bool
+        If True, only the non-zero bins are stored (see SparseHistogram). Saves memory for large histograms with few filled bins
+        (e.g. per pixel histograms of a small region), a dense histogram is created per condition on access only.
+    '''
+    def __init__(self, n_conditions, shape, dtype=np.uint32, sparse=False):
+        self.n_conditions = n_conditions
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.sparse = sparse
+        if sparse:
+            self.hist = SparseHistogram(shape=(n_conditions, ) + self.shape, dtype=self.dtype)
+        else:
+            self.hist = np.zeros(shape=(n_conditions, ) + self.shape, dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        return self.hist.nbytes
+
+    def fill(self, bitmask, coordinates, bitmask_indices=None):
+        '''Adds the hits selected by each condition.
+
+        Parameters
+        ----------
+        bitmask : numpy.array
+            Condition bit mask of the hits.
+        coordinates : tuple of arrays
+            Bin index per dimension of each hit.
+        bitmask_indices : tuple of numpy.arrays
+            The result of get_bitmask_indices(bitmask), if already available (e.g. to fill several histograms).
+        '''
+        hit_index, condition_index = get_bitmask_indices(bitmask, self.n_conditions) if bitmask_indices is None else bitmask_indices
+        if hit_index.shape[0] == 0:
+            return
+        bin_size = int(np.prod(self.shape))
+        indices = condition_index * bin_size + np.ravel_multi_index(coordinates, self.shape)[hit_index]
+        if self.sparse:
+            self.hist.fill_indices(indices)
+            return
+        flat_hist = self.hist.reshape(-1)
+        if flat_hist.shape[0] <= 4 * indices.shape[0]:  # small histogram: count all bins
+            flat_hist += np.bincount(indices, minlength=flat_hist.shape[0]).astype(self.dtype)
+        else:  # large histogram: add the filled bins only
+            filled_bins, counts = np.unique(indices, return_counts=True)
+            flat_hist[filled_bins] += counts.astype(self.dtype)
+
+    def __getitem__(self, condition_index):
+        '''Returns the dense histogram of a condition.
+        '''
+        return self.hist[condition_index]
+
+
+_hit_selections = {}  # HitSelection per conditions, the conditions of repeated calls are parsed once
+
+
+def get_hit_selection(conditions):
+    '''Returns the cached HitSelection of the conditions.
+
+    Parameters
+    ----------
+    conditions : iterable of strings
+
+    Returns
+    -------
+    HitSelection
+    '''
+    conditions = tuple(conditions)
+    if conditions not in _hit_selections:
+        if len(_hit_selections) >= 256:
+            _hit_selections.clear()
+        _hit_selections[conditions] = HitSelection(conditions)
+    return _hit_selections[conditions]
+
+
 def select_hits(hits_array, condition=None):
     '''Selects the hits with condition.
-    E.g.: condition = 'rel_BCID == 7 & event_number < 1000'
+    E.g.: condition = '(relative_BCID == 7) & (event_number < 1000)'
+    To select hits with several conditions use HitSelection.
 
     Parameters
     ----------
@@ -763,11 +1231,38 @@ def select_hits(hits_array, condition=None):
     '''
     if condition is None:
         return hits_array
+    return hits_array[get_hit_selection((condition,)).get_masks(hits_array)[0]]
 
-    for variable in set(re.findall(r'[a-zA-Z_]+', condition)):
-        exec(variable + ' = hits_array[\'' + variable + '\']')
 
-    return hits_array[ne.evaluate(condition)]
+def write_selected_hits(hit_table_in, hit_tables_out, conditions, chunk_size=5000000):
+    '''Selects the hits with several conditions in one pass over the hit table and appends the selected hits of each condition
+    to its own table.
+
+    Parameters
+    ----------
+    hit_table_in : pytable.table
+    hit_tables_out : list of pytable.table
+        One table per condition.
+    conditions : list of strings, HitSelection
+        Conditions in numexpr syntax. None selects all hits.
+    chunk_size : int
+        Number of hits read at once.
+
+    Returns
+    -------
+    list of int
+        Number of selected hits per condition.
+    '''
+    hit_selection = conditions if isinstance(conditions, HitSelection) else get_hit_selection(conditions)
+    if len(hit_tables_out) != len(hit_selection.conditions):
+        raise ValueError('One output table per condition needed')
+    n_selected_hits = [0] * len(hit_tables_out)
+    for index in range(0, hit_table_in.nrows, chunk_size):
+        hits = hit_table_in.read(index, index + chunk_size)
+        for condition_index, (hit_table_out, selected_hits) in enumerate(zip(hit_tables_out, hit_selection.select(hits))):
+            hit_table_out.append(selected_hits)
+            n_selected_hits[condition_index] += selected_hits.shape[0]
+    return n_selected_hits
 
 
 def get_hits_in_events(hits_array, events, assume_sorted=True, condition=None):
@@ -803,11 +1298,7 @@ def get_hits_in_events(hits_array, events, assume_sorted=True, condition=None):
         if condition is None:
             hits_in_events = hits_array[selection]
         else:
-            # bad hack to be able to use numexpr
-            for variable in set(re.findall(r'[a-zA-Z_]+', condition)):
-                exec(variable + ' = hits_array[\'' + variable + '\']')
-
-            hits_in_events = hits_array[ne.evaluate(condition + ' & selection')]
+            hits_in_events = hits_array[np.logical_and(selection, get_hit_selection((condition,)).get_masks(hits_array)[0])]
     except MemoryError:
         logging.error('There are too many hits to do in RAM operations. Consider decreasing chunk size and use the write_hits_in_events function instead.')
         raise MemoryError
@@ -859,6 +1350,115 @@ def get_hits_of_scan_parameter(input_file_hits, scan_parameters=None, try_speedu
             best_chunk_size = int(1.5 * readout_hit_len) if int(1.05 * readout_hit_len) < chunk_size and int(1.05 * readout_hit_len) > 1e3 else chunk_size  # to increase the readout speed, estimated the number of hits for one read instruction
 
 
+def get_event_rows(table, event_numbers, chunk_size=10000000):
+    '''Returns the index of the first row with an event number >= event number for each event number. The event number index
+    is used if available, otherwise the event_number column is read in chunks.
+
+    Parameters
+    ----------
+    table : pytables.table
+        Table with a sorted event_number column.
+    event_numbers : array like
+        Sorted event numbers.
+    chunk_size : int
+        Number of event numbers read at once.
+
+    Returns
+    -------
+    numpy.array
+        Row indices, the number of rows for event numbers larger than the last event number.
+    '''
+    event_numbers = np.asarray(event_numbers)
+    event_index = get_event_index(table)
+    if event_index is not None:
+        return np.array([event_index.get_row(event_number) for event_number in event_numbers], dtype=np.int64)
+    rows = np.full(event_numbers.shape[0], table.nrows, dtype=np.int64)
+    found = 0  # event numbers with a row found
+    for start_index in range(0, table.nrows, chunk_size):
+        chunk_rows = np.searchsorted(table.read(start_index, start_index + chunk_size, field='event_number'), event_numbers[found:])
+        n_found = np.count_nonzero(chunk_rows < min(chunk_size, table.nrows - start_index))
+        rows[found:found + n_found] = start_index + chunk_rows[:n_found]
+        found += n_found
+        if found == event_numbers.shape[0]:
+            break
+    return rows
+
+
+def add_results(result_1, result_2):
+    '''Adds two results (e.g. histograms) element wise. Tuples and lists of results are added per item.
+    '''
+    if isinstance(result_1, (tuple, list)):
+        return type(result_1)(add_results(item_1, item_2) for item_1, item_2 in zip(result_1, result_2))
+    return result_1 + result_2
+
+
+def _reduce_hits_in_rows(args):
+    func, combine, input_file_hits, node_name, start_index, stop_index, chunk_size = args
+    result = None
+    if start_index == stop_index:  # no hits
+        return result
+    with tb.open_file(input_file_hits, mode="r") as in_file_h5:
+        hit_table = in_file_h5.get_node(in_file_h5.root, node_name)
+        while start_index < stop_index:  # start and stop index are at event boundaries
+            hits = hit_table.read(start_index, min(start_index + chunk_size, stop_index))
+            if start_index + hits.shape[0] < stop_index:  # do not split the last event of the chunk
+                hits = hits[:np.searchsorted(hits['event_number'], hits['event_number'][-1], side='left')]
+                if hits.shape[0] == 0:
+                    raise InvalidInputError('Chunk size too small to fit event. Increase chunk size to read full event.')
+            chunk_result = func(hits)
+            result = chunk_result if result is None else combine(result, chunk_result)
+            start_index += hits.shape[0]
+    return result
+
+
+def map_hits_of_scan_parameter(func, input_file_hits, scan_parameters=None, combine=add_results, chunk_size=10000000, max_pending=None, node_name='Hits'):
+    '''Parallel version of get_hits_of_scan_parameter(). Applies func to the hits of each unique combination of scan_parameters
+    in the analysis pool (see analysis_pool). The workers read the hits of their scan parameter setting from the file in chunks and
+    combine the results of the chunks. Only the results are transferred to the main process.
+
+    Parameters
+    ----------
+    func : callable
+        Function taking a hit array and returning a result (e.g. histograms). Has to be picklable (module level function or functools.partial of it).
+    input_file_hits : string
+        File name of a hdf5 file with the hit table and the meta_data node
+    scan_parameters : iterable with strings
+    combine : callable
+        Function combining the results of two chunks of the same scan parameter setting. By default the results are added.
+    chunk_size : int
+        How many rows of data are read into ram by each worker.
+    max_pending : int
+        Maximum number of scan parameter settings analyzed or waiting for the main process, limits the memory for the results.
+        If None, two per worker process.
+    node_name : string
+        Name of the hit table, e.g. ClusterHits.
+
+    Returns
+    -------
+    Yields tuple
+        Scan parameter tuple and the result of func, None if there are no hits for the scan parameter tuple. The results are yielded in the order of the scan parameters.
+    '''
+    with tb.open_file(input_file_hits, mode="r") as in_file_h5:
+        hit_table = in_file_h5.get_node(in_file_h5.root, node_name)
+        meta_data = in_file_h5.root.meta_data[:]
+        meta_data_table_at_scan_parameter = get_unique_scan_parameter_combinations(meta_data, scan_parameters=scan_parameters)
+        parameter_values = get_scan_parameters_table_from_meta_data(meta_data_table_at_scan_parameter, scan_parameters)
+        rows = np.append(get_event_rows(hit_table, meta_data_table_at_scan_parameter['event_number'], chunk_size=chunk_size), hit_table.nrows)  # the hits of the scan parameter settings are in [rows[i], rows[i + 1][
+    if max_pending is None:
+        max_pending = 2 * analysis_pool.get_pool_size()
+    pool = analysis_pool.get_pool()
+    pending = collections.deque()
+    for parameter_index in range(parameter_values.shape[0]):
+        if len(pending) >= max_pending:
+            parameter_value, result = pending.popleft()
+            yield parameter_value, result.get()
+        logging.debug('Analyze hits for ' + str(scan_parameters) + ' = ' + str(parameter_values[parameter_index]))
+        pending.append((parameter_values[parameter_index], pool.apply_async(_reduce_hits_in_rows, ((func, combine, input_file_hits, node_name, rows[parameter_index], rows[parameter_index + 1], chunk_size),))))
+    while pending:
+        parameter_value, result = pending.popleft()
+        yield parameter_value, result.get()
+
+
 def get_data_in_event_range(array, event_start=None, event_stop=None, assume_sorted=True):
     '''Selects the data (rows of a table) that occurred in the given event range [event_start, event_stop[
 
@@ -968,13 +1568,9 @@ def write_hits_in_event_range(hit_table_in, hit_table_out, event_start=None, eve
         hits = hit_table_in.read(iHit, iHit + chunk_size)
         last_event_number = hits[-1]['event_number']
         selected_hits = get_data_in_event_range(hits, event_start=event_start, event_stop=event_stop)
-        if condition is not None:
-            # bad hack to be able to use numexpr
-            for variable in set(re.findall(r'[a-zA-Z_]+', condition)):
-                exec(variable + ' = hits[\'' + variable + '\']')
-            selected_hits = selected_hits[ne.evaluate(condition)]
+        selected_hits = select_hits(selected_hits, condition)
         hit_table_out.append(selected_hits)
-        if last_event_number > event_stop:  # speed up, use the fact that the hits are sorted by event_number
+        if event_stop is not None and last_event_number > event_stop:  # speed up, use the fact that the hits are sorted by event_number
             return iHit + chunk_size
     return start_hit_word
 
@@ -1162,7 +1758,8 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     Additional parameters can be set to increase the readout speed. Events between a certain range can be selected.
     Also the start and the stop indices limiting the table size can be specified to improve performance.
     The event_number column must be sorted.
-    In case of try_speedup is True, it is important to create an index of event_number column with pytables before using this function. Otherwise the queries are slowed down.
+    In case of try_speedup is True, the event number index stored with the table is used (see event_index). Otherwise it is important to create an index of event_number column
+    with pytables before using this function (see index_event_number()). Otherwise the queries are slowed down.
 
     Parameters
     ----------
@@ -1180,7 +1777,7 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
         Maximum chunk size per read.
     try_speedup : bool
         If True, try to reduce the index range to read by searching for the indices of start and stop event number. If these event numbers are usually
-        not in the data this speedup can even slow down the function!
+        not in the data this speedup can even slow down the function! With an event number index (see event_index) the search is fast in any case.
 
     The following parameters are not used when try_speedup is True:
 
@@ -1217,7 +1814,20 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
         raise InvalidInputError('Invalid start/stop event number')
 
     # set start stop indices from the event numbers for fast read if possible; not possible if the given event number does not exist in the data stream
-    if try_speedup and table.colindexed["event_number"]:
+    event_index = get_event_index(table) if try_speedup else None
+    if event_index is not None:  # binary search in the event number index
+        if start_event_number is not None:
+            event_start_index, event_stop_index = event_index.get_event_rows(start_event_number)
+            if max(event_start_index, start_index) < min(event_stop_index, stop_index):  # set start index if possible
+                start_index = max(event_start_index, start_index)
+                start_index_known = True
+
+        if stop_event_number is not None:
+            event_start_index, event_stop_index = event_index.get_event_rows(stop_event_number)
+            if max(event_start_index, start_index) < min(event_stop_index, stop_index):  # set the stop index if possible, stop index is excluded
+                stop_index = max(event_start_index, start_index)
+                stop_index_known = True
+    elif try_speedup and table.colindexed["event_number"]:
         if start_event_number is not None:
             start_condition = 'event_number==' + str(start_event_number)
             start_indices = table.get_where_list(start_condition, start=start_index, stop=stop_index)
@@ -1292,16 +1902,17 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
             last_event_in_chunk = array_chunk["event_number"][-1]
 
             chunk_start_index = 0
+            last_chunk = current_stop_index == table_max_rows or (stop_index_known and current_stop_index == stop_index)  # the stop index of the stop event is at an event boundary
 
             if stop_event_number is None:
-                if current_stop_index == table_max_rows:
+                if last_chunk:
                     chunk_stop_index = array_chunk.shape[0]
                 else:
                     chunk_stop_index = np.searchsorted(array_chunk["event_number"], last_event_in_chunk, side='left')
             else:
                 if last_event_in_chunk >= stop_event_number:
                     chunk_stop_index = np.searchsorted(array_chunk["event_number"], stop_event_number, side='left')
-                elif current_stop_index == table_max_rows:  # this will also add the last event of the table
+                elif last_chunk:  # this will also add the last event of the table
                     chunk_stop_index = array_chunk.shape[0]
                 else:
                     chunk_stop_index = np.searchsorted(array_chunk["event_number"], last_event_in_chunk, side='left')
@@ -1428,6 +2039,81 @@ def get_pixel_thresholds_from_calibration_array(gdacs, calibration_gdacs, thresh
     return interpolation(gdacs)
 
 
+def get_charge_calibration(tdc_calibration_values, tdc_pixel_calibration, max_tdc, min_calibration_points=1, n_pixel_per_chunk=4096):
+    '''Calculates the charge (PlsrDAC) for all TDC values from 0 to max_tdc of all pixels via linear interpolation of the TDC calibration.
+    All pixels are interpolated at once in chunks of pixels. Outside of the calibrated TDC range of a pixel the charge is 0.
+    If the analysis cache is enabled (see analysis_cache.set_cache()) the result is cached.
+
+    Parameters
+    ----------
+    tdc_calibration_values : array like
+        The PlsrDAC settings used during calibration.
+    tdc_pixel_calibration : numpy.array, shape=(80,336,# of PlsrDACs during calibration)
+        The mean TDC value for each pixel and PlsrDAC setting. NaN for missing calibration points.
+    max_tdc : int
+        The number of TDC values.
+    min_calibration_points : int
+        Pixels with less finite or less non-zero calibration points have no charge calibration (charge 0).
+    n_pixel_per_chunk : int
+        Pixels interpolated at once. Limits the memory usage.
+
+    Returns
+    -------
+    numpy.array, shape=(80,336,max_tdc)
+        The charge in PlsrDAC for each pixel and TDC value.
+    '''
+    tdc_calibration_values = np.asarray(tdc_calibration_values, dtype=np.float64)
+    tdc_pixel_calibration = np.asarray(tdc_pixel_calibration, dtype=np.float64)
+    cache = analysis_cache.get_cache()
+    if cache is not None:
+        cache_key = analysis_cache.get_array_key('charge_calibration', tdc_calibration_values, tdc_pixel_calibration, max_tdc, min_calibration_points)
+        charge_calibration = cache.get_array(cache_key)
+        if charge_calibration is not None:
+            return charge_calibration
+    if tdc_calibration_values.shape[0] != tdc_pixel_calibration.shape[-1]:
+        raise ValueError('Length of the provided PlsrDAC values does not match the last dimension of the calibration array')
+    pixel_calibration = tdc_pixel_calibration.reshape(-1, tdc_pixel_calibration.shape[-1])
+    charge_calibration = np.zeros(shape=(pixel_calibration.shape[0], max_tdc))
+    tdc = np.arange(max_tdc, dtype=np.float64)
+    for start_pixel in range(0, pixel_calibration.shape[0], n_pixel_per_chunk):
+        calibration = pixel_calibration[start_pixel:start_pixel + n_pixel_per_chunk]
+        n_points = np.count_nonzero(np.isfinite(calibration), axis=1)
+        calibrated_pixel = np.where(np.logical_and(n_points >= min_calibration_points, np.count_nonzero(calibration != 0, axis=1) >= min_calibration_points))[0]
+        if calibrated_pixel.shape[0] == 0:
+            continue
+        calibration, n_points = calibration[calibrated_pixel], n_points[calibrated_pixel]
+        order = np.argsort(calibration, axis=1)  # NaNs are sorted to the end
+        x = np.take_along_axis(calibration, order, axis=1)
+        y = tdc_calibration_values[order]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = np.diff(y, axis=1) / np.diff(x, axis=1)
+        slope = np.column_stack((np.where(np.isfinite(slope), slope, 0), np.zeros(x.shape[0])))  # the slope after the last calibration point is not used
+        # Number of calibration points <= TDC value for all TDC values: the points are counted at the first TDC value >= the point (NaNs after the
+        # last TDC value) and summed up. The index of the point left of each TDC value follows without a search per pixel.
+        pixel_index = np.arange(x.shape[0])[:, np.newaxis]
+        position = np.ceil(np.clip(np.where(np.isfinite(x), x, max_tdc), -1, max_tdc)).astype(np.int64) + 1
+        n_points_below = np.bincount((pixel_index * (max_tdc + 2) + position).ravel(), minlength=x.shape[0] * (max_tdc + 2)).reshape(x.shape[0], max_tdc + 2)
+        index = np.cumsum(n_points_below, axis=1)[:, 1:max_tdc + 1]
+        left = (pixel_index * x.shape[1] + np.clip(index - 1, 0, x.shape[1] - 1)).ravel()
+        x_left = x.ravel().take(left).reshape(index.shape)
+        charge = y.ravel().take(left).reshape(index.shape) + (tdc - x_left) * slope.ravel().take(left).reshape(index.shape)
+        charge[np.logical_or(index == 0, np.logical_and(index >= n_points[:, np.newaxis], tdc != x_left))] = 0  # outside of the calibrated range, the last calibration point is included
+        charge_calibration[start_pixel + calibrated_pixel] = charge
+    charge_calibration = charge_calibration.reshape(tdc_pixel_calibration.shape[:-1] + (max_tdc, ))
+    if cache is not None:
+        cache.put_array(cache_key, charge_calibration)
+    return charge_calibration
+
+
+def get_charge_calibration_from_file(calibration_file, max_tdc, min_calibration_points=1):
+    '''Returns the charge calibration (see get_charge_calibration()) of the hit or calibration file.
+    '''
+    with tb.open_file(calibration_file, mode="r") as in_file_calibration_h5:
+        tdc_pixel_calibration = in_file_calibration_h5.root.HitOrCalibration[:, :, :, 1]
+        tdc_calibration_values = in_file_calibration_h5.root.HitOrCalibration.attrs.scan_parameter_values[:]
+    return get_charge_calibration(tdc_calibration_values, tdc_pixel_calibration, max_tdc, min_calibration_points=min_calibration_points)
+
+
 class ETA(progressbar.Timer):
     '''Progressbar widget which estimate the time of arrival for the progress bar via exponential moving average.
     '''
@@ -1489,7 +2175,7 @@ def get_data_statistics(interpreted_files):
     print '| *File Name* | *File Size* | *Times Stamp* | *Events* | *Bad Events* | *Measurement time* | *# SR* | *Hits* |'  # Mean Tot | Mean rel. BCID'
     for interpreted_file in interpreted_files:
         with tb.open_file(interpreted_file, mode="r") as in_file_h5:  # open the actual hit file
-            n_hits = np.sum(in_file_h5.root.HistOcc[:])
+            n_hits = np.sum(get_histogram(in_file_h5, 'HistOcc')[:])
             measurement_time = int(in_file_h5.root.meta_data[-1]['timestamp_stop'] - in_file_h5.root.meta_data[0]['timestamp_start'])
 #             mean_tot = np.average(in_file_h5.root.HistTot[:], weights=range(0,16) * np.sum(range(0,16)))# / in_file_h5.root.HistTot[:].shape[0]
 #             mean_bcid = np.average(in_file_h5.root.HistRelBcid[:], weights=range(0,16))
@@ -4,7 +4,8 @@ from __future__ import division
 import logging
 import warnings
 import os
-import multiprocessing as mp
+import sys
+import time
 from functools import partial
 
 from matplotlib.backends.backend_pdf import PdfPages
@@ -24,7 +25,15 @@ from pybar_fei4_interpreter import data_struct
 from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 
 from pybar.analysis import analysis_utils
-from pybar.analysis.plotting import plotting
+from pybar.analysis import analysis_pool
+from pybar.analysis import analysis_cache
+from pybar.analysis.sparse_histogram import SparseHistogram, get_histogram
+from pybar.analysis.table_layout import TunedTable
+from pybar.analysis.adaptive_chunk_size import AdaptiveChunkSize
+from pybar.analysis.stage_profiler import StageProfiler
+from pybar.analysis.event_index import EventIndexedTable, EventIndexWriter, get_event_index, create_event_index
+from pybar.analysis.plotting import plot_registry
+from pybar.analysis.plotting.pdf_report import PdfReport
 from pybar.analysis.analysis_utils import check_bad_data, fix_raw_data, consecutive
 from pybar.daq.readout_utils import is_fe_word, is_data_header, is_trigger_word, logical_and
 
@@ -52,11 +61,89 @@ def fit_scurve(scurve_data, PlsrDAC):  # data of some pixels to fit, has to be g
     return popt[1:3]
 
 
+def _scurve_function(x, p):
+    return scurve(x, p[:, 0:1], p[:, 1:2], p[:, 2:3])
+
+
+def _scurve_jacobian(x, p):  # derivatives of the S-curve by A, mu and sigma
+    z = (x - p[:, 1:2]) / (np.sqrt(2) * p[:, 2:3])
+    jacobian = np.empty(z.shape + (3, ), dtype=np.float64)
+    jacobian[..., 0] = 0.5 * erf(z) + 0.5
+    jacobian[..., 1] = -p[:, 0:1] * np.exp(-z ** 2) / (np.sqrt(2 * np.pi) * p[:, 2:3])
+    jacobian[..., 2] = jacobian[..., 1] * np.sqrt(2) * z
+    return jacobian
+
+
+def fit_scurves(scurve_data, PlsrDAC, threshold=None, noise=None, max_iterations=100, tolerance=1e-6):
+    '''Fitting the S-curves of all pixels at once with a batched Levenberg-Marquardt minimization (see analysis_utils.fit_levenberg_marquardt()).
+
+    Parameters
+    ----------
+    scurve_data : array_like, shape=(n_pixel, n_scan_parameter)
+        The occupancy of each pixel for each PlsrDAC setting.
+    PlsrDAC : array_like, shape=(n_scan_parameter, )
+        The increasing PlsrDAC values.
+    threshold, noise : array_like, shape=(n_pixel, ), None
+        Start values of the fit (e.g. from the fast threshold algorithm). If None, the start values are calculated from the data.
+    max_iterations : int
+        Maximum number of Levenberg-Marquardt steps.
+    tolerance : float
+        Relative change of the sum of squared residuals below which a fit is considered converged.
+
+    Returns
+    -------
+    numpy.array, shape=(n_pixel, 2)
+        Threshold and noise of each pixel. Pixels without data or failed fits are 0.
+    '''
+    scurve_data = np.asarray(scurve_data, dtype=np.float64)
+    x = np.asarray(PlsrDAC, dtype=np.float64)
+    n_pixel = scurve_data.shape[0]
+    if x.shape[0] < 3:
+        raise analysis_utils.NotSupportedError('Less than 3 points found for S-curve fit.')
+    result = np.zeros((n_pixel, 2), dtype=np.float64)
+
+    # start values, same as in fit_scurve()
+    index = np.argmax(np.diff(scurve_data, axis=1), axis=1)
+    max_occ = np.ma.median(np.ma.array(scurve_data, mask=np.arange(x.shape[0])[np.newaxis, :] < index[:, np.newaxis]), axis=1).filled(0.0)
+    with_data = np.abs(max_occ) > 1e-08
+    mu_start = x[index] if threshold is None else np.asarray(threshold, dtype=np.float64).ravel()
+    sigma_start = np.full(n_pixel, 2.5) if noise is None else np.asarray(noise, dtype=np.float64).ravel()
+    sigma_start = np.where(sigma_start > 0, sigma_start, 2.5)  # the fast algorithm returns 0 noise for pixels without data
+
+    active = np.where(with_data)[0]
+    params, converged = analysis_utils.fit_levenberg_marquardt(_scurve_function, _scurve_jacobian, x, scurve_data[active], np.column_stack((max_occ[active], mu_start[active], sigma_start[active])), max_iterations=max_iterations, ftol=tolerance, max_damping=1e10)
+
+    valid = converged & np.all(np.isfinite(params), axis=1) & (params[:, 2] > 0)
+    result[active[valid]] = params[valid, 1:3]
+    result[result[:, 0] < 0] = 0  # threshold < 0 rarely happens if fit does not work
+    failed = active[~valid]
+    if failed.shape[0]:
+        logging.info('S-curve fit: %d pixel(s) did not converge, use single pixel fit', failed.shape[0])
+        for pixel_index in failed:
+            result[pixel_index] = fit_scurve(scurve_data[pixel_index], x)
+    return result
+
+
+class Checkpoint(tb.IsDescription):
+    raw_data_file = tb.StringCol(1024, pos=0)  # file name of the raw data file where the interpretation stopped
+    word_index = tb.UInt64Col(pos=1)  # raw data word index in the raw data file of the first not interpreted event
+    event_number = tb.Int64Col(pos=2)  # event number of the first not interpreted event
+    n_readouts = tb.UInt64Col(pos=3)  # number of readouts (meta data rows) with known event number
+    n_words = tb.UInt64Col(pos=4)  # number of interpreted raw data words of all raw data files
+
+
+_resume_node_names = ('HistOcc', 'HistTot', 'HistTotPixel', 'HistTdc', 'HistTdcPixel', 'HistRelBcid', 'HistServiceRecord', 'HistTdcCounter', 'HistErrorCounter', 'HistTriggerErrorCounter', 'HistClusterSize', 'HistClusterTot', 'meta_data')  # nodes created again by a resumed interpretation
+
+
+def _get_resume_backup_name(node_name):
+    return node_name + '_before_resume'
+
+
 class AnalyzeRawData(object):
 
     """A class to analyze FE-I4 raw data"""
 
-    def __init__(self, raw_data_file=None, analyzed_data_file=None, create_pdf=True, scan_parameter_name=None):
+    def __init__(self, raw_data_file=None, analyzed_data_file=None, create_pdf=True, scan_parameter_name=None, resume=False):
         '''Initialize the AnalyzeRawData object:
             - The c++ objects (Interpreter, Histogrammer, Clusterizer) are constructed
             - Create one scan parameter table from all provided raw data files
@@ -77,6 +164,9 @@ class AnalyzeRawData(object):
         scan_parameter_name : string or iterable
             The name/names of scan parameter(s) to be used during analysis. If None, the scan parameter
             table is used to extract the scan parameters. Otherwise no scan parameter is set.
+        resume : boolean
+            If True and the analyzed_data_file contains a checkpoint (see create_checkpoint), the analyzed_data_file is not overwritten
+            and the interpretation continues at the checkpoint. Only the raw data recorded after the checkpoint is interpreted.
         '''
         self.interpreter = PyDataInterpreter()
         self.histogram = PyDataHistograming()
@@ -146,8 +236,15 @@ class AnalyzeRawData(object):
                 # assume that output file already exists containing analyzed raw data
                 self.out_file_h5 = tb.open_file(self._analyzed_data_file, mode="a", title="Interpreted FE-I4 raw data")
             else:
-                # raw data files are given, overwrite any existing file
-                self.out_file_h5 = tb.open_file(self._analyzed_data_file, mode="w", title="Interpreted FE-I4 raw data")
+                if resume and os.path.isfile(self._analyzed_data_file):
+                    self.out_file_h5 = tb.open_file(self._analyzed_data_file, mode="a", title="Interpreted FE-I4 raw data")
+                    if '/Checkpoint' not in self.out_file_h5:
+                        logging.warning('No checkpoint found in %s, interpreting all raw data', self._analyzed_data_file)
+                        self.out_file_h5.close()
+                        self.out_file_h5 = None
+                if not self.is_open(self.out_file_h5):
+                    # raw data files are given, overwrite any existing file
+                    self.out_file_h5 = tb.open_file(self._analyzed_data_file, mode="w", title="Interpreted FE-I4 raw data")
 
         if raw_data_file is not None and create_pdf:
             if isinstance(raw_data_file, basestring):
@@ -160,6 +257,11 @@ class AnalyzeRawData(object):
         else:
             self.output_pdf = None
         self._scan_parameter_name = scan_parameter_name
+        self._resume = resume
+        self._first_readout_index = 0  # first readout of a resumed interpretation
+        self._previous_meta_event_index = None  # event numbers of the readouts before the checkpoint
+        self._previous_hists = {}  # histograms of the interpretation before the checkpoint
+        self._resume_state = None  # nodes of the analyzed data file before the checkpoint, to restore them if the resumed interpretation fails
         self._settings_from_file_set = False  # the scan settings are in a list of files only in the first one, thus set this flag to suppress warning for other files
 
     def __enter__(self):
@@ -279,6 +381,7 @@ class AnalyzeRawData(object):
         self.meta_event_index = None
         self.fei4b = False
         self.create_hit_table = False
+        self.hit_table_profile = 'full'  # columns of the hit table: profile name (see analysis_utils.hit_table_profiles) or column names
         self.create_empty_event_hits = False
         self.create_meta_event_index = True
         self.create_tot_hist = True
@@ -310,6 +413,57 @@ class AnalyzeRawData(object):
         self.max_tdc_delay = 255
         self.max_trigger_number = 2 ** 16 - 1
         self.set_stop_mode = False  # The FE is read out with stop mode, therefore the BCID plot is different
+        self.use_sparse_hists = False  # store the occupancy, ToT and TDC pixel histograms (per scan parameter) sparse, only the non-zero bins are stored
+        self.create_checkpoint = False  # store a checkpoint to be able to resume the interpretation when more raw data is available
+        self.create_event_index = False  # store the event number index of the hit and cluster tables, see event_index
+        self.memory_budget = None  # memory in bytes for the data of one raw data chunk, if set the chunk size is adapted to the data, see adaptive_chunk_size
+        self.profiler = StageProfiler(enabled=False)  # time and memory per analysis stage, enable with profiler.enabled = True, stored in the Profile table, see stage_profiler
+        self.tune_table_layout = True  # chunk shape and compression level of the output tables from the estimated size and the first data, see table_layout
+        self.cluster_processes = 0  # number of processes clustering the hits in parallel to the raw data interpretation, 0: cluster in the interpretation process
+        self.plot_processes = 1  # number of processes rendering the plots of plot_histograms(), None: number of analysis pool processes, 1: render in the analysis process (default), see pdf_report
+        self.rasterize_plots = False  # rasterize dense 2D maps and scatter plots in the PDF file, see pdf_report
+        self.analysis_cache = analysis_cache.get_cache()  # reuse the interpreted data of previous interpretations with the same raw data and settings
+
+    def get_settings(self):
+        '''Returns the interpretation, histogramming and clustering settings. Used as key for the analysis cache.
+        '''
+        settings = dict((name, getattr(self, name)) for name, value in vars(AnalyzeRawData).iteritems() if isinstance(value, property) and value.fset is not None)
+        for name in ('vcal_c0', 'vcal_c1', 'c_low', 'c_mid', 'c_high', 'c_low_mask', 'c_high_mask'):
+            settings[name] = getattr(self, name)
+        return settings
+
+    def set_settings(self, settings):
+        '''Sets the interpretation, histogramming and clustering settings.
+
+        Parameters
+        ----------
+        settings : dict
+            Setting names and values, e.g. from get_settings().
+        '''
+        for name, value in settings.iteritems():
+            if not hasattr(self, name):
+                raise ValueError('Unknown setting: %s' % name)
+            setattr(self, name, value)
+
+    def get_cache_key(self, raw_data_files=None, use_settings_from_file=True, fei4b=None):
+        '''Returns the analysis cache key of the interpretation of the raw data file(s) with the current settings.
+
+        Parameters
+        ----------
+        raw_data_files : iterable of strings
+            The raw data file(s). If None, the raw data file(s) specified during initialization are taken.
+        use_settings_from_file : boolean
+            See interpret_word_table().
+        fei4b : boolean
+            See interpret_word_table().
+
+        Returns
+        -------
+        string
+        '''
+        if raw_data_files is None:
+            raw_data_files = self.files_dict.keys()
+        return analysis_cache.get_cache_key(raw_data_files, dict(self.get_settings(), use_settings_from_file=use_settings_from_file, fei4b_parameter=fei4b, scan_parameter_name=self._scan_parameter_name))
 
     def reset(self):
         '''Reset the c++ libraries for new analysis.
@@ -334,6 +488,15 @@ class AnalyzeRawData(object):
     def create_hit_table(self, value):
         self._create_hit_table = value
 
+    @property
+    def hit_table_profile(self):
+        return self._hit_table_profile
+
+    @hit_table_profile.setter
+    def hit_table_profile(self, value):
+        self._hit_table_columns = analysis_utils.get_hit_table_columns(value)
+        self._hit_table_profile = value
+
     @property
     def create_empty_event_hits(self):
         return self._create_empty_event_hits
@@ -371,7 +534,7 @@ class AnalyzeRawData(object):
 
     @property
     def create_tot_hist(self):
-        return self.create_tot_hist
+        return self._create_tot_hist
 
     @create_tot_hist.setter
     def create_tot_hist(self, value):
@@ -614,6 +777,14 @@ class AnalyzeRawData(object):
         self._use_tdc_trigger_time_stamp = value
         self.interpreter.use_tdc_trigger_time_stamp(value)
 
+    @property
+    def use_sparse_hists(self):
+        return self._use_sparse_hists
+
+    @use_sparse_hists.setter
+    def use_sparse_hists(self, value):
+        self._use_sparse_hists = value
+
     @property
     def max_tdc_delay(self):
         return self._max_tdc_delay
@@ -640,6 +811,22 @@ class AnalyzeRawData(object):
     def set_stop_mode(self, value):
         self._set_stop_mode = value
 
+    @property
+    def create_checkpoint(self):
+        return self._create_checkpoint
+
+    @create_checkpoint.setter
+    def create_checkpoint(self, value):
+        self._create_checkpoint = value
+
+    @property
+    def create_event_index(self):
+        return self._create_event_index
+
+    @create_event_index.setter
+    def create_event_index(self, value):
+        self._create_event_index = value
+
     def interpret_word_table(self, analyzed_data_file=None, use_settings_from_file=True, fei4b=None):
         '''Interprets the raw data word table of all given raw data files with the c++ library.
         Creates the h5 output file and PDF plots.
@@ -654,12 +841,33 @@ class AnalyzeRawData(object):
         fei4b : boolean
             True if the raw data is from FE-I4B.
         '''
-
+        self._resume_state = None
+        try:
+            self._interpret_word_table(analyzed_data_file=analyzed_data_file, use_settings_from_file=use_settings_from_file, fei4b=fei4b)
+        except BaseException:
+            exc_info = sys.exc_info()
+            if self._resume_state is not None:  # keep the interpretation before the checkpoint
+                try:
+                    self._restore_resume()
+                except Exception:
+                    logging.exception('Cannot restore the interpretation before the checkpoint')
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _interpret_word_table(self, analyzed_data_file, use_settings_from_file, fei4b):
         logging.info('Interpreting raw data file(s): ' + (', ').join(self.files_dict.keys()))
+        self.profiler.reset()
+
+        checkpoint = self._get_checkpoint(analyzed_data_file)
+        if checkpoint is not None or self._create_checkpoint:
+            if self._create_threshold_hists or self._create_fitted_threshold_hists or self._create_mean_tot_hist:
+                raise analysis_utils.NotSupportedError('Threshold and mean ToT histograms cannot be created by a resumable interpretation.')
+            if self._correct_corrupted_data:
+                raise analysis_utils.NotSupportedError('Correction of corrupted data is not supported by a resumable interpretation.')
 
-        if self._create_meta_word_index:
+        if self._create_meta_word_index or self._create_checkpoint:
             meta_word = np.empty((self._chunk_size,), dtype=dtype_from_descr(data_struct.MetaInfoWordTable))
             self.interpreter.set_meta_data_word_index(meta_word)
+            self.interpreter.create_meta_data_word_index(True)  # the checkpoint is set after the last complete event
         self.interpreter.reset_event_variables()
         self.interpreter.reset_counters()
 
@@ -668,10 +876,42 @@ class AnalyzeRawData(object):
         if self.meta_data is None or self.meta_data.shape[0] == 0:
             raise analysis_utils.IncompleteInputError('Meta data is empty. Stopping interpretation.')
 
-        self.interpreter.set_meta_data(self.meta_data)  # tell interpreter the word index per readout to be able to calculate the event number per read out
+        raw_data_files = self.files_dict.keys()
+        index_start_name, index_stop_name, length_name = ('index_start', 'index_stop', 'data_length') if self.interpreter.meta_table_v2 else ('start_index', 'stop_index', 'length')
+        first_file_index, first_word_index, first_readout_index = 0, 0, 0  # first raw data file, raw data word and readout to interpret
+        event_number_offset, word_index_offset = 0, 0  # event number and total raw data word index of the first interpreted event
+        if checkpoint is not None or self._create_checkpoint:
+            readouts_per_file = []
+            for raw_data_file in raw_data_files:
+                with tb.open_file(raw_data_file, mode="r") as in_file_h5:
+                    readouts_per_file.append(in_file_h5.root.meta_data.shape[0])
+            first_readout_per_file = np.r_[0, np.cumsum(readouts_per_file)[:-1]]
+        if checkpoint is not None:
+            raw_data_file_names = [os.path.basename(raw_data_file) for raw_data_file in raw_data_files]
+            if checkpoint['raw_data_file'] not in raw_data_file_names:
+                raise analysis_utils.IncompleteInputError('Raw data file %s of the checkpoint is missing' % checkpoint['raw_data_file'])
+            first_file_index = raw_data_file_names.index(checkpoint['raw_data_file'])
+            if checkpoint['n_readouts'] > self.meta_data.shape[0]:
+                raise analysis_utils.InvalidInputError('Checkpoint does not match the raw data file(s)')
+            first_word_index = int(checkpoint['word_index'])
+            event_number_offset, word_index_offset = int(checkpoint['event_number']), int(checkpoint['n_words'])
+            file_meta_data = self.meta_data[first_readout_per_file[first_file_index]:first_readout_per_file[first_file_index] + readouts_per_file[first_file_index]]
+            first_readout_index = first_readout_per_file[first_file_index] + np.searchsorted(file_meta_data[index_stop_name], first_word_index, side='right')  # readout with the first not interpreted word
+            logging.info('Resume interpretation at event %d (raw data file %s, word index %d)', event_number_offset, checkpoint['raw_data_file'], first_word_index)
+            self._prepare_resume(checkpoint)
+
+        meta_data = self.meta_data[first_readout_index:]
+        if first_word_index:  # the word indices of the readouts of the first raw data file are relative to the first interpreted word
+            meta_data = meta_data.copy()
+            n_shifted_readouts = first_readout_per_file[first_file_index] + readouts_per_file[first_file_index] - first_readout_index
+            index_start = meta_data[index_start_name][:n_shifted_readouts]
+            meta_data[index_start_name][:n_shifted_readouts] = np.where(index_start > first_word_index, index_start - first_word_index, 0)
+            meta_data[index_stop_name][:n_shifted_readouts] -= first_word_index
+            meta_data[length_name][:n_shifted_readouts] = meta_data[index_stop_name][:n_shifted_readouts] - meta_data[index_start_name][:n_shifted_readouts]
+        self.interpreter.set_meta_data(meta_data)  # tell interpreter the word index per readout to be able to calculate the event number per read out
         meta_data_size = self.meta_data.shape[0]
         self.meta_event_index = np.zeros((meta_data_size,), dtype=[('metaEventIndex', np.uint64)])  # this array is filled by the interpreter and holds the event number per read out
-        self.interpreter.set_meta_event_data(self.meta_event_index)  # tell the interpreter the data container to write the meta event index to
+        self.interpreter.set_meta_event_data(self.meta_event_index[first_readout_index:])  # tell the interpreter the data container to write the meta event index to
 
         if self.scan_parameters is None:
             self.histogram.set_no_scan_parameter()
@@ -711,30 +951,53 @@ class AnalyzeRawData(object):
         else:
             self._analyzed_data_file is None
 
+        cache_key = None
+        if self.analysis_cache is not None and self._analyzed_data_file is not None and checkpoint is None and not self._create_checkpoint:
+            cache_key = self.get_cache_key(raw_data_files, use_settings_from_file=use_settings_from_file, fei4b=fei4b)
+            if self.analysis_cache.get(cache_key, self.out_file_h5):
+                self._read_cached_hists()
+                self._close_analyzed_data_file(out_file_h5, close_analyzed_data_file)
+                return
+
+        n_words_estimate = analysis_utils.get_total_n_data_words(self.files_dict)  # upper limit of the number of rows of the output tables
+        chunk_size_controller = self._get_chunk_size_controller(meta_word.itemsize if self._create_meta_word_index or self._create_checkpoint else 0)
+        table_chunk_size = self._chunk_size if chunk_size_controller is None else chunk_size_controller.chunk_size  # size of the first raw data chunk, sets the chunk shape of the hit and meta word tables
+        hit_table, meta_word_index_table, cluster_table, cluster_hit_table = None, None, None, None
         if self._analyzed_data_file is not None:
+            resume = checkpoint is not None  # append to the tables of the previous interpretation
             if self._create_hit_table is True:
-                description = data_struct.HitInfoTable().columns.copy()
-                hit_table = self.out_file_h5.create_table(self.out_file_h5.root, name='Hits', description=description, title='hit_data', filters=self._filter_table, chunkshape=(self._chunk_size / 100,))
+                if self._hit_table_columns is None:
+                    description = data_struct.HitInfoTable().columns.copy()
+                else:
+                    description = analysis_utils.get_hit_dtype(self._hit_table_columns)
+                hit_table = self._create_table('Hits', resume, expected_rows=n_words_estimate, event_index=True, description=description, title='hit_data', filters=self._filter_table, chunkshape=(max(1, table_chunk_size // 100),))
             if self._create_meta_word_index is True:
-                meta_word_index_table = self.out_file_h5.create_table(self.out_file_h5.root, name='EventMetaData', description=data_struct.MetaInfoWordTable, title='event_meta_data', filters=self._filter_table, chunkshape=(self._chunk_size / 10,))
+                meta_word_index_table = self._create_table('EventMetaData', resume, expected_rows=n_words_estimate, description=data_struct.MetaInfoWordTable, title='event_meta_data', filters=self._filter_table, chunkshape=(max(1, table_chunk_size // 10),))
             if self._create_cluster_table:
-                cluster_table = self.out_file_h5.create_table(self.out_file_h5.root, name='Cluster', description=data_struct.ClusterInfoTable, title='Cluster data', filters=self._filter_table, expectedrows=self._chunk_size)
+                cluster_table = self._create_table('Cluster', resume, expected_rows=n_words_estimate, event_index=True, description=data_struct.ClusterInfoTable, title='Cluster data', filters=self._filter_table, expectedrows=self._chunk_size)
             if self._create_cluster_hit_table:
                 description = data_struct.ClusterHitInfoTable().columns.copy()
-                cluster_hit_table = self.out_file_h5.create_table(self.out_file_h5.root, name='ClusterHits', description=description, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
+                cluster_hit_table = self._create_table('ClusterHits', resume, expected_rows=n_words_estimate, event_index=True, description=description, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
 
         logging.info("Interpreting raw data...")
-        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=analysis_utils.get_total_n_data_words(self.files_dict), term_width=80)
+        progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=n_words_estimate, term_width=80)
         progress_bar.start()
         total_words = 0
+        n_hits, interpretation_time, clustering_time = 0, 0.0, 0.0  # for the throughput of the interpretation and clustering stage
+        cluster_pipeline = None
+        file_word_offsets = []  # file index, first interpreted word index and number of previously interpreted words for each raw data file
+        last_event_meta_word = None  # raw data word index of the last complete event
+        hit_array_chunk_size = self._chunk_size  # size of the hit array of the interpreter
 
-        for file_index, raw_data_file in enumerate(self.files_dict.keys()):  # loop over all raw data files
+        for file_index, raw_data_file in enumerate(raw_data_files):  # loop over all raw data files
             self.interpreter.reset_meta_data_counter()
             with tb.open_file(raw_data_file, mode="r") as in_file_h5:
                 if use_settings_from_file:
                     self._deduce_settings_from_file(in_file_h5)
                 else:
                     self.fei4b = fei4b
+                if file_index < first_file_index:  # already interpreted before the checkpoint
+                    continue
                 if self.interpreter.meta_table_v2:
                     index_start = in_file_h5.root.meta_data.read(field='index_start')
                     index_stop = in_file_h5.root.meta_data.read(field='index_stop')
@@ -745,6 +1008,7 @@ class AnalyzeRawData(object):
 
                 # Check for bad data
                 if self._correct_corrupted_data:
+                    check_stage = self.profiler.start('check_corrupted_data')
                     tw = 2147483648  # trigger word
                     dh = 15269888  # data header
                     is_fe_data_header = logical_and(is_fe_word, is_data_header)
@@ -842,75 +1106,211 @@ class AnalyzeRawData(object):
                                 prepend_data_headers = current_prepend_data_headers
 
                     consecutive_bad_words_list = consecutive(sorted(bad_word_index))
+                    self.profiler.stop(check_stage)
 
                 lsb_byte = None
+                start_word_index = first_word_index if file_index == first_file_index else 0
+                n_file_words = in_file_h5.root.raw_data.shape[0]
+                file_word_offsets.append((file_index, start_word_index, total_words))
                 # Loop over raw data in chunks
-                for word_index in range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size):  # loop over all words in the actual raw data file
+                next_word_index = start_word_index
+                while next_word_index < n_file_words:  # loop over all words in the actual raw data file
+                    word_index = next_word_index
+                    chunk_size = self._chunk_size if chunk_size_controller is None else chunk_size_controller.chunk_size
+                    next_word_index = word_index + chunk_size
+                    if chunk_size != hit_array_chunk_size:
+                        self.interpreter.set_hit_array_size(2 * chunk_size)  # worst case: one raw data word becoming 2 hit words
+                        hit_array_chunk_size = chunk_size
+                        if (self._create_meta_word_index or self._create_checkpoint) and meta_word.shape[0] < chunk_size:
+                            meta_word = np.empty((chunk_size,), dtype=meta_word.dtype)
+                            self.interpreter.set_meta_data_word_index(meta_word)
+                    chunk_start_time, chunk_n_hits, chunk_n_clusters = time.time(), n_hits, 0
+                    self.profiler.next_chunk()
+                    read_stage = self.profiler.start('read_raw_data')
                     try:
-                        raw_data = in_file_h5.root.raw_data.read(word_index, word_index + self._chunk_size)
+                        raw_data = in_file_h5.root.raw_data.read(word_index, next_word_index)
                     except OverflowError, e:
                         logging.error('%s: 2^31 xrange() limitation in 32-bit Python', e)
                     except tb.exceptions.HDF5ExtError:
                         logging.warning('Raw data file %s has missing raw data. Continue raw data analysis.', in_file_h5.filename)
                         break
+                    read_stage.n_bytes = raw_data.nbytes
+                    self.profiler.stop(read_stage)
                     total_words += raw_data.shape[0]
                     # fix bad data
                     if self._correct_corrupted_data:
-                        # increase word shift for every bad data chunk in raw data chunk
-                        word_shift = 0
-                        chunk_indices = np.arange(word_index, word_index + self._chunk_size)
-                        for consecutive_bad_word_indices in consecutive_bad_words_list:
-                            selected_words = np.intersect1d(consecutive_bad_word_indices, chunk_indices, assume_unique=True)
-                            if selected_words.shape[0]:
-                                fixed_raw_data, lsb_byte = fix_raw_data(raw_data[selected_words - word_index - word_shift], lsb_byte=lsb_byte)
-                                raw_data = np.r_[raw_data[:selected_words[0] - word_index - word_shift], fixed_raw_data, raw_data[selected_words[-1] - word_index + 1 - word_shift:]]
-                                # check if last word of bad data chunk in current raw data chunk
-                                if consecutive_bad_word_indices[-1] in selected_words:
-                                    lsb_byte = None
-                                    # word shift by removing data word at the beginning of each defect chunk
-                                    word_shift += 1
-                                # bad data chunk is at the end of current raw data chunk
-                                else:
-                                    break
-
-                    self.interpreter.interpret_raw_data(raw_data)  # interpret the raw data
-                    # store remaining buffered event in the interpreter at the end of the last file
-                    if file_index == len(self.files_dict.keys()) - 1 and word_index == range(0, in_file_h5.root.raw_data.shape[0], self._chunk_size)[-1]:  # store hits of the latest event of the last file
-                        self.interpreter.store_event()
-                    hits = self.interpreter.get_hits()
+                        with self.profiler.stage('correct_corrupted_data', raw_data.nbytes):
+                            # increase word shift for every bad data chunk in raw data chunk
+                            word_shift = 0
+                            chunk_indices = np.arange(word_index, next_word_index)
+                            for consecutive_bad_word_indices in consecutive_bad_words_list:
+                                selected_words = np.intersect1d(consecutive_bad_word_indices, chunk_indices, assume_unique=True)
+                                if selected_words.shape[0]:
+                                    fixed_raw_data, lsb_byte = fix_raw_data(raw_data[selected_words - word_index - word_shift], lsb_byte=lsb_byte)
+                                    raw_data = np.r_[raw_data[:selected_words[0] - word_index - word_shift], fixed_raw_data, raw_data[selected_words[-1] - word_index + 1 - word_shift:]]
+                                    # check if last word of bad data chunk in current raw data chunk
+                                    if consecutive_bad_word_indices[-1] in selected_words:
+                                        lsb_byte = None
+                                        # word shift by removing data word at the beginning of each defect chunk
+                                        word_shift += 1
+                                    # bad data chunk is at the end of current raw data chunk
+                                    else:
+                                        break
+
+                    start_time = time.time()
+                    with self.profiler.stage('interpretation', raw_data.nbytes):
+                        self.interpreter.interpret_raw_data(raw_data)  # interpret the raw data
+                        # store remaining buffered event in the interpreter at the end of the last file, the event might be incomplete if more raw data is expected
+                        if not self._create_checkpoint and file_index == len(raw_data_files) - 1 and next_word_index >= n_file_words:  # store hits of the latest event of the last file
+                            self.interpreter.store_event()
+                        hits = self.interpreter.get_hits()
+                    interpretation_time += time.time() - start_time
+                    n_hits += hits.shape[0]
                     if self.scan_parameters is not None:
                         nEventIndex = self.interpreter.get_n_meta_data_event()
-                        self.histogram.add_meta_event_index(self.meta_event_index, nEventIndex)
+                        self.histogram.add_meta_event_index(self.meta_event_index, first_readout_index + nEventIndex)
                     if self.is_histogram_hits():
-                        self.histogram_hits(hits)
+                        with self.profiler.stage('histogramming', hits.nbytes):
+                            self.histogram_hits(hits)
+                    if event_number_offset:  # continue the event numbering of the interpretation before the checkpoint, the hit array of the interpreter is read-only
+                        hits = hits.copy()
+                        hits['event_number'] += event_number_offset
                     if self.is_cluster_hits():
-                        cluster_hits, clusters = self.cluster_hits(hits)
-                        if self._create_cluster_hit_table:
-                            cluster_hit_table.append(cluster_hits)
-                        if self._create_cluster_table:
-                            cluster_table.append(clusters)
-                        if self._create_cluster_size_hist:
-                            if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_size_hist.shape[0]:
-                                self._cluster_size_hist.resize(np.max(clusters['size']) + 1)
-                            self._cluster_size_hist += fast_analysis_utils.hist_1d_index(clusters['size'], shape=self._cluster_size_hist.shape)
-                        if self._create_cluster_tot_hist:
-                            if clusters['tot'].shape[0] > 0 and np.max(clusters['tot']) + 1 > self._cluster_tot_hist.shape[0]:
-                                self._cluster_tot_hist.resize((np.max(clusters['tot']) + 1, self._cluster_tot_hist.shape[1]))
-                            if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_tot_hist.shape[1]:
-                                self._cluster_tot_hist.resize((self._cluster_tot_hist.shape[0], np.max(clusters['size']) + 1))
-                            self._cluster_tot_hist += fast_analysis_utils.hist_2d_index(clusters['tot'], clusters['size'], shape=self._cluster_tot_hist.shape)
-                    if self._analyzed_data_file is not None and self._create_hit_table:
-                        hit_table.append(hits)
-                    if self._analyzed_data_file is not None and self._create_meta_word_index:
-                        size = self.interpreter.get_n_meta_data_word()
-                        meta_word_index_table.append(meta_word[:size])
+                        if self.cluster_processes and cluster_pipeline is None and hasattr(os, 'fork'):  # started at the first chunk, the clusterizer settings are deduced from the first raw data file
+                            cluster_pipeline = analysis_pool.Pipeline(self._cluster_hits_chunk, processes=self.cluster_processes)
+                        if cluster_pipeline is not None:  # the hits are clustered in parallel to the interpretation of the next chunks
+                            with self.profiler.stage('clustering', hits.nbytes):  # time waiting for a free cluster process
+                                cluster_pipeline.put(hits)
+                            with self.profiler.stage('store_clusters') as store_stage:
+                                for cluster_hits, clusters in cluster_pipeline.get():
+                                    self._store_clusters(cluster_hits, clusters, cluster_hit_table, cluster_table)
+                                    chunk_n_clusters += clusters.shape[0]
+                                    store_stage.n_bytes += cluster_hits.nbytes + clusters.nbytes
+                        else:
+                            start_time = time.time()
+                            with self.profiler.stage('clustering', hits.nbytes):
+                                cluster_hits, clusters = self.cluster_hits(hits)
+                            clustering_time += time.time() - start_time
+                            with self.profiler.stage('store_clusters', cluster_hits.nbytes + clusters.nbytes):
+                                self._store_clusters(cluster_hits, clusters, cluster_hit_table, cluster_table)
+                            chunk_n_clusters += clusters.shape[0]
+                    with self.profiler.stage('write_tables') as write_stage:
+                        if self._analyzed_data_file is not None and self._create_hit_table:
+                            hit_table.append(hits if self._hit_table_columns is None else analysis_utils.select_hit_columns(hits, analysis_utils.get_hit_dtype(self._hit_table_columns)))
+                            write_stage.n_bytes += hits.nbytes
+                        if self._create_checkpoint:
+                            size = self.interpreter.get_n_meta_data_word()
+                            if size:
+                                last_event_meta_word = meta_word[size - 1].copy()
+                        if self._analyzed_data_file is not None and self._create_meta_word_index:
+                            size = self.interpreter.get_n_meta_data_word()
+                            meta_word['event_number'][:size] += event_number_offset
+                            meta_word['start_index'][:size] += word_index_offset
+                            meta_word['stop_index'][:size] += word_index_offset
+                            meta_word_index_table.append(meta_word[:size])
+                            write_stage.n_bytes += meta_word[:size].nbytes
+                        self.out_file_h5.flush()
 
                     if total_words <= progress_bar.maxval:  # Otherwise exception is thrown
                         progress_bar.update(total_words)
-                    self.out_file_h5.flush()
+                    if chunk_size_controller is not None:
+                        chunk_size_controller.update(min(chunk_size, n_file_words - word_index), n_hits - chunk_n_hits, chunk_n_clusters, time.time() - chunk_start_time)
+        if chunk_size_controller is not None and chunk_size_controller.chunk_sizes:
+            logging.info('Adaptive chunk size: %d to %d raw data words, set memory_budget = None and chunk_size = %d to use a fixed chunk size', min(chunk_size_controller.chunk_sizes), max(chunk_size_controller.chunk_sizes), chunk_size_controller.chunk_size)
+        if hit_array_chunk_size != self._chunk_size:
+            self.interpreter.set_hit_array_size(2 * self._chunk_size)
+        self.profiler.end_chunks()
+        if cluster_pipeline is not None:
+            with self.profiler.stage('store_clusters') as store_stage:
+                for cluster_hits, clusters in cluster_pipeline.close():
+                    self._store_clusters(cluster_hits, clusters, cluster_hit_table, cluster_table)
+                    store_stage.n_bytes += cluster_hits.nbytes + clusters.nbytes
+            clustering_time = cluster_pipeline.busy_time
+        self._close_tables(hit_table, meta_word_index_table, cluster_table, cluster_hit_table)
         progress_bar.finish()
-        self._create_additional_data()
+        self._log_throughput(total_words, interpretation_time, n_hits, clustering_time, cluster_processes=0 if cluster_pipeline is None else self.cluster_processes)
+        if self._create_checkpoint:
+            self.interpreter.create_meta_data_word_index(self._create_meta_word_index)
+        if checkpoint is not None:  # event numbers of the readouts before the checkpoint are taken from the previous interpretation
+            self.meta_event_index['metaEventIndex'][first_readout_index:] += event_number_offset
+            if self._previous_meta_event_index is not None:
+                self.meta_event_index['metaEventIndex'][:self._previous_meta_event_index.shape[0]] = self._previous_meta_event_index
+        self._first_readout_index = first_readout_index
+        with self.profiler.stage('create_additional_data'):
+            self._create_additional_data()
+        self._previous_hists = {}
+
+        if self._analyzed_data_file is not None and self._create_checkpoint:
+            if last_event_meta_word is None:  # no complete event, keep the previous checkpoint
+                if checkpoint is None:
+                    self._store_checkpoint(raw_data_file=os.path.basename(raw_data_files[0]), word_index=0, event_number=0, n_readouts=0, n_words=0)
+                else:
+                    self._store_checkpoint(**dict((name, checkpoint[name]) for name in checkpoint.dtype.names))
+            else:
+                stop_word_index = last_event_meta_word['stop_index']  # first word of the next event
+                for file_index, start_word_index, n_words in reversed(file_word_offsets):
+                    if n_words <= stop_word_index:
+                        break
+                checkpoint_word_index = start_word_index + stop_word_index - n_words
+                file_meta_data = self.meta_data[first_readout_per_file[file_index]:first_readout_per_file[file_index] + readouts_per_file[file_index]]
+                self._store_checkpoint(raw_data_file=os.path.basename(raw_data_files[file_index]),
+                                       word_index=checkpoint_word_index,
+                                       event_number=event_number_offset + last_event_meta_word['event_number'] + 1,
+                                       n_readouts=first_readout_per_file[file_index] + np.count_nonzero(file_meta_data[index_start_name] < checkpoint_word_index),
+                                       n_words=word_index_offset + stop_word_index)
+        if checkpoint is not None:
+            self._finish_resume()
+
+        if cache_key is not None:
+            self.analysis_cache.put(cache_key, self.out_file_h5)
+        self._store_profile()
+
+        self._close_analyzed_data_file(out_file_h5, close_analyzed_data_file)
+
+    def _get_chunk_size_controller(self, meta_word_size):
+        if self.memory_budget is None:
+            return None
+        hit_size = analysis_utils.get_hit_dtype().itemsize
+        bytes_per_hit, bytes_per_cluster = 2 * hit_size, 0  # copies of the hits (event number offset, hit table columns)
+        if self.is_cluster_hits():
+            n_chunks = 1 + (2 * self.cluster_processes if self.cluster_processes else 0)  # chunks queued in the cluster pipeline
+            bytes_per_hit += n_chunks * (hit_size + dtype_from_descr(data_struct.ClusterHitInfoTable).itemsize)
+            bytes_per_cluster = n_chunks * dtype_from_descr(data_struct.ClusterInfoTable).itemsize
+        bytes_per_word = 4 + 2 * hit_size + meta_word_size  # raw data, hit array of the interpreter (two hits per word), meta word index
+        return AdaptiveChunkSize(self.memory_budget, self._chunk_size, bytes_per_word=bytes_per_word, bytes_per_hit=bytes_per_hit, bytes_per_cluster=bytes_per_cluster)
 
+    def _cluster_hits_chunk(self, hits):  # used by the cluster pipeline
+        return self.cluster_hits(hits)
+
+    def _store_clusters(self, cluster_hits, clusters, cluster_hit_table, cluster_table):
+        if self._create_cluster_hit_table:
+            cluster_hit_table.append(cluster_hits)
+        if self._create_cluster_table:
+            cluster_table.append(clusters)
+        if self._create_cluster_size_hist:
+            if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_size_hist.shape[0]:
+                self._cluster_size_hist.resize(np.max(clusters['size']) + 1)
+            self._cluster_size_hist += fast_analysis_utils.hist_1d_index(clusters['size'], shape=self._cluster_size_hist.shape)
+        if self._create_cluster_tot_hist:
+            if clusters['tot'].shape[0] > 0 and np.max(clusters['tot']) + 1 > self._cluster_tot_hist.shape[0]:
+                self._cluster_tot_hist.resize((np.max(clusters['tot']) + 1, self._cluster_tot_hist.shape[1]))
+            if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_tot_hist.shape[1]:
+                self._cluster_tot_hist.resize((self._cluster_tot_hist.shape[0], np.max(clusters['size']) + 1))
+            self._cluster_tot_hist += fast_analysis_utils.hist_2d_index(clusters['tot'], clusters['size'], shape=self._cluster_tot_hist.shape)
+
+    def _log_throughput(self, n_words, interpretation_time, n_hits, clustering_time, cluster_processes):
+        logging.info('Interpretation: %d raw data words in %.1f s (%.2f Mwords/s)', n_words, interpretation_time, n_words / max(interpretation_time, 1e-6) / 1e6)
+        if self.is_cluster_hits():
+            logging.info('Clustering: %d hits in %.1f s (%.2f Mhits/s) in %s', n_hits, clustering_time, n_hits / max(clustering_time, 1e-6) / 1e6, ('%d parallel process(es)' % cluster_processes) if cluster_processes else 'the interpretation process')
+
+    def _store_profile(self):  # after the analysis cache, the profile of a cached interpretation is not reused
+        if not self.profiler.enabled:
+            return
+        self.profiler.log_summary()
+        if self.is_open(self.out_file_h5) and self.out_file_h5.mode != 'r':
+            self.profiler.store(self.out_file_h5)
+
+    def _close_analyzed_data_file(self, out_file_h5, close_analyzed_data_file):
         if close_analyzed_data_file:
             self.out_file_h5.close()
             self.out_file_h5 = None
@@ -920,11 +1320,154 @@ class AnalyzeRawData(object):
         else:
             self._analyzed_data_file = None
 
+    def _get_checkpoint(self, analyzed_data_file=None):
+        '''Returns the checkpoint of the analyzed data file if the interpretation is resumed, otherwise None.
+        '''
+        if not self._resume or not self.is_open(self.out_file_h5) or '/Checkpoint' not in self.out_file_h5:
+            return None
+        if analyzed_data_file is not None and os.path.abspath(analyzed_data_file) != os.path.abspath(self.out_file_h5.filename):
+            return None
+        return self.out_file_h5.root.Checkpoint[0]
+
+    def _prepare_resume(self, checkpoint):
+        '''Reads the histograms and the readout event numbers of the interpretation before the checkpoint from the analyzed data file.
+        The histograms and the meta data are renamed to backup nodes and the number of rows of the tables is stored in the checkpoint.
+        The backup nodes are removed when the resumed interpretation succeeds (see _finish_resume()), otherwise the analyzed data file is restored (see _restore_resume()).
+        '''
+        root = self.out_file_h5.root
+        if 'resume_state' in root.Checkpoint.attrs:  # a previous resumed interpretation was aborted (e.g. process killed)
+            self._resume_state = root.Checkpoint.attrs.resume_state
+            self._restore_resume()
+        for node_name in _resume_node_names:  # backup nodes of a finished resumed interpretation that was aborted before removing them
+            if _get_resume_backup_name(node_name) in root:
+                self.out_file_h5.remove_node(root, _get_resume_backup_name(node_name), recursive=True)
+        for node_name in _resume_node_names:
+            if node_name != 'meta_data' and node_name in root:
+                self._previous_hists[node_name] = get_histogram(self.out_file_h5, node_name)[:]
+        if 'meta_data' in root:
+            self._previous_meta_event_index = root.meta_data.read(stop=checkpoint['n_readouts'], field='event_number')
+        else:
+            self._previous_meta_event_index = None
+        self._resume_state = {'node_names': [node._v_name for node in self.out_file_h5.iter_nodes(root)],
+                              'n_rows': dict((node._v_name, (node.nrows, getattr(node.attrs, 'nrows', None))) for node in self.out_file_h5.iter_nodes(root) if isinstance(node, (tb.Table, tb.EArray)) and node._v_name not in _resume_node_names)}
+        root.Checkpoint.attrs.resume_state = self._resume_state
+        for node_name in _resume_node_names:
+            if node_name in root:
+                self.out_file_h5.rename_node(root, newname=_get_resume_backup_name(node_name), name=node_name)
+        self.out_file_h5.flush()
+
+    def _finish_resume(self):
+        '''Removes the nodes of the interpretation before the checkpoint after a successful resumed interpretation.
+        '''
+        root = self.out_file_h5.root
+        for node_name in _resume_node_names:
+            if _get_resume_backup_name(node_name) in root:
+                self.out_file_h5.remove_node(root, _get_resume_backup_name(node_name), recursive=True)
+        if not self._create_checkpoint:
+            self.out_file_h5.remove_node(root, 'Checkpoint')
+        elif 'resume_state' in root.Checkpoint.attrs:
+            del root.Checkpoint.attrs.resume_state
+        self._resume_state = None
+
+    def _restore_resume(self):
+        '''Restores the analyzed data file of the interpretation before the checkpoint: nodes created by the resumed interpretation
+        are removed, the tables are truncated and the backup nodes are renamed.
+        '''
+        root = self.out_file_h5.root
+        backup_names = [_get_resume_backup_name(node_name) for node_name in _resume_node_names]
+        for node in list(self.out_file_h5.iter_nodes(root)):
+            if node._v_name not in self._resume_state['node_names'] and node._v_name not in backup_names:
+                self.out_file_h5.remove_node(root, node._v_name, recursive=True)
+        for node_name, (nrows, index_nrows) in self._resume_state['n_rows'].iteritems():
+            node = self.out_file_h5.get_node(root, node_name)
+            if node.nrows > nrows:
+                node.truncate(nrows)
+            if index_nrows is not None:  # event index
+                node.attrs.nrows = index_nrows
+        for node_name in _resume_node_names:
+            if _get_resume_backup_name(node_name) in root:
+                if node_name in root:
+                    self.out_file_h5.remove_node(root, node_name, recursive=True)
+                self.out_file_h5.rename_node(root, newname=node_name, name=_get_resume_backup_name(node_name))
+        if 'Checkpoint' in root and 'resume_state' in root.Checkpoint.attrs:
+            del root.Checkpoint.attrs.resume_state
+        self.out_file_h5.flush()
+        self._resume_state = None
+        logging.info('Restored the interpretation before the checkpoint')
+
+    def _store_checkpoint(self, **checkpoint):
+        if '/Checkpoint' in self.out_file_h5:
+            self.out_file_h5.remove_node(self.out_file_h5.root, 'Checkpoint')
+        checkpoint_table = self.out_file_h5.create_table(self.out_file_h5.root, name='Checkpoint', description=Checkpoint, title='Interpretation checkpoint')
+        row = checkpoint_table.row
+        for name, value in checkpoint.iteritems():
+            row[name] = value
+        row.append()
+        checkpoint_table.flush()
+        logging.info('Storing checkpoint at event %d (raw data file %s, word index %d)', checkpoint['event_number'], checkpoint['raw_data_file'], checkpoint['word_index'])
+
+    def _create_table(self, name, resume, expected_rows=None, event_index=False, **kwargs):
+        nrows = 0
+        if resume and name in self.out_file_h5.root:
+            table = self.out_file_h5.get_node(self.out_file_h5.root, name)
+            if event_index and self._create_event_index and get_event_index(table) is None:  # missing or outdated index of the interpretation before the checkpoint
+                create_event_index(table)
+            nrows = table.nrows
+        elif self.tune_table_layout and expected_rows is not None:  # created on the first append
+            table = TunedTable(self.out_file_h5, name=name, description=kwargs['description'], expected_rows=expected_rows, filters=kwargs['filters'], title=kwargs.get('title', ''))
+        else:
+            table = self.out_file_h5.create_table(self.out_file_h5.root, name=name, **kwargs)
+        if event_index and self._create_event_index:
+            return EventIndexedTable(table, EventIndexWriter(self.out_file_h5, self.out_file_h5.root, name, nrows=nrows))
+        return table
+
+    def _close_tables(self, *tables):  # create tuned tables without data and store the event indices
+        for table in tables:
+            if isinstance(table, EventIndexedTable):
+                table.close()
+                table = table.table
+            if isinstance(table, TunedTable):
+                table.create()
+
+    def _read_cached_hists(self):
+        '''Sets the histograms of the analysis from the interpreted data copied from the analysis cache.
+        The counters of the interpreter and histogrammer are not filled, since the raw data is not interpreted.
+        '''
+        for create_hist, node_name, attribute_name in ((self._create_service_record_hist, 'HistServiceRecord', 'service_record_hist'),
+                                                        (self._create_tdc_counter_hist, 'HistTdcCounter', 'tdc_counter_hist'),
+                                                        (self._create_error_hist, 'HistErrorCounter', 'error_counter_hist'),
+                                                        (self._create_trigger_error_hist, 'HistTriggerErrorCounter', 'trigger_error_counter_hist'),
+                                                        (self._create_tot_hist, 'HistTot', 'tot_hist'),
+                                                        (self._create_tot_pixel_hist, 'HistTotPixel', 'tot_pixel_hist_array'),
+                                                        (self._create_tdc_hist, 'HistTdc', 'tdc_hist'),
+                                                        (self._create_tdc_pixel_hist, 'HistTdcPixel', 'tdc_pixel_hist_array'),
+                                                        (self._create_rel_bcid_hist, 'HistRelBcid', 'rel_bcid_hist'),
+                                                        (self._create_occupancy_hist, 'HistOcc', 'occupancy_array'),
+                                                        (self._create_mean_tot_hist, 'HistMeanTot', 'mean_tot_array'),
+                                                        (self._create_threshold_hists, 'HistThreshold', 'threshold_hist'),
+                                                        (self._create_threshold_hists, 'HistNoise', 'noise_hist'),
+                                                        (self._create_cluster_size_hist, 'HistClusterSize', '_cluster_size_hist'),
+                                                        (self._create_cluster_tot_hist, 'HistClusterTot', '_cluster_tot_hist')):
+            if create_hist and node_name in self.out_file_h5.root:
+                setattr(self, attribute_name, get_histogram(self.out_file_h5, node_name)[:])
+
+    def _add_previous_hist(self, node_name, hist):
+        '''Adds the histogram of the interpretation before the checkpoint. Histograms with different shapes
+        (e.g. more scan parameters) are extended.
+        '''
+        previous_hist = self._previous_hists.get(node_name)
+        if previous_hist is None:
+            return hist
+        result = np.zeros(shape=np.maximum(hist.shape, previous_hist.shape), dtype=hist.dtype)
+        result[tuple(slice(0, size) for size in hist.shape)] += hist
+        result[tuple(slice(0, size) for size in previous_hist.shape)] += previous_hist.astype(hist.dtype)
+        return result
+
     def _create_additional_data(self):
         logging.info('Creating selected event histograms...')
         if self._analyzed_data_file is not None and self._create_meta_event_index:
             meta_data_size = self.meta_data.shape[0]
-            n_event_index = self.interpreter.get_n_meta_data_event()
+            n_event_index = self._first_readout_index + self.interpreter.get_n_meta_data_event()
             if meta_data_size == n_event_index:
                 if self.interpreter.meta_table_v2:
                     description = data_struct.MetaInfoEventTableV2().columns.copy()
@@ -957,22 +1500,22 @@ class AnalyzeRawData(object):
             else:
                 logging.error('Meta data analysis failed')
         if self._create_service_record_hist:
-            self.service_record_hist = self.interpreter.get_service_records_counters()
+            self.service_record_hist = self._add_previous_hist('HistServiceRecord', self.interpreter.get_service_records_counters())
             if self._analyzed_data_file is not None:
                 service_record_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistServiceRecord', title='Service Record Histogram', atom=tb.Atom.from_dtype(self.service_record_hist.dtype), shape=self.service_record_hist.shape, filters=self._filter_table)
                 service_record_hist_table[:] = self.service_record_hist
         if self._create_tdc_counter_hist:
-            self.tdc_counter_hist = self.interpreter.get_tdc_counters()
+            self.tdc_counter_hist = self._add_previous_hist('HistTdcCounter', self.interpreter.get_tdc_counters())
             if self._analyzed_data_file is not None:
                 tdc_counter_hist = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTdcCounter', title='All Tdc word counter values', atom=tb.Atom.from_dtype(self.tdc_counter_hist.dtype), shape=self.tdc_counter_hist.shape, filters=self._filter_table)
                 tdc_counter_hist[:] = self.tdc_counter_hist
         if self._create_error_hist:
-            self.error_counter_hist = self.interpreter.get_error_counters()
+            self.error_counter_hist = self._add_previous_hist('HistErrorCounter', self.interpreter.get_error_counters())
             if self._analyzed_data_file is not None:
                 error_counter_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistErrorCounter', title='Error Counter Histogram', atom=tb.Atom.from_dtype(self.error_counter_hist.dtype), shape=self.error_counter_hist.shape, filters=self._filter_table)
                 error_counter_hist_table[:] = self.error_counter_hist
         if self._create_trigger_error_hist:
-            self.trigger_error_counter_hist = self.interpreter.get_trigger_error_counters()
+            self.trigger_error_counter_hist = self._add_previous_hist('HistTriggerErrorCounter', self.interpreter.get_trigger_error_counters())
             if self._analyzed_data_file is not None:
                 trigger_error_counter_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTriggerErrorCounter', title='Trigger Error Counter Histogram', atom=tb.Atom.from_dtype(self.trigger_error_counter_hist.dtype), shape=self.trigger_error_counter_hist.shape, filters=self._filter_table)
                 trigger_error_counter_hist_table[:] = self.trigger_error_counter_hist
@@ -980,30 +1523,35 @@ class AnalyzeRawData(object):
         self._create_additional_hit_data()
         self._create_additional_cluster_data()
 
+    def _store_pixel_hist(self, node_name, title, hist):
+        if self._use_sparse_hists:
+            SparseHistogram.from_dense(hist).to_hdf5(self.out_file_h5, name=node_name, title=title, filters=self._filter_table)
+        else:
+            hist_out = self.out_file_h5.create_carray(self.out_file_h5.root, name=node_name, title=title, atom=tb.Atom.from_dtype(hist.dtype), shape=hist.shape, filters=self._filter_table)
+            hist_out[:] = hist
+
     def _create_additional_hit_data(self, safe_to_file=True):
         logging.info('Create selected hit histograms')
         if self._create_tot_hist:
-            self.tot_hist = self.histogram.get_tot_hist()
+            self.tot_hist = self._add_previous_hist('HistTot', self.histogram.get_tot_hist())
             if self._analyzed_data_file is not None and safe_to_file:
                 tot_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTot', title='ToT Histogram', atom=tb.Atom.from_dtype(self.tot_hist.dtype), shape=self.tot_hist.shape, filters=self._filter_table)
                 tot_hist_table[:] = self.tot_hist
         if self._create_tot_pixel_hist:
             if self._analyzed_data_file is not None and safe_to_file:
-                self.tot_pixel_hist_array = np.swapaxes(self.histogram.get_tot_pixel_hist(), 0, 1)  # swap axis col,row, parameter --> row, col, parameter
-                tot_pixel_hist_out = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTotPixel', title='Tot Pixel Histogram', atom=tb.Atom.from_dtype(self.tot_pixel_hist_array.dtype), shape=self.tot_pixel_hist_array.shape, filters=self._filter_table)
-                tot_pixel_hist_out[:] = self.tot_pixel_hist_array
+                self.tot_pixel_hist_array = self._add_previous_hist('HistTotPixel', np.swapaxes(self.histogram.get_tot_pixel_hist(), 0, 1))  # swap axis col,row, parameter --> row, col, parameter
+                self._store_pixel_hist('HistTotPixel', 'Tot Pixel Histogram', self.tot_pixel_hist_array)
         if self._create_tdc_hist:
-            self.tdc_hist = self.histogram.get_tdc_hist()
+            self.tdc_hist = self._add_previous_hist('HistTdc', self.histogram.get_tdc_hist())
             if self._analyzed_data_file is not None and safe_to_file:
                 tdc_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTdc', title='Tdc Histogram', atom=tb.Atom.from_dtype(self.tdc_hist.dtype), shape=self.tdc_hist.shape, filters=self._filter_table)
                 tdc_hist_table[:] = self.tdc_hist
         if self._create_tdc_pixel_hist:
             if self._analyzed_data_file is not None and safe_to_file:
-                self.tdc_pixel_hist_array = np.swapaxes(self.histogram.get_tdc_pixel_hist(), 0, 1)  # swap axis col,row, parameter --> row, col, parameter
-                tdc_pixel_hist_out = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistTdcPixel', title='Tdc Pixel Histogram', atom=tb.Atom.from_dtype(self.tdc_pixel_hist_array.dtype), shape=self.tdc_pixel_hist_array.shape, filters=self._filter_table)
-                tdc_pixel_hist_out[:] = self.tdc_pixel_hist_array
+                self.tdc_pixel_hist_array = self._add_previous_hist('HistTdcPixel', np.swapaxes(self.histogram.get_tdc_pixel_hist(), 0, 1))  # swap axis col,row, parameter --> row, col, parameter
+                self._store_pixel_hist('HistTdcPixel', 'Tdc Pixel Histogram', self.tdc_pixel_hist_array)
         if self._create_rel_bcid_hist:
-            self.rel_bcid_hist = self.histogram.get_rel_bcid_hist()
+            self.rel_bcid_hist = self._add_previous_hist('HistRelBcid', self.histogram.get_rel_bcid_hist())
             if self._analyzed_data_file is not None and safe_to_file:
                 if not self.set_stop_mode:
                     rel_bcid_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistRelBcid', title='relative BCID Histogram', atom=tb.Atom.from_dtype(self.rel_bcid_hist.dtype), shape=(16, ), filters=self._filter_table)
@@ -1012,10 +1560,9 @@ class AnalyzeRawData(object):
                     rel_bcid_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistRelBcid', title='relative BCID Histogram in stop mode read out', atom=tb.Atom.from_dtype(self.rel_bcid_hist.dtype), shape=self.rel_bcid_hist.shape, filters=self._filter_table)
                     rel_bcid_hist_table[:] = self.rel_bcid_hist
         if self._create_occupancy_hist:
-            self.occupancy_array = np.swapaxes(self.histogram.get_occupancy(), 0, 1)  # swap axis col,row, parameter --> row, col, parameter
+            self.occupancy_array = self._add_previous_hist('HistOcc', np.swapaxes(self.histogram.get_occupancy(), 0, 1))  # swap axis col,row, parameter --> row, col, parameter
             if self._analyzed_data_file is not None and safe_to_file:
-                occupancy_array_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistOcc', title='Occupancy Histogram', atom=tb.Atom.from_dtype(self.occupancy_array.dtype), shape=self.occupancy_array.shape, filters=self._filter_table)
-                occupancy_array_table[0:336, 0:80, 0:self.histogram.get_n_parameters()] = self.occupancy_array
+                self._store_pixel_hist('HistOcc', 'Occupancy Histogram', self.occupancy_array)
         if self._create_mean_tot_hist:
             self.mean_tot_array = np.swapaxes(self.histogram.get_mean_tot(), 0, 1)  # swap axis col,row, parameter --> row, col, parameter
             if self._analyzed_data_file is not None and safe_to_file:
@@ -1039,7 +1586,8 @@ class AnalyzeRawData(object):
         if self._create_fitted_threshold_hists:
             _, scan_parameters_idx = np.unique(self.scan_parameters['PlsrDAC'], return_index=True)
             scan_parameters = self.scan_parameters['PlsrDAC'][np.sort(scan_parameters_idx)]
-            self.scurve_fit_results = self.fit_scurves_multithread(self.out_file_h5, PlsrDAC=scan_parameters)
+            with self.profiler.stage('fit_scurves'):
+                self.scurve_fit_results = self.fit_scurves(self.out_file_h5, PlsrDAC=scan_parameters)
             if self._analyzed_data_file is not None and safe_to_file:
                 fitted_threshold_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistThresholdFitted', title='Threshold Fitted Histogram', atom=tb.Atom.from_dtype(self.scurve_fit_results.dtype), shape=(336, 80), filters=self._filter_table)
                 fitted_noise_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistNoiseFitted', title='Noise Fitted Histogram', atom=tb.Atom.from_dtype(self.scurve_fit_results.dtype), shape=(336, 80), filters=self._filter_table)
@@ -1055,11 +1603,13 @@ class AnalyzeRawData(object):
     def _create_additional_cluster_data(self, safe_to_file=True):
         logging.info('Create selected cluster histograms')
         if self._create_cluster_size_hist:
+            self._cluster_size_hist = self._add_previous_hist('HistClusterSize', self._cluster_size_hist)
             if self._analyzed_data_file is not None and safe_to_file:
                 cluster_size_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistClusterSize', title='Cluster Size Histogram', atom=tb.Atom.from_dtype(self._cluster_size_hist.dtype), shape=self._cluster_size_hist.shape, filters=self._filter_table)
                 cluster_size_hist_table[:] = self._cluster_size_hist
         if self._create_cluster_tot_hist:
             self._cluster_tot_hist[:, 0] = self._cluster_tot_hist.sum(axis=1)  # First bin is the projection of the others
+            self._cluster_tot_hist = self._add_previous_hist('HistClusterTot', self._cluster_tot_hist)
             if self._analyzed_data_file is not None and safe_to_file:
                 cluster_tot_hist_table = self.out_file_h5.create_carray(self.out_file_h5.root, name='HistClusterTot', title='Cluster Tot Histogram', atom=tb.Atom.from_dtype(self._cluster_tot_hist.dtype), shape=self._cluster_tot_hist.shape, filters=self._filter_table)
                 cluster_tot_hist_table[:] = self._cluster_tot_hist
@@ -1121,10 +1671,11 @@ class AnalyzeRawData(object):
         self.out_file_h5 = out_file_h5
         self._analyzed_data_file = self.out_file_h5.filename
 
+        cluster_table, cluster_hit_table = None, None
         if self._create_cluster_table:
-            cluster_table = self.out_file_h5.create_table(self.out_file_h5.root, name='Cluster', description=data_struct.ClusterInfoTable, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
+            cluster_table = self._create_table('Cluster', False, expected_rows=in_file_h5.root.Hits.nrows, event_index=True, description=data_struct.ClusterInfoTable, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
         if self._create_cluster_hit_table:
-            cluster_hit_table = self.out_file_h5.create_table(self.out_file_h5.root, name='ClusterHits', description=data_struct.ClusterHitInfoTable, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
+            cluster_hit_table = self._create_table('ClusterHits', False, expected_rows=in_file_h5.root.Hits.nrows, event_index=True, description=data_struct.ClusterHitInfoTable, title='cluster_hit_data', filters=self._filter_table, expectedrows=self._chunk_size)
 
         if self._create_cluster_size_hist:  # Cluster size result histogram
             self._cluster_size_hist = np.zeros(shape=(6, ), dtype=np.uint32)
@@ -1158,18 +1709,24 @@ class AnalyzeRawData(object):
         progress_bar.start()
 
         for hits, index in analysis_utils.data_aligned_at_events(in_file_h5.root.Hits, chunk_size=self._chunk_size):
+            self.profiler.next_chunk()
             n_hits += hits.shape[0]
+            hits = analysis_utils.expand_hits(hits)  # hit tables can have a column subset
 
             if self.is_cluster_hits():
-                cluster_hits, clusters = self.cluster_hits(hits)
+                with self.profiler.stage('clustering', hits.nbytes):
+                    cluster_hits, clusters = self.cluster_hits(hits)
 
             if self.is_histogram_hits():
-                self.histogram_hits(hits)
+                with self.profiler.stage('histogramming', hits.nbytes):
+                    self.histogram_hits(hits)
 
             if self._analyzed_data_file is not None and self._create_cluster_hit_table:
-                cluster_hit_table.append(cluster_hits)
+                with self.profiler.stage('write_tables', cluster_hits.nbytes):
+                    cluster_hit_table.append(cluster_hits)
             if self._analyzed_data_file is not None and self._create_cluster_table:
-                cluster_table.append(clusters)
+                with self.profiler.stage('write_tables', clusters.nbytes):
+                    cluster_table.append(clusters)
                 if self._create_cluster_size_hist:
                     if clusters['size'].shape[0] > 0 and np.max(clusters['size']) + 1 > self._cluster_size_hist.shape[0]:
                         self._cluster_size_hist.resize(np.max(clusters['size']) + 1)
@@ -1182,6 +1739,8 @@ class AnalyzeRawData(object):
                     self._cluster_tot_hist += fast_analysis_utils.hist_2d_index(clusters['tot'], clusters['size'], shape=self._cluster_tot_hist.shape)
             self.out_file_h5.flush()
             progress_bar.update(index)
+        self.profiler.end_chunks()
+        self._close_tables(cluster_table, cluster_hit_table)
         progress_bar.finish()
 
         if table_size == 0:
@@ -1190,8 +1749,10 @@ class AnalyzeRawData(object):
         if n_hits != table_size:
             raise analysis_utils.AnalysisError('Tables have different sizes. Not all hits were analyzed.')
 
-        self._create_additional_hit_data()
-        self._create_additional_cluster_data()
+        with self.profiler.stage('create_additional_data'):
+            self._create_additional_hit_data()
+            self._create_additional_cluster_data()
+        self._store_profile()
         if close_analyzed_data_out_file:
             out_file_h5.close()
         if close_analyzed_data_file:
@@ -1206,6 +1767,7 @@ class AnalyzeRawData(object):
     def analyze_hits(self, hits, scan_parameter=None):
         n_hits = hits.shape[0]
         logging.debug('Analyze %d hits' % n_hits)
+        hits = analysis_utils.expand_hits(hits)  # hit tables can have a column subset
 
         if scan_parameter is None:  # if nothing specified keep actual setting
             logging.debug('Keep scan parameter settings ')
@@ -1239,7 +1801,9 @@ class AnalyzeRawData(object):
         self.histogram.add_hits(clusters[start_index:stop_index])
 
     def plot_histograms(self, pdf_filename=None, analyzed_data_file=None, maximum=None, create_hit_hists_only=False):  # plots the histogram from output file if available otherwise from ram
+        plot_stage = self.profiler.start('plot_histograms')
         logging.info('Creating histograms%s', (' (source: %s)' % analyzed_data_file) if analyzed_data_file is not None else (' (source: %s)' % self._analyzed_data_file) if self._analyzed_data_file is not None else '')
+        out_file_h5 = None
         close_analyzed_data_file = False
         if analyzed_data_file is not None:
             if self.is_open(self.out_file_h5) and os.path.abspath(analyzed_data_file) == os.path.abspath(self.out_file_h5.filename):
@@ -1273,110 +1837,119 @@ class AnalyzeRawData(object):
         if output_pdf is None:
             raise ValueError('Parameter "pdf_filename" not specified.')
         logging.info('Saving histograms to PDF file: %s', str(output_pdf._file.fh.name))
+        plot_names = []  # registered plots, see plot_registry
         if self._create_threshold_hists:
-            if self._create_threshold_mask:  # mask pixel with bad data for plotting
-                if out_file_h5 is not None:
-                    self.threshold_mask = analysis_utils.generate_threshold_mask(out_file_h5.root.HistNoise[:])
-                else:
-                    self.threshold_mask = analysis_utils.generate_threshold_mask(self.noise_hist)
-            else:
-                self.threshold_mask = np.zeros_like(out_file_h5.root.HistThreshold[:] if out_file_h5 is not None else self.threshold_hist, dtype=np.bool)
-            threshold_hist = np.ma.array(out_file_h5.root.HistThreshold[:] if out_file_h5 is not None else self.threshold_hist, mask=self.threshold_mask)
-            noise_hist = np.ma.array(out_file_h5.root.HistNoise[:] if out_file_h5 is not None else self.noise_hist, mask=self.threshold_mask)
-            mask_cnt = np.ma.count_masked(noise_hist)
-            logging.info('Fast algorithm: masking %d pixel(s)', mask_cnt)
-            plotting.plot_three_way(hist=threshold_hist, title='Threshold%s' % ((' (masked %i pixel(s))' % mask_cnt) if self._create_threshold_mask else ''), x_axis_title="threshold [PlsrDAC]", filename=output_pdf, bins=100, minimum=0, maximum=maximum)
-            plotting.plot_three_way(hist=noise_hist, title='Noise%s' % ((' (masked %i pixel(s))' % mask_cnt) if self._create_threshold_mask else ''), x_axis_title="noise [PlsrDAC]", filename=output_pdf, bins=100, minimum=0, maximum=maximum)
+            plot_names.extend(['threshold_fast', 'noise_fast'])
         if self._create_fitted_threshold_hists:
-            if self._create_fitted_threshold_mask:
-                if out_file_h5 is not None:
-                    self.fitted_threshold_mask = analysis_utils.generate_threshold_mask(out_file_h5.root.HistNoiseFitted[:])
-                else:
-                    self.fitted_threshold_mask = analysis_utils.generate_threshold_mask(self.scurve_fit_results[:, :, 1])
-            else:
-                self.threshold_mask = np.zeros_like(out_file_h5.root.HistThresholdFitted[:] if out_file_h5 is not None else self.scurve_fit_results, dtype=np.bool8)
-            threshold_hist = np.ma.array(out_file_h5.root.HistThresholdFitted[:] if out_file_h5 is not None else self.scurve_fit_results[:, :, 0], mask=self.fitted_threshold_mask)
-            noise_hist = np.ma.array(out_file_h5.root.HistNoiseFitted[:] if out_file_h5 is not None else self.scurve_fit_results[:, :, 1], mask=self.fitted_threshold_mask)
-            threshold_hist_calib = np.ma.array(out_file_h5.root.HistThresholdFittedCalib[:] if out_file_h5 is not None else self.threshold_hist_calib[:], mask=self.fitted_threshold_mask)
-            noise_hist_calib = np.ma.array(out_file_h5.root.HistNoiseFittedCalib[:] if out_file_h5 is not None else self.noise_hist_calib[:], mask=self.fitted_threshold_mask)
-            mask_cnt = np.ma.count_masked(noise_hist)
-            logging.info('S-curve fit: masking %d pixel(s)', mask_cnt)
-            plotting.plot_three_way(hist=threshold_hist, title='Threshold (S-curve fit, masked %i pixel(s))' % mask_cnt, x_axis_title="Threshold [PlsrDAC]", filename=output_pdf, bins=100, minimum=0, maximum=maximum)
-            plotting.plot_three_way(hist=noise_hist, title='Noise (S-curve fit, masked %i pixel(s))' % mask_cnt, x_axis_title="Noise [PlsrDAC]", filename=output_pdf, bins=100, minimum=0, maximum=maximum)
-            plotting.plot_three_way(hist=threshold_hist_calib, title='Threshold (S-curve fit, masked %i pixel(s))' % mask_cnt, x_axis_title="Threshold [e]", filename=output_pdf, bins=100, minimum=0)
-            plotting.plot_three_way(hist=noise_hist_calib, title='Noise (S-curve fit, masked %i pixel(s))' % mask_cnt, x_axis_title="Noise [e]", filename=output_pdf, bins=100, minimum=0)
+            plot_names.extend(['threshold', 'noise', 'threshold_calib', 'noise_calib'])
         if self._create_occupancy_hist:
             if self._create_fitted_threshold_hists:
-                _, scan_parameters_idx = np.unique(self.scan_parameters['PlsrDAC'], return_index=True)
-                scan_parameters = self.scan_parameters['PlsrDAC'][np.sort(scan_parameters_idx)]
-                plotting.plot_scurves(occupancy_hist=out_file_h5.root.HistOcc[:] if out_file_h5 is not None else self.occupancy_array[:], filename=output_pdf, scan_parameters=scan_parameters, scan_parameter_name="PlsrDAC")
+                plot_names.append('scurves')
+            elif self._create_source_scan_hist:
+                plot_names.extend(['fancy_occupancy', 'occupancy'])
             else:
-                hist = np.sum(out_file_h5.root.HistOcc[:], axis=2) if out_file_h5 is not None else np.sum(self.occupancy_array[:], axis=2)
-                occupancy_array_masked = np.ma.masked_equal(hist, 0)
-                if self._create_source_scan_hist:
-                    plotting.plot_fancy_occupancy(hist=occupancy_array_masked, filename=output_pdf, z_max='median')
-                    plotting.plot_occupancy(hist=occupancy_array_masked, filename=output_pdf, z_max='maximum')
-                else:
-                    plotting.plot_three_way(hist=occupancy_array_masked, title="Occupancy", x_axis_title="occupancy", filename=output_pdf, maximum=maximum)
-                    plotting.plot_occupancy(hist=occupancy_array_masked, filename=output_pdf, z_max='median')
+                plot_names.extend(['occupancy_three_way', 'occupancy'])
         if self._create_tot_hist:
-            plotting.plot_tot(hist=out_file_h5.root.HistTot[:] if out_file_h5 is not None else self.tot_hist, filename=output_pdf)
+            plot_names.append('tot')
         if self._create_tot_pixel_hist:
-            tot_pixel_hist = out_file_h5.root.HistTotPixel[:] if out_file_h5 is not None else self.tot_pixel_hist_array
-            total_hits_masked = np.ma.masked_equal(np.sum(tot_pixel_hist, axis=2), 0)
-            mean_pixel_tot = np.average(tot_pixel_hist, axis=2, weights=range(16)) * sum(range(0, 16)) / total_hits_masked
-            plotting.plot_three_way(mean_pixel_tot, title='Mean ToT', x_axis_title='mean ToT', filename=output_pdf, minimum=0, maximum=15)
+            plot_names.append('mean_tot')
         if self._create_tdc_counter_hist:
-            plotting.plot_tdc_counter(hist=out_file_h5.root.HistTdcCounter[:] if out_file_h5 is not None else self.tdc_hist_counter, filename=output_pdf)
+            plot_names.append('tdc_counter')
         if self._create_tdc_hist:
-            plotting.plot_tdc(hist=out_file_h5.root.HistTdc[:] if out_file_h5 is not None else self.tdc_hist, filename=output_pdf)
+            plot_names.append('tdc')
         if self._create_cluster_size_hist:
-            plotting.plot_cluster_size(hist=out_file_h5.root.HistClusterSize[:] if out_file_h5 is not None else self.cluster_size_hist, filename=output_pdf)
+            plot_names.append('cluster_size')
         if self._create_cluster_tot_hist:
-            plotting.plot_cluster_tot(hist=out_file_h5.root.HistClusterTot[:] if out_file_h5 is not None else self.cluster_tot_hist, filename=output_pdf)
+            plot_names.append('cluster_tot')
         if self._create_cluster_tot_hist and self._create_cluster_size_hist:
-            plotting.plot_cluster_tot_size(hist=out_file_h5.root.HistClusterTot[:] if out_file_h5 is not None else self.cluster_tot_hist, filename=output_pdf)
+            plot_names.append('cluster_tot_size')
         if self._create_rel_bcid_hist:
-            if self.set_stop_mode:
-                plotting.plot_relative_bcid_stop_mode(hist=out_file_h5.root.HistRelBcid[:] if out_file_h5 is not None else self.rel_bcid_hist, filename=output_pdf)
-            else:
-                plotting.plot_relative_bcid(hist=out_file_h5.root.HistRelBcid[0:16] if out_file_h5 is not None else self.rel_bcid_hist[0:16], filename=output_pdf)
+            plot_names.append('relative_bcid_stop_mode' if self.set_stop_mode else 'relative_bcid')
         if self._create_tdc_pixel_hist:
-            tdc_pixel_hist = out_file_h5.root.HistTdcPixel[:, :, :1024] if out_file_h5 is not None else self.tdc_pixel_hist_array[:, :, :1024]  # only take first 1024 values, otherwise memory error likely
-            total_hits_masked = np.ma.masked_equal(np.sum(tdc_pixel_hist, axis=2), 0)
-            mean_pixel_tdc = np.average(tdc_pixel_hist, axis=2, weights=range(1024)) * sum(range(0, 1024)) / total_hits_masked
-            plotting.plot_three_way(mean_pixel_tdc, title='Mean TDC', x_axis_title='mean TDC', maximum=2 * np.ma.median(np.ma.masked_invalid(mean_pixel_tdc)), filename=output_pdf)
-        if not create_hit_hists_only:
-            if analyzed_data_file is None and self._create_error_hist:
-                plotting.plot_event_errors(hist=out_file_h5.root.HistErrorCounter[:] if out_file_h5 is not None else self.error_counter_hist, filename=output_pdf)
-            if analyzed_data_file is None and self._create_service_record_hist:
-                plotting.plot_service_records(hist=out_file_h5.root.HistServiceRecord[:] if out_file_h5 is not None else self.service_record_hist, filename=output_pdf)
-            if analyzed_data_file is None and self._create_trigger_error_hist:
-                plotting.plot_trigger_errors(hist=out_file_h5.root.HistTriggerErrorCounter[:] if out_file_h5 is not None else self.trigger_error_counter_hist, filename=output_pdf)
-
+            plot_names.append('mean_tdc')
+        if not create_hit_hists_only and analyzed_data_file is None:
+            if self._create_error_hist:
+                plot_names.append('event_errors')
+            if self._create_service_record_hist:
+                plot_names.append('service_records')
+            if self._create_trigger_error_hist:
+                plot_names.append('trigger_errors')
+        if out_file_h5 is not None:
+            get_hist = partial(get_histogram, out_file_h5)
+        else:
+            get_hist = self._get_hist
+        if self._create_threshold_hists:  # mask pixel with bad data for plotting, the masks are applied by the registered plots
+            self.threshold_mask = analysis_utils.generate_threshold_mask(get_hist('HistNoise')[:]) if self._create_threshold_mask else np.zeros(get_hist('HistThreshold')[:].shape, dtype=np.bool)
+            logging.info('Fast algorithm: masking %d pixel(s)', np.count_nonzero(self.threshold_mask))
+        if self._create_fitted_threshold_hists:
+            self.fitted_threshold_mask = analysis_utils.generate_threshold_mask(get_hist('HistNoiseFitted')[:]) if self._create_fitted_threshold_mask else np.zeros(get_hist('HistThresholdFitted')[:].shape, dtype=np.bool)
+            logging.info('S-curve fit: masking %d pixel(s)', np.count_nonzero(self.fitted_threshold_mask))
+        report = PdfReport(processes=self.plot_processes, rasterize=self.rasterize_plots)  # with plot_processes > 1 the plots are rendered in parallel and appended in order
+        for plot_name in plot_names:
+            plot_registry.add_plot(report, plot_name, get_hist, maximum=maximum, threshold_mask=self._create_threshold_mask, fitted_threshold_mask=self._create_fitted_threshold_mask, occupancy_z_max='maximum' if self._create_source_scan_hist else 'median')
+        report.save(output_pdf)
+
+        self.profiler.stop(plot_stage)
+        self._store_profile()
         if close_analyzed_data_file:
             out_file_h5.close()
         if close_pdf:
             logging.info('Closing output PDF file: %s', str(output_pdf._file.fh.name))
             output_pdf.close()
 
+    def _get_hist(self, node_name):  # histogram in memory with the node name of the interpreted data file
+        return {
+            'HistThreshold': lambda: self.threshold_hist,
+            'HistNoise': lambda: self.noise_hist,
+            'HistThresholdFitted': lambda: self.scurve_fit_results[:, :, 0],
+            'HistNoiseFitted': lambda: self.scurve_fit_results[:, :, 1],
+            'HistThresholdFittedCalib': lambda: self.threshold_hist_calib,
+            'HistNoiseFittedCalib': lambda: self.noise_hist_calib,
+            'HistOcc': lambda: self.occupancy_array,
+            'HistTot': lambda: self.tot_hist,
+            'HistTotPixel': lambda: self.tot_pixel_hist_array,
+            'HistTdcCounter': lambda: self.tdc_hist_counter,
+            'HistTdc': lambda: self.tdc_hist,
+            'HistTdcPixel': lambda: self.tdc_pixel_hist_array,
+            'HistClusterSize': lambda: self.cluster_size_hist,
+            'HistClusterTot': lambda: self.cluster_tot_hist,
+            'HistRelBcid': lambda: self.rel_bcid_hist,
+            'HistErrorCounter': lambda: self.error_counter_hist,
+            'HistServiceRecord': lambda: self.service_record_hist,
+            'HistTriggerErrorCounter': lambda: self.trigger_error_counter_hist,
+            'meta_data': lambda: self.scan_parameters}[node_name]()  # the S-curves take the PlsrDAC values from the meta data
+
+    def fit_scurves(self, hit_table_file=None, PlsrDAC=None):
+        '''Fits the S-curves of all pixels in one process with the batched fit. Start values are taken from the fast threshold algorithm if available.
+        '''
+        logging.info("Start S-curve fit")
+        occupancy_hist = get_histogram(hit_table_file, 'HistOcc')[:] if hit_table_file is not None else self.occupancy_array[:]  # take data from RAM if no file is opened
+        occupancy_hist_shaped = occupancy_hist.reshape(occupancy_hist.shape[0] * occupancy_hist.shape[1], occupancy_hist.shape[2])
+        # reverse data to fit s-curve
+        if PlsrDAC[0] > PlsrDAC[-1]:
+            occupancy_hist_shaped = np.flip(occupancy_hist_shaped, axis=1)
+            PlsrDAC = np.flip(PlsrDAC, axis=0)
+        if self._create_threshold_hists:  # fast algorithm results as start values
+            threshold, noise = self.threshold_hist.ravel(), self.noise_hist.ravel()
+        else:
+            threshold, noise = None, None
+        result_array = fit_scurves(occupancy_hist_shaped, PlsrDAC=PlsrDAC, threshold=threshold, noise=noise)
+        logging.info("S-curve fit finished")
+        return result_array.reshape(occupancy_hist.shape[0], occupancy_hist.shape[1], 2)
+
     def fit_scurves_multithread(self, hit_table_file=None, PlsrDAC=None):
-        logging.info("Start S-curve fit on %d CPU core(s)", mp.cpu_count())
-        occupancy_hist = hit_table_file.root.HistOcc[:] if hit_table_file is not None else self.occupancy_array[:]  # take data from RAM if no file is opened
+        logging.info("Start S-curve fit on %d CPU core(s)", analysis_pool.get_pool_size())
+        occupancy_hist = get_histogram(hit_table_file, 'HistOcc')[:] if hit_table_file is not None else self.occupancy_array[:]  # take data from RAM if no file is opened
         occupancy_hist_shaped = occupancy_hist.reshape(occupancy_hist.shape[0] * occupancy_hist.shape[1], occupancy_hist.shape[2])
         # reverse data to fit s-curve
         if PlsrDAC[0] > PlsrDAC[-1]:
             occupancy_hist_shaped = np.flip(occupancy_hist_shaped, axis=1)
             PlsrDAC = np.flip(PlsrDAC, axis=0)
         partialfit_scurve = partial(fit_scurve, PlsrDAC=PlsrDAC)  # trick to give a function more than one parameter, needed for pool.map
-        pool = mp.Pool()  # create as many workers as physical cores are available
         try:
-            result_list = pool.map(partialfit_scurve, occupancy_hist_shaped.tolist())
+            result_list = analysis_pool.map_rows(partialfit_scurve, occupancy_hist_shaped)  # the occupancy is shared with the workers of the analysis pool
         except TypeError:
             raise analysis_utils.NotSupportedError('Less than 3 points found for S-curve fit.')
-        finally:
-            pool.close()
-            pool.join()
         result_array = np.array(result_list)
         logging.info("S-curve fit finished")
         return result_array.reshape(occupancy_hist.shape[0], occupancy_hist.shape[1], 2)
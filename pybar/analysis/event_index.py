@@ -0,0 +1,163 @@
+"""Event number index of tables with a sorted event_number column (Hits, Cluster, ClusterHits). The event number of every
+index_step-th row is stored in the <table name>EventIndex array next to the table. The rows of an event are found with a binary search
+in the index and one read of the event_number column of index_step rows, see data_aligned_at_events(try_speedup=True).
+The index is written while appending to the table (AnalyzeRawData.create_event_index) or created for existing tables with create_event_index().
+"""
+import logging
+
+import numpy as np
+import tables as tb
+
+
+index_step = 10000  # rows per index entry, about the chunk shape of the tables (see table_layout)
+
+
+def get_index_name(table_name):
+    return table_name + 'EventIndex'
+
+
+def get_event_index(table):
+    '''Returns the event index of the table, None if not existing or not up to date.
+
+    Parameters
+    ----------
+    table : tables.Table
+
+    Returns
+    -------
+    EventIndex
+    '''
+    index_name = get_index_name(table.name)
+    if index_name not in table._v_parent:
+        return None
+    index_array = table._v_parent._f_get_child(index_name)
+    if index_array.attrs.nrows != table.nrows:  # table was appended without updating the index
+        logging.debug('Event index %s is not up to date, ignoring it', index_array._v_pathname)
+        return None
+    return EventIndex(table, index_array[:], index_array.attrs.step)
+
+
+def create_event_index(table, step=index_step, chunk_size=1000000):
+    '''Creates the event index of an existing table. An existing index is replaced.
+
+    Parameters
+    ----------
+    table : tables.Table
+        Table with a sorted event_number column. The file has to be opened in write or append mode.
+    step : int
+        Rows per index entry.
+    chunk_size : int
+        Rows read at once.
+
+    Returns
+    -------
+    EventIndex
+    '''
+    index_name = get_index_name(table.name)
+    if index_name in table._v_parent:
+        table._v_file.remove_node(table._v_parent, index_name)
+    writer = EventIndexWriter(table._v_file, table._v_parent, table.name, step=step)
+    for start_index in range(0, table.nrows, chunk_size):
+        writer.append(table.read(start_index, start_index + chunk_size, field='event_number'))
+    writer.close()
+    return get_event_index(table)
+
+
+class EventIndex(object):
+    '''Event number index of a table.
+
+    Parameters
+    ----------
+    table : tables.Table
+    event_numbers : numpy.array
+        Event numbers of the rows 0, step, 2 * step, ...
+    step : int
+        Rows per index entry.
+    '''
+    def __init__(self, table, event_numbers, step):
+        self.table = table
+        self.event_numbers = event_numbers
+        self.step = int(step)
+        self._block = None  # last read event numbers (start row, event numbers)
+
+    def _read_block(self, block_index):
+        start_row = block_index * self.step
+        if self._block is None or self._block[0] != start_row:
+            self._block = (start_row, self.table.read(start_row, min(start_row + self.step, self.table.nrows), field='event_number'))
+        return self._block[1]
+
+    def get_row(self, event_number, side='left'):
+        '''Returns the index of the first row with an event number >= event_number (side='left') or > event_number (side='right').
+        '''
+        block_index = np.searchsorted(self.event_numbers, event_number, side=side)  # the row is in the block before
+        if block_index == 0:
+            return 0
+        return (block_index - 1) * self.step + int(np.searchsorted(self._read_block(block_index - 1), event_number, side=side))
+
+    def get_event_rows(self, event_number):
+        '''Returns the start and stop row index of an event. Start and stop are equal if the event does not exist.
+        '''
+        return self.get_row(event_number, side='left'), self.get_row(event_number, side='right')
+
+
+class EventIndexWriter(object):
+    '''Writes the event index while appending to a table.
+
+    Parameters
+    ----------
+    h5_file : tables.File
+    where : tables.Group
+        Group of the table.
+    table_name : string
+    step : int
+        Rows per index entry.
+    nrows : int
+        Number of rows of the table. For appending to an existing table and index.
+    '''
+    def __init__(self, h5_file, where, table_name, step=index_step, nrows=0):
+        self.step = step
+        self.nrows = nrows
+        index_name = get_index_name(table_name)
+        if index_name in where:
+            self.index_array = where._f_get_child(index_name)
+            if self.index_array.attrs.nrows != nrows or self.index_array.attrs.step != step:
+                raise ValueError('Event index %s does not match the table' % self.index_array._v_pathname)
+        else:
+            if nrows != 0:
+                raise ValueError('Event index of a non-empty table, use create_event_index()')
+            self.index_array = h5_file.create_earray(where, name=index_name, atom=tb.Int64Atom(), shape=(0,), title='Event number of every %d-th row of %s' % (step, table_name), filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            self.index_array.attrs.step = step
+            self.index_array.attrs.nrows = 0
+
+    def append(self, event_numbers):
+        '''Adds the event numbers of the rows appended to the table.
+        '''
+        first_index_row = -self.nrows % self.step  # first row of the appended rows with an index entry
+        self.index_array.append(event_numbers[first_index_row::self.step].astype(np.int64))
+        self.nrows += event_numbers.shape[0]
+
+    def close(self):
+        self.index_array.attrs.nrows = self.nrows
+        self.index_array.flush()
+
+
+class EventIndexedTable(object):
+    '''Table that updates its event index on append.
+
+    Parameters
+    ----------
+    table : tables.Table, TunedTable
+    index_writer : EventIndexWriter
+    '''
+    def __init__(self, table, index_writer):
+        self.table = table
+        self.index_writer = index_writer
+
+    def append(self, rows):
+        self.table.append(rows)
+        self.index_writer.append(rows['event_number'])
+
+    def close(self):
+        '''Stores the number of indexed rows. The index is not valid before.
+        '''
+        self.index_writer.close()
@@ -0,0 +1,184 @@
+"""Interpretation of the raw data during data taking. The raw data of a run is written to a private copy of the raw data file
+and interpreted in a separate process from time to time by resuming the previous interpretation (see AnalyzeRawData create_checkpoint).
+When the run stops, the remaining raw data is interpreted and the interpreted data is stored in the analysis cache under the key of
+the raw data file of the run. The offline analysis of the run finds the interpreted data in the cache and does not interpret the raw data again.
+"""
+import logging
+import os
+import time
+import shutil
+import signal
+import tempfile
+import traceback
+import multiprocessing as mp
+from Queue import Empty, Full
+
+import tables as tb
+
+from pybar.analysis import analysis_cache
+from pybar.analysis.analysis_cache import AnalysisCache
+from pybar.analysis.analyze_raw_data import AnalyzeRawData
+from pybar.daq.fei4_raw_data import open_raw_data_file
+
+
+def _interpret(raw_data_file, settings, create_checkpoint, cache=None, cache_raw_data_files=None):
+    with AnalyzeRawData(raw_data_file=raw_data_file, create_pdf=False, resume=True) as analyze_raw_data:
+        analyze_raw_data.set_settings(settings)
+        analyze_raw_data.create_checkpoint = create_checkpoint
+        analyze_raw_data.analysis_cache = None
+        analyze_raw_data.interpreter.set_warning_output(False)
+        if cache is not None:
+            cache_key = analyze_raw_data.get_cache_key(cache_raw_data_files)  # key of the offline interpretation of the raw data file(s) of the run
+        analyze_raw_data.interpret_word_table()
+        if cache is not None:
+            cache.put(cache_key, analyze_raw_data.out_file_h5)
+
+
+def _interpret_live(data_queue, result_queue, settings, interval, cache_dir, cache_size):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # keyboard interrupt is handled by the main process
+    try:
+        raw_data_file, scan_parameters = data_queue.get()
+        raw_data = open_raw_data_file(raw_data_file, mode='a', scan_parameters=scan_parameters, catalog=False)  # temporary copy, not part of the run
+        n_readouts = 0  # readouts since the last interpretation
+        last_interpretation = time.time()
+        while True:
+            try:
+                item = data_queue.get(timeout=max(0.1, interval - (time.time() - last_interpretation)))
+            except Empty:
+                item = None
+            if item is not None and item[0] == 'data':
+                raw_data.append_item(item[1], scan_parameters=item[2], flush=False)
+                n_readouts += 1
+            elif item is not None and item[0] == 'stop':
+                raw_data.close()
+                _interpret(raw_data_file, settings, create_checkpoint=False, cache=AnalysisCache(cache_dir, max_size=cache_size), cache_raw_data_files=item[1])
+                result_queue.put((True, None))
+                return
+            if n_readouts and time.time() - last_interpretation >= interval:
+                raw_data.close()
+                _interpret(raw_data_file, settings, create_checkpoint=True)
+                raw_data = open_raw_data_file(raw_data_file, mode='a', scan_parameters=scan_parameters, catalog=False)
+                n_readouts = 0
+                last_interpretation = time.time()
+    except Exception:
+        result_queue.put((False, traceback.format_exc()))
+
+
+class LiveInterpretation(object):
+    '''Interprets the raw data of a run during data taking in a separate process. The process is started on initialization
+    and has to be created before opening any HDF5 file, since the open files (and their file locks) are inherited by the process.
+    The raw data file of the run is passed with start(), the data has to be added with add_data() in the same way as to the raw data file.
+
+    Parameters
+    ----------
+    settings : dict
+        Interpretation settings of the offline analysis of the run (see AnalyzeRawData.set_settings()).
+    interval : float
+        Time in seconds between the interpretations during data taking.
+    max_queued_readouts : int
+        Maximum number of readouts waiting to be written by the process. If the process cannot keep up with the data taking,
+        add_data() does not block and the live interpretation has to be aborted.
+    '''
+    def __init__(self, settings, interval=10.0, max_queued_readouts=1000):
+        cache = analysis_cache.get_cache()
+        if cache is None:
+            raise RuntimeError('Live interpretation requires the analysis cache')
+        self._tmp_dir = tempfile.mkdtemp(prefix='pybar_live_')
+        self._data_queue = mp.Queue(maxsize=max_queued_readouts)
+        self._result_queue = mp.Queue()
+        self._process = mp.Process(target=_interpret_live, args=(self._data_queue, self._result_queue, settings, interval, cache.cache_dir, cache.max_size))
+        self._process.daemon = True
+        self._process.start()
+
+    def start(self, raw_data_file):
+        '''Starts the live interpretation of the raw data file.
+
+        Parameters
+        ----------
+        raw_data_file : fei4_raw_data.RawDataFile
+            Opened raw data file of the run. The configuration nodes are copied from this file.
+        '''
+        filename = os.path.join(self._tmp_dir, os.path.basename(raw_data_file.h5_file.filename))
+        with tb.open_file(filename, mode='w', title=raw_data_file.h5_file.title) as h5_file:
+            for node in raw_data_file.h5_file.list_nodes('/', classname='Group'):  # configuration
+                raw_data_file.h5_file.copy_node(node, h5_file.root, overwrite=True, recursive=True)
+        self._data_queue.put((filename, dict(raw_data_file.scan_parameters)))
+        logging.info('Started live interpretation of raw data file %s', raw_data_file.h5_file.filename)
+
+    def add_data(self, data_tuple, scan_parameters=None):
+        '''Adds a readout to the live interpretation.
+
+        Parameters
+        ----------
+        data_tuple : tuple
+            Data tuple of the format (data (np.array), last_time (float), curr_time (float), status (int)).
+        scan_parameters : dict
+            Scan parameter values of the readout.
+
+        Returns
+        -------
+        bool
+            False if the readout could not be added because the process is not running or the queue is full.
+            The live interpretation has to be aborted then.
+        '''
+        if self._process is None or not self._process.is_alive():
+            return False
+        try:
+            self._data_queue.put_nowait(('data', data_tuple, scan_parameters))
+        except Full:  # do not block the readout
+            return False
+        return True
+
+    def stop(self, raw_data_files, timeout=None):
+        '''Interprets the remaining raw data and stores the interpreted data in the analysis cache.
+
+        Parameters
+        ----------
+        raw_data_files : iterable of strings
+            Closed raw data file(s) of the run.
+        timeout : float
+            Maximum time in seconds to wait for the interpretation. If None, wait until finished or until the process exited.
+
+        Returns
+        -------
+        bool
+            True if the interpreted data was stored in the analysis cache.
+        '''
+        if self._process is None:
+            return False
+        stop_time = None if timeout is None else time.time() + timeout
+        success, exc = False, 'Timeout'
+        while self._process.is_alive():  # the queue can be full, do not block if the process died
+            try:
+                self._data_queue.put(('stop', raw_data_files), timeout=0.1)
+                break
+            except Full:
+                pass
+        while stop_time is None or time.time() < stop_time:
+            process_alive = self._process.is_alive()  # checked before get(), a result put before the process exited is received
+            try:
+                success, exc = self._result_queue.get(timeout=0.1)
+                break
+            except Empty:
+                if not process_alive:  # e.g. killed or crashed without result
+                    exc = 'Live interpretation process exited with exit code %s' % self._process.exitcode
+                    break
+        if success:
+            logging.info('Live interpretation finished')
+        else:
+            logging.warning('Live interpretation failed, the raw data will be interpreted again:\n%s', exc)
+        self.abort()
+        return success
+
+    def abort(self):
+        '''Stops the live interpretation without storing the interpreted data.
+        '''
+        if self._process is not None:
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process.join()
+            self._process = None
+            self._data_queue.cancel_join_thread()  # do not wait for the readouts which were not transferred
+            self._data_queue.close()
+            self._result_queue.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
@@ -0,0 +1,223 @@
+"""Multi-page PDF reports rendered in parallel. The plotting functions (see plotting, e.g. plot_three_way(), plot_occupancy()) of a report
+are called in the workers of the analysis pool (see analysis_pool), each renders its page(s) to an in-memory PDF. The pages are appended
+to the output PDF file (matplotlib PdfPages) in the order the plots were added to the report, the page content is unchanged.
+Optionally, dense 2D maps and scatter plots are rasterized (see rasterize_figure()) to reduce the rendering time and the file size.
+"""
+import logging
+import re
+from distutils.version import LooseVersion
+from io import BytesIO
+
+import matplotlib
+from matplotlib.backends.backend_pdf import PdfPages, Reference
+from matplotlib.figure import Figure
+
+from pybar.analysis import analysis_pool
+
+
+def rasterize_figure(figure, min_elements=1000):
+    '''Rasterizes the collections (e.g. pcolormesh, hist2d, scatter) and lines with many elements in the PDF output. Text, axes and
+    images are not changed.
+
+    Parameters
+    ----------
+    figure : matplotlib.figure.Figure
+    min_elements : int
+        Minimum number of elements (patches, markers, line points) of a rasterized collection or line.
+    '''
+    for ax in figure.axes:
+        for artist in ax.collections:
+            if max(len(artist.get_paths()), len(artist.get_offsets())) >= min_elements:
+                artist.set_rasterized(True)
+        for artist in ax.lines:
+            if len(artist.get_xydata()) >= min_elements:
+                artist.set_rasterized(True)
+
+
+class _RasterizingPdfPages(PdfPages):
+    __slots__ = ()
+
+    def savefig(self, figure=None, **kwargs):
+        if isinstance(figure, Figure):
+            rasterize_figure(figure)
+        super(_RasterizingPdfPages, self).savefig(figure, **kwargs)
+
+
+def _render_pages(args):  # runs in a worker process, returns the PDF data of the pages of one plotting function call
+    plot_function, plot_args, plot_kwargs, rasterize = args
+    pdf_data = BytesIO()
+    pdf = _RasterizingPdfPages(pdf_data) if rasterize else PdfPages(pdf_data)
+    try:
+        plot_function(*plot_args, filename=pdf, **plot_kwargs)
+    finally:
+        pdf.close()
+    return pdf_data.getvalue()
+
+
+_reference_pattern = re.compile(br'(?<![\d.])(\d+) 0 R(?![A-Za-z0-9])')
+
+
+_pdf_file_attributes = ('endStream', 'reserveObject', 'recordXref', 'write', 'pagesObject', 'pageList')  # private matplotlib PdfFile interface used to append pages
+_matplotlib_versions = ('2.0', '3.0')  # matplotlib versions (minimum, maximum excluded) with the used PdfFile interface and PDF output
+
+
+def can_append_pdf_pages(output_pdf):
+    '''Returns True if pages can be appended to the PdfPages with append_pdf_pages(), i.e. the matplotlib version is supported and
+    provides the used PdfFile interface.
+    '''
+    if not LooseVersion(_matplotlib_versions[0]) <= LooseVersion(matplotlib.__version__) < LooseVersion(_matplotlib_versions[1]):
+        return False
+    pdf_file = getattr(output_pdf, '_file', None)
+    return pdf_file is not None and all(hasattr(pdf_file, name) for name in _pdf_file_attributes)
+
+
+def append_pdf_pages(output_pdf, pdf_data, render=None):
+    '''Appends the pages of a PDF file created by matplotlib (PdfPages, Figure.savefig()) to an open PdfPages. The objects of the pages
+    (content streams, fonts, images) are copied with new object numbers, the page content is not changed.
+    The PDF data is parsed completely before the output file is changed, the output file is unchanged if an exception is raised while parsing.
+
+    Parameters
+    ----------
+    output_pdf : matplotlib.backends.backend_pdf.PdfPages
+    pdf_data : string
+        Content of the PDF file.
+    render : callable
+        Function rendering the pages to the PdfPages given as argument. Called instead of appending the PDF data if the pages
+        cannot be appended (see can_append_pdf_pages()) or the PDF data is not supported. If None, the exception is raised.
+
+    Returns
+    -------
+    int
+        Number of appended pages, None if the pages were rendered.
+    '''
+    try:
+        if not can_append_pdf_pages(output_pdf):
+            raise NotImplementedError('Appending PDF pages is not supported by this matplotlib version')
+        return _append_pdf_pages(output_pdf, pdf_data)
+    except Exception:  # the output file is unchanged, render the pages in this process
+        if render is None:
+            raise
+        logging.warning('Cannot append the rendered PDF pages, plot is rendered in the analysis process', exc_info=True)
+        render(output_pdf)
+
+
+def _append_pdf_pages(output_pdf, pdf_data):
+    startxref = int(re.search(br'startxref\s+(\d+)\s+%%EOF\s*$', pdf_data).group(1))
+    xref = re.match(br'xref\s+0 (\d+)\s+', pdf_data[startxref:])
+    offsets = {}  # object number -> offset
+    for object_number, entry in enumerate(re.findall(br'(\d{10}) \d{5} ([nf])', pdf_data[startxref + xref.end():])[:int(xref.group(1))]):
+        if entry[1] == b'n':
+            offsets[object_number] = int(entry[0])
+    trailer = pdf_data[pdf_data.index(b'trailer', startxref):]
+    root = int(re.search(br'/Root (\d+) 0 R', trailer).group(1))
+    info = re.search(br'/Info (\d+) 0 R', trailer)
+    object_ends = dict(zip(sorted(offsets.values()), sorted(offsets.values())[1:] + [startxref]))
+
+    def get_object(object_number):
+        return pdf_data[offsets[object_number]:object_ends[offsets[object_number]]]
+
+    pages = int(re.search(br'/Pages (\d+) 0 R', get_object(root)).group(1))
+    kids = re.search(br'/Kids\s*\[([^\]]*)\]', get_object(pages)).group(1)
+    page_numbers = [int(kid) for kid in _reference_pattern.findall(kids)]
+    skipped = set((root, pages)) | (set() if info is None else set((int(info.group(1)), )))
+    copied = [object_number for object_number in sorted(offsets, key=offsets.get) if object_number not in skipped]
+    objects = []  # object number, dictionary, stream data (copied unchanged)
+    for object_number in copied:
+        data = get_object(object_number)
+        header_end = data.index(b' obj') + 4
+        stream_start = data.find(b'\nstream\n')
+        dictionary_end = len(data) if stream_start < 0 else stream_start
+        objects.append((object_number, data[header_end:dictionary_end], data[dictionary_end:]))
+    references = set(int(reference) for _, dictionary, _ in objects for reference in _reference_pattern.findall(dictionary))
+    if not references.issubset(set(copied) | set((pages, ))) or not set(page_numbers).issubset(copied):
+        raise ValueError('Unknown object reference in PDF data')
+
+    pdf_file = output_pdf._file
+    pdf_file.endStream()  # the content stream of the last page is closed with the next page
+    object_numbers = {pages: pdf_file.pagesObject.id}  # the pages are added to the page tree of the output file
+    for object_number in sorted(copied):
+        object_numbers[object_number] = pdf_file.reserveObject('appended object').id
+
+    def replace_reference(match):
+        return b'%d 0 R' % object_numbers[int(match.group(1))]
+
+    for object_number, dictionary, stream in objects:
+        pdf_file.recordXref(object_numbers[object_number])
+        pdf_file.write(b'%d 0 obj' % object_numbers[object_number])
+        pdf_file.write(_reference_pattern.sub(replace_reference, dictionary))
+        pdf_file.write(stream)
+    pdf_file.pageList.extend(Reference(object_numbers[page_number]) for page_number in page_numbers)
+    return len(page_numbers)
+
+
+class PdfReport(object):
+    '''Collects the plots of a PDF report and renders them in parallel.
+
+    Parameters
+    ----------
+    processes : int
+        Maximum number of plots rendered at once. If None, the number of worker processes of the analysis pool. If 1, the plots are
+        rendered in the calling process. The plots are also rendered in the calling process if the pages cannot be appended
+        (see can_append_pdf_pages()).
+    rasterize : bool
+        If True, dense 2D maps and scatter plots are rasterized (see rasterize_figure()).
+
+    Examples
+    --------
+    >>> report = PdfReport(processes=None)
+    >>> report.add(plotting.plot_three_way, hist=threshold_hist, title='Threshold')
+    >>> report.add(plotting.plot_occupancy, hist=occupancy_hist)
+    >>> report.save(output_pdf)
+    '''
+    def __init__(self, processes=1, rasterize=False):
+        self.processes = processes
+        self.rasterize = rasterize
+        self.plots = []
+
+    def add(self, plot_function, *args, **kwargs):
+        '''Adds a plot. The plotting function is called with the given arguments and the output file as filename argument.
+        The plotting function and the arguments have to be picklable (e.g. module level function, numpy arrays).
+        '''
+        self.plots.append((plot_function, args, kwargs))
+
+    def __len__(self):
+        return len(self.plots)
+
+    def save(self, output_pdf):
+        '''Renders the plots and appends the pages to the output PDF file in the order the plots were added.
+
+        Parameters
+        ----------
+        output_pdf : matplotlib.backends.backend_pdf.PdfPages, string
+            PDF file or file name.
+        '''
+        if not isinstance(output_pdf, PdfPages):
+            with PdfPages(output_pdf) as output_pdf:
+                return self.save(output_pdf)
+        processes = analysis_pool.get_pool_size() if self.processes is None else self.processes
+        if not can_append_pdf_pages(output_pdf):
+            if processes > 1 or self.rasterize:
+                logging.warning('Cannot append PDF pages with this matplotlib version, plots are rendered in the analysis process')
+            for plot_function, args, kwargs in self.plots:
+                plot_function(*args, filename=output_pdf, **kwargs)
+        elif processes <= 1 or len(self.plots) <= 1:
+            for plot in self.plots:
+                if self.rasterize:
+                    self._append_pages(output_pdf, plot, _render_pages((plot[0], plot[1], plot[2], True)))
+                else:
+                    plot[0](*plot[1], filename=output_pdf, **plot[2])
+        else:
+            logging.debug('Rendering %d plots in %d processes', len(self.plots), processes)
+            pool = analysis_pool.get_pool()
+            pending = []
+            for plot in self.plots:
+                pending.append((plot, pool.apply_async(_render_pages, ((plot[0], plot[1], plot[2], self.rasterize), ))))
+                if len(pending) > processes:  # limits the memory of the rendered pages waiting to be appended
+                    plot, result = pending.pop(0)
+                    self._append_pages(output_pdf, plot, result.get())
+            for plot, result in pending:
+                self._append_pages(output_pdf, plot, result.get())
+        self.plots = []
+
+    def _append_pages(self, output_pdf, plot, pdf_data):
+        append_pdf_pages(output_pdf, pdf_data, render=lambda output_pdf: plot[0](*plot[1], filename=output_pdf, **plot[2]))
@@ -0,0 +1,335 @@
+"""Plots of interpreted data files rendered on demand. Each registered plot is created from one or more histogram nodes of the
+interpreted data file (e.g. 'tot' from HistTot). A plot is rendered only when requested and stored in a plot cache directory
+under a key calculated from the content of its histogram nodes. The least recently used plots are removed if the cache directory exceeds
+its maximum size (see max_cache_size). Requesting the plot again or for an interpreted file with the
+same histograms returns the cached image. Analyses can skip the PDF creation (e.g. AnalyzeRawData(create_pdf=False) in tuning
+loops) and the plots are created later from the interpreted file without repeating the analysis.
+The registered plots are also used by AnalyzeRawData.plot_histograms() (see add_plot()).
+
+Command line usage:
+    python -m pybar.analysis.plotting.plot_registry <interpreted file> [plot names] [--output <PDF file>] [--list]
+"""
+import logging
+import os
+import re
+import argparse
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import tables as tb
+from matplotlib.backends.backend_pdf import PdfPages
+
+from pybar.analysis import analysis_cache
+from pybar.analysis.analysis_utils import generate_threshold_mask
+from pybar.analysis.sparse_histogram import SparseHistogram, get_histogram
+from pybar.analysis.plotting import plotting
+from pybar.analysis.plotting.pdf_report import PdfReport, append_pdf_pages, can_append_pdf_pages
+
+
+PLOT_VERSION = 2  # increase to invalidate cached plots created by different plotting functions
+output_formats = ('png', 'pdf')
+max_cache_size = 1024 ** 3  # default maximum size of a plot cache directory in bytes, the least recently used plots are removed
+_cached_plot_name = re.compile(r'^\w+_[0-9a-f]{40}\.(%s)$' % '|'.join(output_formats))  # <plot name>_<key>.<format>
+
+_plots = OrderedDict()  # plot name -> histogram node names, plotting function, function returning the plotting function arguments from the histograms
+
+
+def register_plot(name, node_names, plot_function, get_kwargs=None):
+    '''Registers a plot. An existing plot with the same name is replaced.
+
+    Parameters
+    ----------
+    name : string
+        Plot name.
+    node_names : string, iterable of strings
+        Names of the histogram nodes of the interpreted data file the plot is created from.
+    plot_function : function
+        Plotting function taking the output file name as filename argument (see plotting).
+    get_kwargs : function
+        Returns the arguments of the plotting function (dict) from the histograms in the order of node_names and the plot options
+        as keyword arguments (e.g. maximum, threshold_mask, see AnalyzeRawData.plot_histograms()). The histograms are numpy arrays,
+        tables nodes or SparseHistogram objects and have to be sliced to get numpy arrays (e.g. hist[:]).
+        If None, the first histogram is the hist argument.
+    '''
+    if isinstance(node_names, basestring):
+        node_names = (node_names, )
+    _plots[name] = (tuple(node_names), plot_function, _get_hist_kwargs if get_kwargs is None else get_kwargs)
+
+
+def _get_hist_kwargs(hist, *_, **__):
+    return {'hist': hist[:]}
+
+
+def _get_plot(name):
+    if name not in _plots:
+        raise ValueError('Unknown plot %s, available plots: %s' % (name, ', '.join(_plots)))
+    return _plots[name]
+
+
+def add_plot(report, name, get_hist, **options):
+    '''Adds a registered plot to a PDF report.
+
+    Parameters
+    ----------
+    report : pdf_report.PdfReport
+    name : string
+        Plot name, see get_plot_names().
+    get_hist : function
+        Returns the histogram of a node name (numpy array, tables node or SparseHistogram).
+    options
+        Plot options passed to the get_kwargs function of the plot (see register_plot()).
+    '''
+    node_names, plot_function, get_kwargs = _get_plot(name)
+    report.add(plot_function, **get_kwargs(*[get_hist(node_name) for node_name in node_names], **options))
+
+
+def get_plot_names(h5_file=None):
+    '''Returns the names of the registered plots.
+
+    Parameters
+    ----------
+    h5_file : tables.File
+        If not None, only the plots with all histogram nodes in the file.
+
+    Returns
+    -------
+    list of strings
+    '''
+    return [name for name, (node_names, _, _) in _plots.iteritems() if h5_file is None or all(node_name in h5_file.root for node_name in node_names)]
+
+
+def get_default_cache_dir(interpreted_file):
+    '''Returns the plot cache directory used if no directory is given, the directory plot_cache next to the interpreted data file.
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(interpreted_file)), 'plot_cache')
+
+
+def _get_cached_plot(h5_file, name, cache_dir, output_format, options, max_size=None):
+    node_names, plot_function, get_kwargs = _get_plot(name)
+    if output_format not in output_formats:
+        raise ValueError('Unknown plot format %s' % output_format)
+    hists = [get_histogram(h5_file, node_name)[:] for node_name in node_names]
+    file_name = os.path.join(cache_dir, '%s_%s.%s' % (name, analysis_cache.get_array_key('plot', PLOT_VERSION, name, options, *hists), output_format))
+    if os.path.isfile(file_name):
+        logging.debug('Using cached plot %s', file_name)
+        os.utime(file_name, None)  # mark as recently used
+        return file_name
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmp_file_name = tempfile.mkstemp(dir=cache_dir, suffix='.' + output_format)  # unique for concurrent requests, the extension selects the image format
+    os.close(fd)
+    try:
+        plot_function(filename=tmp_file_name, **get_kwargs(*hists, **options))
+        os.rename(tmp_file_name, file_name)  # another process requesting the plot can only see the complete file
+    finally:
+        if os.path.isfile(tmp_file_name):
+            os.remove(tmp_file_name)
+    _evict_plots(cache_dir, max_cache_size if max_size is None else max_size, keep=file_name)
+    return file_name
+
+
+def _evict_plots(cache_dir, max_size, keep):  # removes the least recently used plots if the cache directory exceeds the maximum size
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if not _cached_plot_name.match(file_name):  # other files in the cache directory
+            continue
+        file_name = os.path.join(cache_dir, file_name)
+        if file_name != keep:
+            stat = os.stat(file_name)
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+    size = os.path.getsize(keep) + sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, file_name in sorted(entries):  # least recently used first
+        if size <= max_size:
+            break
+        try:
+            os.remove(file_name)
+        except OSError:  # removed by another process
+            pass
+        size -= entry_size
+        logging.debug('Plot cache: removed %s', file_name)
+
+
+def get_plot(interpreted_file, name, cache_dir=None, output_format='png', max_size=None, **options):
+    '''Returns the image file of a plot of an interpreted data file. The plot is rendered if it is not in the plot cache.
+
+    Parameters
+    ----------
+    interpreted_file : string
+    name : string
+        Plot name, see get_plot_names().
+    cache_dir : string
+        Plot cache directory. If None, see get_default_cache_dir().
+    output_format : string
+        'png' or 'pdf'.
+    max_size : int
+        Maximum size of the plot cache directory in bytes. If None, max_cache_size.
+    options
+        Plot options (see register_plot()).
+
+    Returns
+    -------
+    string
+        File name of the image in the plot cache.
+    '''
+    with tb.open_file(interpreted_file, mode="r") as in_file_h5:
+        return _get_cached_plot(in_file_h5, name, get_default_cache_dir(interpreted_file) if cache_dir is None else cache_dir, output_format, options, max_size=max_size)
+
+
+def write_plots(interpreted_file, output_pdf, names=None, cache_dir=None, max_size=None, **options):
+    '''Writes plots of an interpreted data file to a PDF file. Only the plots not in the plot cache are rendered.
+
+    Parameters
+    ----------
+    interpreted_file : string
+    output_pdf : matplotlib.backends.backend_pdf.PdfPages, string
+        PDF file or file name.
+    names : iterable of strings
+        Plot names. If None, all plots with the histograms in the interpreted data file.
+    cache_dir : string
+        Plot cache directory. If None, see get_default_cache_dir().
+    max_size : int
+        Maximum size of the plot cache directory in bytes. If None, max_cache_size.
+    options
+        Plot options (see register_plot()).
+
+    Returns
+    -------
+    list of strings
+        Names of the written plots.
+    '''
+    if not isinstance(output_pdf, PdfPages):
+        with PdfPages(output_pdf) as output_pdf:
+            return write_plots(interpreted_file, output_pdf, names=names, cache_dir=cache_dir, max_size=max_size, **options)
+    if cache_dir is None:
+        cache_dir = get_default_cache_dir(interpreted_file)
+    with tb.open_file(interpreted_file, mode="r") as in_file_h5:
+        names = get_plot_names(in_file_h5) if names is None else list(names)
+        for name in names:
+            def render_plot(output_pdf):
+                report = PdfReport()
+                add_plot(report, name, lambda node_name: get_histogram(in_file_h5, node_name), **options)
+                report.save(output_pdf)
+
+            if not can_append_pdf_pages(output_pdf):  # the cached pages cannot be appended with this matplotlib version, render the plot
+                render_plot(output_pdf)
+                continue
+            with open(_get_cached_plot(in_file_h5, name, cache_dir, 'pdf', options, max_size=max_size), 'rb') as pdf_file:
+                append_pdf_pages(output_pdf, pdf_file.read(), render=render_plot)
+    return names
+
+
+def _get_masked_kwargs(hist, noise_hist, create_mask, title, masked_title, **kwargs):  # threshold and noise maps with the pixels of bad S-curves masked
+    hist = hist[:]
+    hist = np.ma.array(hist, mask=generate_threshold_mask(noise_hist[:]) if create_mask else np.zeros(hist.shape, dtype=np.bool_))
+    kwargs.update({'hist': hist, 'title': (masked_title % np.ma.count_masked(hist)) if create_mask else title})
+    return kwargs
+
+
+def _get_scurves_kwargs(occupancy_hist, threshold_hist, meta_data, **_):  # the fitted threshold histogram selects S-curve fitted threshold scans
+    plsr_dac = meta_data[:]['PlsrDAC']
+    _, scan_parameters_index = np.unique(plsr_dac, return_index=True)
+    return {'occupancy_hist': occupancy_hist if isinstance(occupancy_hist, SparseHistogram) else occupancy_hist[:], 'scan_parameters': plsr_dac[np.sort(scan_parameters_index)], 'scan_parameter_name': 'PlsrDAC'}  # a sparse occupancy histogram is not densified
+
+
+def _get_mean_kwargs(hist, n_bins, title, x_axis_title, **kwargs):
+    hist = hist[:, :, :n_bins]
+    mean_hist = np.average(hist, axis=2, weights=range(n_bins)) * sum(range(n_bins)) / np.ma.masked_equal(np.sum(hist, axis=2), 0)
+    kwargs.update({'hist': mean_hist, 'title': title, 'x_axis_title': x_axis_title})
+    return kwargs
+
+
+def _get_mean_tdc_kwargs(hist, **_):
+    kwargs = _get_mean_kwargs(hist, 1024, 'Mean TDC', 'mean TDC')  # only take first 1024 values, otherwise memory error likely
+    kwargs['maximum'] = 2 * np.ma.median(np.ma.masked_invalid(kwargs['hist']))
+    return kwargs
+
+
+def _get_threshold_fast_kwargs(hist, noise_hist, threshold_mask=True, maximum=None, **_):
+    return _get_masked_kwargs(hist, noise_hist, threshold_mask, 'Threshold', 'Threshold (masked %i pixel(s))', x_axis_title='threshold [PlsrDAC]', bins=100, minimum=0, maximum=maximum)
+
+
+def _get_noise_fast_kwargs(hist, threshold_mask=True, maximum=None, **_):
+    return _get_masked_kwargs(hist, hist, threshold_mask, 'Noise', 'Noise (masked %i pixel(s))', x_axis_title='noise [PlsrDAC]', bins=100, minimum=0, maximum=maximum)
+
+
+def _get_threshold_kwargs(hist, noise_hist, fitted_threshold_mask=True, maximum=None, **_):
+    return _get_masked_kwargs(hist, noise_hist, fitted_threshold_mask, 'Threshold (S-curve fit)', 'Threshold (S-curve fit, masked %i pixel(s))', x_axis_title='Threshold [PlsrDAC]', bins=100, minimum=0, maximum=maximum)
+
+
+def _get_noise_kwargs(hist, fitted_threshold_mask=True, maximum=None, **_):
+    return _get_masked_kwargs(hist, hist, fitted_threshold_mask, 'Noise (S-curve fit)', 'Noise (S-curve fit, masked %i pixel(s))', x_axis_title='Noise [PlsrDAC]', bins=100, minimum=0, maximum=maximum)
+
+
+def _get_threshold_calib_kwargs(hist, noise_hist, fitted_threshold_mask=True, **_):
+    return _get_masked_kwargs(hist, noise_hist, fitted_threshold_mask, 'Threshold (S-curve fit)', 'Threshold (S-curve fit, masked %i pixel(s))', x_axis_title='Threshold [e]', bins=100, minimum=0)
+
+
+def _get_noise_calib_kwargs(hist, noise_hist, fitted_threshold_mask=True, **_):
+    return _get_masked_kwargs(hist, noise_hist, fitted_threshold_mask, 'Noise (S-curve fit)', 'Noise (S-curve fit, masked %i pixel(s))', x_axis_title='Noise [e]', bins=100, minimum=0)
+
+
+def _get_occupancy_kwargs(hist, occupancy_z_max='median', **_):
+    return {'hist': np.ma.masked_equal(np.sum(hist[:], axis=2), 0), 'z_max': occupancy_z_max}
+
+
+def _get_occupancy_three_way_kwargs(hist, maximum=None, **_):
+    return {'hist': np.ma.masked_equal(np.sum(hist[:], axis=2), 0), 'title': 'Occupancy', 'x_axis_title': 'occupancy', 'maximum': maximum}
+
+
+def _get_fancy_occupancy_kwargs(hist, **_):
+    return {'hist': np.ma.masked_equal(np.sum(hist[:], axis=2), 0), 'z_max': 'median'}
+
+
+def _get_mean_tot_kwargs(hist, **_):
+    return _get_mean_kwargs(hist, 16, 'Mean ToT', 'mean ToT', minimum=0, maximum=15)
+
+
+def _get_relative_bcid_kwargs(hist, **_):
+    return {'hist': hist[0:16]}
+
+
+register_plot('threshold_fast', ('HistThreshold', 'HistNoise'), plotting.plot_three_way, _get_threshold_fast_kwargs)
+register_plot('noise_fast', 'HistNoise', plotting.plot_three_way, _get_noise_fast_kwargs)
+register_plot('threshold', ('HistThresholdFitted', 'HistNoiseFitted'), plotting.plot_three_way, _get_threshold_kwargs)
+register_plot('noise', 'HistNoiseFitted', plotting.plot_three_way, _get_noise_kwargs)
+register_plot('threshold_calib', ('HistThresholdFittedCalib', 'HistNoiseFitted'), plotting.plot_three_way, _get_threshold_calib_kwargs)
+register_plot('noise_calib', ('HistNoiseFittedCalib', 'HistNoiseFitted'), plotting.plot_three_way, _get_noise_calib_kwargs)
+register_plot('scurves', ('HistOcc', 'HistThresholdFitted', 'meta_data'), plotting.plot_scurves, _get_scurves_kwargs)  # only for S-curve fitted threshold scans
+register_plot('occupancy', 'HistOcc', plotting.plot_occupancy, _get_occupancy_kwargs)
+register_plot('occupancy_three_way', 'HistOcc', plotting.plot_three_way, _get_occupancy_three_way_kwargs)
+register_plot('fancy_occupancy', 'HistOcc', plotting.plot_fancy_occupancy, _get_fancy_occupancy_kwargs)
+register_plot('tot', 'HistTot', plotting.plot_tot)
+register_plot('mean_tot', 'HistTotPixel', plotting.plot_three_way, _get_mean_tot_kwargs)
+register_plot('tdc_counter', 'HistTdcCounter', plotting.plot_tdc_counter)
+register_plot('tdc', 'HistTdc', plotting.plot_tdc)
+register_plot('mean_tdc', 'HistTdcPixel', plotting.plot_three_way, _get_mean_tdc_kwargs)
+register_plot('cluster_size', 'HistClusterSize', plotting.plot_cluster_size)
+register_plot('cluster_tot', 'HistClusterTot', plotting.plot_cluster_tot)
+register_plot('cluster_tot_size', 'HistClusterTot', plotting.plot_cluster_tot_size)
+register_plot('relative_bcid', 'HistRelBcid', plotting.plot_relative_bcid, _get_relative_bcid_kwargs)
+register_plot('relative_bcid_stop_mode', 'HistRelBcid', plotting.plot_relative_bcid_stop_mode)
+register_plot('event_errors', 'HistErrorCounter', plotting.plot_event_errors)
+register_plot('service_records', 'HistServiceRecord', plotting.plot_service_records)
+register_plot('trigger_errors', 'HistTriggerErrorCounter', plotting.plot_trigger_errors)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    parser = argparse.ArgumentParser(description='Plots of interpreted pyBAR data files, rendered on demand and cached')
+    parser.add_argument('interpreted_file', help='interpreted data file')
+    parser.add_argument('plots', nargs='*', help='plot names, all available plots if not given')
+    parser.add_argument('--list', action='store_true', help='list the available plots')
+    parser.add_argument('--output', help='PDF file, if not given the cached image file names are printed')
+    parser.add_argument('--format', default='png', choices=output_formats, help='image format of the cached plots')
+    parser.add_argument('--cache_dir', help='plot cache directory, default: plot_cache next to the interpreted data file')
+    parser.add_argument('--max_cache_size', type=int, help='maximum size of the plot cache directory in bytes, default: %d' % max_cache_size)
+    args = parser.parse_args()
+    with tb.open_file(args.interpreted_file, mode="r") as in_file_h5:
+        available_plots = get_plot_names(in_file_h5)
+    if args.list:
+        print '\n'.join(available_plots)
+    elif args.output:
+        write_plots(args.interpreted_file, args.output, names=args.plots or None, cache_dir=args.cache_dir, max_size=args.max_cache_size)
+    else:
+        for plot_name in args.plots or available_plots:
+            print get_plot(args.interpreted_file, plot_name, cache_dir=args.cache_dir, output_format=args.format, max_size=args.max_cache_size)
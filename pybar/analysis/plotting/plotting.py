@@ -18,6 +18,8 @@ import numpy as np
 from scipy.stats import norm  # chisquare, mstats
 # from scipy.optimize import curve_fit
 
+from pybar.analysis.sparse_histogram import SparseHistogram
+
 
 def plot_tdc_event(points, filename=None):
     fig = Figure()
@@ -422,17 +424,27 @@ def plot_cluster_size(hist, title=None, filename=None):
 
 # tornado plot
 def plot_scurves(occupancy_hist, scan_parameters, title='S-curves', ylabel='Occupancy', max_occ=None, scan_parameter_name=None, min_x=None, max_x=None, extend_bin_width=True, filename=None):
-    occ_mask = np.all((occupancy_hist == 0), axis=2) | np.all(np.isnan(occupancy_hist), axis=2)
-    occupancy_hist = np.ma.masked_invalid(occupancy_hist)
-    if max_occ is None:
-        if np.allclose(occupancy_hist, 0.0) or np.all(occ_mask == 1):
-            max_occ = 0.0
-        else:
-            max_occ = math.ceil(2 * np.ma.median(np.amax(occupancy_hist[~occ_mask], axis=1)))
     if len(occupancy_hist.shape) < 3:
         raise ValueError('Found array with shape %s' % str(occupancy_hist.shape))
-
     n_pixel = occupancy_hist.shape[0] * occupancy_hist.shape[1]
+    if isinstance(occupancy_hist, SparseHistogram):  # only the non-zero occupancies are stored
+        pixel_index = occupancy_hist.indices // occupancy_hist.shape[2]
+        occ_mask = np.bincount(pixel_index, minlength=n_pixel) == 0
+        if max_occ is None:
+            if occupancy_hist.nnz == 0:
+                max_occ = 0.0
+            else:
+                pixel_starts = np.flatnonzero(np.r_[True, pixel_index[1:] != pixel_index[:-1]])
+                max_occ = math.ceil(2 * np.median(np.maximum.reduceat(occupancy_hist.values, pixel_starts)))
+    else:
+        occ_mask = np.all((occupancy_hist == 0), axis=2) | np.all(np.isnan(occupancy_hist), axis=2)
+        occupancy_hist = np.ma.masked_invalid(occupancy_hist)
+        if max_occ is None:
+            if np.allclose(occupancy_hist, 0.0) or np.all(occ_mask == 1):
+                max_occ = 0.0
+            else:
+                max_occ = math.ceil(2 * np.ma.median(np.amax(occupancy_hist[~occ_mask], axis=1)))
+
     scan_parameters = np.array(scan_parameters)
     if extend_bin_width and len(scan_parameters) >= 2:
         # adding mirror scan parameter for plotting range -0.5 ...
@@ -446,14 +458,7 @@ def plot_scurves(occupancy_hist, scan_parameters, title='S-curves', ylabel='Occu
     else:
         x_bins = np.arange(-0.5, max(scan_parameters) + 1.5)
     y_bins = np.arange(-0.5, max_occ + 1.5)
-
-    for index, scan_parameter in enumerate(scan_parameters):
-        compressed_data = np.ma.masked_array(occupancy_hist[:, :, index], mask=occ_mask, copy=True).compressed()
-        tmp_hist, yedges, xedges = np.histogram2d(compressed_data, [scan_parameter] * compressed_data.shape[0], bins=(y_bins, x_bins))
-        if index == 0:
-            hist = tmp_hist
-        else:
-            hist += tmp_hist
+    hist, xedges, yedges = get_scurve_hist(occupancy_hist, scan_parameters, x_bins=x_bins, y_bins=y_bins, pixel_mask=np.ma.getdata(occ_mask))
 
     fig = Figure()
     FigureCanvas(fig)
@@ -495,6 +500,66 @@ def plot_scurves(occupancy_hist, scan_parameters, title='S-curves', ylabel='Occu
         fig.savefig(filename)
 
 
+def get_bin_index(values, edges):
+    '''Returns the bin index of the values, -1 for values outside of the bins. The last bin includes its upper edge (like numpy.histogram).
+    '''
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = edges.shape[0] - 2
+    index[index >= edges.shape[0] - 1] = -1
+    return index
+
+
+def get_scurve_hist(occupancy_hist, scan_parameters, x_bins, y_bins, pixel_mask=None, n_pixel_per_chunk=4096):
+    '''Returns the S-curve density, the number of pixels per scan parameter bin and occupancy bin. All scan parameters are histogrammed at once,
+    the occupancy is processed in chunks of pixels.
+
+    Parameters
+    ----------
+    occupancy_hist : numpy.array, numpy.ma.MaskedArray, SparseHistogram
+        Occupancy per pixel (first two dimensions) and scan parameter (third dimension). Masked and not finite values are omitted.
+        For a SparseHistogram only the non-zero occupancies are read, all other occupancies of the not masked pixels are zero.
+    scan_parameters : array
+        Scan parameter value of each index of the third dimension.
+    x_bins, y_bins : array
+        Bin edges of the scan parameter and the occupancy.
+    pixel_mask : numpy.array
+        Boolean array (first two dimensions), True for the pixels to omit.
+    n_pixel_per_chunk : int
+        Number of pixels processed at once.
+
+    Returns
+    -------
+    tuple
+        Histogram (occupancy bins, scan parameter bins), scan parameter bin edges, occupancy bin edges. Equal to the sum of
+        numpy.histogram2d() of the occupancies of each scan parameter.
+    '''
+    x_bins, y_bins = np.asarray(x_bins, dtype=np.float64), np.asarray(y_bins, dtype=np.float64)
+    n_x, n_y = x_bins.shape[0] - 1, y_bins.shape[0] - 1
+    n_pixel, n_scan_parameters = occupancy_hist.shape[0] * occupancy_hist.shape[1], occupancy_hist.shape[2]
+    x_index = get_bin_index(np.asarray(scan_parameters, dtype=np.float64), x_bins)
+    pixel_mask = np.zeros(n_pixel, dtype=np.bool) if pixel_mask is None else np.asarray(pixel_mask, dtype=np.bool).reshape(-1)
+    hist = np.zeros(n_y * n_x, dtype=np.float64)
+    if isinstance(occupancy_hist, SparseHistogram):
+        pixel_index, scan_parameter_index = np.divmod(occupancy_hist.indices, n_scan_parameters)
+        selection = ~pixel_mask[pixel_index]
+        entries_x_index, entries_y_index = x_index[scan_parameter_index[selection]], get_bin_index(occupancy_hist.values[selection], y_bins)
+        selection = (entries_x_index >= 0) & (entries_y_index >= 0)
+        hist += np.bincount(entries_y_index[selection] * n_x + entries_x_index[selection], minlength=n_y * n_x)
+        n_zero = np.count_nonzero(~pixel_mask) - np.bincount(scan_parameter_index[~pixel_mask[pixel_index]], minlength=n_scan_parameters)  # number of not stored zero occupancies per scan parameter
+        zero_y_index = get_bin_index(np.zeros(1), y_bins)[0]
+        if zero_y_index >= 0:
+            hist += np.bincount(zero_y_index * n_x + x_index[x_index >= 0], weights=n_zero[x_index >= 0], minlength=n_y * n_x)
+    else:
+        occupancy_hist = occupancy_hist.reshape(n_pixel, n_scan_parameters)
+        for start in range(0, n_pixel, n_pixel_per_chunk):
+            occupancy = occupancy_hist[start:start + n_pixel_per_chunk]
+            values = np.ma.getdata(occupancy)
+            y_index = get_bin_index(values, y_bins)
+            selection = ~np.ma.getmaskarray(occupancy) & np.isfinite(values) & ~pixel_mask[start:start + n_pixel_per_chunk, np.newaxis] & (x_index >= 0)[np.newaxis, :] & (y_index >= 0)
+            hist += np.bincount((y_index * n_x + x_index[np.newaxis, :])[selection], minlength=n_y * n_x)
+    return hist.reshape(n_y, n_x), x_bins, y_bins
+
+
 def plot_scatter_time(x, y, yerr=None, title=None, legend=None, plot_range=None, plot_range_y=None, x_label=None, y_label=None, marker_style='-o', log_x=False, log_y=False, filename=None):
     logging.info("Plot time scatter plot %s", (': ' + title) if title is not None else '')
     fig = Figure()
@@ -0,0 +1,172 @@
+"""Sparse storage of histograms with a large number of mostly empty bins (e.g. occupancy per pixel and scan parameter).
+Only the non-zero bins are stored (coordinate format with flat bin indices). The histogram is densified lazily per slice.
+"""
+import numpy as np
+import tables as tb
+
+
+class SparseHistogram(object):
+    '''Histogram storing only the non-zero bins. Slicing returns dense numpy arrays (like a PyTables array node).
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the dense histogram.
+    dtype : numpy.dtype
+        Data type of the bin contents.
+    '''
+    def __init__(self, shape, dtype=np.uint32):
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.indices = np.zeros(0, dtype=np.int64)  # sorted flat bin indices of the non-zero bins
+        self.values = np.zeros(0, dtype=self.dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nnz(self):
+        '''Number of non-zero bins.
+        '''
+        return self.indices.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    @classmethod
+    def from_dense(cls, array):
+        '''Creates a sparse histogram from a dense array.
+        '''
+        hist = cls(shape=array.shape, dtype=array.dtype)
+        hist.indices = np.flatnonzero(array).astype(np.int64)
+        hist.values = array.ravel()[hist.indices]
+        return hist
+
+    def fill(self, coordinates, weights=None):
+        '''Adds entries to the histogram, e.g. the hits of a chunk.
+
+        Parameters
+        ----------
+        coordinates : tuple of arrays
+            Bin index per dimension of each entry.
+        weights : array
+            Weight of each entry. If None, each entry is counted once.
+        '''
+        self.fill_indices(np.ravel_multi_index(coordinates, self.shape), weights)
+
+    def fill_indices(self, indices, weights=None):
+        '''Adds entries given by their flat bin index.
+
+        Parameters
+        ----------
+        indices : array
+            Flat bin index of each entry.
+        weights : array
+            Weight of each entry. If None, each entry is counted once.
+        '''
+        if weights is None:
+            weights = np.ones(indices.shape[0], dtype=self.dtype)
+        self._add(indices, weights)
+
+    def __iadd__(self, other):
+        if other.shape != self.shape:
+            raise ValueError('Histogram shapes do not match')
+        self._add(other.indices, other.values)
+        return self
+
+    def _add(self, indices, values):
+        indices, inverse = np.unique(np.concatenate((self.indices, indices)), return_inverse=True)
+        values = np.bincount(inverse, weights=np.concatenate((self.values, values)), minlength=indices.shape[0])
+        selection = values != 0
+        self.indices = indices[selection].astype(np.int64)
+        self.values = values[selection].astype(self.dtype)
+
+    def __getitem__(self, key):
+        '''Returns the dense histogram of the selected bins. Supports integers, slices and Ellipsis.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            index = key.index(Ellipsis)
+            key = key[:index] + (slice(None),) * (self.ndim - len(key) + 1) + key[index + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError('Too many indices')
+        coordinates = np.unravel_index(self.indices, self.shape)
+        selection = np.ones(self.indices.shape[0], dtype=bool)
+        out_shape, out_coordinates = [], []
+        for axis_key, axis_coordinates, n_bins in zip(key, coordinates, self.shape):
+            selected_bins = np.arange(n_bins)[axis_key]
+            position = np.full(n_bins, -1, dtype=np.int64)  # position of each bin in the selection
+            position[selected_bins] = np.arange(np.size(selected_bins))
+            axis_positions = position[axis_coordinates]
+            selection &= axis_positions >= 0
+            if np.ndim(selected_bins):  # integer indices remove the dimension
+                out_shape.append(selected_bins.shape[0])
+                out_coordinates.append(axis_positions)
+        dense = np.zeros(out_shape, dtype=self.dtype)
+        dense[tuple(axis_positions[selection] for axis_positions in out_coordinates)] = self.values[selection]
+        return dense
+
+    def toarray(self):
+        '''Returns the dense histogram.
+        '''
+        return self[...]
+
+    def to_hdf5(self, h5_file, name, title='', filters=None, where=None):
+        '''Stores the histogram in a table with the flat bin index and the bin content of the non-zero bins.
+        The shape is stored in the table attributes.
+
+        Parameters
+        ----------
+        h5_file : tables.File
+        name : string
+            Node name.
+        title : string
+        filters : tables.Filters
+        where : tables.Group
+            Group of the node. If None, the root group.
+        '''
+        data = np.zeros(self.nnz, dtype=[('index', np.int64), ('value', self.dtype)])
+        data['index'], data['value'] = self.indices, self.values
+        table = h5_file.create_table(h5_file.root if where is None else where, name=name, description=data.dtype, title=title, filters=filters, expectedrows=max(self.nnz, 1))
+        table.append(data)
+        table.attrs.sparse_histogram_shape = self.shape
+        return table
+
+    @classmethod
+    def from_hdf5(cls, node):
+        '''Reads a histogram stored with to_hdf5().
+        '''
+        data = node[:]
+        hist = cls(shape=node.attrs.sparse_histogram_shape, dtype=data.dtype['value'])
+        hist.indices, hist.values = data['index'], data['value']
+        return hist
+
+
+def is_sparse_histogram_node(node):
+    '''Returns True if the node stores a sparse histogram.
+    '''
+    return isinstance(node, tb.Table) and 'sparse_histogram_shape' in node.attrs
+
+
+def get_histogram(h5_file, name):
+    '''Returns a histogram node of an interpreted data file. Sparse histograms are returned as SparseHistogram.
+    Both can be sliced to get dense numpy arrays, e.g. get_histogram(h5_file, 'HistOcc')[:, :, 0].
+
+    Parameters
+    ----------
+    h5_file : tables.File
+    name : string
+        Node name.
+
+    Returns
+    -------
+    tables.Array or SparseHistogram
+    '''
+    node = h5_file.get_node(h5_file.root, name)
+    if is_sparse_histogram_node(node):
+        return SparseHistogram.from_hdf5(node)
+    return node
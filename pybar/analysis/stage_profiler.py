@@ -0,0 +1,185 @@
+"""Wall time, CPU time, processed bytes and peak memory of the analysis stages (raw data read, interpretation, histogramming, clustering,
+table writes, S-curve fits, plotting). The stages are recorded per chunk and summarized per stage. The summary and the per chunk records
+are stored in the Profile and ProfileChunks tables of the interpreted data file.
+
+The peak memory is the increase of the peak resident set size of the process during a stage. A stage that stays below the peak of
+the previous stages has no increase. The memory of child processes (e.g. the cluster pipeline, the analysis pool) is not included.
+The wall time of a stage includes the time of nested stages.
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import tables as tb
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class ProfileTable(tb.IsDescription):
+    stage = tb.StringCol(32, pos=0)
+    calls = tb.UInt64Col(pos=1)
+    wall_time = tb.Float64Col(pos=2)  # s
+    cpu_time = tb.Float64Col(pos=3)  # s
+    n_bytes = tb.UInt64Col(pos=4)
+    throughput = tb.Float64Col(pos=5)  # bytes/s
+    peak_rss_delta = tb.UInt64Col(pos=6)  # maximum increase of the peak resident set size per call in bytes
+
+
+class ProfileChunkTable(tb.IsDescription):
+    chunk = tb.Int64Col(pos=0)  # -1: outside of a chunk loop
+    stage = tb.StringCol(32, pos=1)
+    wall_time = tb.Float64Col(pos=2)  # s
+    cpu_time = tb.Float64Col(pos=3)  # s
+    n_bytes = tb.UInt64Col(pos=4)
+    peak_rss_delta = tb.UInt64Col(pos=5)  # increase of the peak resident set size in bytes
+
+
+def get_peak_rss():
+    '''Returns the peak resident set size of the process in bytes, 0 if not available.
+    '''
+    if resource is None:
+        return 0
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024  # kB on Linux
+
+
+def get_cpu_time():
+    '''Returns the user and system CPU time of the process in seconds.
+    '''
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Stage(object):
+    '''Measurement of one stage call. The number of processed bytes can be set until the stage is stopped.
+    '''
+    def __init__(self, name, n_bytes=0, measure=True):
+        self.name = name
+        self.n_bytes = n_bytes
+        if measure:
+            self.peak_rss, self.cpu_time, self.wall_time = get_peak_rss(), get_cpu_time(), time.time()
+        else:
+            self.peak_rss, self.cpu_time, self.wall_time = None, None, None
+
+
+class StageProfiler(object):
+    '''Records wall time, CPU time, processed bytes and the peak memory increase of the analysis stages.
+
+    Parameters
+    ----------
+    enabled : boolean
+        If False, the stages are not measured.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.chunk_index = -1
+        self._n_chunks = 0
+        self._chunks = []  # chunk index, stage, wall time, CPU time, bytes, peak memory increase per stage call
+
+    def next_chunk(self):
+        '''Starts the next chunk. The following stage calls are recorded for this chunk. The chunks of
+        several chunk loops (e.g. interpretation and hit table analysis) are numbered consecutively.
+        '''
+        self.chunk_index = self._n_chunks
+        self._n_chunks += 1
+
+    def end_chunks(self):
+        '''Ends the chunk loop. The following stage calls are recorded outside of a chunk.
+        '''
+        self.chunk_index = -1
+
+    def start(self, name, n_bytes=0):
+        '''Starts the measurement of a stage.
+
+        Parameters
+        ----------
+        name : string
+            Name of the stage.
+        n_bytes : int
+            Number of processed bytes. Can be set later with the n_bytes attribute of the returned Stage.
+
+        Returns
+        -------
+        Stage
+        '''
+        return Stage(name, n_bytes, measure=self.enabled)
+
+    def stop(self, stage):
+        '''Stops the measurement of a stage and records it.
+        '''
+        if stage.wall_time is None:
+            return
+        self._chunks.append((self.chunk_index, stage.name, time.time() - stage.wall_time, get_cpu_time() - stage.cpu_time, stage.n_bytes, get_peak_rss() - stage.peak_rss))
+
+    @contextmanager
+    def stage(self, name, n_bytes=0):
+        '''Context manager measuring a stage, see start().
+        '''
+        stage = self.start(name, n_bytes)
+        try:
+            yield stage
+        finally:
+            self.stop(stage)
+
+    def get_chunks(self):
+        '''Returns the measurements of all stage calls.
+
+        Returns
+        -------
+        numpy.recarray with the columns of ProfileChunkTable
+        '''
+        return np.array(self._chunks, dtype=tb.dtype_from_descr(ProfileChunkTable))
+
+    def get_summary(self):
+        '''Returns the measurements summed per stage in the order of the first call.
+
+        Returns
+        -------
+        numpy.recarray with the columns of ProfileTable
+        '''
+        stages = OrderedDict()
+        for _, name, wall_time, cpu_time, n_bytes, peak_rss_delta in self._chunks:
+            calls, total_wall_time, total_cpu_time, total_n_bytes, max_peak_rss_delta = stages.get(name, (0, 0.0, 0.0, 0, 0))
+            stages[name] = (calls + 1, total_wall_time + wall_time, total_cpu_time + cpu_time, total_n_bytes + n_bytes, max(max_peak_rss_delta, peak_rss_delta))
+        summary = np.zeros(len(stages), dtype=tb.dtype_from_descr(ProfileTable))
+        for index, (name, (calls, wall_time, cpu_time, n_bytes, peak_rss_delta)) in enumerate(stages.iteritems()):
+            summary[index] = (name, calls, wall_time, cpu_time, n_bytes, n_bytes / wall_time if wall_time > 0 else 0.0, peak_rss_delta)
+        return summary
+
+    def store(self, h5_file):
+        '''Stores the summary and the stage calls in the Profile and ProfileChunks tables. Existing tables are replaced.
+
+        Parameters
+        ----------
+        h5_file : tables.File
+            File opened in write or append mode.
+        '''
+        for name, description, title, data in (('Profile', ProfileTable, 'Analysis stage profile', self.get_summary()), ('ProfileChunks', ProfileChunkTable, 'Analysis stage profile per chunk', self.get_chunks())):
+            if name in h5_file.root:
+                h5_file.remove_node(h5_file.root, name)
+            table = h5_file.create_table(h5_file.root, name=name, description=description, title=title)
+            table.append(data)
+            table.flush()
+
+    def log_summary(self, level=logging.INFO):
+        '''Logs the summary table.
+        '''
+        summary = self.get_summary()
+        if summary.shape[0] == 0:
+            return
+        logging.log(level, 'Analysis stage profile:')
+        logging.log(level, '%-24s %8s %10s %10s %12s %12s %14s', 'stage', 'calls', 'wall [s]', 'CPU [s]', 'data [MB]', 'MB/s', 'peak mem [MB]')
+        for stage in summary:
+            logging.log(level, '%-24s %8d %10.3f %10.3f %12.1f %12.1f %14.1f', stage['stage'], stage['calls'], stage['wall_time'], stage['cpu_time'], stage['n_bytes'] / 1e6, stage['throughput'] / 1e6, stage['peak_rss_delta'] / 1e6)
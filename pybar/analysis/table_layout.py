@@ -0,0 +1,109 @@
+"""Layout of the interpreted data tables (Hits, EventMetaData, Cluster, ClusterHits). The chunk shape is derived from the row size,
+the expected number of rows and the read patterns of the analysis functions. The compression level is chosen by compressing the first data
+appended to the table, the size of blosc compressed tables depends strongly on the compression level and the data.
+See examples/example_benchmark/benchmark_table_layout.py for the write and read times of different layouts.
+"""
+import logging
+
+import numpy as np
+import tables as tb
+
+
+target_chunk_bytes = 512 * 1024  # sequential reads are not faster with larger chunks, event range reads are slower
+min_read_chunk_size = 50000  # smallest number of rows read at once by the analysis functions (e.g. analyze_hits_per_scan_parameter())
+complevels = (1, 3, 5, 9)  # compression levels tried
+n_probe_rows = 65536  # number of rows compressed to choose the compression level
+
+
+def get_chunkshape(row_size, expected_rows):
+    '''Returns the chunk shape of a table.
+
+    Parameters
+    ----------
+    row_size : int
+        Size of a table row in bytes.
+    expected_rows : int
+        Estimated number of rows of the table.
+
+    Returns
+    -------
+    tuple
+    '''
+    n_rows = min(target_chunk_bytes // row_size, min_read_chunk_size // 2)  # a read of the smallest chunk size touches at most three chunks
+    return (int(min(n_rows, max(expected_rows, 1024))),)  # the estimate can be too small, e.g. for resumed interpretations
+
+
+def get_filters(data, description, chunkshape, filters):
+    '''Returns the filters with the compression level resulting in the smallest compressed size of the data.
+
+    Parameters
+    ----------
+    data : numpy.array
+        Data of the table, the first n_probe_rows rows are compressed.
+    description : tables.IsDescription, dict of tables.Col, numpy.dtype
+        Description of the table.
+    chunkshape : tuple
+    filters : tables.Filters
+        Filters of the table. Only the compression level is changed.
+
+    Returns
+    -------
+    tables.Filters
+    '''
+    if not filters.complevel or data.shape[0] == 0:
+        return filters
+    sizes = []
+    with tb.open_file('table_layout_probe.h5', mode='w', driver='H5FD_CORE', driver_core_backing_store=0) as probe_file_h5:  # in memory file
+        for complevel in complevels:
+            probe_table = probe_file_h5.create_table(probe_file_h5.root, name='probe_%d' % complevel, description=description, filters=filters.copy(complevel=complevel), chunkshape=chunkshape)
+            probe_table.append(data[:n_probe_rows])
+            probe_table.flush()
+            sizes.append(probe_table.size_on_disk)
+    return filters.copy(complevel=complevels[int(np.argmin(sizes))])  # smallest level for equal sizes
+
+
+class TunedTable(object):
+    '''Table that is created on the first append with the layout tuned to the appended data.
+
+    Parameters
+    ----------
+    h5_file : tables.File
+    name : string
+    description : tables.IsDescription, dict of tables.Col, numpy.dtype
+    expected_rows : int
+        Estimated number of rows of the table.
+    filters : tables.Filters
+    title : string
+    '''
+    def __init__(self, h5_file, name, description, expected_rows, filters, title=''):
+        self.h5_file = h5_file
+        self.name = name
+        self.description = description
+        self.expected_rows = int(max(expected_rows, 1))
+        self.filters = filters
+        self.title = title
+        self.table = None
+
+    def append(self, rows):
+        if self.table is None:
+            if rows.shape[0] == 0:  # tune with the first data
+                return
+            self.create(rows)
+        self.table.append(rows)
+
+    def create(self, data=None):
+        '''Creates the table if not already created.
+
+        Parameters
+        ----------
+        data : numpy.array
+            Data to tune the compression level. If None, the given filters are used.
+        '''
+        if self.table is not None:
+            return self.table
+        dtype = self.description if isinstance(self.description, np.dtype) else tb.description.dtype_from_descr(self.description)
+        chunkshape = get_chunkshape(dtype.itemsize, self.expected_rows)
+        filters = self.filters if data is None else get_filters(data, self.description, chunkshape, self.filters)
+        logging.debug('Creating table %s with chunk shape %s and compression level %d', self.name, chunkshape, filters.complevel)
+        self.table = self.h5_file.create_table(self.h5_file.root, name=self.name, description=self.description, title=self.title, filters=filters, chunkshape=chunkshape, expectedrows=self.expected_rows)
+        return self.table
@@ -0,0 +1,155 @@
+"""Quantities of an interpreted data file as a function of time: mean beam spot position, event rate and number of cluster per event.
+The time bins are formed by combining a fixed number of read outs of the meta data (combine_n_readouts). The hit and the cluster table are
+read once in chunks and the quantities of all time bins are accumulated together, see get_time_series() and analysis.analyze_time_series().
+"""
+from __future__ import division
+
+import logging
+
+import numpy as np
+import tables as tb
+
+from pybar_fei4_interpreter.analysis_utils import hist_2d_index, get_n_cluster_in_events
+
+
+class TimeSeries(object):
+    '''Accumulates hits and clusters per time bin. The hits and clusters have to be added in the order of the event number.
+
+    Parameters
+    ----------
+    meta_data : numpy.recarray
+        Meta data with event_number and timestamp_start column.
+    combine_n_readouts : int
+        Number of read outs per time bin.
+    n_cluster_bins : int
+        Number of bins of the number of cluster per event histograms.
+    occupancy_callback : function
+        If not None, called with the time bin index and the occupancy histogram (row, column) of every time bin.
+    '''
+    def __init__(self, meta_data, combine_n_readouts=1000, n_cluster_bins=10, occupancy_callback=None):
+        self.timestamp_start = meta_data['timestamp_start'][::combine_n_readouts].astype(np.float64)
+        self.timestamp_stop = np.append(self.timestamp_start[1:], np.nan)  # the last time bin has no stop time stamp
+        self.event_number_start = meta_data['event_number'][::combine_n_readouts].astype(np.int64)
+        self.n_bins = self.timestamp_start.shape[0]
+        self.n_cluster_bins = n_cluster_bins
+        self.occupancy_callback = occupancy_callback
+        self.n_hits = np.zeros(self.n_bins, dtype=np.int64)
+        self.sum_column = np.zeros(self.n_bins, dtype=np.float64)
+        self.sum_row = np.zeros(self.n_bins, dtype=np.float64)
+        self.n_cluster_hist = np.zeros((self.n_bins, n_cluster_bins), dtype=np.int64)
+        self.n_events_with_cluster = np.zeros(self.n_bins, dtype=np.int64)
+        self._last_event = None  # event number and number of cluster of the last event, it can continue in the next cluster chunk
+        self._occupancy_bin = 0  # time bin of the occupancy histogram
+        self._occupancy = np.zeros((80, 336), dtype=np.uint32)  # occupancy (column, row) of the current time bin
+
+    def get_time_bins(self, event_numbers):
+        '''Returns the time bin index of the event numbers, -1 for events before the first time bin.
+        '''
+        return np.searchsorted(self.event_number_start, event_numbers, side='right') - 1
+
+    def add_hits(self, hits):
+        time_bins = self.get_time_bins(hits['event_number'])
+        selection = time_bins >= 0
+        if not np.all(selection):
+            hits, time_bins = hits[selection], time_bins[selection]
+        self.n_hits += np.bincount(time_bins, minlength=self.n_bins)
+        self.sum_column += np.bincount(time_bins, weights=hits['column'] - 1, minlength=self.n_bins)
+        self.sum_row += np.bincount(time_bins, weights=hits['row'] - 1, minlength=self.n_bins)
+        if self.occupancy_callback is not None and hits.shape[0]:
+            bin_starts = np.searchsorted(time_bins, np.arange(time_bins[0], time_bins[-1] + 2))  # hits are sorted by time bin
+            for time_bin, start, stop in zip(range(time_bins[0], time_bins[-1] + 1), bin_starts[:-1], bin_starts[1:]):
+                if start == stop:
+                    continue
+                self._set_occupancy_bin(time_bin)
+                self._occupancy += hist_2d_index(hits['column'][start:stop] - 1, hits['row'][start:stop] - 1, shape=(80, 336)).astype(np.uint32)
+
+    def add_cluster(self, cluster):
+        if cluster.shape[0] == 0:
+            return
+        n_cluster = get_n_cluster_in_events(cluster['event_number'])  # event number, number of cluster
+        if self._last_event is not None:
+            if n_cluster[0, 0] == self._last_event[0]:  # the event continues in this chunk
+                n_cluster[0, 1] += self._last_event[1]
+            else:
+                self._add_n_cluster(np.array([self._last_event]))
+        self._last_event = tuple(n_cluster[-1])
+        self._add_n_cluster(n_cluster[:-1])
+
+    def _add_n_cluster(self, n_cluster):
+        time_bins = self.get_time_bins(n_cluster[:, 0])
+        self.n_events_with_cluster += np.bincount(time_bins[time_bins >= 0], minlength=self.n_bins)
+        selection = np.logical_and(time_bins >= 0, n_cluster[:, 1] <= self.n_cluster_bins)  # the last histogram bin includes its upper edge
+        hist_indices = time_bins[selection] * self.n_cluster_bins + np.minimum(n_cluster[selection, 1], self.n_cluster_bins - 1)
+        self.n_cluster_hist += np.bincount(hist_indices, minlength=self.n_bins * self.n_cluster_bins).reshape(self.n_bins, self.n_cluster_bins)
+
+    def _set_occupancy_bin(self, time_bin):  # reports the occupancy of the time bins before time_bin, also of the time bins without hits
+        while self._occupancy_bin < time_bin:
+            self.occupancy_callback(self._occupancy_bin, self._occupancy.T)
+            self._occupancy_bin += 1
+            self._occupancy = np.zeros((80, 336), dtype=np.uint32)
+
+    def finish(self):
+        '''Adds the last event of the cluster and reports the occupancy of the remaining time bins. Has to be called after the last hits and clusters were added.
+        '''
+        if self._last_event is not None:
+            self._add_n_cluster(np.array([self._last_event]))
+            self._last_event = None
+        if self.occupancy_callback is not None:
+            self._set_occupancy_bin(self.n_bins)
+
+    def get_beam_spot(self):
+        '''Returns the mean column and row index per time bin (NaN for time bins without hits).
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum_column / self.n_hits, self.sum_row / self.n_hits
+
+    def get_event_rate(self):
+        '''Returns the number of events per second for all but the last time bin.
+        '''
+        return np.diff(self.event_number_start) / np.diff(self.timestamp_start)
+
+    def get_n_cluster_per_event(self, include_no_cluster=False):
+        '''Returns the fraction of events per number of cluster per time bin.
+
+        Parameters
+        ----------
+        include_no_cluster : bool
+            If True, the events without cluster are counted in the first bin. Not available for the last time bin, since its number of events is not known.
+        '''
+        hist = self.n_cluster_hist.astype(np.float64)
+        if include_no_cluster:
+            hist[:-1, 0] = np.diff(self.event_number_start) - self.n_events_with_cluster[:-1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (hist / np.sum(hist, axis=1)[:, np.newaxis]).astype(np.float32)
+
+
+def get_time_series(interpreted_file, combine_n_readouts=1000, hits=True, cluster=True, chunk_size=10000000, occupancy_callback=None):
+    '''Reads the hit and cluster table of an interpreted data file once and returns the accumulated TimeSeries.
+
+    Parameters
+    ----------
+    interpreted_file : string
+    combine_n_readouts : int
+        Number of read outs per time bin.
+    hits, cluster : bool
+        If True, the hit / cluster table is read.
+    chunk_size : int
+        Number of table rows read at once.
+    occupancy_callback : function
+        See TimeSeries.
+
+    Returns
+    -------
+    TimeSeries
+    '''
+    with tb.open_file(interpreted_file, mode="r") as in_file_h5:
+        time_series = TimeSeries(in_file_h5.root.meta_data[:], combine_n_readouts=combine_n_readouts, occupancy_callback=occupancy_callback if hits else None)
+        for use_table, table_name, add_data in ((hits, 'Hits', time_series.add_hits), (cluster, 'Cluster', time_series.add_cluster)):
+            if not use_table:
+                continue
+            table = in_file_h5.get_node(in_file_h5.root, table_name)
+            logging.debug('Read %d rows of %s', table.nrows, table._v_pathname)
+            for start_index in range(0, table.nrows, chunk_size):
+                add_data(table.read(start_index, start_index + chunk_size))
+        time_series.finish()
+    return time_series
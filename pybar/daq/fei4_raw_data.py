@@ -9,6 +9,8 @@ import zmq
 
 from pybar_fei4_interpreter.data_struct import MetaTableV2 as MetaTable, generate_scan_parameter_description
 
+from pybar.daq import run_catalog
+
 
 def send_meta_data(socket, conf, name):
     '''Sends the config via ZeroMQ to a specified socket. Is called at the beginning of a run and when the config changes. Conf can be any config dictionary.
@@ -44,8 +46,9 @@ def send_data(socket, data, scan_parameters={}, name='ReadoutData'):
         pass
 
 
-def open_raw_data_file(filename, mode="w", title="", scan_parameters=None, socket_address=None):
-    '''Mimics pytables.open_file() and stores the configuration and run configuration
+def open_raw_data_file(filename, mode="w", title="", scan_parameters=None, socket_address=None, catalog=True):
+    '''Mimics pytables.open_file() and stores the configuration and run configuration. If catalog is False, the closed
+    file(s) are not added to the run catalog (e.g. temporary copies).
 
     Returns:
     RawDataFile Object
@@ -55,7 +58,7 @@ def open_raw_data_file(filename, mode="w", title="", scan_parameters=None, socke
         # do something here
         raw_data_file.append(self.readout.data, scan_parameters={scan_parameter:scan_parameter_value})
     '''
-    return RawDataFile(filename=filename, mode=mode, title=title, scan_parameters=scan_parameters, socket_address=socket_address)
+    return RawDataFile(filename=filename, mode=mode, title=title, scan_parameters=scan_parameters, socket_address=socket_address, catalog=catalog)
 
 
 class RawDataFile(object):
@@ -65,7 +68,7 @@ class RawDataFile(object):
     '''Raw data file object. Saving data queue to HDF5 file.
     '''
 
-    def __init__(self, filename, mode="w", title='', scan_parameters=None, socket_address=None):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created):
+    def __init__(self, filename, mode="w", title='', scan_parameters=None, socket_address=None, catalog=True):  # mode="r+" to append data, raw_data_file_h5 must exist, "w" to overwrite raw_data_file_h5, "a" to append data, if raw_data_file_h5 does not exist it is created):
         self.lock = RLock()
         if os.path.splitext(filename)[1].strip().lower() != '.h5':
             self.base_filename = filename
@@ -81,6 +84,8 @@ class RawDataFile(object):
         self.meta_data_table = None
         self.scan_param_table = None
         self.h5_file = None
+        self.live_interpretation = None  # receives the data of the raw data file (see pybar.analysis.live_interpretation)
+        self.catalog = catalog  # add the closed file(s) to the run catalog
 
         if socket_address:
             context = zmq.Context.instance()
@@ -139,12 +144,43 @@ class RawDataFile(object):
             except tb.exceptions.NodeError:
                 self.scan_param_table = self.h5_file.get_node(self.h5_file.root, name='scan_parameters')
 
-    def close(self, close_socket=True):
+    def close(self, close_socket=True, base_filename=None, part=None):
+        '''Closes the raw data file and adds it to the run catalog if enabled.
+
+        Parameters
+        ----------
+        close_socket : bool
+            If True, the socket connection is closed.
+        base_filename : string
+            Base file name of the run for the run catalog. If None, the base file name of the raw data file.
+        part : int
+            Index of the file (file size limit) for the run catalog. If None, the index of the current file.
+        '''
         with self.lock:
+            if base_filename is None:
+                base_filename = self.base_filename
+            if part is None:
+                part = self.filenames.get(self.curr_filename, 0)
             self.flush()
             logging.info('Closing raw data file: %s', self.h5_file.filename)
-            self.h5_file.close()
-            self.h5_file = None
+            filename = self.h5_file.filename
+            if not self.catalog:
+                self.h5_file.close()
+                self.h5_file = None
+            else:
+                try:  # the run catalog is not needed to take data
+                    catalog_info = run_catalog.get_file_info(self.h5_file)
+                except Exception:
+                    catalog_info = None
+                self.h5_file.close()
+                self.h5_file = None
+                try:
+                    if catalog_info is not None:
+                        run_catalog.RunCatalog(os.path.dirname(os.path.abspath(filename))).add_file(filename, catalog_info, base_file_name=base_filename, part=part)
+                except Exception:
+                    catalog_info = None
+                if catalog_info is None:
+                    logging.warning('Cannot add %s to the run catalog', filename)
         if self.socket and close_socket:
             logging.info('Closing socket connection')
             self.socket.close()  # close here, do not wait for garbage collector
@@ -152,6 +188,7 @@ class RawDataFile(object):
 
     def append_item(self, data_tuple, scan_parameters=None, new_file=False, flush=True):
         with self.lock:
+            curr_base_filename, curr_part = self.base_filename, self.filenames.get(self.curr_filename, 0)  # catalog entry of the opened file, taken before switching to a new file
             if scan_parameters:
                 # check for not existing keys
                 diff = set(scan_parameters).difference(set(self.scan_parameters))
@@ -173,8 +210,9 @@ class RawDataFile(object):
                     with tb.open_file(filename, mode='a', title=filename) as h5_file:  # append, since file can already exists when scan parameters are jumping back and forth
                         for node in nodes:
                             self.h5_file.copy_node(node, h5_file.root, overwrite=True, recursive=True)
-                    self.close(close_socket=False)
+                    self.close(close_socket=False, base_filename=curr_base_filename, part=curr_part)
                     self.open(filename, 'a', filename)
+                    self.abort_live_interpretation('Raw data is written to multiple files')
             total_words = self.raw_data_earray.nrows
             raw_data = data_tuple[0]
             len_raw_data = raw_data.shape[0]
@@ -187,8 +225,9 @@ class RawDataFile(object):
                 with tb.open_file(filename, mode='a', title=filename) as h5_file:  # append, since file can already exists when scan parameters are jumping back and forth
                     for node in nodes:
                         self.h5_file.copy_node(node, h5_file.root, overwrite=True, recursive=True)
-                self.close(close_socket=False)
+                self.close(close_socket=False, base_filename=curr_base_filename, part=curr_part)
                 self.open(filename, 'a', filename)
+                self.abort_live_interpretation('Raw data is written to multiple files')
                 total_words = self.raw_data_earray.nrows  # in case of re-opening existing file
             self.raw_data_earray.append(raw_data)
             self.meta_data_table.row['timestamp_start'] = data_tuple[1]
@@ -207,6 +246,21 @@ class RawDataFile(object):
                 self.flush()
             if self.socket:
                 send_data(self.socket, data_tuple, self.scan_parameters)
+            if self.live_interpretation is not None and not self.live_interpretation.add_data(data_tuple, self.scan_parameters):
+                self.abort_live_interpretation('Live interpretation cannot keep up with the data taking')
+
+    def abort_live_interpretation(self, reason):
+        '''Aborts the live interpretation, e.g. if raw data is written to multiple files (the live interpretation supports only a single raw data file).
+
+        Parameters
+        ----------
+        reason : string
+            Reason of the abort.
+        '''
+        if self.live_interpretation is not None:
+            logging.warning('%s, aborting live interpretation', reason)
+            self.live_interpretation.abort()
+            self.live_interpretation = None
 
     def append(self, data_iterable, scan_parameters=None, new_file=False, flush=True):
         with self.lock:
@@ -0,0 +1,224 @@
+"""Catalog of the raw data files and runs of a module directory in a SQLite database (run_catalog.sqlite). The raw data files are added
+when they are closed (see RawDataFile.close()), the run status is added at the end of a run (see Fei4RunBase). The analysis functions
+(e.g. get_data_file_names_from_scan_base(), get_parameter_from_files(), combine_meta_data()) take the number of raw data words and readouts,
+the time range and the scan parameter values from the catalog instead of opening the files. A catalog entry is used only if the size and
+the modification time of the file are unchanged. Existing files are added with RunCatalog.update().
+"""
+import logging
+import os
+import re
+import glob
+import json
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import tables as tb
+
+
+catalog_file_name = 'run_catalog.sqlite'
+analysis_file_suffixes = ('_analyzed.h5', '_interpreted.h5', '_cut.h5', '_result.h5', '_hists.h5')  # files without raw data, not added by RunCatalog.update()
+
+_schema = ('CREATE TABLE IF NOT EXISTS files (file_name TEXT PRIMARY KEY, base_file_name TEXT, part INTEGER, run_number INTEGER, n_words INTEGER, n_readouts INTEGER, timestamp_start REAL, timestamp_stop REAL, size INTEGER, mtime REAL)',
+           'CREATE TABLE IF NOT EXISTS scan_parameters (file_name TEXT, name TEXT, position INTEGER, min_value INTEGER, max_value INTEGER, scan_values TEXT, PRIMARY KEY (file_name, name))',
+           'CREATE TABLE IF NOT EXISTS runs (run_number INTEGER PRIMARY KEY, scan_id TEXT, status TEXT, start_time TEXT, stop_time TEXT)')
+
+
+def get_run_number(file_name):
+    '''Returns the run number from the file name (<run number>_<module id>_<scan id>...), None if the file name does not start with a run number.
+    '''
+    match = re.match(r'(\d+)_', os.path.basename(file_name))
+    return int(match.group(1)) if match else None
+
+
+def get_file_info(h5_file):
+    '''Returns the catalog entry of an opened raw data file.
+
+    Parameters
+    ----------
+    h5_file : tables.File
+
+    Returns
+    -------
+    dict
+        Number of raw data words and readouts, time range of the readouts and scan parameter values (ordered list of name, values).
+    '''
+    meta_data = h5_file.root.meta_data
+    info = {'n_words': h5_file.root.raw_data.shape[0], 'n_readouts': meta_data.nrows, 'timestamp_start': None, 'timestamp_stop': None, 'scan_parameters': []}
+    if meta_data.nrows:
+        if 'timestamp_start' in meta_data.colnames:
+            info['timestamp_start'], info['timestamp_stop'] = float(meta_data[0]['timestamp_start']), float(meta_data[-1]['timestamp_stop'])
+        else:  # old meta data format
+            info['timestamp_start'], info['timestamp_stop'] = float(meta_data[0]['timestamp']), float(meta_data[-1]['timestamp'])
+    if 'scan_parameters' in h5_file.root:
+        scan_parameters = h5_file.root.scan_parameters[:]
+        info['scan_parameters'] = [(name, np.unique(scan_parameters[name]).tolist()) for name in scan_parameters.dtype.names]
+    return info
+
+
+def get_file_infos(file_names):
+    '''Returns the catalog entries of the files. Files not in a catalog or changed since being cataloged are omitted.
+
+    Parameters
+    ----------
+    file_names : iterable of strings
+
+    Returns
+    -------
+    dict
+        Catalog entry (see get_file_info()) per file name.
+    '''
+    file_names_per_directory = {}
+    for file_name in file_names:
+        file_names_per_directory.setdefault(os.path.dirname(os.path.abspath(file_name)), []).append(file_name)
+    infos = {}
+    for directory, directory_file_names in file_names_per_directory.iteritems():
+        catalog = RunCatalog(directory)
+        if not catalog.exists():
+            continue
+        try:
+            infos.update(catalog.get_files(directory_file_names))
+        except sqlite3.Error:
+            logging.warning('Cannot read run catalog %s', catalog.file_name)
+    return infos
+
+
+class RunCatalog(object):
+    '''Run catalog of a directory.
+
+    Parameters
+    ----------
+    directory : string
+        Directory of the raw data files.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.file_name = os.path.join(directory, catalog_file_name)
+
+    def exists(self):
+        return os.path.isfile(self.file_name)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.file_name, timeout=30.0)  # several processes can access the catalog
+        for statement in _schema:
+            connection.execute(statement)
+        return connection
+
+    def add_file(self, file_name, info, base_file_name=None, part=0):
+        '''Adds a closed raw data file. An existing entry is replaced.
+
+        Parameters
+        ----------
+        file_name : string
+        info : dict
+            Catalog entry of the file, see get_file_info().
+        base_file_name : string
+            File name without scan parameter and part suffix of the files of one run.
+        part : int
+            Index of the file if a run is split into several files due to the file size.
+        '''
+        stat = os.stat(file_name)
+        name = os.path.basename(file_name)
+        with closing(self._connect()) as connection:
+            with connection:  # transaction
+                connection.execute('DELETE FROM scan_parameters WHERE file_name = ?', (name,))
+                base_name = os.path.basename(base_file_name) if base_file_name else os.path.splitext(name)[0]
+                connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (name, base_name, part, get_run_number(name), info['n_words'], info['n_readouts'], info['timestamp_start'], info['timestamp_stop'], stat.st_size, stat.st_mtime))
+                connection.executemany('INSERT INTO scan_parameters VALUES (?, ?, ?, ?, ?, ?)', [(name, parameter, position, min(values) if values else None, max(values) if values else None, json.dumps(values)) for position, (parameter, values) in enumerate(info['scan_parameters'])])
+
+    def get_files(self, file_names=None):
+        '''Returns the catalog entries of files in the directory. Files not in the catalog or changed since being cataloged are omitted.
+
+        Parameters
+        ----------
+        file_names : iterable of strings
+            If None, all cataloged files.
+
+        Returns
+        -------
+        dict
+            Catalog entry (see get_file_info()) with base_file_name, part and run_number per file name.
+        '''
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT file_name, base_file_name, part, run_number, n_words, n_readouts, timestamp_start, timestamp_stop, size, mtime FROM files').fetchall()
+            scan_parameters = connection.execute('SELECT file_name, name, scan_values FROM scan_parameters ORDER BY file_name, position').fetchall()
+        if file_names is None:
+            file_names = [os.path.join(self.directory, row[0]) for row in rows]
+        file_names = dict((os.path.basename(file_name), file_name) for file_name in file_names)
+        infos = {}
+        for name, base_file_name, part, run_number, n_words, n_readouts, timestamp_start, timestamp_stop, size, mtime in rows:
+            if name not in file_names:
+                continue
+            try:
+                stat = os.stat(file_names[name])
+            except OSError:  # file removed
+                continue
+            if stat.st_size != size or stat.st_mtime != mtime:  # file changed
+                continue
+            infos[file_names[name]] = {'base_file_name': base_file_name, 'part': part, 'run_number': run_number, 'n_words': n_words, 'n_readouts': n_readouts, 'timestamp_start': timestamp_start, 'timestamp_stop': timestamp_stop, 'scan_parameters': []}
+        cataloged_file_names = dict((os.path.basename(file_name), file_name) for file_name in infos)
+        for name, parameter, values in scan_parameters:
+            if name in cataloged_file_names:
+                infos[cataloged_file_names[name]]['scan_parameters'].append((parameter, json.loads(values)))
+        return infos
+
+    def update(self):
+        '''Adds the raw data files of the directory which are not cataloged or changed since being cataloged.
+
+        Returns
+        -------
+        list of strings
+            Added file names.
+        '''
+        file_names = [file_name for file_name in glob.glob(os.path.join(self.directory, '*.h5')) if not any(file_name.endswith(suffix) for suffix in analysis_file_suffixes)]
+        cataloged = self.get_files(file_names)
+        added_file_names = []
+        for file_name in sorted(set(file_names) - set(cataloged)):
+            try:
+                with tb.open_file(file_name, mode="r") as h5_file:
+                    if 'raw_data' not in h5_file.root or 'meta_data' not in h5_file.root:
+                        continue
+                    info = get_file_info(h5_file)
+            except (IOError, tb.HDF5ExtError):
+                logging.warning('Cannot read %s', file_name)
+                continue
+            self.add_file(file_name, info)
+            added_file_names.append(file_name)
+        if added_file_names:
+            logging.info('Added %d file(s) to the run catalog %s', len(added_file_names), self.file_name)
+        return added_file_names
+
+    def set_run_status(self, run_number, scan_id, status, start_time=None, stop_time=None):
+        '''Adds or updates a run.
+
+        Parameters
+        ----------
+        run_number : int
+        scan_id : string
+        status : string
+            Run status (e.g. FINISHED, ABORTED), see run_manager.run_status.
+        start_time, stop_time : datetime.datetime
+        '''
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)', (run_number, scan_id, status, None if start_time is None else str(start_time), None if stop_time is None else str(stop_time)))
+
+    def get_runs(self, status=None):
+        '''Returns the runs.
+
+        Parameters
+        ----------
+        status : string, iterable of strings
+            If not None, only the runs with the given status.
+
+        Returns
+        -------
+        list of dict
+            Run number, scan id, status, start and stop time per run ordered by run number.
+        '''
+        if isinstance(status, basestring):
+            status = (status,)
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT run_number, scan_id, status, start_time, stop_time FROM runs ORDER BY run_number').fetchall()
+        return [dict(zip(('run_number', 'scan_id', 'status', 'start_time', 'stop_time'), row)) for row in rows if status is None or row[2] in status]
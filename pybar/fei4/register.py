@@ -7,6 +7,7 @@ from collections import OrderedDict
 import copy
 import datetime
 from contextlib import contextmanager
+from functools import wraps
 from importlib import import_module
 from operator import itemgetter
 
@@ -90,6 +91,10 @@ class FEI4Register(object):
             readonly = reg.get('readonly', False)
             description = reg.get('description', '')
             self.global_registers[name] = dict(name=name, address=address, offset=offset, bitlength=bitlength, addresses=addresses, littleendian=littleendian, register_littleendian=register_littleendian, value=value, readonly=readonly, description=description)
+        self.global_register_names_by_address = {}  # speed up of get_global_register_bitsets(), names since restore() replaces the register objects
+        for name, reg in self.global_registers.iteritems():
+            for address in reg['addresses']:
+                self.global_register_names_by_address.setdefault(address, []).append(name)
         for name, reg in fe_type['pixel_registers'].iteritems():
             pxstrobe = reg.get('pxstrobe')
             bitlength = reg.get('bitlength')
@@ -138,10 +143,12 @@ class FEI4Register(object):
         Parameters
         ----------
         configuration_file : string
-            Path to the configuration file (text or HDF5 file).
+            Path to the configuration file (text, HDF5 or binary snapshot file).
         '''
         if os.path.isfile(configuration_file):
-            if not isinstance(configuration_file, tb.file.File) and os.path.splitext(configuration_file)[1].strip().lower() != ".h5":
+            if not isinstance(configuration_file, tb.file.File) and os.path.splitext(configuration_file)[1].strip().lower() == ".npz":
+                load_configuration_from_npz(self, configuration_file)
+            elif not isinstance(configuration_file, tb.file.File) and os.path.splitext(configuration_file)[1].strip().lower() != ".h5":
                 load_configuration_from_text_file(self, configuration_file)
             else:
                 load_configuration_from_hdf5(self, configuration_file)
@@ -154,9 +161,11 @@ class FEI4Register(object):
         Parameters
         ----------
         configuration_file : string
-            Filename of the configuration file.
+            Filename of the configuration file (text, HDF5 or binary snapshot file).
         '''
-        if not isinstance(configuration_file, tb.file.File) and os.path.splitext(configuration_file)[1].strip().lower() != ".h5":
+        if not isinstance(configuration_file, tb.file.File) and os.path.splitext(configuration_file)[1].strip().lower() == ".npz":
+            return save_configuration_to_npz(self, configuration_file)
+        elif not isinstance(configuration_file, tb.file.File) and os.path.splitext(configuration_file)[1].strip().lower() != ".h5":
             return save_configuration_to_text_file(self, configuration_file)
         else:
             return save_configuration_to_hdf5(self, configuration_file)
@@ -247,6 +256,7 @@ class FEI4Register(object):
                 dcs = range(40)
             joint_write = kwargs.pop("joint_write", False)
             same_mask_for_all_dc = kwargs.pop("same_mask_for_all_dc", False)
+            write_dcs = dcs[:1] if same_mask_for_all_dc else dcs
             register_objects = self.get_pixel_register_objects(do_sort=['pxstrobe'], **kwargs)
             # prepare for writing pixel registers
             if not self.broadcast:
@@ -300,10 +310,10 @@ class FEI4Register(object):
                     self.set_global_register_value("Latch_En", 0)
                 self.set_global_register_value("Pixel_Strobes", pxstrobes)
                 commands.extend(self.get_commands("WrRegister", name=["Pixel_Strobes", "Latch_En"]))
-                for dc_no in (dcs[:1] if same_mask_for_all_dc else dcs):
+                register_bitsets = self.get_pixel_register_bitsets(register_objects[0], bit_nos=[0], dcs=write_dcs)[0]
+                for dc_no, register_bitset in zip(write_dcs, register_bitsets):
                     self.set_global_register_value("Colpr_Addr", dc_no)
                     commands.extend(self.get_commands("WrRegister", name=["Colpr_Addr"]))
-                    register_bitset = self.get_pixel_register_bitset(register_objects[0], 0, dc_no)
                     commands.extend([self.build_command(command_name, PixelData=register_bitset, ChipID=8, **kwargs)])  # broadcast
                     if do_latch:
                         commands.extend(self.get_commands("GlobalPulse", Width=0))
@@ -320,14 +330,14 @@ class FEI4Register(object):
                         self.set_global_register_value("Latch_En", 1)
                         commands.extend(self.get_commands("WrRegister", name=["Latch_En"]))
                     bitlength = register_object['bitlength']
+                    register_bitsets = self.get_pixel_register_bitsets(register_object, dcs=write_dcs)  # all bits and double columns at once
                     for bit_no, pxstrobe_bit_no in (enumerate(range(bitlength)) if (register_object['littleendian'] is False) else enumerate(reversed(range(bitlength)))):
                         if do_latch:
                             self.set_global_register_value("Pixel_Strobes", 2 ** (pxstrobe + bit_no))
                             commands.extend(self.get_commands("WrRegister", name=["Pixel_Strobes"]))
-                        for dc_no in (dcs[:1] if same_mask_for_all_dc else dcs):
+                        for dc_no, register_bitset in zip(write_dcs, register_bitsets[pxstrobe_bit_no]):
                             self.set_global_register_value("Colpr_Addr", dc_no)
                             commands.extend(self.get_commands("WrRegister", name=["Colpr_Addr"]))
-                            register_bitset = self.get_pixel_register_bitset(register_object, pxstrobe_bit_no, dc_no)
                             commands.extend([self.build_command(command_name, PixelData=register_bitset, ChipID=8, **kwargs)])  # broadcast
                             if do_latch:
                                 commands.extend(self.get_commands("GlobalPulse", Width=0))
@@ -373,6 +383,7 @@ class FEI4Register(object):
             for register_object in register_objects:
                 pxstrobe = register_object['pxstrobe']
                 bitlength = register_object['bitlength']
+                register_bitsets = self.get_pixel_register_bitsets(register_object, dcs=dcs)  # all bits and double columns at once
                 for pxstrobe_bit_no in range(bitlength):
                     logging.debug('Pixel Register %s Bit %d', register_object['name'], pxstrobe_bit_no)
                     do_latch = True
@@ -382,7 +393,7 @@ class FEI4Register(object):
                         self.set_global_register_value("Pixel_Strobes", 0)  # do not latch
                         do_latch = False
                     commands.extend(self.get_commands("WrRegister", name=["Pixel_Strobes"]))
-                    for dc_no in dcs:
+                    for dc_no, register_bitset in zip(dcs, register_bitsets[pxstrobe_bit_no if (register_object['littleendian'] is False) else register_object['bitlength'] - pxstrobe_bit_no - 1]):
                         self.set_global_register_value("Colpr_Addr", dc_no)
                         commands.extend(self.get_commands("WrRegister", name=["Colpr_Addr"]))
                         if do_latch is True:
@@ -395,7 +406,6 @@ class FEI4Register(object):
                         self.set_global_register_value("S1", 0)
                         self.set_global_register_value("SR_Clock", 0)
                         commands.extend(self.get_commands("WrRegister", name=["S0", "S1", "SR_Clock"]))
-                        register_bitset = self.get_pixel_register_bitset(register_object, pxstrobe_bit_no if (register_object['littleendian'] is False) else register_object['bitlength'] - pxstrobe_bit_no - 1, dc_no)
                         if self.fei4b:
                             self.set_global_register_value("SR_Read", 1)
                             commands.extend(self.get_commands("WrRegister", name=["SR_Read"]))
@@ -527,7 +537,9 @@ class FEI4Register(object):
         """
         register_bitsets = []
         for register_address in register_addresses:
-            register_objects = self.get_global_register_objects(addresses=register_address)
+            register_objects = [self.global_registers[name] for name in self.global_register_names_by_address.get(register_address, [])]
+            if not register_objects:
+                raise ValueError('Global register objects empty')
             register_bitset = bitarray(16, endian='little')  # TODO remove hardcoded register size, see also below
             register_bitset.setall(0)
             register_littleendian = False
@@ -582,19 +594,34 @@ class FEI4Register(object):
         """
         if not 0 <= dc_no < 40:
             raise ValueError("Pixel register %s: DC out of range" % register_object['name'])
-        if not 0 <= bit_no < register_object['bitlength']:
+        return self.get_pixel_register_bitsets(register_object, bit_nos=[bit_no], dcs=[dc_no])[0][0]
+
+    def get_pixel_register_bitsets(self, register_object, bit_nos=None, dcs=None):
+        """Calculating pixel register bitsets of many bits and double columns at once.
+
+        Usage: get_pixel_register_bitsets(object, [bit_number_1, bit_number_2, ...], [double_column_number_1, double_column_number_2, ...])
+        Receives: register object, bit numbers (all bits if None), double column numbers (all double columns if None)
+        Returns: double column bitsets (list of lists, indexed by bit number and double column number)
+
+        """
+        bit_nos = range(register_object['bitlength']) if bit_nos is None else list(bit_nos)
+        dcs = range(40) if dcs is None else list(dcs)
+        if not all(0 <= bit_no < register_object['bitlength'] for bit_no in bit_nos):
             raise ValueError("Pixel register %s: bit number out of range" % register_object['name'])
-        col0 = register_object['value'][dc_no * 2, :]
-        sel0 = (2 ** bit_no == (col0 & 2 ** bit_no))
-        bv0 = bitarray(sel0.tolist(), endian='little')
-        col1 = register_object['value'][dc_no * 2 + 1, :]
-        sel1 = (2 ** bit_no == (col1 & 2 ** bit_no))
-        # sel1 = sel1.astype(numpy.uint8) # copy of array
-        # sel1 = sel1.view(dtype=np.uint8) # in-place type conversion
-        bv1 = bitarray(sel1.tolist(), endian='little')
-        bv1.reverse()  # shifted first
-        # bv = bv1+bv0
-        return bv1 + bv0
+        if not all(0 <= dc_no < 40 for dc_no in dcs):
+            raise ValueError("Pixel register %s: DC out of range" % register_object['name'])
+        value = register_object['value'][np.array(dcs, dtype=np.int64)[:, np.newaxis] * 2 + np.arange(2)]  # double column, column, row
+        bits = (value[np.newaxis] >> np.array(bit_nos, dtype=np.uint8)[:, np.newaxis, np.newaxis, np.newaxis]) & 1  # bit, double column, column, row
+        bits = np.concatenate((bits[:, :, 1, ::-1], bits[:, :, 0, :]), axis=2)  # second column shifted first
+        data = np.packbits(bits.reshape(bits.shape[:2] + (-1, 8))[..., ::-1], axis=-1)  # first bit in least significant bit, as bitarray with little endian
+        register_bitsets = []
+        for bit_data in data:
+            register_bitsets.append([])
+            for dc_data in bit_data:
+                register_bitset = bitarray(endian='little')
+                register_bitset.frombytes(dc_data.tobytes())
+                register_bitsets[-1].append(register_bitset)
+        return register_bitsets
 
     @contextmanager
     def restored(self, name=None):
@@ -1019,7 +1046,104 @@ def save_configuration_to_hdf5(register, configuration_file, name=''):
             save_conf()
 
 
+def load_configuration_from_npz(register, configuration_file):
+    '''Loading configuration from binary snapshot (numpy .npz file) to register object
+
+    Parameters
+    ----------
+    register : pybar.fei4.register object
+    configuration_file : string
+        Filename of the binary snapshot.
+    '''
+    logging.info("Loading configuration: %s" % configuration_file)
+    register.configuration_file = configuration_file
+    with np.load(configuration_file) as snapshot:
+        miscellaneous, calibration_parameters, global_register, pixel_register = snapshot['miscellaneous'], snapshot['calibration_parameters'], snapshot['global_register'], snapshot['pixel_register']
+
+    # miscellaneous
+    for name, value in miscellaneous:
+        value = literal_eval(value)
+        if name == 'Flavor':
+            if not register.flavor:
+                register.init_fe_type(value)
+        elif name == 'Chip_ID':
+            if not register.chip_address:
+                register.set_chip_address(chip_address=value & 0x7, broadcast=True if value & 0x8 else False)
+        else:
+            register.miscellaneous[name] = value
+
+    # calibration parameters
+    for name, value in calibration_parameters:
+        register.calibration_parameters[name] = literal_eval(value)
+
+    # global
+    for name, value in global_register:
+        register.set_global_register_value(name, value)
+
+    # pixels
+    for name, value in pixel_register:
+        if name in register.pixel_registers:
+            register.set_pixel_register_value(name, value)
+
+
+def save_configuration_to_npz(register, configuration_file):
+    '''Saving configuration to binary snapshot (numpy .npz file) from register object
+
+    The snapshot has the content of the HDF5 configuration in one structured array per group and loads in milliseconds.
+    The text files remain the editable configuration.
+
+    Parameters
+    ----------
+    register : pybar.fei4.register object
+    configuration_file : string
+        Filename of the binary snapshot.
+    '''
+    logging.info("Saving configuration: %s" % configuration_file)
+    register.configuration_file = configuration_file
+    name_value_dtype = [('name', 'S256'), ('value', 'S1024')]  # see NameValue
+    miscellaneous = [('Flavor', repr(register.flavor)), ('Chip_ID', repr(register.chip_id))] + [(key, repr(value)) for key, value in register.miscellaneous.iteritems()]
+    calibration_parameters = [(key, repr(value)) for key, value in register.calibration_parameters.iteritems()]
+    global_register = [(global_reg['name'], global_reg['value']) for global_reg in sorted(register.get_global_register_objects(readonly=False), key=itemgetter('name'))]
+    pixel_register = [(pixel_reg['name'], pixel_reg['value']) for pixel_reg in sorted(register.pixel_registers.itervalues(), key=itemgetter('name'))]
+    with open(configuration_file, 'wb') as f:  # file object, numpy would append .npz to other file extensions
+        np.savez_compressed(f,
+                            miscellaneous=np.array(miscellaneous, dtype=name_value_dtype),
+                            calibration_parameters=np.array(calibration_parameters, dtype=name_value_dtype),
+                            global_register=np.array(global_register, dtype=[('name', 'S256'), ('value', np.int64)]),
+                            pixel_register=np.array(pixel_register, dtype=[('name', 'S256'), ('value', np.uint8, (80, 336))]))
+
+
 # Helper functions
+_parse_cache = {}  # parser name and file name -> modification time, size and result of the parsed configuration text file
+
+
+def cached_parser(parse_function):
+    '''Decorator caching the results of a configuration text file parser. A file is only parsed again if its modification time or size
+    changed, reloading the same configuration in a session (e.g. by the scans of a primlist) takes the result from the cache.
+    The caller gets a copy of the result.
+    '''
+    @wraps(parse_function)
+    def cached_parse_function(filename):
+        stat = os.stat(filename)
+        key = (parse_function.__name__, os.path.abspath(filename))
+        if key not in _parse_cache or _parse_cache[key][:2] != (stat.st_mtime, stat.st_size):
+            _parse_cache[key] = (stat.st_mtime, stat.st_size, parse_function(filename))
+        return copy.deepcopy(_parse_cache[key][2])
+    return cached_parse_function
+
+
+def _set_parse_cache(parse_function, filename, value):  # called after writing a file with known content, the next load takes it from the cache
+    stat = os.stat(filename)
+    _parse_cache[(parse_function.__name__, os.path.abspath(filename))] = (stat.st_mtime, stat.st_size, copy.deepcopy(value))
+
+
+def clear_parse_cache():
+    '''Clears the cache of parsed configuration text files.
+    '''
+    _parse_cache.clear()
+
+
+@cached_parser
 def parse_global_config(filename):  # parses the global config text file
     with open(filename, 'r') as f:
         f.seek(0)
@@ -1044,6 +1168,7 @@ def parse_global_config(filename):  # parses the global config text file
     return config_dict
 
 
+@cached_parser
 def parse_pixel_mask_config(filename):
     mask = np.empty((80, 336), dtype=np.uint8)
     with open(filename, 'r') as f:
@@ -1076,8 +1201,10 @@ def write_pixel_mask_config(filename, value):
         seq.append("\n".join([(repr(row + 1).rjust(3) + "  ") + "  ".join(["-".join(["".join([repr(value[col, row]) for col in range(col_fine, col_fine + 5)]) for col_fine in range(col_coarse, col_coarse + 10, 5)]) for col_coarse in range(0, 80, 10)]) for row in range(336)]))
         seq.append("\n")
         f.writelines(seq)
+    _set_parse_cache(parse_pixel_mask_config, filename, np.asarray(value, dtype=np.uint8))
 
 
+@cached_parser
 def parse_pixel_dac_config(filename):
     mask = np.empty((80, 336), dtype=np.uint8)
     with open(filename, 'r') as f:
@@ -1114,6 +1241,7 @@ def write_pixel_dac_config(filename, value):
         seq.append("\n".join(["\n".join([((repr(row + 1).rjust(3) + ("a" if col_coarse == 0 else "b") + "  ") + "   ".join([" ".join([repr(value[col, row]).rjust(2) for col in range(col_fine, col_fine + 10)]) for col_fine in range(col_coarse, col_coarse + 40, 10)])) for col_coarse in range(0, 80, 40)]) for row in range(336)]))
         seq.append("\n")
         f.writelines(seq)
+    _set_parse_cache(parse_pixel_dac_config, filename, np.asarray(value, dtype=np.uint8))
 
 
 def bitarray_from_value(value, size=None, fmt='Q'):
@@ -31,7 +31,10 @@ from pybar.fei4.register_utils import FEI4RegisterUtils, is_fe_ready
 from pybar.daq.fifo_readout import FifoReadout, RxSyncError, EightbTenbError, FifoError, NoDataTimeout, StopTimeout
 from pybar.daq.readout_utils import save_configuration_dict
 from pybar.daq.fei4_raw_data import open_raw_data_file, send_meta_data
+from pybar.daq.run_catalog import RunCatalog
 from pybar.analysis.analysis_utils import AnalysisError
+from pybar.analysis.analysis_cache import get_cache
+from pybar.analysis.live_interpretation import LiveInterpretation
 from pybar.daq.readout_utils import logical_or, logical_and, is_trigger_word, is_fe_word, is_data_from_channel, is_tdc_word, is_tdc_from_channel, convert_tdc_to_channel, false
 
 
@@ -1096,9 +1099,21 @@ class Fei4RunBase(RunBase):
             self.close_files()
         finally:
             # in case something fails, call this on last resort
+            for f in self._raw_data_files.values():
+                if f.live_interpretation is not None:
+                    f.live_interpretation.abort()
             self._raw_data_files.clear()
 
     def open_files(self):
+        # interpret raw data during data taking, processes are started before opening the files
+        live_interpretations = {}
+        settings = self.get_interpretation_settings()
+        if settings is not None:
+            if get_cache() is None:
+                logging.warning('Analysis cache is disabled, no live interpretation of the raw data')
+            else:
+                for selected_module_id in self._selected_modules:
+                    live_interpretations[selected_module_id] = LiveInterpretation(settings=settings)
         for selected_module_id in self._selected_modules:
             self._raw_data_files[selected_module_id] = open_raw_data_file(filename=self.get_output_filename(module_id=selected_module_id),
                                                                           mode='w',
@@ -1117,11 +1132,19 @@ class Fei4RunBase(RunBase):
                     global_register_config[global_reg['name']] = global_reg['value']
                 send_meta_data(self._raw_data_files[selected_module_id].socket, global_register_config, name='GlobalRegisterConf')
                 send_meta_data(self._raw_data_files[selected_module_id].socket, self._run_conf, name='RunConf')
+            if selected_module_id in live_interpretations:
+                live_interpretations[selected_module_id].start(self._raw_data_files[selected_module_id])
+                self._raw_data_files[selected_module_id].live_interpretation = live_interpretations[selected_module_id]
 
     def close_files(self):
         # close all file objects
         for f in self._raw_data_files.values():
+            filename = f.h5_file.filename
             f.close()
+            if f.live_interpretation is not None:
+                # interpret remaining raw data, the analysis will use the interpreted data from the analysis cache
+                f.live_interpretation.stop(raw_data_files=[filename])
+                f.live_interpretation = None
         # delete all file objects
         self._raw_data_files.clear()
 
@@ -1275,6 +1298,13 @@ class Fei4RunBase(RunBase):
 
     def _cleanup(self):  # called in run base after exception handling
         super(Fei4RunBase, self)._cleanup()
+        for module_id in self._modules:
+            module_path = os.path.dirname(self.get_output_filename(module_id=module_id))
+            if os.path.isdir(module_path):
+                try:
+                    RunCatalog(module_path).set_run_status(self.run_number, self.run_id, self.run_status, start_time=self._run_start_time, stop_time=self._run_stop_time)
+                except Exception:
+                    logging.warning('Cannot add run %d to the run catalog of module %s', self.run_number, module_id)
         if 'send_message' in self._conf and self._run_status in self._conf['send_message']['status']:
             subject = '{}{} ({})'.format(self._conf['send_message']['subject_prefix'], self._run_status, gethostname())
             last_status_message = '{} run {} ({}) in {} (total time: {})'.format(self.run_status, self.run_number, self.__class__.__name__, self.working_dir, str(self._total_run_time))
@@ -1304,6 +1334,15 @@ class Fei4RunBase(RunBase):
         '''
         pass
 
+    def get_interpretation_settings(self):
+        '''Returns the interpretation settings of the data analysis.
+
+        If settings are returned and the analysis cache is enabled, the raw data is interpreted during data taking
+        (see pybar.analysis.live_interpretation) and the data analysis uses the interpreted data from the analysis cache.
+        The data analysis has to interpret the raw data with these settings (see AnalyzeRawData.set_settings()).
+        '''
+        return None
+
 
 class ExcThread(Thread):
     def run(self):
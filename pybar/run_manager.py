@@ -20,6 +20,8 @@ from functools import wraps
 from yaml import safe_load
 
 from pybar.utils.utils import find_file_dir_up
+from pybar.analysis import analysis_pool
+from pybar.analysis import analysis_cache
 
 
 punctuation = '!,.:;?'
@@ -471,10 +473,19 @@ class RunManager(object):
         else:
             raise ValueError('Cannot deduce working directory from configuration')
         logging.info('Using working directory %s', self._conf['working_dir'])
+        if 'analysis_processes' in self._conf:  # size of the analysis pool shared by all runs
+            analysis_pool.set_pool_size(self._conf['analysis_processes'])
+        if self._conf.get('analysis_cache_dir'):  # cache for interpreted data shared by all runs
+            cache_dir = os.path.normpath(self._conf['analysis_cache_dir'].replace('\\', '/'))
+            if not os.path.isabs(cache_dir):
+                cache_dir = os.path.join(self._conf['working_dir'], cache_dir)
+            analysis_cache.set_cache(cache_dir=cache_dir, max_size=int(float(self._conf.get('analysis_cache_size', 10)) * 1024 ** 3))
+            logging.info('Using analysis cache %s', cache_dir)
 
     def close(self):
         if self.current_run is not None:
             self.current_run.close()
+        analysis_pool.close_pool()
 
     def __enter__(self):
         return self
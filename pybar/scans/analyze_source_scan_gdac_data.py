@@ -24,6 +24,7 @@ from pybar.analysis import analysis
 from pybar.analysis import analysis_utils
 from pybar.analysis.plotting import plotting
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
+from pybar.analysis.sparse_histogram import get_histogram
 
 
 analysis_configuration = {
@@ -150,7 +151,7 @@ def analyse_selected_hits(input_file_hits, output_file_hits, output_file_hits_an
 def analyze_injected_charge(data_analyzed_file):
     logging.info('Analyze the injected charge')
     with tb.open_file(data_analyzed_file, mode="r") as in_file_h5:
-        occupancy = in_file_h5.root.HistOcc[:].T
+        occupancy = get_histogram(in_file_h5, 'HistOcc')[:].T
         gdacs = analysis_utils.get_scan_parameter(in_file_h5.root.meta_data[:])['GDAC']
         with PdfPages(os.path.splitext(data_analyzed_file)[0] + '.pdf') as plot_file:
             plotting.plot_scatter(gdacs, occupancy.sum(axis=(0, 1)), title='Single pixel hit rate at different thresholds', x_label='Threshold setting [GDAC]', y_label='Single pixel hit rate', log_x=True, filename=plot_file)
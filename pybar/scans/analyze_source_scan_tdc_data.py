@@ -19,12 +19,10 @@ from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import tables as tb
 import numpy as np
-from scipy.interpolate import interp1d
 from scipy.ndimage.interpolation import shift
 
 import progressbar
 
-from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 from pybar.analysis import analysis_utils
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
 from pybar.analysis.plotting.plotting import plot_three_way, plot_1d_hist
@@ -85,24 +83,10 @@ def analyze_raw_data(input_files, output_file_hits, interpreter_plots, overwrite
                 analyze_raw_data.plot_histograms()  # plots all activated histograms into one pdf
 
 
-def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_select_mask, event_status_condition, calibration_file=None, correct_calibration=None, max_tdc=1000, ignore_disabled_regions=True, n_bins=200, plot_data=True):
+def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_select_mask, event_status_condition, calibration_file=None, correct_calibration=None, max_tdc=1000, ignore_disabled_regions=True, n_bins=200, plot_data=True, sparse_hists=False):
     for condition in hit_selection_conditions:
         logging.info('Histogram TDC hits with %s', condition)
 
-    def get_charge(max_tdc, tdc_calibration_values, tdc_pixel_calibration):  # return the charge from calibration
-        charge_calibration = np.zeros(shape=(80, 336, max_tdc))
-        for column in range(80):
-            for row in range(336):
-                actual_pixel_calibration = tdc_pixel_calibration[column, row, :]
-                # Only take pixels with at least 3 valid calibration points
-                if np.count_nonzero(actual_pixel_calibration != 0) > 2 and np.count_nonzero(np.isfinite(actual_pixel_calibration)) > 2:
-                    selected_measurements = np.isfinite(actual_pixel_calibration)  # Select valid calibration steps
-                    selected_actual_pixel_calibration = actual_pixel_calibration[selected_measurements]
-                    selected_tdc_calibration_values = tdc_calibration_values[selected_measurements]
-                    interpolation = interp1d(x=selected_actual_pixel_calibration, y=selected_tdc_calibration_values, kind='slinear', bounds_error=False, fill_value=0)
-                    charge_calibration[column, row, :] = interpolation(np.arange(max_tdc))
-        return charge_calibration
-
     def plot_tdc_tot_correlation(data, condition, output_pdf):
         logging.info('Plot correlation histogram for %s', condition)
         data = np.ma.array(data, mask=(data <= 0))
@@ -188,13 +172,7 @@ def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_s
                 output_pdf.savefig(fig)
                 return offset_mean
 
-    def delete_disabled_regions(hits, enable_mask):
-        n_hits = hits.shape[0]
-
-        # Tread no hits case
-        if n_hits == 0:
-            return hits
-
+    def get_disabled_region(enable_mask):
         # Column, row array with True for disabled pixels
         disabled_mask = ~enable_mask.astype(np.bool).T.copy()
         disabled_region = disabled_mask.copy()
@@ -207,16 +185,7 @@ def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_s
 
         logging.info('Masking %d additional pixel neighbouring %d disabled pixels', np.count_nonzero(disabled_region) - n_disabled_pixels, n_disabled_pixels)
 
-        # Make 1D selection array with disabled pixels
-        disabled_pixels = np.where(disabled_region)
-        disabled_pixels_1d = (disabled_pixels[0] + 1) * disabled_region.shape[1] + (disabled_pixels[1] + 1)  # + 1 because pixel index 0,0 has column/row = 1
-
-        hits_1d = hits['column'].astype(np.uint32) * disabled_region.shape[1] + hits['row']  # change dtype to fit new number
-        hits = hits[np.in1d(hits_1d, disabled_pixels_1d, invert=True)]
-
-        logging.info('Lost %d hits (%d percent) due to disabling neighbours', n_hits - hits.shape[0], (1. - float(hits.shape[0]) / n_hits) * 100)
-
-        return hits
+        return disabled_region
 
     # Create data
     with tb.open_file(input_file_hits, mode="r") as in_hit_file_h5:
@@ -227,39 +196,41 @@ def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_s
             logging.warning('No enabled pixel mask found in data! Assume all pixels are enabled.')
             enabled_pixels = np.ones(shape=(336, 80))
 
-        # Result hists, initialized per condition
-        pixel_tdc_hists_per_condition = [np.zeros(shape=(80, 336, max_tdc), dtype=np.uint16) for _ in hit_selection_conditions] if hit_selection_conditions else []
-        pixel_tdc_timestamp_hists_per_condition = [np.zeros(shape=(80, 336, 256), dtype=np.uint16) for _ in hit_selection_conditions] if hit_selection_conditions else []
-        mean_pixel_tdc_hists_per_condition = [np.zeros(shape=(80, 336), dtype=np.uint16) for _ in hit_selection_conditions] if hit_selection_conditions else []
-        mean_pixel_tdc_timestamp_hists_per_condition = [np.zeros(shape=(80, 336), dtype=np.uint16) for _ in hit_selection_conditions] if hit_selection_conditions else []
-        tdc_hists_per_condition = [np.zeros(shape=(max_tdc), dtype=np.uint16) for _ in hit_selection_conditions] if hit_selection_conditions else []
-        tdc_corr_hists_per_condition = [np.zeros(shape=(max_tdc, 16), dtype=np.uint32) for _ in hit_selection_conditions] if hit_selection_conditions else []
+        # Result hists of all conditions, filled in one pass per chunk
+        n_conditions = len(hit_selection_conditions)
+        pixel_tdc_hists = analysis_utils.ConditionHistogram(n_conditions, shape=(80, 336, max_tdc), dtype=np.uint16, sparse=sparse_hists)
+        pixel_tdc_timestamp_hists = analysis_utils.ConditionHistogram(n_conditions, shape=(80, 336, 256), dtype=np.uint16, sparse=sparse_hists)
+        tdc_corr_hists = analysis_utils.ConditionHistogram(n_conditions, shape=(max_tdc, 16), dtype=np.uint32)
 
         n_hits_per_condition = [0 for _ in range(len(hit_selection_conditions) + 2)]  # condition 1, 2 are all hits, hits of goode events
+        n_lost_hits_per_condition = np.zeros(n_conditions, dtype=np.int64)  # hits in disabled regions
+        disabled_region = get_disabled_region(enabled_pixels) if ignore_disabled_regions else None
 
         logging.info('Select hits and create TDC histograms for %d cut conditions', len(hit_selection_conditions))
         progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=cluster_hit_table.shape[0], term_width=80)
         progress_bar.start()
+        hit_selection = analysis_utils.HitSelection(hit_selection_conditions)  # all conditions are evaluated in one pass, common terms once
         for cluster_hits, _ in analysis_utils.data_aligned_at_events(cluster_hit_table, chunk_size=10000000):
             n_hits_per_condition[0] += cluster_hits.shape[0]
             selected_events_cluster_hits = cluster_hits[np.logical_and(cluster_hits['TDC'] < max_tdc, (cluster_hits['event_status'] & event_status_select_mask) == event_status_condition)]
             n_hits_per_condition[1] += selected_events_cluster_hits.shape[0]
-            for index, condition in enumerate(hit_selection_conditions):
-                selected_cluster_hits = analysis_utils.select_hits(selected_events_cluster_hits, condition)
-                if ignore_disabled_regions:
-                    selected_cluster_hits = delete_disabled_regions(hits=selected_cluster_hits, enable_mask=enabled_pixels)
-
-                n_hits_per_condition[2 + index] += selected_cluster_hits.shape[0]
-                column, row, tdc = selected_cluster_hits['column'] - 1, selected_cluster_hits['row'] - 1, selected_cluster_hits['TDC']
-                pixel_tdc_hists_per_condition[index] += fast_analysis_utils.hist_3d_index(column, row, tdc, shape=(80, 336, max_tdc))
-                mean_pixel_tdc_hists_per_condition[index] = np.average(pixel_tdc_hists_per_condition[index], axis=2, weights=range(0, max_tdc)) * np.sum(np.arange(0, max_tdc)) / pixel_tdc_hists_per_condition[index].sum(axis=2)
-                tdc_timestamp = selected_cluster_hits['TDC_time_stamp']
-                pixel_tdc_timestamp_hists_per_condition[index] += fast_analysis_utils.hist_3d_index(column, row, tdc_timestamp, shape=(80, 336, 256))
-                mean_pixel_tdc_timestamp_hists_per_condition[index] = np.average(pixel_tdc_timestamp_hists_per_condition[index], axis=2, weights=range(0, 256)) * np.sum(np.arange(0, 256)) / pixel_tdc_timestamp_hists_per_condition[index].sum(axis=2)
-                tdc_hists_per_condition[index] = pixel_tdc_hists_per_condition[index].sum(axis=(0, 1), dtype=np.uint32)  # fix dtype, sum will otherwise increase precision
-                tdc_corr_hists_per_condition[index] += fast_analysis_utils.hist_2d_index(tdc, selected_cluster_hits['tot'], shape=(max_tdc, 16))
+            column, row, tdc = selected_events_cluster_hits['column'] - 1, selected_events_cluster_hits['row'] - 1, selected_events_cluster_hits['TDC']
+            condition_bitmask = hit_selection.get_bitmask(selected_events_cluster_hits)  # bit i is set if the hit fulfills condition i
+            if disabled_region is not None:
+                in_disabled_region = disabled_region[column, row]
+                n_lost_hits_per_condition += np.bincount(analysis_utils.get_bitmask_indices(condition_bitmask[in_disabled_region], n_conditions)[1], minlength=n_conditions)
+                condition_bitmask[in_disabled_region] = 0
+            bitmask_indices = analysis_utils.get_bitmask_indices(condition_bitmask, n_conditions)
+            for index, n_selected_hits in enumerate(np.bincount(bitmask_indices[1], minlength=n_conditions)):
+                n_hits_per_condition[2 + index] += n_selected_hits
+            pixel_tdc_hists.fill(condition_bitmask, (column, row, tdc), bitmask_indices=bitmask_indices)
+            pixel_tdc_timestamp_hists.fill(condition_bitmask, (column, row, selected_events_cluster_hits['TDC_time_stamp']), bitmask_indices=bitmask_indices)
+            tdc_corr_hists.fill(condition_bitmask, (tdc, selected_events_cluster_hits['tot']), bitmask_indices=bitmask_indices)
             progress_bar.update(n_hits_per_condition[0])
         progress_bar.finish()
+        for index, n_lost_hits in enumerate(n_lost_hits_per_condition):
+            if ignore_disabled_regions and n_hits_per_condition[2 + index] + n_lost_hits:
+                logging.info('Lost %d hits (%d percent) due to disabling neighbours for condition %d', n_lost_hits, float(n_lost_hits) / (n_hits_per_condition[2 + index] + n_lost_hits) * 100, index)
 
         # Take TDC calibration if available and calculate charge for each TDC value and pixel
         if calibration_file is not None:
@@ -268,19 +239,20 @@ def histogram_tdc_hits(input_file_hits, hit_selection_conditions, event_status_s
                 tdc_calibration_values = in_file_calibration_h5.root.HitOrCalibration.attrs.scan_parameter_values[:]
                 if correct_calibration is not None:
                     tdc_calibration += get_calibration_correction(tdc_calibration, tdc_calibration_values, correct_calibration)
-            charge_calibration = get_charge(max_tdc, tdc_calibration_values, tdc_calibration)
+            charge_calibration = analysis_utils.get_charge_calibration(tdc_calibration_values, tdc_calibration, max_tdc, min_calibration_points=3)  # only pixels with at least 3 valid calibration points
         else:
             charge_calibration = None
 
         # Store data of result histograms
         with tb.open_file(os.path.splitext(input_file_hits)[0] + '_tdc_hists.h5', mode="w") as out_file_h5:
             for index, condition in enumerate(hit_selection_conditions):
-                pixel_tdc_hist_result = np.swapaxes(pixel_tdc_hists_per_condition[index], 0, 1)
-                pixel_tdc_timestamp_hist_result = np.swapaxes(pixel_tdc_timestamp_hists_per_condition[index], 0, 1)
-                mean_pixel_tdc_hist_result = np.swapaxes(mean_pixel_tdc_hists_per_condition[index], 0, 1)
-                mean_pixel_tdc_timestamp_hist_result = np.swapaxes(mean_pixel_tdc_timestamp_hists_per_condition[index], 0, 1)
-                tdc_hists_per_condition_result = tdc_hists_per_condition[index]
-                tdc_corr_hist_result = np.swapaxes(tdc_corr_hists_per_condition[index], 0, 1)
+                pixel_tdc_hist, pixel_tdc_timestamp_hist = pixel_tdc_hists[index], pixel_tdc_timestamp_hists[index]
+                pixel_tdc_hist_result = np.swapaxes(pixel_tdc_hist, 0, 1)
+                pixel_tdc_timestamp_hist_result = np.swapaxes(pixel_tdc_timestamp_hist, 0, 1)
+                mean_pixel_tdc_hist_result = np.swapaxes(np.average(pixel_tdc_hist, axis=2, weights=range(0, max_tdc)) * np.sum(np.arange(0, max_tdc)) / pixel_tdc_hist.sum(axis=2), 0, 1)
+                mean_pixel_tdc_timestamp_hist_result = np.swapaxes(np.average(pixel_tdc_timestamp_hist, axis=2, weights=range(0, 256)) * np.sum(np.arange(0, 256)) / pixel_tdc_timestamp_hist.sum(axis=2), 0, 1)
+                tdc_hists_per_condition_result = pixel_tdc_hist.sum(axis=(0, 1), dtype=np.uint32)  # fix dtype, sum will otherwise increase precision
+                tdc_corr_hist_result = np.swapaxes(tdc_corr_hists[index], 0, 1)
                 # Create result hists
                 out_1 = out_file_h5.create_carray(out_file_h5.root, name='HistPixelTdcCondition_%d' % index, title='Hist Pixel Tdc with %s' % condition, atom=tb.Atom.from_dtype(pixel_tdc_hist_result.dtype), shape=pixel_tdc_hist_result.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
                 out_2 = out_file_h5.create_carray(out_file_h5.root, name='HistPixelTdcTimestampCondition_%d' % index, title='Hist Pixel Tdc Timestamp with %s' % condition, atom=tb.Atom.from_dtype(pixel_tdc_timestamp_hist_result.dtype), shape=pixel_tdc_timestamp_hist_result.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
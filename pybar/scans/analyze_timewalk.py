@@ -7,7 +7,6 @@ from matplotlib import pyplot as plt
 from matplotlib import cm
 import tables as tb
 import numpy as np
-from scipy.interpolate import interp1d
 
 import progressbar
 
@@ -18,27 +17,9 @@ def plsr_dac_to_charge(plsr_dac):
     return 72.16 * plsr_dac + 2777.63
 
 
-def get_charge(max_tdc, tdc_calibration_values, tdc_pixel_calibration):  # Return the charge from calibration
-    ''' Interpolatet the TDC calibration for each pixel from 0 to max_tdc'''
-    charge_calibration = np.zeros(shape=(80, 336, max_tdc))
-    for column in range(80):
-        for row in range(336):
-            actual_pixel_calibration = tdc_pixel_calibration[column, row, :]
-            if np.any(actual_pixel_calibration != 0) and np.any(np.isfinite(actual_pixel_calibration)):
-                selected_measurements = np.isfinite(actual_pixel_calibration)  # Select valid calibration steps
-                selected_actual_pixel_calibration = actual_pixel_calibration[selected_measurements]
-                selected_tdc_calibration_values = tdc_calibration_values[selected_measurements]
-                interpolation = interp1d(x=selected_actual_pixel_calibration, y=selected_tdc_calibration_values, kind='slinear', bounds_error=False, fill_value=0)
-                charge_calibration[column, row, :] = interpolation(np.arange(max_tdc))
-    return charge_calibration
-
-
 def get_charge_calibration(calibation_file, max_tdc):
     ''' Open the hit or calibration file and return the calibration per pixel'''
-    with tb.open_file(calibation_file, mode="r") as in_file_calibration_h5:
-        tdc_calibration = in_file_calibration_h5.root.HitOrCalibration[:, :, :, 1]
-        tdc_calibration_values = in_file_calibration_h5.root.HitOrCalibration.attrs.scan_parameter_values[:]
-    return get_charge(max_tdc, tdc_calibration_values, tdc_calibration)
+    return analysis_utils.get_charge_calibration_from_file(calibation_file, max_tdc)
 
 
 def get_time_walk_hist(hit_file, charge_calibration, event_status_select_mask, event_status_condition, hit_selection_conditions, max_timesamp, max_tdc, max_charge):
@@ -50,20 +31,19 @@ def get_time_walk_hist(hit_file, charge_calibration, event_status_select_mask, e
         progress_bar.start()
         n_hits, n_selected_hits = 0, 0
         timewalk = np.zeros(shape=(200, max_timesamp), dtype=np.float32)
+        hit_selection = analysis_utils.HitSelection(hit_selection_conditions)
+        charge_table = plsr_dac_to_charge(charge_calibration).astype(np.float32)  # charge in electrons for each Col/Row/TDC tuple from per pixel charge calibration and PlsrDAC calibration
         for cluster_hits, _ in analysis_utils.data_aligned_at_events(cluster_hit_table, chunk_size=10000000):
             n_hits += cluster_hits.shape[0]
             selected_events_cluster_hits = cluster_hits[np.logical_and(cluster_hits['TDC'] < max_tdc, (cluster_hits['event_status'] & event_status_select_mask) == event_status_condition)]
-            for _, condition in enumerate(hit_selection_conditions):
-                selected_cluster_hits = analysis_utils.select_hits(selected_events_cluster_hits, condition)
-                n_selected_hits += selected_cluster_hits.shape[0]
-                column_index, row_index, tdc, tdc_timestamp = selected_cluster_hits['column'] - 1, selected_cluster_hits['row'] - 1, selected_cluster_hits['TDC'], selected_cluster_hits['TDC_time_stamp']
-
-                # Charge values for each Col/Row/TDC tuple from per pixel charge calibration
-                # and PlsrDAC calibration in electrons
-                charge_values = plsr_dac_to_charge(charge_calibration[column_index, row_index, tdc]).astype(np.float32)
-
-                actual_timewalk, xedges, yedges = np.histogram2d(charge_values, tdc_timestamp, bins=timewalk.shape, range=((0, max_charge), (0, max_timesamp)))
-                timewalk += actual_timewalk
+            # The hits of all conditions are histogrammed at once, each hit is weighted with the number of conditions selecting it
+            hit_index, _ = analysis_utils.get_bitmask_indices(hit_selection.get_bitmask(selected_events_cluster_hits), len(hit_selection_conditions))
+            n_selections = np.bincount(hit_index, minlength=selected_events_cluster_hits.shape[0])
+            n_selected_hits += hit_index.shape[0]
+            selected_cluster_hits, n_selections = selected_events_cluster_hits[n_selections > 0], n_selections[n_selections > 0]
+            charge_values = charge_table[selected_cluster_hits['column'] - 1, selected_cluster_hits['row'] - 1, selected_cluster_hits['TDC']]
+            actual_timewalk, xedges, yedges = np.histogram2d(charge_values, selected_cluster_hits['TDC_time_stamp'], bins=timewalk.shape, range=((0, max_charge), (0, max_timesamp)), weights=n_selections)
+            timewalk += actual_timewalk
 
             progress_bar.update(n_hits)
         progress_bar.finish()
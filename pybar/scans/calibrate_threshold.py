@@ -16,46 +16,57 @@ import progressbar
 from pybar_fei4_interpreter import data_struct
 from pybar.run_manager import RunManager
 from pybar.scans.scan_threshold_fast import FastThresholdScan
-from pybar.analysis import analysis_utils
+from pybar.analysis import analysis_utils, analysis_pool
 from pybar.analysis.plotting.plotting import plot_three_way, plot_scurves, plot_scatter
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
+from pybar.analysis.sparse_histogram import get_histogram
+
+
+def analyze_raw_data_file(file_name):  # Analysis of the raw data file of one parameter value, has to be global for the multiprocessing module
+    if os.path.isfile(os.path.splitext(file_name)[0] + '_interpreted.h5'):  # skip analysis if already done
+        logging.warning('Analyzed data file ' + file_name + ' already exists. Skip analysis for this file.')
+    else:
+        with AnalyzeRawData(raw_data_file=file_name, create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.create_tot_hist = False
+            analyze_raw_data.create_tot_pixel_hist = False
+            analyze_raw_data.create_fitted_threshold_hists = True
+            analyze_raw_data.create_threshold_mask = True
+            analyze_raw_data.interpreter.set_warning_output(False)  # RX errors would fill the console
+            analyze_raw_data.interpret_word_table()
+
+
+def analyze_raw_data_files(raw_data_files):  # Analysis of the raw data files of all parameter values
+    if analysis_pool.get_pool_size() > 1 and len(raw_data_files) > 1:  # analyze the raw data files of the parameter values in parallel, the S-curve fit of each file runs in one process
+        analysis_pool.get_pool().map(analyze_raw_data_file, raw_data_files, chunksize=1)
+    else:
+        for raw_data_file in raw_data_files:
+            analyze_raw_data_file(raw_data_file)
+
+
+def store_calibration_data_as_table(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_values):
+    logging.info("Storing calibration data in a table...")
+    filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+    mean_threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='MeanThresholdCalibration', description=data_struct.MeanThresholdCalibrationTable, title='mean_threshold_calibration', filters=filter_table)
+    threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='ThresholdCalibration', description=data_struct.ThresholdCalibrationTable, title='threshold_calibration', filters=filter_table)
+    # one row per pixel and parameter value, ordered by column, row and parameter value
+    column, row, parameter_value_index = np.indices(threshold_calibration.shape[:2] + (len(parameter_values), )).reshape(3, -1)
+    threshold_calib = np.zeros(shape=column.shape, dtype=threshold_calib_table.dtype)
+    threshold_calib['column'] = column
+    threshold_calib['row'] = row
+    threshold_calib['parameter_value'] = np.asarray(parameter_values)[parameter_value_index]
+    threshold_calib['threshold'] = threshold_calibration[column, row, parameter_value_index]
+    threshold_calib_table.append(threshold_calib)
+    mean_threshold_calib = np.zeros(shape=(len(parameter_values), ), dtype=mean_threshold_calib_table.dtype)
+    mean_threshold_calib['parameter_value'] = parameter_values
+    mean_threshold_calib['mean_threshold'] = mean_threshold_calibration[:len(parameter_values)]
+    mean_threshold_calib['threshold_rms'] = mean_threshold_rms_calibration[:len(parameter_values)]
+    mean_threshold_calib_table.append(mean_threshold_calib)
+    threshold_calib_table.flush()
+    mean_threshold_calib_table.flush()
+    logging.info("done")
 
 
 def create_threshold_calibration(scan_base_file_name, create_plots=True):  # Create calibration function, can be called stand alone
-    def analyze_raw_data_file(file_name):
-        if os.path.isfile(os.path.splitext(file_name)[0] + '_interpreted.h5'):  # skip analysis if already done
-            logging.warning('Analyzed data file ' + file_name + ' already exists. Skip analysis for this file.')
-        else:
-            with AnalyzeRawData(raw_data_file=file_name, create_pdf=False) as analyze_raw_data:
-                analyze_raw_data.create_tot_hist = False
-                analyze_raw_data.create_tot_pixel_hist = False
-                analyze_raw_data.create_fitted_threshold_hists = True
-                analyze_raw_data.create_threshold_mask = True
-                analyze_raw_data.interpreter.set_warning_output(False)  # RX errors would fill the console
-                analyze_raw_data.interpret_word_table()
-
-    def store_calibration_data_as_table(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_values):
-        logging.info("Storing calibration data in a table...")
-        filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
-        mean_threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='MeanThresholdCalibration', description=data_struct.MeanThresholdCalibrationTable, title='mean_threshold_calibration', filters=filter_table)
-        threshold_calib_table = out_file_h5.create_table(out_file_h5.root, name='ThresholdCalibration', description=data_struct.ThresholdCalibrationTable, title='threshold_calibration', filters=filter_table)
-        for column in range(80):
-            for row in range(336):
-                for parameter_value_index, parameter_value in enumerate(parameter_values):
-                    threshold_calib_table.row['column'] = column
-                    threshold_calib_table.row['row'] = row
-                    threshold_calib_table.row['parameter_value'] = parameter_value
-                    threshold_calib_table.row['threshold'] = threshold_calibration[column, row, parameter_value_index]
-                    threshold_calib_table.row.append()
-        for parameter_value_index, parameter_value in enumerate(parameter_values):
-            mean_threshold_calib_table.row['parameter_value'] = parameter_value
-            mean_threshold_calib_table.row['mean_threshold'] = mean_threshold_calibration[parameter_value_index]
-            mean_threshold_calib_table.row['threshold_rms'] = mean_threshold_rms_calibration[parameter_value_index]
-            mean_threshold_calib_table.row.append()
-        threshold_calib_table.flush()
-        mean_threshold_calib_table.flush()
-        logging.info("done")
-
     def store_calibration_data_as_array(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_name, parameter_values):
         logging.info("Storing calibration data in an array...")
         filter_table = tb.Filters(complib='blosc', complevel=5, fletcher32=False)
@@ -91,8 +102,7 @@ def create_threshold_calibration(scan_base_file_name, create_plots=True):  # Cre
 
     calibration_file = first_scan_base_file_name + '_calibration'
 
-    for raw_data_file in raw_data_files:  # analyze each raw data file, not using multithreading here, it is already used in s-curve fit
-        analyze_raw_data_file(raw_data_file)
+    analyze_raw_data_files(raw_data_files)
 
     files_per_parameter = analysis_utils.get_parameter_value_from_file_names([os.path.splitext(file_name)[0] + '_interpreted.h5' for file_name in raw_data_files], parameter_name, unique=True, sort=True)
 
@@ -111,7 +121,7 @@ def create_threshold_calibration(scan_base_file_name, create_plots=True):  # Cre
     for index, (analyzed_data_file, parameters) in enumerate(files_per_parameter.items()):
         parameter_values.append(parameters.values()[0][0])
         with tb.open_file(analyzed_data_file, mode="r") as in_file_h5:
-            occupancy_masked = mask_columns(pixel_array=in_file_h5.root.HistOcc[:], ignore_columns=ignore_columns)  # mask the not scanned columns for analysis and plotting
+            occupancy_masked = mask_columns(pixel_array=get_histogram(in_file_h5, 'HistOcc')[:], ignore_columns=ignore_columns)  # mask the not scanned columns for analysis and plotting
             thresholds_masked = mask_columns(pixel_array=in_file_h5.root.HistThresholdFitted[:], ignore_columns=ignore_columns)
             if create_plots:
                 plot_three_way(hist=thresholds_masked, title='Threshold Fitted for ' + parameters.keys()[0] + ' = ' + str(parameters.values()[0][0]), filename=output_pdf)
@@ -100,17 +100,22 @@ class ExtTriggerScan(Fei4RunBase):
                             self.stop(msg='Trigger limit was reached: %i' % self.max_triggers)
         logging.info('Total amount of triggers collected: %d', self.dut['TLU']['TRIGGER_COUNTER'])
 
+    def get_interpretation_settings(self):
+        settings = {'trigger_data_format': self.dut['TLU']['DATA_FORMAT'],
+                    'create_source_scan_hist': True,
+                    'create_cluster_size_hist': True,
+                    'create_cluster_tot_hist': True,
+                    'align_at_trigger': True}
+        if self.enable_tdc:
+            settings.update({'create_tdc_counter_hist': True,  # histogram all TDC words
+                             'create_tdc_hist': True,  # histogram the hit TDC information
+                             'align_at_tdc': False})  # align events at the TDC word
+        return settings
+
     def analyze(self):
         with AnalyzeRawData(raw_data_file=self.output_filename, create_pdf=True) as analyze_raw_data:
-            analyze_raw_data.trigger_data_format = self.dut['TLU']['DATA_FORMAT']
-            analyze_raw_data.create_source_scan_hist = True
-            analyze_raw_data.create_cluster_size_hist = True
-            analyze_raw_data.create_cluster_tot_hist = True
-            analyze_raw_data.align_at_trigger = True
-            if self.enable_tdc:
-                analyze_raw_data.create_tdc_counter_hist = True  # histogram all TDC words
-                analyze_raw_data.create_tdc_hist = True  # histogram the hit TDC information
-                analyze_raw_data.align_at_tdc = False  # align events at the TDC word
+            analyze_raw_data.set_settings(self.get_interpretation_settings())
+            analyze_raw_data.cluster_processes = 2  # cluster in parallel to the interpretation
             analyze_raw_data.interpreter.set_warning_output(False)
             analyze_raw_data.interpret_word_table()
             analyze_raw_data.interpreter.print_summary()
@@ -82,6 +82,7 @@ class Fei4SelfTriggerScan(Fei4RunBase):
             analyze_raw_data.create_cluster_size_hist = True  # can be set to false to omit cluster hit creation, can save some time, standard setting is false
             analyze_raw_data.create_source_scan_hist = True
             analyze_raw_data.create_cluster_tot_hist = True
+            analyze_raw_data.cluster_processes = 2  # cluster in parallel to the interpretation
             analyze_raw_data.interpreter.set_warning_output(False)
             analyze_raw_data.interpret_word_table()
             analyze_raw_data.interpreter.print_summary()
@@ -17,19 +17,14 @@ PlsrDAC injection circuit. Because the direct hit delay measurements with a trig
 '''
 import logging
 import re
-import multiprocessing as mp
-import math
-import warnings
 
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 import tables as tb
 import numpy as np
-from scipy.optimize import curve_fit, OptimizeWarning
 from scipy.interpolate import interp1d
 from scipy.special import erf
-warnings.simplefilter("ignore", OptimizeWarning)  # deactivate : Covariance warning
 
 import progressbar
 
@@ -39,49 +34,99 @@ from pybar.fei4.register_utils import invert_pixel_mask
 from pybar.fei4_run_base import Fei4RunBase
 from pybar.fei4.register_utils import scan_loop
 from pybar.run_manager import RunManager
-from pybar.analysis.analysis_utils import get_hits_of_scan_parameter, get_scan_parameter, get_mean_from_histogram
+from pybar.analysis.analysis_utils import map_hits_of_scan_parameter, get_scan_parameter, get_mean_from_histogram, fit_levenberg_marquardt
 from pybar.analysis.analyze_raw_data import AnalyzeRawData
+from pybar.analysis.sparse_histogram import SparseHistogram
 from pybar.analysis.plotting.plotting import plot_scurves, plot_three_way
 
 
-warnings.simplefilter("ignore", OptimizeWarning)  # deactivate : Covariance warning
-
-
 def scurve(x, offset, mu, sigma):
     return offset + 0.5 * erf((x - mu) / (np.sqrt(2) * sigma)) + 0.5
 
 
-def fit_bcid_jumps(scurve_data, max_chi_2=2.0):  # Data of some pixels to fit, has to be global for the multiprocessing module
-    offset_min = int(math.ceil(min(scurve_data)))  # Offset min is minimum BCID of Scurve fit
-    offset_max = int(math.floor(max(scurve_data)))  # Offset max is minimum BCID of Scurve fit + 1
-
-    if offset_max - offset_min > 2:  # Restrict to detection of two BCID jumps, otherwise most likely corrupt data
-        offset_max = offset_min + 2
-    index = range(len(scurve_data))
-    result = -np.ones(4)
-    for offset_index, offset in enumerate(xrange(offset_min, offset_max)):  # loop over up to two Scurves
-        actual_index = [index[i] for i in index if offset <= scurve_data[i] <= offset + 1]
-        if not actual_index or len(actual_index) < 5:  # Omit broken data
-            continue
-        actual_data = [scurve_data[i] for i in index if offset <= scurve_data[i] <= offset + 1]
-        n_points_left = sum([1 for i in actual_data if i == offset])
-        n_points_right = sum([1 for i in actual_data if i == offset + 1])
-        if n_points_left < 2 or n_points_right < 2:  # Omit not sufficient data
-            continue
-        start_value = actual_index[np.argmax(np.diff(actual_data))]
-        try:
-            popt, _ = curve_fit(scurve, actual_index, actual_data, p0=[offset, start_value, 1.], check_finite=False)  # offset is also a fit parameter, since there are PlsrDAC settings that let the BCID jitter more
-            if popt[1] > 0 and popt[0] > offset - 0.05:  # mu < 0 or too low offset indicates bad fit
-                chi_2 = np.sum((scurve(actual_index, popt[0], popt[1], popt[2]) - actual_data) ** 2)
-                if chi_2 < max_chi_2:  # Omit bad quality fits
-                    result[offset_index * 2: offset_index * 2 + 1] = offset
-                    result[offset_index * 2 + 1: offset_index * 2 + 2] = popt[1]
-        except RuntimeError:  # Fit failed
-            pass
-    if result[0] == -1 and result[2] != -1:  # If the first scurve fit failed but not the second, define second s-curve as first
-        result[0], result[1] = result[2], result[3]
-        result[2], result[3] = -1, -1
-    return result
+def histogram_bcid_tot(hits):  # Histograms of the hits of one scan parameter setting, has to be global for the multiprocessing module
+    column, row, rel_bcid, tot = hits['column'] - 1, hits['row'] - 1, hits['relative_BCID'], hits['tot']
+    return hist_3d_index(column, row, rel_bcid, shape=(80, 336, 16)), hist_3d_index(column, row, tot, shape=(80, 336, 16)), hist_1d_index(tot, shape=(16,))
+
+
+def fill_delay_histogram(hist, pixel_hist, injection_delay_index):
+    '''Adds the histogram per pixel (column, row, bin) of one injection delay to the sparse histogram per pixel and injection delay (row, column, injection delay, bin).
+    '''
+    column, row, bin_index = np.nonzero(pixel_hist)
+    hist.fill((row, column, np.full(row.shape[0], injection_delay_index, dtype=np.int64), bin_index), weights=pixel_hist[column, row, bin_index])
+
+
+def get_mean_bin(hist):
+    '''Returns the mean bin of the last dimension of a sparse histogram for all bins of the other dimensions, NaN for empty bins.
+    '''
+    index, bin_index = np.divmod(hist.indices, hist.shape[-1])
+    n_bins = int(np.prod(hist.shape[:-1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_bin = np.bincount(index, weights=hist.values * bin_index, minlength=n_bins) / np.bincount(index, weights=hist.values, minlength=n_bins)
+    return mean_bin.reshape(hist.shape[:-1])
+
+
+def _bcid_scurve_function(x, p):
+    return scurve(x, p[:, 0:1], p[:, 1:2], p[:, 2:3])
+
+
+def _bcid_scurve_jacobian(x, p):  # derivatives of the S-curve by offset, mu and sigma
+    z = (x - p[:, 1:2]) / (np.sqrt(2) * p[:, 2:3])
+    gauss = np.exp(-z ** 2) / np.sqrt(np.pi)
+    return np.stack((np.ones_like(z), -gauss / (np.sqrt(2) * p[:, 2:3]), -gauss * z / p[:, 2:3]), axis=2)
+
+
+def fit_bcid_jumps(pixel_data, max_chi_2=2.0, n_pixel_per_chunk=4096):
+    '''Detects up to two BCID jumps per pixel with S-curve fits of the mean relative BCID as a function of the injection delay.
+    The jumps of all pixels are fitted at once (see analysis_utils.fit_levenberg_marquardt()).
+
+    Parameters
+    ----------
+    pixel_data : numpy.array
+        Mean relative BCID per pixel (leading dimensions) and injection delay (last dimension), without NaNs.
+    max_chi_2 : float
+        Maximum chi square of a fit, pixels with a larger chi square have no BCID jump.
+    n_pixel_per_chunk : int
+        Number of pixels fitted at once.
+
+    Returns
+    -------
+    numpy.array
+        BCID and delay (mu of the S-curve fit) of the first and second jump per pixel (last dimension), -1 if the jump was not found.
+    '''
+    pixel_data = np.asarray(pixel_data)
+    data = pixel_data.reshape(-1, pixel_data.shape[-1])
+    result = -np.ones((data.shape[0], 4))
+    x = np.arange(data.shape[1], dtype=np.float64)
+    for start_pixel in range(0, data.shape[0], n_pixel_per_chunk):
+        chunk = data[start_pixel:start_pixel + n_pixel_per_chunk]
+        offset_min = np.ceil(np.amin(chunk, axis=1)).astype(np.int64)  # offset min is minimum BCID of S-curve fit
+        offset_max = np.minimum(np.floor(np.amax(chunk, axis=1)).astype(np.int64), offset_min + 2)  # restrict to detection of two BCID jumps, otherwise most likely corrupt data
+        for offset_index in range(2):  # up to two S-curves per pixel
+            pixels = np.flatnonzero(offset_min + offset_index < offset_max)
+            offset = (offset_min[pixels] + offset_index)[:, np.newaxis]
+            y = chunk[pixels]
+            selection = (offset <= y) & (y <= offset + 1)
+            n_points_left, n_points_right = np.count_nonzero(y == offset, axis=1), np.count_nonzero(y == offset + 1, axis=1)
+            valid = (np.count_nonzero(selection, axis=1) >= 5) & (n_points_left >= 2) & (n_points_right >= 2)  # omit broken data and not sufficient data
+            pixels, offset, y, selection = pixels[valid], offset[valid], y[valid], selection[valid]
+            if pixels.shape[0] == 0:
+                continue
+            # Start value of mu is the first point of the largest increase between consecutive selected points
+            previous_index = np.maximum.accumulate(np.where(selection, np.arange(y.shape[1]), -1), axis=1)
+            previous_index = np.c_[-np.ones(y.shape[0], dtype=previous_index.dtype), previous_index[:, :-1]]  # index of the previous selected point
+            increase = np.where(selection & (previous_index >= 0), y - y[np.arange(y.shape[0])[:, np.newaxis], np.maximum(previous_index, 0)], -np.inf)
+            start_value = previous_index[np.arange(y.shape[0]), np.argmax(increase, axis=1)]
+            # Offset is also a fit parameter, since there are PlsrDAC settings that let the BCID jitter more
+            popt, converged = fit_levenberg_marquardt(_bcid_scurve_function, _bcid_scurve_jacobian, x, y, np.column_stack((offset[:, 0], start_value, np.ones(pixels.shape[0]))), weights=selection, max_iterations=200)
+            with np.errstate(invalid='ignore'):
+                chi_2 = np.sum(selection * (scurve(x, popt[:, 0:1], popt[:, 1:2], popt[:, 2:3]) - y) ** 2, axis=1)
+                good_fit = converged & (popt[:, 1] > 0) & (popt[:, 0] > offset[:, 0] - 0.05) & (chi_2 < max_chi_2)  # mu < 0, too low offset or large chi square indicates bad fit
+            result[start_pixel + pixels[good_fit], offset_index * 2] = offset[good_fit, 0]
+            result[start_pixel + pixels[good_fit], offset_index * 2 + 1] = popt[good_fit, 1]
+    only_second = (result[:, 0] == -1) & (result[:, 2] != -1)  # if the first S-curve fit failed but not the second, define second S-curve as first
+    result[only_second, 0:2], result[only_second, 2:4] = result[only_second, 2:4], -1
+    return result.reshape(pixel_data.shape[:-1] + (4, ))
 
 
 def analyze_hit_delay(raw_data_file):
@@ -105,27 +150,21 @@ def analyze_hit_delay(raw_data_file):
         hists_folder_4 = out_file_h5.create_group(out_file_h5.root, 'PixelHistsMeanTot')
         hists_folder_5 = out_file_h5.create_group(out_file_h5.root, 'HistsTot')
 
-        def store_bcid_histograms(bcid_array, tot_array, tot_pixel_array):
+        def store_bcid_histograms(bcid_hist, tot_array, tot_pixel_hist):  # the histograms per pixel and injection delay are sparse (row, column, injection delay, bin)
             logging.debug('Store histograms for PlsrDAC ' + str(old_plsr_dac))
-            bcid_mean_array = np.average(bcid_array, axis=3, weights=range(0, 16)) * sum(range(0, 16)) / np.sum(bcid_array, axis=3).astype('f4')  # calculate the mean BCID per pixel and scan parameter
-            tot_pixel_mean_array = np.average(tot_pixel_array, axis=3, weights=range(0, 16)) * sum(range(0, 16)) / np.sum(tot_pixel_array, axis=3).astype('f4')  # calculate the mean tot per pixel and scan parameter
-            bcid_mean_result = np.swapaxes(bcid_mean_array, 0, 1)
-            bcid_result = np.swapaxes(bcid_array, 0, 1)
-            tot_pixel_result = np.swapaxes(tot_pixel_array, 0, 1)
-            tot_mean_pixel_result = np.swapaxes(tot_pixel_mean_array, 0, 1)
+            bcid_mean_result = get_mean_bin(bcid_hist)  # calculate the mean BCID per pixel and scan parameter
+            tot_mean_pixel_result = get_mean_bin(tot_pixel_hist)  # calculate the mean tot per pixel and scan parameter
 
             out = out_file_h5.create_carray(hists_folder, name='HistPixelMeanRelBcidPerDelayPlsrDac_%03d' % old_plsr_dac, title='Mean relative BCID hist per pixel and different PlsrDAC delays for PlsrDAC ' + str(old_plsr_dac), atom=tb.Atom.from_dtype(bcid_mean_result.dtype), shape=bcid_mean_result.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
             out.attrs.dimensions = 'column, row, injection delay'
             out.attrs.injection_delay_values = injection_delay
             out[:] = bcid_mean_result
-            out_2 = out_file_h5.create_carray(hists_folder_2, name='HistPixelRelBcidPerDelayPlsrDac_%03d' % old_plsr_dac, title='Relative BCID hist per pixel and different PlsrDAC delays for PlsrDAC ' + str(old_plsr_dac), atom=tb.Atom.from_dtype(bcid_result.dtype), shape=bcid_result.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            out_2 = bcid_hist.to_hdf5(out_file_h5, where=hists_folder_2, name='HistPixelRelBcidPerDelayPlsrDac_%03d' % old_plsr_dac, title='Relative BCID hist per pixel and different PlsrDAC delays for PlsrDAC ' + str(old_plsr_dac), filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))  # read with get_histogram()
             out_2.attrs.dimensions = 'column, row, injection delay, relative bcid'
             out_2.attrs.injection_delay_values = injection_delay
-            out_2[:] = bcid_result
-            out_3 = out_file_h5.create_carray(hists_folder_3, name='HistPixelTotPerDelayPlsrDac_%03d' % old_plsr_dac, title='Tot hist per pixel and different PlsrDAC delays for PlsrDAC ' + str(old_plsr_dac), atom=tb.Atom.from_dtype(tot_pixel_result.dtype), shape=tot_pixel_result.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            out_3 = tot_pixel_hist.to_hdf5(out_file_h5, where=hists_folder_3, name='HistPixelTotPerDelayPlsrDac_%03d' % old_plsr_dac, title='Tot hist per pixel and different PlsrDAC delays for PlsrDAC ' + str(old_plsr_dac), filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
             out_3.attrs.dimensions = 'column, row, injection delay'
             out_3.attrs.injection_delay_values = injection_delay
-            out_3[:] = tot_pixel_result
             out_4 = out_file_h5.create_carray(hists_folder_4, name='HistPixelMeanTotPerDelayPlsrDac_%03d' % old_plsr_dac, title='Mean tot hist per pixel and different PlsrDAC delays for PlsrDAC ' + str(old_plsr_dac), atom=tb.Atom.from_dtype(tot_mean_pixel_result.dtype), shape=tot_mean_pixel_result.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
             out_4.attrs.dimensions = 'column, row, injection delay'
             out_4.attrs.injection_delay_values = injection_delay
@@ -147,36 +186,35 @@ def analyze_hit_delay(raw_data_file):
             injection_delay = scan_parameters_dict[scan_parameters_dict.keys()[1]]  # injection delay par name is unknown and should be in the inner loop
             scan_parameters = scan_parameters_dict.keys()
 
-        bcid_array = np.zeros((80, 336, len(injection_delay), 16), dtype=np.uint16)  # bcid array of actual PlsrDAC
-        tot_pixel_array = np.zeros((80, 336, len(injection_delay), 16), dtype=np.uint16)  # tot pixel array of actual PlsrDAC
+        bcid_hist = SparseHistogram(shape=(336, 80, len(injection_delay), 16), dtype=np.uint16)  # bcid histogram of actual PlsrDAC, mostly empty
+        tot_pixel_hist = SparseHistogram(shape=(336, 80, len(injection_delay), 16), dtype=np.uint16)  # tot pixel histogram of actual PlsrDAC
         tot_array = np.zeros((16,), dtype=np.uint32)  # tot array of actual PlsrDAC
 
         logging.info('Store histograms for PlsrDAC values ' + str(plsr_dac))
         progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=max(plsr_dac) - min(plsr_dac), term_width=80)
 
-        for index, (parameters, hits) in enumerate(get_hits_of_scan_parameter(raw_data_file + '_interpreted.h5', scan_parameters, try_speedup=True, chunk_size=10000000)):
+        for index, (parameters, histograms) in enumerate(map_hits_of_scan_parameter(histogram_bcid_tot, raw_data_file + '_interpreted.h5', scan_parameters, chunk_size=10000000)):  # histograms of the scan parameter settings are created in parallel
             if index == 0:
-                progress_bar.start()  # Start after the event index is created to get reasonable ETA
+                progress_bar.start()  # Start after the first result to get reasonable ETA
+            if histograms is None:  # no hits for this setting
+                continue
             actual_plsr_dac, actual_injection_delay = parameters[0], parameters[1]
-            column, row, rel_bcid, tot = hits['column'] - 1, hits['row'] - 1, hits['relative_BCID'], hits['tot']
-            bcid_array_fast = hist_3d_index(column, row, rel_bcid, shape=(80, 336, 16))
-            tot_pixel_array_fast = hist_3d_index(column, row, tot, shape=(80, 336, 16))
-            tot_array_fast = hist_1d_index(tot, shape=(16,))
+            bcid_array_fast, tot_pixel_array_fast, tot_array_fast = histograms
 
             if old_plsr_dac != actual_plsr_dac:  # Store the data of the actual PlsrDAC value
                 if old_plsr_dac:  # Special case for the first PlsrDAC setting
-                    store_bcid_histograms(bcid_array, tot_array, tot_pixel_array)
+                    store_bcid_histograms(bcid_hist, tot_array, tot_pixel_hist)
                     progress_bar.update(old_plsr_dac - min(plsr_dac))
                 # Reset the histrograms for the next PlsrDAC setting
-                bcid_array = np.zeros((80, 336, len(injection_delay), 16), dtype=np.uint16)
-                tot_pixel_array = np.zeros((80, 336, len(injection_delay), 16), dtype=np.uint16)
+                bcid_hist = SparseHistogram(shape=(336, 80, len(injection_delay), 16), dtype=np.uint16)
+                tot_pixel_hist = SparseHistogram(shape=(336, 80, len(injection_delay), 16), dtype=np.uint16)
                 tot_array = np.zeros((16,), dtype=np.uint32)
                 old_plsr_dac = actual_plsr_dac
             injection_delay_index = np.where(np.array(injection_delay) == actual_injection_delay)[0][0]
-            bcid_array[:, :, injection_delay_index, :] += bcid_array_fast
-            tot_pixel_array[:, :, injection_delay_index, :] += tot_pixel_array_fast
+            fill_delay_histogram(bcid_hist, bcid_array_fast, injection_delay_index)
+            fill_delay_histogram(tot_pixel_hist, tot_pixel_array_fast, injection_delay_index)
             tot_array += tot_array_fast
-        store_bcid_histograms(bcid_array, tot_array, tot_pixel_array)  # save histograms of last PlsrDAC setting
+        store_bcid_histograms(bcid_hist, tot_array, tot_pixel_hist)  # save histograms of last PlsrDAC setting
         progress_bar.finish()
 
     # Take the mean relative BCID histogram of each PlsrDAC value and calculate the delay for each pixel
@@ -198,13 +236,8 @@ def analyze_hit_delay(raw_data_file):
             pixel_data_fixed[nans] = np.interp(x(nans), x(~nans), pixel_data_fixed[~nans])  # interpolate Nans
             pixel_data_fixed = pixel_data_fixed.reshape(pixel_data.shape[0], pixel_data.shape[1], pixel_data.shape[2])  # Reshape after interpolation of Nans
 
-            # Fit all BCID jumps per pixel (1 - 2 jumps expected) with multithreading
-            pixel_data_shaped = pixel_data_fixed.reshape(pixel_data_fixed.shape[0] * pixel_data_fixed.shape[1], pixel_data_fixed.shape[2]).tolist()
-            pool = mp.Pool()  # create as many workers as physical cores are available
-            result_array = np.array(pool.map(fit_bcid_jumps, pixel_data_shaped))
-            pool.close()
-            pool.join()
-            result_array = result_array.reshape(pixel_data_fixed.shape[0], pixel_data_fixed.shape[1], 4)
+            # Fit all BCID jumps per pixel (1 - 2 jumps expected) at once
+            result_array = fit_bcid_jumps(pixel_data_fixed)
 
             # Store array to file
             out = in_file_h5.create_carray(hists_folder, name='PixelHistsBcidJumpsPlsrDac_%03d' % actual_plsr_dac, title='BCID jumps per pixel for PlsrDAC ' + str(actual_plsr_dac), atom=tb.Atom.from_dtype(result_array.dtype), shape=result_array.shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
@@ -2,10 +2,18 @@
 '''
 import unittest
 import os
+import shutil
+import signal
+import tempfile
+import time
+import cPickle as pickle
 
+import mock
 import progressbar
 import tables as tb
 import numpy as np
+from matplotlib.backends.backend_pdf import PdfPages
+from scipy.interpolate import interp1d
 
 from pixel_clusterizer.clusterizer import HitClusterizer
 
@@ -14,17 +22,52 @@ from pybar_fei4_interpreter.data_histograming import PyDataHistograming
 from pybar_fei4_interpreter import analysis_utils as fast_analysis_utils
 from pybar_fei4_interpreter import data_struct
 
-from pybar.analysis.analyze_raw_data import AnalyzeRawData
+from pybar.analysis.analyze_raw_data import AnalyzeRawData, fit_scurve, fit_scurves, scurve
+from pybar.analysis.analysis import analyze_time_series, analyse_n_cluster_per_event
+from pybar.analysis import analysis_cache, analysis_pool
+from pybar.analysis.analysis_pool import Pipeline, SharedArray
+from pybar.analysis.analysis_cache import AnalysisCache
+from pybar.analysis.live_interpretation import LiveInterpretation
+from pybar.analysis.sparse_histogram import SparseHistogram, get_histogram
+from pybar.analysis import table_layout
+from pybar.analysis.adaptive_chunk_size import AdaptiveChunkSize
+from pybar.analysis import event_index
+from pybar.analysis.event_index import get_event_index, create_event_index
+from pybar.analysis.plotting import plotting
+from pybar.analysis.plotting.pdf_report import PdfReport
+from pybar.analysis.plotting import plot_registry
+from pybar.daq.fei4_raw_data import open_raw_data_file
+from pybar.fei4.register import FEI4Register, clear_parse_cache, write_pixel_dac_config
+from pybar.daq import run_catalog
+from pybar.daq.run_catalog import RunCatalog
 from pybar.testing.tools import test_tools
 from pybar.scans.calibrate_hit_or import create_hitor_calibration
+from pybar.scans.calibrate_threshold import analyze_raw_data_files, store_calibration_data_as_table
+from pybar.scans.scan_hit_delay import fit_bcid_jumps, fill_delay_histogram, get_mean_bin
 from pybar.daq.readout_utils import get_col_row_array_from_data_record_array, convert_data_array, is_data_record
-from pybar.analysis.analysis_utils import data_aligned_at_events, InvalidInputError
+from pybar.analysis.analysis_utils import data_aligned_at_events, InvalidInputError, IncompleteInputError, select_hits, split_condition, write_selected_hits, map_hits_of_scan_parameter
+from pybar.analysis import analysis_utils
 import pybar.scans.analyze_source_scan_tdc_data as tdc_analysis
 
 
 tests_data_folder = 'test_analysis_data/'
 
 
+def get_tot_hist(hits):  # has to be global for the multiprocessing module
+    return np.bincount(hits['tot'], minlength=16)
+
+
+def get_row_sum(row):  # has to be global for the multiprocessing module
+    return row.sum()
+
+
+def process_pipeline_item(item):  # has to be global for the multiprocessing module
+    if item < 0:
+        raise ValueError('Negative item %d' % item)
+    time.sleep(0.01 * (item % 3))  # results are received out of order
+    return item * 2
+
+
 class TestAnalysis(unittest.TestCase):
 
     @classmethod
@@ -105,6 +148,20 @@ class TestAnalysis(unittest.TestCase):
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_2.h5'))
         os.remove(os.path.join(tests_data_folder, 'unit_test_data_5_interpreted.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_resumed.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_resumed_interpreted.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_cached.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_live.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_cluster_pipeline.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_live_interpreted.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_sparse.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits_analyzed.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_static_layout.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_adaptive_chunk_size.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_profile.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_event_index.h5'))
+        os.remove(os.path.join(tests_data_folder, 'unit_test_data_1_selected_hits.h5'))
         os.remove(os.path.join(tests_data_folder, 'hit_or_calibration.pdf'))
         os.remove(os.path.join(tests_data_folder, 'hit_or_calibration_interpreted.h5'))
         os.remove(os.path.join(tests_data_folder, 'hit_or_calibration_calibration.h5'))
@@ -276,6 +333,779 @@ class TestAnalysis(unittest.TestCase):
                 pass
             self.assertTrue(exception_ok & np.all(array == array_fast))
 
+    def test_scurve_fit(self):  # check batched S-curve fit against the single pixel fit
+        plsr_dac = np.arange(0, 100, dtype=np.float64)
+        threshold, noise = np.random.normal(40.0, 5.0, 500), np.random.normal(3.0, 0.5, 500)
+        occupancy = np.random.binomial(100, scurve(plsr_dac[np.newaxis, :], 1.0, threshold[:, np.newaxis], np.abs(noise[:, np.newaxis]))).astype(np.float64)
+        occupancy[:10] = 0  # pixels without data
+        result = fit_scurves(occupancy, plsr_dac)
+        result_single = np.array([fit_scurve(pixel_occupancy, plsr_dac) for pixel_occupancy in occupancy])
+        self.assertTrue(np.allclose(result, result_single, rtol=1e-3, atol=1e-3))
+        self.assertTrue(np.all(result[:10] == 0))
+
+    def test_scurve_fit_singular(self):  # pixels with a singular or non finite system must not stop the batched fit of the other pixels
+        plsr_dac = np.arange(0, 100, dtype=np.float64)
+        threshold, noise = np.random.normal(40.0, 5.0, 500), np.random.normal(3.0, 0.5, 500)
+        occupancy = np.random.binomial(100, scurve(plsr_dac[np.newaxis, :], 1.0, threshold[:, np.newaxis], np.abs(noise[:, np.newaxis]))).astype(np.float64)
+        threshold_start = threshold.copy()
+        threshold_start[:5] = np.nan  # non finite system in the first step
+        with mock.patch('pybar.analysis.analyze_raw_data.fit_scurve', side_effect=fit_scurve) as mock_fit_scurve:
+            result = fit_scurves(occupancy, plsr_dac, threshold=threshold_start, noise=np.abs(noise))
+        self.assertEqual(mock_fit_scurve.call_count, 5)  # only these pixels are fitted one by one
+        result_single = np.array([fit_scurve(pixel_occupancy, plsr_dac) for pixel_occupancy in occupancy])
+        self.assertTrue(np.allclose(result, result_single, rtol=1e-3, atol=1e-3))
+
+    def test_bcid_jump_fit(self):  # the BCID jumps of all pixels are fitted at once
+        delay = np.arange(0, 60, dtype=np.float64)
+        first_jump, second_jump = np.random.uniform(10.0, 20.0, 500), np.random.uniform(35.0, 45.0, 500)
+        mean_bcid = 4.0 + np.round(scurve(delay[np.newaxis, :], 1.0, first_jump[:, np.newaxis], 1.5) + scurve(delay[np.newaxis, :], 1.0, second_jump[:, np.newaxis], 1.5), 2)  # mean of 100 hits
+        mean_bcid[:10] = 4.0  # pixels without BCID jump
+        mean_bcid = mean_bcid.astype(np.float32)
+        result = fit_bcid_jumps(mean_bcid.reshape(20, 25, 60))
+        self.assertEqual(result.shape, (20, 25, 4))
+        result = result.reshape(500, 4)
+        self.assertTrue(np.all(result[:10] == -1))
+        self.assertTrue(np.all(result[10:, 0] == 4) and np.all(result[10:, 2] == 5))
+        self.assertTrue(np.allclose(result[10:, 1], first_jump[10:], atol=0.05) and np.allclose(result[10:, 3], second_jump[10:], atol=0.05))
+        self.assertTrue(np.allclose(fit_bcid_jumps(mean_bcid[20]), result[20]))
+
+    def test_hit_delay_histograms(self):  # the sparse histograms per pixel and injection delay have to give the dense histograms and mean values
+        random_state = np.random.RandomState(0)
+        pixel_hists = random_state.poisson(0.01, (3, 80, 336, 16)).astype(np.uint16)  # histograms per injection delay (column, row, bin)
+        hist = SparseHistogram(shape=(336, 80, 3, 16), dtype=np.uint16)
+        for injection_delay_index, pixel_hist in enumerate(pixel_hists):
+            fill_delay_histogram(hist, pixel_hist, injection_delay_index)
+        dense_hist = np.transpose(pixel_hists, axes=(2, 1, 0, 3))
+        self.assertTrue(np.array_equal(hist[:], dense_hist))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_bin = np.average(dense_hist, axis=3, weights=range(0, 16)) * sum(range(0, 16)) / np.sum(dense_hist, axis=3).astype('f4')
+        self.assertTrue(np.allclose(get_mean_bin(hist), mean_bin, equal_nan=True))
+
+    def test_configuration_snapshot(self):  # the binary snapshot and the text configuration with and without parse cache have to give the same register values
+        configuration = FEI4Register(configuration_file=os.path.join(os.path.dirname(__file__), '..', 'config', 'fei4', 'configs', 'std_cfg_fei4b.cfg'))
+        configuration.set_pixel_register_value('TDAC', np.random.randint(0, 32, (80, 336)))
+        configuration.calibration_parameters['Pulser_Corr_C_Inj_Low'] = [1.0, 2.5]
+        output_folder = tempfile.mkdtemp()
+        try:
+            configuration.save_configuration(os.path.join(output_folder, 'fei4b.cfg'))
+            configuration.save_configuration(os.path.join(output_folder, 'fei4b.npz'))
+            for file_name, parse_cache in ((os.path.join('configs', 'fei4b.cfg'), True), (os.path.join('configs', 'fei4b.cfg'), False), ('fei4b.npz', False)):
+                if not parse_cache:
+                    clear_parse_cache()
+                loaded_configuration = FEI4Register(configuration_file=os.path.join(output_folder, file_name))
+                self.assertEqual((loaded_configuration.flavor, loaded_configuration.chip_id), (configuration.flavor, configuration.chip_id))
+                self.assertEqual(loaded_configuration.calibration_parameters, configuration.calibration_parameters)
+                for name in configuration.get_global_register_attributes('name', readonly=False):
+                    self.assertEqual(loaded_configuration.get_global_register_value(name), configuration.get_global_register_value(name))
+                for name in configuration.pixel_registers:
+                    self.assertTrue(np.array_equal(loaded_configuration.get_pixel_register_value(name), configuration.get_pixel_register_value(name)))
+            loaded_configuration.pixel_registers['TDAC']['value'][:] = 0  # the cached values are copied
+            self.assertTrue(np.array_equal(FEI4Register(configuration_file=os.path.join(output_folder, 'configs', 'fei4b.cfg')).get_pixel_register_value('TDAC'), configuration.get_pixel_register_value('TDAC')))
+            tdac = (configuration.get_pixel_register_value('TDAC') + 1) % 32  # the changed file is parsed again
+            tdac_file = os.path.join(output_folder, 'tdacs', 'tdac_fei4b.dat')
+            write_pixel_dac_config(os.path.join(output_folder, 'tdac.dat'), tdac)
+            modification_time = os.path.getmtime(tdac_file)
+            shutil.copyfile(os.path.join(output_folder, 'tdac.dat'), tdac_file)
+            os.utime(tdac_file, (modification_time + 10, modification_time + 10))
+            self.assertTrue(np.array_equal(FEI4Register(configuration_file=os.path.join(output_folder, 'configs', 'fei4b.cfg')).get_pixel_register_value('TDAC'), tdac))
+        finally:
+            shutil.rmtree(output_folder)
+
+    def test_pixel_register_bitsets(self):  # bitsets of all double columns and bits at once, the second column of a double column is shifted first
+        configuration = FEI4Register(fe_type='fei4b', chip_address=0)
+        tdac = np.random.randint(0, 32, (80, 336))
+        configuration.set_pixel_register_value('TDAC', tdac)
+        register_bitsets = configuration.get_pixel_register_bitsets(configuration.pixel_registers['TDAC'])
+        self.assertEqual((len(register_bitsets), len(register_bitsets[0])), (5, 40))
+        for bit_no in range(5):
+            for dc_no in range(40):
+                bits = ((tdac[dc_no * 2 + 1, ::-1] >> bit_no) & 1).tolist() + ((tdac[dc_no * 2, :] >> bit_no) & 1).tolist()
+                self.assertEqual(register_bitsets[bit_no][dc_no].tolist(), [bool(bit) for bit in bits])
+                self.assertEqual(configuration.get_pixel_register_bitset(configuration.pixel_registers['TDAC'], bit_no, dc_no), register_bitsets[bit_no][dc_no])
+        self.assertEqual(configuration.get_pixel_register_bitsets(configuration.pixel_registers['TDAC'], bit_nos=[3], dcs=[7, 2]), [[register_bitsets[3][7], register_bitsets[3][2]]])
+
+    def test_resumed_interpretation(self):  # interpret growing raw data with checkpoints and compare to the interpretation of the complete raw data
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1.h5'), mode="r") as in_file_h5:
+            raw_data, meta_data = in_file_h5.root.raw_data[:], in_file_h5.root.meta_data[:]
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_resumed.h5'), mode="w") as out_file_h5:
+                in_file_h5.root.raw_data.copy(out_file_h5.root, stop=meta_data[9]['index_stop'])
+                in_file_h5.root.meta_data.copy(out_file_h5.root, stop=10)
+        for n_readouts in (10, 15, meta_data.shape[0]):
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_resumed.h5'), mode="a") as raw_data_file_h5:  # simulate data taking
+                last_readout = raw_data_file_h5.root.meta_data.shape[0]
+                raw_data_file_h5.root.raw_data.append(raw_data[meta_data[last_readout - 1]['index_stop']:meta_data[n_readouts - 1]['index_stop']])
+                raw_data_file_h5.root.meta_data.append(meta_data[last_readout:n_readouts])
+            with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_resumed.h5'), create_pdf=False, resume=True) as analyze_raw_data:
+                analyze_raw_data.chunk_size = 300007
+                analyze_raw_data.create_hit_table = True
+                analyze_raw_data.create_cluster_table = True
+                analyze_raw_data.create_trigger_error_hist = True
+                analyze_raw_data.create_cluster_size_hist = True
+                analyze_raw_data.create_cluster_tot_hist = True
+                analyze_raw_data.create_meta_word_index = True
+                analyze_raw_data.create_checkpoint = n_readouts != meta_data.shape[0]  # last interpretation stores the last event
+                analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_resumed_interpreted.h5'),
+                                                            node_names=["Hits", "Cluster", "EventMetaData", "meta_data", "HistOcc", "HistTot", "HistTotPixel", "HistRelBcid", "HistErrorCounter", "HistClusterSize", "HistClusterTot"])
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_resumed_interpretation_failure(self):  # a failed resumed interpretation has to keep the interpretation before the checkpoint
+        output_dir = tempfile.mkdtemp()
+        try:
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1.h5'), mode="r") as in_file_h5:
+                raw_data, meta_data = in_file_h5.root.raw_data[:], in_file_h5.root.meta_data[:]
+                for file_name in ('failed.h5', 'resumed.h5'):
+                    with tb.open_file(os.path.join(output_dir, file_name), mode="w") as out_file_h5:
+                        in_file_h5.root.raw_data.copy(out_file_h5.root, stop=meta_data[9]['index_stop'])
+                        in_file_h5.root.meta_data.copy(out_file_h5.root, stop=10)
+
+            def interpret(file_name, create_checkpoint):
+                with AnalyzeRawData(raw_data_file=os.path.join(output_dir, file_name), create_pdf=False, resume=True) as analyze_raw_data:
+                    analyze_raw_data.chunk_size = 300007
+                    analyze_raw_data.create_hit_table = True
+                    analyze_raw_data.create_meta_word_index = True
+                    analyze_raw_data.create_checkpoint = create_checkpoint
+                    analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+
+            for file_name in ('failed.h5', 'resumed.h5'):
+                interpret(file_name, create_checkpoint=True)
+                with tb.open_file(os.path.join(output_dir, file_name), mode="a") as raw_data_file_h5:  # simulate data taking
+                    raw_data_file_h5.root.raw_data.append(raw_data[meta_data[9]['index_stop']:])
+                    raw_data_file_h5.root.meta_data.append(meta_data[10:])
+            shutil.copy(os.path.join(output_dir, 'failed_interpreted.h5'), os.path.join(output_dir, 'checkpoint_interpreted.h5'))
+            with mock.patch.object(AnalyzeRawData, '_create_additional_data', side_effect=RuntimeError('Failure after appending the hits')):
+                self.assertRaises(RuntimeError, interpret, 'failed.h5', create_checkpoint=False)
+            data_equal, error_msg = test_tools.compare_h5_files(os.path.join(output_dir, 'checkpoint_interpreted.h5'), os.path.join(output_dir, 'failed_interpreted.h5'))
+            self.assertTrue(data_equal, msg=error_msg)
+            for file_name in ('failed.h5', 'resumed.h5'):
+                interpret(file_name, create_checkpoint=False)
+            data_equal, error_msg = test_tools.compare_h5_files(os.path.join(output_dir, 'resumed_interpreted.h5'), os.path.join(output_dir, 'failed_interpreted.h5'))
+            self.assertTrue(data_equal, msg=error_msg)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_analysis_cache(self):  # the second interpretation has to be taken from the cache
+        cache_dir = tempfile.mkdtemp()
+        try:
+            analysis_cache = AnalysisCache(cache_dir=cache_dir)
+            hists = []
+            for _ in range(2):
+                with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_cached.h5'), create_pdf=False) as analyze_raw_data:
+                    analyze_raw_data.analysis_cache = analysis_cache
+                    analyze_raw_data.chunk_size = 500009
+                    analyze_raw_data.create_hit_table = True
+                    analyze_raw_data.create_cluster_table = True
+                    analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+                    hists.append((analyze_raw_data.occupancy_array, analyze_raw_data.tot_hist, analyze_raw_data.rel_bcid_hist))
+            metrics = analysis_cache.get_metrics()
+            self.assertEqual((metrics['hits'], metrics['misses'], metrics['entries']), (1, 1, 1))
+            for interpreted_hist, cached_hist in zip(*hists):  # the histograms in memory are also set from the cache
+                self.assertTrue(np.array_equal(cached_hist, interpreted_hist))
+            data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                                os.path.join(tests_data_folder, 'unit_test_data_1_cached.h5'),
+                                                                node_names=["Hits", "Cluster", "meta_data", "HistOcc", "HistTot", "HistRelBcid"])
+            self.assertTrue(data_equal, msg=error_msg)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_raw_data_fingerprint(self):  # every raw data word changes the fingerprint, the chunk size does not
+        temp_dir = tempfile.mkdtemp()
+        try:
+            raw_data_file = os.path.join(temp_dir, 'unit_test_data_1.h5')
+            shutil.copy(os.path.join(tests_data_folder, 'unit_test_data_1.h5'), raw_data_file)
+            fingerprint = analysis_cache.get_raw_data_fingerprint([raw_data_file])
+            self.assertEqual(analysis_cache.get_raw_data_fingerprint([raw_data_file], chunk_size=1001), fingerprint)
+            with tb.open_file(raw_data_file, mode="r+") as in_file_h5:
+                word_index = in_file_h5.root.raw_data.shape[0] // 2 + 123  # not at a chunk boundary
+                in_file_h5.root.raw_data[word_index] ^= 1
+            self.assertNotEqual(analysis_cache.get_raw_data_fingerprint([raw_data_file]), fingerprint)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_analysis_pool_shared_array(self):  # only the file name is pickled, the file is removed by the creating process only
+        array = np.arange(1000, dtype=np.uint32).reshape(100, 10)
+        shared_array = SharedArray(array)
+        self.assertTrue(os.path.isfile(shared_array.filename))
+        self.assertLess(len(pickle.dumps(shared_array, pickle.HIGHEST_PROTOCOL)), array.nbytes)
+        shared_array_copy = pickle.loads(pickle.dumps(shared_array, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(shared_array_copy.filename, shared_array.filename)
+        self.assertTrue(np.all(shared_array_copy[:] == array))
+        shared_array_copy.release()
+        self.assertTrue(os.path.isfile(shared_array.filename))
+        shared_array.release()
+        self.assertFalse(os.path.isfile(shared_array.filename))
+        with SharedArray(np.array([], dtype=np.uint32)) as empty_shared_array:  # empty arrays are pickled directly
+            self.assertIsNone(empty_shared_array.filename)
+            self.assertEqual(len(pickle.loads(pickle.dumps(empty_shared_array, pickle.HIGHEST_PROTOCOL))), 0)
+
+    def test_analysis_pool_map_rows(self):  # the results are in the order of the rows for any number of chunks
+        pool_size = analysis_pool._pool_size
+        try:
+            self.assertRaises(ValueError, analysis_pool.set_pool_size, 0)
+            analysis_pool.set_pool_size(2)
+            pool = analysis_pool.get_pool()
+            self.assertIs(analysis_pool.get_pool(), pool)  # the pool is reused
+            array = np.random.randint(0, 100, size=(101, 10))
+            for n_chunks in (None, 1, 7, 1000):
+                self.assertEqual(analysis_pool.map_rows(get_row_sum, array, n_chunks=n_chunks), list(array.sum(axis=1)))
+            self.assertEqual(analysis_pool.map_rows(get_row_sum, array[:0]), [])
+            analysis_pool.set_pool_size(2)
+            self.assertIs(analysis_pool.get_pool(), pool)  # same size, the pool is kept
+            analysis_pool.set_pool_size(3)
+            self.assertIsNone(analysis_pool._pool)  # different size, the pool is closed and recreated on next use
+            self.assertIsNot(analysis_pool.get_pool(), pool)
+            self.assertEqual(analysis_pool.get_pool_size(), 3)
+            analysis_pool.close_pool()
+            self.assertIsNone(analysis_pool._pool)
+        finally:
+            analysis_pool.set_pool_size(pool_size)
+            analysis_pool.close_pool()
+
+    def test_analysis_pool_pipeline(self):  # the results are in the order of the items, exceptions of the processes are raised in the main process
+        with Pipeline(process_pipeline_item, processes=3, max_queued_items=2) as pipeline:
+            results = []
+            for item in range(20):
+                pipeline.put(item)
+                results.extend(pipeline.get())
+            results.extend(pipeline.close())
+        self.assertEqual(results, [item * 2 for item in range(20)])
+        with Pipeline(process_pipeline_item, processes=2) as pipeline:
+            pipeline.put(1)
+            pipeline.put(-1)
+            with self.assertRaises(RuntimeError) as context:
+                pipeline.get(block=True)
+            self.assertIn('Negative item -1', str(context.exception))
+        self.assertRaises(ValueError, Pipeline, process_pipeline_item, processes=0)
+
+    def test_cluster_pipeline(self):  # clustering in parallel processes has to give the same result
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_cluster_pipeline.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 300007
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.create_cluster_hit_table = True
+            analyze_raw_data.create_cluster_table = True
+            analyze_raw_data.create_cluster_size_hist = True
+            analyze_raw_data.create_cluster_tot_hist = True
+            analyze_raw_data.cluster_processes = 2
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_cluster_pipeline.h5'),
+                                                            node_names=["Hits", "ClusterHits", "Cluster", "HistClusterSize", "HistClusterTot"])
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_live_interpretation(self):  # interpret raw data during data taking, the analysis has to take the result from the cache
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = analysis_cache.set_cache(cache_dir=cache_dir)
+            settings = {'chunk_size': 500009, 'create_hit_table': True, 'create_cluster_table': True, 'create_cluster_size_hist': True, 'create_cluster_tot_hist': True}
+            live_interpretation = LiveInterpretation(settings=settings, interval=0.1)
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1.h5'), mode="r") as in_file_h5:
+                raw_data, meta_data = in_file_h5.root.raw_data[:], in_file_h5.root.meta_data[:]
+            raw_data_file = open_raw_data_file(os.path.join(tests_data_folder, 'unit_test_data_1_live.h5'), mode='w')
+            live_interpretation.start(raw_data_file)
+            raw_data_file.live_interpretation = live_interpretation
+            for readout in meta_data:  # simulate data taking
+                raw_data_file.append_item((raw_data[readout['index_start']:readout['index_stop']], readout['timestamp_start'], readout['timestamp_stop'], readout['error']))
+                time.sleep(0.01)
+            raw_data_file.close()
+            self.assertTrue(live_interpretation.stop(raw_data_files=[os.path.join(tests_data_folder, 'unit_test_data_1_live.h5')]))
+            with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_live.h5'), create_pdf=False) as analyze_raw_data:
+                analyze_raw_data.set_settings(settings)
+                analyze_raw_data.interpret_word_table()
+            self.assertEqual(cache.get_metrics()['hits'], 1)
+            data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                                os.path.join(tests_data_folder, 'unit_test_data_1_live_interpreted.h5'),
+                                                                node_names=["Hits", "Cluster", "meta_data", "HistOcc", "HistTot", "HistRelBcid", "HistClusterSize", "HistClusterTot"])
+            self.assertTrue(data_equal, msg=error_msg)
+        finally:
+            analysis_cache.set_cache(cache_dir=None)
+            shutil.rmtree(cache_dir)
+
+    def test_live_interpretation_abort(self):  # a stalled live interpretation must not block the data taking, a died one not the stop
+        temp_dir = tempfile.mkdtemp()
+        try:
+            analysis_cache.set_cache(cache_dir=os.path.join(temp_dir, 'cache'))
+            live_interpretation = LiveInterpretation(settings={}, max_queued_readouts=2)
+            os.kill(live_interpretation._process.pid, signal.SIGSTOP)  # the process does not read the queue anymore
+            data_tuple = (np.ones(10, dtype=np.uint32), 0.0, 0.0, 0)
+            self.assertEqual([live_interpretation.add_data(data_tuple) for _ in range(3)], [True, True, False])  # queue full
+            os.kill(live_interpretation._process.pid, signal.SIGCONT)
+            live_interpretation.abort()
+            raw_data_file = open_raw_data_file(os.path.join(temp_dir, 'live.h5'), mode='w')
+            raw_data_file.live_interpretation = mock.Mock(**{'add_data.return_value': False})
+            live_interpretation = raw_data_file.live_interpretation
+            raw_data_file.append_item(data_tuple)
+            live_interpretation.abort.assert_called_once_with()
+            self.assertIsNone(raw_data_file.live_interpretation)
+            raw_data_file.close()
+            live_interpretation = LiveInterpretation(settings={})
+            os.kill(live_interpretation._process.pid, signal.SIGKILL)  # the process dies without result
+            self.assertFalse(live_interpretation.stop(raw_data_files=[os.path.join(temp_dir, 'live.h5')]))
+        finally:
+            analysis_cache.set_cache(cache_dir=None)
+            shutil.rmtree(temp_dir)
+
+    def test_sparse_histograms(self):  # sparse stored histograms have to be identical to the dense histograms
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_sparse.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 500009
+            analyze_raw_data.use_sparse_hists = True
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as dense_file_h5:
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_sparse.h5'), mode="r") as sparse_file_h5:
+                for node_name in ('HistOcc', 'HistTotPixel'):
+                    sparse_hist = get_histogram(sparse_file_h5, node_name)
+                    self.assertTrue(isinstance(sparse_hist, SparseHistogram))
+                    dense_hist = dense_file_h5.get_node(dense_file_h5.root, node_name)[:]
+                    self.assertTrue(np.array_equal(sparse_hist[:], dense_hist))
+                    self.assertTrue(np.array_equal(sparse_hist[10:20, :, 0], dense_hist[10:20, :, 0]))
+                    self.assertTrue(np.array_equal(SparseHistogram.from_dense(dense_hist).toarray(), dense_hist))
+        hist = SparseHistogram(shape=(4, 3, 2))
+        hist.fill((np.array([0, 1, 1, 3]), np.array([2, 0, 0, 1]), np.array([1, 1, 1, 0])))
+        hist += SparseHistogram.from_dense(np.ones((4, 3, 2), dtype=np.uint32))
+        result = np.ones((4, 3, 2), dtype=np.uint32)
+        result[0, 2, 1], result[1, 0, 1], result[3, 1, 0] = 2, 3, 2
+        self.assertTrue(np.array_equal(hist.toarray(), result))
+        self.assertTrue(np.array_equal(hist[..., 1], result[..., 1]))
+
+    def test_hit_table_profile(self):  # hit table with a column subset, the hit analysis has to give the same result
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 500009
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.hit_table_profile = 'pixel'
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        with AnalyzeRawData(raw_data_file=None, analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 500009
+            analyze_raw_data.analyze_hit_table(analyzed_data_out_file=os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits_analyzed.h5'))
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as in_file_h5:
+            hits = in_file_h5.root.Hits[:]
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits.h5'), mode="r") as in_file_h5:
+            pixel_hits = in_file_h5.root.Hits[:]
+        self.assertEqual(pixel_hits.dtype.names, ('event_number', 'column', 'row', 'tot'))
+        for name in pixel_hits.dtype.names:
+            self.assertTrue(np.array_equal(pixel_hits[name], hits[name]))
+        self.assertTrue(np.array_equal(select_hits(pixel_hits, 'tot > 5'), pixel_hits[pixel_hits['tot'] > 5]))
+        self.assertRaises(IncompleteInputError, select_hits, pixel_hits, 'relative_BCID > 5')
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_pixel_hits_analyzed.h5'),
+                                                            node_names=["HistOcc", "HistTot", "HistTotPixel"])
+        self.assertTrue(data_equal, msg=error_msg)
+        with AnalyzeRawData(raw_data_file=None, create_pdf=False) as analyze_raw_data:
+            with self.assertRaises(InvalidInputError):
+                analyze_raw_data.hit_table_profile = ('column', 'row')  # the event number is needed
+
+    def test_table_layout(self):  # tables with the tuned layout have to contain the same data and be not larger than with the static layout
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_static_layout.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 500009
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.create_cluster_hit_table = True
+            analyze_raw_data.create_cluster_table = True
+            analyze_raw_data.create_trigger_error_hist = True
+            analyze_raw_data.create_cluster_size_hist = True
+            analyze_raw_data.create_cluster_tot_hist = True
+            analyze_raw_data.create_meta_word_index = True
+            analyze_raw_data.tune_table_layout = False
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_static_layout.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as tuned_file_h5:
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_static_layout.h5'), mode="r") as static_file_h5:
+                for node_name in ('Hits', 'ClusterHits', 'Cluster', 'EventMetaData'):
+                    tuned_table = tuned_file_h5.get_node(tuned_file_h5.root, node_name)
+                    self.assertLessEqual(tuned_table.chunkshape[0], table_layout.min_read_chunk_size)
+                    self.assertLessEqual(tuned_table.size_on_disk, 1.1 * static_file_h5.get_node(static_file_h5.root, node_name).size_on_disk)
+                self.assertEqual((static_file_h5.root.Hits.chunkshape, static_file_h5.root.EventMetaData.chunkshape), ((500009 // 100,), (500009 // 10,)))
+
+    def test_adaptive_chunk_size(self):  # the interpreted data does not depend on the chunk size
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_adaptive_chunk_size.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 20000
+            analyze_raw_data.memory_budget = 20000000
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.create_cluster_hit_table = True
+            analyze_raw_data.create_cluster_table = True
+            analyze_raw_data.create_trigger_error_hist = True
+            analyze_raw_data.create_cluster_size_hist = True
+            analyze_raw_data.create_cluster_tot_hist = True
+            analyze_raw_data.create_meta_word_index = True
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_adaptive_chunk_size.h5'))
+        self.assertTrue(data_equal, msg=error_msg)
+        # The chunk size is increased while the throughput increases and limited by the memory budget
+        chunk_size_controller = AdaptiveChunkSize(memory_budget=1000000, chunk_size=20000, bytes_per_word=4, bytes_per_hit=20, min_chunk_size=1000)
+        self.assertEqual(chunk_size_controller.update(20000, 0, 0, 1.), 40000)
+        self.assertEqual(chunk_size_controller.update(40000, 20000, 0, 1.), 71428)  # 1000000 / (4 + 0.5 * 20)
+        self.assertEqual(chunk_size_controller.update(71428, 0, 0, 1000.), 40000)  # no throughput gain
+        self.assertEqual(chunk_size_controller.update(40000, 0, 0, 1.), 40000)
+
+    def test_stage_profiler(self):  # the profile is stored additionally to the unchanged interpreted data
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_profile.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 500009
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.create_cluster_hit_table = True
+            analyze_raw_data.create_cluster_table = True
+            analyze_raw_data.create_trigger_error_hist = True
+            analyze_raw_data.create_cluster_size_hist = True
+            analyze_raw_data.create_cluster_tot_hist = True
+            analyze_raw_data.create_meta_word_index = True
+            analyze_raw_data.profiler.enabled = True
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as in_file_h5:
+            node_names = [node._v_name for node in in_file_h5.root]
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_profile.h5'), node_names=node_names)
+        self.assertTrue(data_equal, msg=error_msg)
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_profile.h5'), mode="r") as in_file_h5:
+            n_words = in_file_h5.root.EventMetaData[-1]['stop_index']
+            profile = dict((stage['stage'], stage) for stage in in_file_h5.root.Profile[:])
+            profile_chunks = in_file_h5.root.ProfileChunks[:]
+        n_chunks = (n_words + 500009 - 1) // 500009
+        for stage in ('read_raw_data', 'interpretation', 'histogramming', 'clustering', 'store_clusters', 'write_tables'):
+            self.assertEqual(profile[stage]['calls'], n_chunks)
+            self.assertEqual(np.count_nonzero(profile_chunks['stage'] == stage), n_chunks)
+        self.assertEqual(profile['read_raw_data']['n_bytes'], 4 * n_words)
+        self.assertEqual(profile['create_additional_data']['calls'], 1)
+        self.assertTrue(np.all(profile_chunks['chunk'][profile_chunks['stage'] == 'create_additional_data'] == -1))
+        self.assertEqual(np.unique(profile_chunks['chunk'][profile_chunks['chunk'] >= 0]).shape[0], n_chunks)
+
+    def test_event_index(self):  # event ranges read with the event number index have to be equal to the ranges read without
+        with AnalyzeRawData(raw_data_file=os.path.join(tests_data_folder, 'unit_test_data_1.h5'), analyzed_data_file=os.path.join(tests_data_folder, 'unit_test_data_1_event_index.h5'), create_pdf=False) as analyze_raw_data:
+            analyze_raw_data.chunk_size = 500009
+            analyze_raw_data.create_hit_table = True
+            analyze_raw_data.create_cluster_hit_table = True
+            analyze_raw_data.create_cluster_table = True
+            analyze_raw_data.create_trigger_error_hist = True
+            analyze_raw_data.create_cluster_size_hist = True
+            analyze_raw_data.create_cluster_tot_hist = True
+            analyze_raw_data.create_meta_word_index = True
+            analyze_raw_data.create_event_index = True
+            analyze_raw_data.interpret_word_table(use_settings_from_file=False, fei4b=False)
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as in_file_h5:
+            node_names = [node._v_name for node in in_file_h5.root]
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'),
+                                                            os.path.join(tests_data_folder, 'unit_test_data_1_event_index.h5'), node_names=node_names)
+        self.assertTrue(data_equal, msg=error_msg)
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_event_index.h5'), mode="r+") as in_file_h5:
+            for table in (in_file_h5.root.Hits, in_file_h5.root.Cluster, in_file_h5.root.ClusterHits):
+                event_numbers = table.read(field='event_number')
+                index = get_event_index(table)
+                self.assertTrue(np.array_equal(index.event_numbers, event_numbers[::event_index.index_step]))
+                for event_number in (event_numbers[0] - 1, event_numbers[0], event_numbers[event_index.index_step], event_numbers[-1] // 2, event_numbers[-1], event_numbers[-1] + 1):
+                    self.assertEqual(index.get_event_rows(event_number), (np.searchsorted(event_numbers, event_number, side='left'), np.searchsorted(event_numbers, event_number, side='right')))
+                for start_event_number, stop_event_number in ((event_numbers[10], event_numbers[20000]), (event_numbers[event_index.index_step], event_numbers[-1]), (event_numbers[-1] // 2, event_numbers[-1] // 2 + 1000)):
+                    data = np.concatenate([hits for hits, _ in data_aligned_at_events(table, start_event_number=start_event_number, stop_event_number=stop_event_number, try_speedup=True, chunk_size=100000)])
+                    self.assertTrue(np.array_equal(data, table[np.searchsorted(event_numbers, start_event_number):np.searchsorted(event_numbers, stop_event_number)]))
+            in_file_h5.remove_node(in_file_h5.root, 'HitsEventIndex')
+            self.assertTrue(get_event_index(in_file_h5.root.Hits) is None)
+            self.assertTrue(np.array_equal(create_event_index(in_file_h5.root.Hits, step=1000).event_numbers, in_file_h5.root.Hits.read(field='event_number')[::1000]))
+
+    def test_hit_selection(self):  # the hits selected with several conditions in one pass have to be equal to the hits selected per condition
+        self.assertEqual(split_condition('(tot > 5) & ((column > 40) | (row < 100))'), ('(tot > 5)', '((column > 40) | (row < 100))'))
+        self.assertEqual(split_condition('(tot > 5) & ((column > 40) & (row < 100))'), ('(tot > 5)', '(column > 40)', '(row < 100)'))
+        self.assertEqual(split_condition('tot > 5 & row < 100'), ('tot > 5 & row < 100',))
+        conditions = ['(relative_BCID > 3) & (relative_BCID < 9)', '(relative_BCID>3) & (relative_BCID < 9) & (tot > 5)', '(tot > 5) & ((column > 40) | (row < 100))', 'tot > 5', None]
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as in_file_h5:
+            hits = in_file_h5.root.Hits[:]
+            selections = [(hits['relative_BCID'] > 3) & (hits['relative_BCID'] < 9), (hits['relative_BCID'] > 3) & (hits['relative_BCID'] < 9) & (hits['tot'] > 5), (hits['tot'] > 5) & ((hits['column'] > 40) | (hits['row'] < 100)), hits['tot'] > 5, np.ones_like(hits['tot'], dtype=np.bool)]
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_selected_hits.h5'), mode="w") as out_file_h5:
+                hit_tables_out = [out_file_h5.create_table(out_file_h5.root, name='Hits_%d' % index, description=in_file_h5.root.Hits.description) for index in range(len(conditions))]
+                n_selected_hits = write_selected_hits(in_file_h5.root.Hits, hit_tables_out, conditions, chunk_size=100003)
+                for index, (condition, selection) in enumerate(zip(conditions, selections)):
+                    self.assertTrue(np.array_equal(select_hits(hits, condition), hits[selection]))
+                    self.assertTrue(np.array_equal(hit_tables_out[index][:], hits[selection]))
+                    self.assertEqual(n_selected_hits[index], np.count_nonzero(selection))
+
+    def test_condition_histogram(self):  # the histograms of all conditions filled in one pass have to be equal to the histograms of the hits selected per condition
+        conditions = ['(relative_BCID > 3) & (relative_BCID < 9)', '(tot > 5) & ((column > 40) | (row < 100))', 'tot > 5', None]
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as in_file_h5:
+            hits = in_file_h5.root.Hits[:]
+        hit_selection = analysis_utils.HitSelection(conditions)
+        bitmask = hit_selection.get_bitmask(hits)
+        for index, mask in enumerate(hit_selection.get_masks(hits)):
+            self.assertTrue(np.array_equal((bitmask >> index) & 1 == 1, np.ones(hits.shape[0], dtype=np.bool) if mask is None else mask))
+        for sparse in (False, True):
+            condition_hists = analysis_utils.ConditionHistogram(len(conditions), shape=(80, 336, 16), dtype=np.uint16, sparse=sparse)
+            for start_index in range(0, hits.shape[0], 10007):
+                chunk = hits[start_index:start_index + 10007]
+                condition_hists.fill(bitmask[start_index:start_index + 10007], (chunk['column'] - 1, chunk['row'] - 1, chunk['tot']))
+            for index, selected_hits in enumerate(hit_selection.select(hits)):
+                hist = np.histogramdd((selected_hits['column'] - 1, selected_hits['row'] - 1, selected_hits['tot']), bins=(80, 336, 16), range=((0, 80), (0, 336), (0, 16)))[0]
+                self.assertTrue(np.array_equal(condition_hists[index], hist))
+        self.assertRaises(analysis_utils.NotSupportedError, analysis_utils.get_bitmask_dtype, 65)
+
+    def test_map_hits_of_scan_parameter(self):  # the results per scan parameter of the worker processes have to be equal to the results of the hits of the scan parameter
+        with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_2.h5'), mode="r") as in_file_h5:
+            hits = in_file_h5.root.Hits[:]
+            meta_data = in_file_h5.root.meta_data[:]
+        parameter_values, parameter_indices = np.unique(meta_data['parameter'], return_index=True)
+        start_event_numbers = np.append(meta_data['event_number'][parameter_indices], hits['event_number'][-1] + 1)
+        results = list(map_hits_of_scan_parameter(get_tot_hist, os.path.join(tests_data_folder, 'unit_test_data_4_interpreted_2.h5'), scan_parameters=['parameter'], chunk_size=50, max_pending=1))
+        self.assertEqual([parameter[0] for parameter, _ in results], list(parameter_values))
+        for index, (_, tot_hist) in enumerate(results):
+            selected_hits = hits[(hits['event_number'] >= start_event_numbers[index]) & (hits['event_number'] < start_event_numbers[index + 1])]
+            self.assertTrue(np.array_equal(tot_hist, get_tot_hist(selected_hits)))
+
+    def test_run_catalog(self):  # the analysis functions have to give the same results with and without the run catalog
+        catalog_dir = tempfile.mkdtemp()
+        try:
+            file_names = [os.path.join(catalog_dir, file_name) for file_name in ('unit_test_data_4_parameter_128.h5', 'unit_test_data_4_parameter_256.h5')]
+            for file_name in file_names:
+                shutil.copy(os.path.join(tests_data_folder, os.path.basename(file_name)), file_name)
+            files_dict = analysis_utils.get_parameter_from_files(file_names)
+            n_words = analysis_utils.get_total_n_data_words(files_dict, precise=True)
+            meta_data = analysis_utils.combine_meta_data(files_dict)
+            self.assertEqual(sorted(RunCatalog(catalog_dir).update()), sorted(file_names))
+            self.assertEqual(RunCatalog(catalog_dir).update(), [])
+            infos = run_catalog.get_file_infos(file_names)
+            for file_name in file_names:
+                with tb.open_file(file_name, mode="r") as in_file_h5:
+                    self.assertEqual(infos[file_name]['n_words'], in_file_h5.root.raw_data.shape[0])
+                    self.assertEqual(infos[file_name]['n_readouts'], in_file_h5.root.meta_data.shape[0])
+                    self.assertEqual(infos[file_name]['timestamp_start'], in_file_h5.root.meta_data[0]['timestamp_start'])
+                    self.assertEqual(infos[file_name]['timestamp_stop'], in_file_h5.root.meta_data[-1]['timestamp_stop'])
+            self.assertEqual(analysis_utils.get_parameter_from_files(file_names), files_dict)
+            self.assertEqual(analysis_utils.get_total_n_data_words(files_dict), n_words)
+            self.assertTrue(np.array_equal(analysis_utils.combine_meta_data(files_dict), meta_data))
+            RunCatalog(catalog_dir).set_run_status(4, 'test_scan', 'FINISHED')
+            self.assertEqual([(run['run_number'], run['status']) for run in RunCatalog(catalog_dir).get_runs(status='FINISHED')], [(4, 'FINISHED')])
+            self.assertEqual(RunCatalog(catalog_dir).get_runs(status='ABORTED'), [])
+            with tb.open_file(file_names[0], mode="a") as out_file_h5:  # changed files are not taken from the catalog
+                out_file_h5.root.raw_data.append(np.zeros(10, dtype=out_file_h5.root.raw_data.dtype))
+            self.assertEqual(run_catalog.get_file_infos(file_names).keys(), file_names[1:])
+        finally:
+            shutil.rmtree(catalog_dir)
+
+    def test_run_catalog_file_parts(self):  # the closed file has to be cataloged with its own part when the raw data is written to a new file
+        catalog_dir = tempfile.mkdtemp()
+        try:
+            raw_data_file = open_raw_data_file(os.path.join(catalog_dir, '1_test_scan'), mode='w', scan_parameters={'parameter': 0})
+            raw_data_file.max_table_size = 10
+            raw_data = np.arange(8, dtype=np.uint32)
+            raw_data_file.append_item((raw_data, 1.0, 2.0, 0), scan_parameters={'parameter': 0}, new_file=True)
+            raw_data_file.append_item((raw_data, 2.0, 3.0, 0), scan_parameters={'parameter': 0}, new_file=True)  # file size limit, new part
+            raw_data_file.append_item((raw_data, 3.0, 4.0, 0), scan_parameters={'parameter': 1}, new_file=True)  # new scan parameter, new file
+            raw_data_file.close()
+            infos = RunCatalog(catalog_dir).get_files()
+            self.assertEqual(sorted((os.path.basename(file_name), info['base_file_name'], info['part'], info['n_words']) for file_name, info in infos.items()),
+                             [('1_test_scan.h5', '1_test_scan', 0, 8), ('1_test_scan_1.h5', '1_test_scan', 1, 8), ('1_test_scan_parameter_1.h5', '1_test_scan', 0, 8)])
+            with open_raw_data_file(os.path.join(catalog_dir, '2_test_scan_copy'), mode='w', catalog=False) as raw_data_file:  # temporary copies are not cataloged
+                raw_data_file.append_item((raw_data, 1.0, 2.0, 0), new_file=False)
+            self.assertEqual(len(RunCatalog(catalog_dir).get_files()), 3)
+        finally:
+            shutil.rmtree(catalog_dir)
+
+    def test_time_series(self):  # the quantities of one pass over the hit and cluster table have to be equal to the quantities of the hits and clusters of every time bin
+        output_dir = tempfile.mkdtemp()
+        try:
+            with PdfPages(os.path.join(output_dir, 'time_series.pdf')) as output_pdf:
+                results = analyze_time_series([os.path.join(tests_data_folder, 'unit_test_data_1')], combine_n_readouts=5, include_no_cluster=True, chunk_size=9973, plot_occupancy_hists=True, output_pdf=output_pdf, output_file=os.path.join(output_dir, 'time_series.h5'))
+                n_cluster = analyse_n_cluster_per_event([os.path.join(tests_data_folder, 'unit_test_data_1')], include_no_cluster=True, combine_n_readouts=5, output_pdf=output_pdf)
+            self.assertTrue(np.array_equal(n_cluster[1], results['n_cluster'][1]))
+            with tb.open_file(os.path.join(tests_data_folder, 'unit_test_data_1_interpreted.h5'), mode="r") as in_file_h5:
+                meta_data, hits, cluster = in_file_h5.root.meta_data[:], in_file_h5.root.Hits[:], in_file_h5.root.Cluster[:]
+            timestamp_start, event_number_start = meta_data['timestamp_start'][::5], meta_data['event_number'][::5]
+            event_number_stop = np.append(event_number_start[1:], np.iinfo(np.int64).max)
+            self.assertTrue(np.array_equal(results['beam_spot'][0], timestamp_start))
+            self.assertTrue(np.allclose(results['event_rate'][1], np.diff(event_number_start).astype(np.float64) / np.diff(timestamp_start)))
+            for index, (start, stop) in enumerate(zip(event_number_start, event_number_stop)):
+                selected_hits = hits[(hits['event_number'] >= start) & (hits['event_number'] < stop)]
+                self.assertAlmostEqual(results['beam_spot'][1][index], np.mean(selected_hits['column'] - 1))
+                self.assertAlmostEqual(results['beam_spot'][2][index], np.mean(selected_hits['row'] - 1))
+                selected_cluster = cluster[(cluster['event_number'] >= start) & (cluster['event_number'] < stop)]
+                event_numbers, n_cluster_per_event = np.unique(selected_cluster['event_number'], return_counts=True)
+                hist = np.histogram(n_cluster_per_event, bins=10, range=(0, 10))[0]
+                if index < event_number_start.shape[0] - 1:  # the number of events without cluster is not known for the last time bin
+                    hist[0] = stop - start - event_numbers.shape[0]
+                self.assertTrue(np.allclose(results['n_cluster'][1][index], hist.astype(np.float64) / np.sum(hist)))
+            with tb.open_file(os.path.join(output_dir, 'time_series.h5'), mode="r") as in_file_h5:
+                self.assertEqual([in_file_h5.root.Beamspot.nrows, in_file_h5.root.Eventrate.nrows, in_file_h5.root.n_cluster.nrows], [timestamp_start.shape[0], timestamp_start.shape[0] - 1, timestamp_start.shape[0]])
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_pdf_report(self):  # the pages rendered in parallel have to be appended in order to a valid PDF file
+        hist = np.ma.masked_equal(np.random.RandomState(0).poisson(3, (336, 80)), 0)
+        output_dir = tempfile.mkdtemp()
+        try:
+            for processes, rasterize in ((1, False), (2, False), (2, True)):
+                output_pdf_file = os.path.join(output_dir, 'report_%d_%d.pdf' % (processes, rasterize))
+                with PdfPages(output_pdf_file) as output_pdf:
+                    plotting.plot_tot(hist=np.arange(16), filename=output_pdf)
+                    report = PdfReport(processes=processes, rasterize=rasterize)
+                    report.add(plotting.plot_three_way, hist=hist, title='Occupancy')
+                    report.add(plotting.plot_occupancy, hist=hist)
+                    report.add(plotting.plot_scurves, occupancy_hist=np.random.RandomState(0).poisson(3, (80, 336, 10)), scan_parameters=range(10))
+                    report.save(output_pdf)
+                    plotting.plot_tot(hist=np.arange(16), filename=output_pdf)
+                    self.assertEqual(output_pdf.get_pagecount(), 5)
+                with open(output_pdf_file, 'rb') as pdf_file:
+                    pdf_data = pdf_file.read()
+                xref = pdf_data[int(pdf_data.split('startxref')[-1].split()[0]):].split('trailer')[0].splitlines()[2:]
+                for object_number, entry in enumerate(xref[1:], start=1):  # the offset of every object has to point to its start
+                    self.assertTrue(pdf_data[int(entry[:10]):].startswith('%d 0 obj' % object_number))
+                self.assertEqual(pdf_data.count('/Type /Page '), 5)
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_pdf_report_fallback(self):  # the plots are rendered in the calling process if the rendered pages cannot be appended
+        hist = np.ma.masked_equal(np.random.RandomState(0).poisson(3, (336, 80)), 0)
+        output_dir = tempfile.mkdtemp()
+        try:
+            for patched_name, patch_kwargs in (('pybar.analysis.plotting.pdf_report.can_append_pdf_pages', {'return_value': False}),
+                                               ('pybar.analysis.plotting.pdf_report._append_pdf_pages', {'side_effect': ValueError('Unknown object reference in PDF data')}),
+                                               ('matplotlib.__version__', {'new': '99.0.0'})):  # untested matplotlib version
+                output_pdf_file = os.path.join(output_dir, 'report_%s.pdf' % patched_name)
+                with mock.patch(patched_name, **patch_kwargs):
+                    with PdfPages(output_pdf_file) as output_pdf:
+                        report = PdfReport(processes=2, rasterize=True)
+                        report.add(plotting.plot_three_way, hist=hist, title='Occupancy')
+                        report.add(plotting.plot_occupancy, hist=hist)
+                        report.save(output_pdf)
+                        self.assertEqual(output_pdf.get_pagecount(), 2)
+                with open(output_pdf_file, 'rb') as pdf_file:
+                    pdf_data = pdf_file.read()
+                self.assertEqual(pdf_data.count('/Type /Page '), 2)
+                self.assertTrue(pdf_data.rstrip().endswith('%%EOF'))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_plot_registry(self):  # plots are rendered once per histogram content and taken from the plot cache afterwards
+        cache_dir = tempfile.mkdtemp()
+        try:
+            interpreted_file = os.path.join(tests_data_folder, 'unit_test_data_1_result.h5')
+            with tb.open_file(interpreted_file, mode="r") as in_file_h5:
+                plot_names = plot_registry.get_plot_names(in_file_h5)
+            self.assertEqual(plot_names[:4], ['occupancy', 'occupancy_three_way', 'fancy_occupancy', 'tot'])
+            self.assertFalse('threshold' in plot_names)  # no S-curve fit histograms
+            plot_file = plot_registry.get_plot(interpreted_file, 'tot', cache_dir=cache_dir)
+            self.assertTrue(os.path.isfile(plot_file))
+            inode = os.stat(plot_file).st_ino
+            self.assertEqual(plot_registry.get_plot(interpreted_file, 'tot', cache_dir=cache_dir), plot_file)
+            self.assertEqual(os.stat(plot_file).st_ino, inode)  # not rendered again, a rendered plot is a new file
+            with PdfPages(os.path.join(cache_dir, 'plots.pdf')) as output_pdf:
+                self.assertEqual(plot_registry.write_plots(interpreted_file, output_pdf, names=['tot', 'relative_bcid'], cache_dir=cache_dir), ['tot', 'relative_bcid'])
+                self.assertEqual(output_pdf.get_pagecount(), 2)
+            self.assertRaises(ValueError, plot_registry.get_plot, interpreted_file, 'threshold_map', cache_dir=cache_dir)
+            interpreted_file = os.path.join(tests_data_folder, 'unit_test_data_2_result.h5')
+            with tb.open_file(interpreted_file, mode="r") as in_file_h5:
+                plot_names = plot_registry.get_plot_names(in_file_h5)
+            self.assertEqual(plot_names[:2], ['threshold_fast', 'noise_fast'])  # fast threshold algorithm histograms
+            self.assertFalse('scurves' in plot_names)  # only for S-curve fitted threshold scans
+            self.assertNotEqual(plot_registry.get_plot(interpreted_file, 'threshold_fast', cache_dir=cache_dir), plot_registry.get_plot(interpreted_file, 'threshold_fast', cache_dir=cache_dir, threshold_mask=False))  # the options are part of the key
+            self.assertEqual(len([file_name for file_name in os.listdir(cache_dir) if file_name.endswith('.png')]), 3)  # no temporary files left
+            plot_file = plot_registry.get_plot(interpreted_file, 'noise_fast', cache_dir=cache_dir, max_size=1)  # the least recently used plots are removed, the latest is kept
+            self.assertEqual([file_name for file_name in os.listdir(cache_dir) if file_name.endswith('.png')], [os.path.basename(plot_file)])
+            self.assertTrue(os.path.isfile(os.path.join(cache_dir, 'plots.pdf')))  # not a cached plot
+            interpreted_file = os.path.join(cache_dir, 'threshold_scan_interpreted.h5')
+            with tb.open_file(interpreted_file, mode="w") as out_file_h5:
+                random_state = np.random.RandomState(0)
+                out_file_h5.create_carray(out_file_h5.root, name='HistOcc', obj=random_state.binomial(100, 0.5, (336, 80, 5)).astype(np.uint32))
+                out_file_h5.create_carray(out_file_h5.root, name='HistThresholdFitted', obj=random_state.normal(40.0, 2.0, (336, 80)))
+                out_file_h5.create_carray(out_file_h5.root, name='HistNoiseFitted', obj=random_state.normal(2.0, 0.2, (336, 80)))
+                out_file_h5.create_carray(out_file_h5.root, name='HistTdcPixel', obj=random_state.poisson(0.1, (336, 80, 1100)).astype(np.uint8))
+                out_file_h5.create_table(out_file_h5.root, name='meta_data', obj=np.array([(plsr_dac, ) for plsr_dac in (10, 10, 20, 30, 40, 50)], dtype=[('PlsrDAC', np.uint32)]))
+            with tb.open_file(interpreted_file, mode="r") as in_file_h5:
+                self.assertEqual(plot_registry.get_plot_names(in_file_h5), ['threshold', 'noise', 'scurves', 'occupancy', 'occupancy_three_way', 'fancy_occupancy', 'mean_tdc'])
+            with PdfPages(os.path.join(cache_dir, 'threshold_scan.pdf')) as output_pdf:
+                plot_registry.write_plots(interpreted_file, output_pdf, names=['threshold', 'scurves', 'mean_tdc'], cache_dir=cache_dir)
+                self.assertEqual(output_pdf.get_pagecount(), 3)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_scurve_hist(self):  # the S-curve density of all scan parameters at once has to be equal to the sum of the 2D histograms per scan parameter
+        random_state = np.random.RandomState(0)
+        occupancy = random_state.binomial(100, 1.0 / (1.0 + np.exp(-(np.arange(20)[np.newaxis, np.newaxis, :] - random_state.normal(10, 2, (80, 336, 1))))))
+        occupancy[:5] = 0  # pixels without hits
+        occupancy_float = occupancy.astype(np.float32)
+        occupancy_float[10:20, :, 5:8] = np.nan
+        scan_parameters = np.arange(20) * 2.5
+        x_bins, y_bins = np.arange(-1.25, 50.0, 2.5), np.arange(-0.5, 90.5)  # values above the last bin are omitted
+        pixel_mask = np.all(occupancy == 0, axis=2)
+        for occupancy_hist in (occupancy, occupancy_float, SparseHistogram.from_dense(occupancy)):
+            hist, x_edges, y_edges = plotting.get_scurve_hist(occupancy_hist, scan_parameters, x_bins=x_bins, y_bins=y_bins, pixel_mask=pixel_mask, n_pixel_per_chunk=1000)
+            dense_occupancy = occupancy_hist[:] if isinstance(occupancy_hist, SparseHistogram) else occupancy_hist
+            expected_hist = np.zeros_like(hist)
+            for index, scan_parameter in enumerate(scan_parameters):
+                values = dense_occupancy[:, :, index][~pixel_mask]
+                values = values[np.isfinite(values)]
+                expected_hist += np.histogram2d(values, np.full(values.shape[0], scan_parameter), bins=(y_bins, x_bins))[0]
+            self.assertTrue(np.array_equal(hist, expected_hist))
+            self.assertTrue(np.array_equal(x_edges, x_bins) and np.array_equal(y_edges, y_bins))
+
+    def test_charge_calibration(self):  # the charge calibration of all pixels at once has to be equal to the linear interpolation of each pixel
+        with tb.open_file(os.path.join(tests_data_folder, 'hit_or_calibration_tdc.h5'), mode="r") as in_file_h5:
+            tdc_pixel_calibration = in_file_h5.root.HitOrCalibration[:, :, :, 1]
+            tdc_calibration_values = in_file_h5.root.HitOrCalibration.attrs.scan_parameter_values[:]
+        tdc_pixel_calibration[60, 100, 2] = tdc_pixel_calibration[60, 100, 3]  # calibration points with the same TDC value
+        tdc_pixel_calibration[60, 101, :2] = tdc_pixel_calibration[60, 101, 1::-1]  # not sorted calibration points
+        tdc_pixel_calibration[60, 102, 3:] = np.nan  # missing calibration points
+        tdc_pixel_calibration[60, 103, 2:] = np.nan  # not enough calibration points
+        cache_dir = tempfile.mkdtemp()
+        try:
+            analysis_cache.set_cache(cache_dir=cache_dir)
+            charge_calibrations = [analysis_utils.get_charge_calibration(tdc_calibration_values, tdc_pixel_calibration, max_tdc=500, min_calibration_points=3) for _ in range(2)]
+            self.assertEqual(analysis_cache.get_cache().get_metrics()['hits'], 1)
+            self.assertTrue(np.array_equal(charge_calibrations[0], charge_calibrations[1]))
+        finally:
+            analysis_cache.set_cache(cache_dir=None)
+            shutil.rmtree(cache_dir)
+        for column, row in [(54, 74), (60, 100), (60, 101), (60, 102), (60, 103), (74, 274), (0, 0)]:
+            pixel_calibration = tdc_pixel_calibration[column, row]
+            if np.count_nonzero(pixel_calibration != 0) > 2 and np.count_nonzero(np.isfinite(pixel_calibration)) > 2:
+                selected_measurements = np.isfinite(pixel_calibration)
+                charge = interp1d(x=pixel_calibration[selected_measurements], y=tdc_calibration_values[selected_measurements], kind='slinear', bounds_error=False, fill_value=0)(np.arange(500))
+            else:
+                charge = np.zeros(500)
+            self.assertTrue(np.allclose(charge_calibrations[0][column, row], charge))
+
+    def test_threshold_calibration_table(self):  # the calibration tables have to be in the same row order as filled row by row (column, row, parameter value)
+        output_dir = tempfile.mkdtemp()
+        try:
+            parameter_values = [20, 30, 50]
+            threshold_calibration = np.random.normal(50.0, 5.0, (80, 336, 4))  # more parameter values allocated than used
+            mean_threshold_calibration, mean_threshold_rms_calibration = np.mean(threshold_calibration, axis=(0, 1)), np.std(threshold_calibration, axis=(0, 1))
+            with tb.open_file(os.path.join(output_dir, 'calibration.h5'), mode="w") as out_file_h5:
+                store_calibration_data_as_table(out_file_h5, mean_threshold_calibration, mean_threshold_rms_calibration, threshold_calibration, parameter_values)
+                threshold_calib = out_file_h5.root.ThresholdCalibration[:]
+                mean_threshold_calib = out_file_h5.root.MeanThresholdCalibration[:]
+            expected_rows = []
+            for column in range(80):
+                for row in range(336):
+                    for parameter_value_index, parameter_value in enumerate(parameter_values):
+                        expected_rows.append((column, row, parameter_value, threshold_calibration[column, row, parameter_value_index]))
+            expected_rows = np.array(expected_rows)
+            self.assertEqual(threshold_calib.shape[0], expected_rows.shape[0])
+            for index, field in enumerate(('column', 'row', 'parameter_value', 'threshold')):
+                self.assertTrue(np.allclose(threshold_calib[field], expected_rows[:, index]))
+            self.assertTrue(np.all(mean_threshold_calib['parameter_value'] == parameter_values))
+            self.assertTrue(np.allclose(mean_threshold_calib['mean_threshold'], mean_threshold_calibration[:3]))
+            self.assertTrue(np.allclose(mean_threshold_calib['threshold_rms'], mean_threshold_rms_calibration[:3]))
+        finally:
+            shutil.rmtree(output_dir)
+
+    def test_threshold_calibration_analysis(self):  # the raw data files of the parameter values analyzed in parallel have to give the same result as analyzed one after another
+        output_dir = tempfile.mkdtemp()
+        pool_size = analysis_pool._pool_size
+        try:
+            raw_data_files = []
+            for index in range(3):  # PlsrDAC scan of a few pixels, the scan parameters are reduced to PlsrDAC
+                raw_data_files.append(os.path.join(output_dir, 'threshold_calibration_%d.h5' % index))
+                shutil.copy(os.path.join(tests_data_folder, 'hit_or_calibration.h5'), raw_data_files[-1])
+                with tb.open_file(raw_data_files[-1], mode="r+") as raw_data_file_h5:
+                    scan_parameters = raw_data_file_h5.root.scan_parameters[:][['PlsrDAC']]
+                    raw_data_file_h5.remove_node(raw_data_file_h5.root, 'scan_parameters')
+                    raw_data_file_h5.create_table(raw_data_file_h5.root, name='scan_parameters', obj=scan_parameters)
+            analysis_pool.set_pool_size(2)
+            analyze_raw_data_files(raw_data_files[:2])  # in the worker processes of the analysis pool
+            analysis_pool.set_pool_size(1)
+            analyze_raw_data_files(raw_data_files[2:])  # in this process
+            for raw_data_file in raw_data_files[:2]:
+                data_equal, error_msg = test_tools.compare_h5_files(os.path.splitext(raw_data_files[2])[0] + '_interpreted.h5', os.path.splitext(raw_data_file)[0] + '_interpreted.h5', node_names=["HistOcc", "HistThresholdFitted", "HistNoiseFitted"])
+                self.assertTrue(data_equal, msg=error_msg)
+        finally:
+            analysis_pool.set_pool_size(pool_size)
+            analysis_pool.close_pool()
+            shutil.rmtree(output_dir)
+
     def test_hit_or_calibration(self):
         create_hitor_calibration(os.path.join(tests_data_folder, 'hit_or_calibration'), plot_pixel_calibrations=True)
         data_equal, error_msg = test_tools.compare_h5_files(os.path.join(tests_data_folder, 'hit_or_calibration_interpreted_result.h5'),